@@ -0,0 +1,151 @@
+"""
+按上游和 API Key 自适应调整并发上限（AIMD）
+以首字节延迟（TTFT）的历史最小值作为基线：
+延迟接近基线且上限被用满时加性增长，延迟膨胀、429、5xx 或连接失败时乘性收缩，
+避免静态上限过低浪费容量或过高导致请求在 Dify 内部排队
+"""
+
+import os
+import time
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+from circuit_breaker import key_fingerprint
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+ADAPTIVE_LIMIT = REGISTRY.gauge(
+    "opendify_adaptive_limit", "自适应并发上限", ("upstream", "key"))
+ADAPTIVE_BASELINE = REGISTRY.gauge(
+    "opendify_adaptive_limit_baseline_seconds", "首字节延迟基线", ("upstream", "key"))
+ADAPTIVE_REJECTED = REGISTRY.counter(
+    "opendify_adaptive_limit_rejected_total", "超出自适应并发上限被拒绝的请求数", ("upstream", "key"))
+
+
+class ConcurrencyLimitExceeded(Exception):
+    """在途请求数达到自适应上限"""
+
+    def __init__(self, upstream: str, limit: int):
+        super().__init__(f"Adaptive concurrency limit reached ({limit} in flight) for {upstream}")
+        self.upstream = upstream
+        self.limit = limit
+
+
+def load_adaptive_config() -> dict:
+    """从环境变量读取自适应并发配置"""
+    return {
+        "enabled": os.getenv("ADAPTIVE_LIMIT_ENABLED", "false").strip().lower() in ("1", "true", "yes", "on"),
+        "initial_limit": float(os.getenv("ADAPTIVE_LIMIT_INITIAL", "20")),
+        "min_limit": float(os.getenv("ADAPTIVE_LIMIT_MIN", "1")),
+        "max_limit": float(os.getenv("ADAPTIVE_LIMIT_MAX", "200")),
+        # 每次收缩乘以该系数
+        "backoff": float(os.getenv("ADAPTIVE_LIMIT_BACKOFF", "0.7")),
+        # TTFT 超过基线的倍数视为延迟膨胀
+        "tolerance": float(os.getenv("ADAPTIVE_LIMIT_TOLERANCE", "2.0")),
+        # 基线向较大样本缓慢漂移的比例，适应上游正常的延迟变化
+        "baseline_drift": float(os.getenv("ADAPTIVE_LIMIT_BASELINE_DRIFT", "0.01")),
+    }
+
+
+class _LimitState:
+    __slots__ = ("limit", "in_flight", "baseline", "last_decrease", "labels")
+
+    def __init__(self, limit: float, labels: dict):
+        self.limit = limit
+        self.in_flight = 0
+        self.baseline = None
+        self.last_decrease = 0.0
+        self.labels = labels
+
+
+class LimitPermit:
+    """占用一个自适应名额，release 可重复调用"""
+
+    def __init__(self, limiter: Optional["AdaptiveLimiter"], state: Optional[_LimitState]):
+        self._limiter = limiter
+        self._state = state
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released and self._state is not None:
+            self._released = True
+            self._limiter._release(self._state)
+
+
+class AdaptiveLimiter:
+    """工作进程内、按 (上游, API Key) 维护的 AIMD 并发上限"""
+
+    def __init__(self, config: Optional[dict] = None):
+        self.config = config or load_adaptive_config()
+        self._lock = threading.Lock()
+        self._states: Dict[Tuple[str, str], _LimitState] = {}
+
+    def _state(self, upstream: str, api_key: str) -> _LimitState:
+        state = self._states.get((upstream, api_key))
+        if state is None:
+            labels = {"upstream": upstream, "key": key_fingerprint(api_key)}
+            state = self._states[(upstream, api_key)] = _LimitState(self.config["initial_limit"], labels)
+            ADAPTIVE_LIMIT.set(state.limit, **labels)
+        return state
+
+    def limit(self, upstream: str, api_key: str) -> int:
+        """当前允许的在途请求数"""
+        with self._lock:
+            return int(self._state(upstream, api_key).limit)
+
+    def acquire(self, upstream: str, api_key: str) -> LimitPermit:
+        """占用一个名额，达到上限时抛出 ConcurrencyLimitExceeded；未启用时不做限制"""
+        if not self.config["enabled"]:
+            return LimitPermit(None, None)
+        with self._lock:
+            state = self._state(upstream, api_key)
+            if state.in_flight >= int(state.limit):
+                ADAPTIVE_REJECTED.inc(**state.labels)
+                raise ConcurrencyLimitExceeded(upstream, int(state.limit))
+            state.in_flight += 1
+        return LimitPermit(self, state)
+
+    def _release(self, state: _LimitState) -> None:
+        with self._lock:
+            state.in_flight = max(0, state.in_flight - 1)
+
+    def record(self, upstream: str, api_key: str, latency: Optional[float] = None, overloaded: bool = False) -> None:
+        """
+        记录一次上游调用
+        overloaded=True 表示 429、5xx、超时或连接失败，立即乘性收缩；
+        否则根据首字节延迟与基线的比值调整
+        """
+        if not self.config["enabled"]:
+            return
+        config = self.config
+        now = time.time()
+        with self._lock:
+            state = self._state(upstream, api_key)
+            if not overloaded and latency is not None:
+                if state.baseline is None or latency < state.baseline:
+                    state.baseline = latency
+                else:
+                    state.baseline += (latency - state.baseline) * config["baseline_drift"]
+                overloaded = latency > state.baseline * config["tolerance"]
+
+            if overloaded:
+                # 同一批并发请求的膨胀样本只收缩一次（间隔至少一个基线 RTT）
+                if now - state.last_decrease < (state.baseline or 0.0):
+                    return
+                state.limit = max(config["min_limit"], state.limit * config["backoff"])
+                state.last_decrease = now
+            elif state.in_flight * 2 >= state.limit:
+                # 只有上限被实际用到一半以上时才增长，避免空闲时无限放大
+                state.limit = min(config["max_limit"], state.limit + 1.0 / state.limit)
+            else:
+                return
+            ADAPTIVE_LIMIT.set(round(state.limit, 2), **state.labels)
+            if state.baseline is not None:
+                ADAPTIVE_BASELINE.set(round(state.baseline, 4), **state.labels)
+
+    def reset(self) -> None:
+        """fork 之后清空本进程的状态"""
+        self._lock = threading.Lock()
+        self._states = {}
@@ -0,0 +1,239 @@
+"""
+工作进程内的准入控制
+限制每个工作进程、每个模型同时进行的上游调用数，超出部分在有界队列中等待，
+队列已满或等待超时时返回 OpenAI 风格的 429 + Retry-After
+配置了 FairScheduler 时，等待者按用户/模型的加权占用而不是到达顺序被唤醒
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from typing import Dict, Optional
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_IN_FLIGHT = REGISTRY.gauge(
+    "opendify_admission_in_flight", "已准入、正在调用上游的请求数", ("model",))
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge(
+    "opendify_admission_queue_depth", "等待准入的请求数")
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    "opendify_admission_wait_seconds", "请求在准入队列中的等待时间", ("model",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+ADMISSION_REJECTED = REGISTRY.counter(
+    "opendify_admission_rejected_total", "被准入控制拒绝的请求数", ("model", "reason"))
+
+
+class AdmissionRejected(Exception):
+    """请求未获准入"""
+
+    def __init__(self, model: str, reason: str, retry_after: int):
+        super().__init__(f"Too many concurrent requests for model {model} ({reason})")
+        self.model = model
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def load_admission_config() -> dict:
+    """从环境变量读取准入控制配置，0 表示不限制"""
+    model_limits = {}
+    limits_str = os.getenv("ADMISSION_MODEL_LIMITS", "").strip()
+    if limits_str:
+        try:
+            model_limits = {k: int(v) for k, v in json.loads(limits_str).items()}
+        except (json.JSONDecodeError, AttributeError, ValueError) as e:
+            logger.error(f"Failed to parse ADMISSION_MODEL_LIMITS: {e}")
+    return {
+        "max_concurrent": int(os.getenv("ADMISSION_MAX_CONCURRENT", "200")),
+        "default_model_limit": int(os.getenv("ADMISSION_DEFAULT_MODEL_LIMIT", "0")),
+        "model_limits": model_limits,
+        "max_queue": int(os.getenv("ADMISSION_MAX_QUEUE", "100")),
+        "max_wait": float(os.getenv("ADMISSION_MAX_WAIT", "5")),
+        "retry_after": int(os.getenv("ADMISSION_RETRY_AFTER", "2")),
+    }
+
+
+class AdmissionTicket:
+    """准入凭证，release 可重复调用"""
+
+    def __init__(self, controller: "AdmissionController", model: str, user: str = ""):
+        self._controller = controller
+        self.model = model
+        self.user = user
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._controller._release(self.model, self.user)
+
+
+class _Waiter:
+    __slots__ = ("model", "user", "priority", "event", "granted", "enqueued_at")
+
+    def __init__(self, model: str, user: str, priority: str):
+        self.model = model
+        self.user = user
+        self.priority = priority
+        self.event = threading.Event()
+        self.granted = False
+        self.enqueued_at = time.time()
+
+
+class AdmissionController:
+    """按工作进程和模型限制并发上游调用"""
+
+    # 启用公平调度时，等待者定期重新检查跨进程的全局名额
+    SCHEDULER_POLL_INTERVAL = 0.05
+
+    def __init__(self, config: Optional[dict] = None, scheduler=None):
+        self.config = dict(config or load_admission_config())
+        self.scheduler = scheduler
+        self._lock = threading.Lock()
+        self._in_flight_total = 0
+        self._in_flight: Dict[str, int] = {}
+        self._waiters = deque()
+
+    def model_limit(self, model: str) -> int:
+        return self.config["model_limits"].get(model, self.config["default_model_limit"])
+
+    def _has_capacity(self, model: str, user: str = "", priority: str = "") -> bool:
+        max_concurrent = self.config["max_concurrent"]
+        if max_concurrent > 0 and self._in_flight_total >= max_concurrent:
+            return False
+        limit = self.model_limit(model)
+        if limit > 0 and self._in_flight.get(model, 0) >= limit:
+            return False
+        return self.scheduler is None or self.scheduler.has_capacity(user, priority)
+
+    def _grant(self, model: str, user: str = "") -> None:
+        self._in_flight_total += 1
+        self._in_flight[model] = self._in_flight.get(model, 0) + 1
+        ADMISSION_IN_FLIGHT.inc(model=model)
+        if self.scheduler is not None:
+            self.scheduler.on_grant(user, model)
+
+    def _select_waiter(self) -> Optional[_Waiter]:
+        """
+        选出下一个可以准入的等待者，跳过已满的模型和超出份额的用户
+        未配置调度器时先来先服务，否则选加权占用最小的等待者，相同时按到达顺序
+        """
+        if self.scheduler is None:
+            for waiter in self._waiters:
+                if self._has_capacity(waiter.model):
+                    return waiter
+            return None
+
+        best, best_key = None, None
+        for waiter in self._waiters:
+            if not self._has_capacity(waiter.model, waiter.user, waiter.priority):
+                continue
+            key = (self.scheduler.score(waiter.user, waiter.model, waiter.priority), waiter.enqueued_at)
+            if best_key is None or key < best_key:
+                best, best_key = waiter, key
+        return best
+
+    def _dispatch(self) -> None:
+        """在持有锁的情况下，尽可能多地唤醒等待者"""
+        while self._waiters:
+            waiter = self._select_waiter()
+            if waiter is None:
+                break
+            self._waiters.remove(waiter)
+            self._grant(waiter.model, waiter.user)
+            waiter.granted = True
+            waiter.event.set()
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+
+    def acquire(self, model: str, user: str = "", priority: str = "interactive") -> AdmissionTicket:
+        """
+        获取准入：有空闲名额时立即返回，否则排队等待最多 max_wait 秒
+        队列已满或等待超时时抛出 AdmissionRejected
+        """
+        with self._lock:
+            # 未配置调度器时，排队中的请求都在等待各自已满的名额（每次释放都会重新分配），
+            # 有空闲名额的请求直接准入，不排在它们后面；配置了调度器时由 _dispatch 按加权占用决定顺序
+            if (self.scheduler is None or not self._waiters) and self._has_capacity(model, user, priority):
+                self._grant(model, user)
+                ADMISSION_WAIT_SECONDS.observe(0.0, model=model)
+                return AdmissionTicket(self, model, user)
+            if len(self._waiters) >= self.config["max_queue"]:
+                ADMISSION_REJECTED.inc(model=model, reason="queue_full")
+                raise AdmissionRejected(model, "queue_full", self.config["retry_after"])
+            waiter = _Waiter(model, user, priority)
+            self._waiters.append(waiter)
+            if self.scheduler is not None:
+                # 新到的轻量用户可能排在被限额的重度用户之前
+                self._dispatch()
+                if not waiter.granted:
+                    self.scheduler.on_wait(user, priority)
+            ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+
+        if self.scheduler is None:
+            waiter.event.wait(self.config["max_wait"])
+        else:
+            # 其他工作进程释放的名额不会通知本进程，需要定期重新调度
+            deadline = waiter.enqueued_at + self.config["max_wait"]
+            while not waiter.event.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                if not waiter.event.wait(min(self.SCHEDULER_POLL_INTERVAL, remaining)):
+                    with self._lock:
+                        self._dispatch()
+
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+                ADMISSION_REJECTED.inc(model=model, reason="queue_timeout")
+                raise AdmissionRejected(model, "queue_timeout", self.config["retry_after"])
+
+        ADMISSION_WAIT_SECONDS.observe(time.time() - waiter.enqueued_at, model=model)
+        return AdmissionTicket(self, model, user)
+
+    def _release(self, model: str, user: str = "") -> None:
+        with self._lock:
+            self._in_flight_total = max(0, self._in_flight_total - 1)
+            self._in_flight[model] = max(0, self._in_flight.get(model, 0) - 1)
+            ADMISSION_IN_FLIGHT.dec(model=model)
+            if self.scheduler is not None:
+                self.scheduler.on_release(user, model)
+            self._dispatch()
+
+    def update_limits(self, **changes) -> dict:
+        """运行时调整限制，放宽限制时立即唤醒等待者"""
+        with self._lock:
+            for name in ("max_concurrent", "default_model_limit", "max_queue", "retry_after"):
+                if name in changes and changes[name] is not None:
+                    self.config[name] = int(changes[name])
+            if changes.get("max_wait") is not None:
+                self.config["max_wait"] = float(changes["max_wait"])
+            if changes.get("model_limits") is not None:
+                self.config["model_limits"] = {k: int(v) for k, v in changes["model_limits"].items()}
+            self._dispatch()
+            logger.info(f"🚦 Admission limits updated: {self.config}")
+            return dict(self.config)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            snapshot = {
+                "config": dict(self.config),
+                "in_flight_total": self._in_flight_total,
+                "in_flight": dict(self._in_flight),
+                "queue_depth": len(self._waiters),
+            }
+            if self.scheduler is not None:
+                snapshot["global_in_flight"] = self.scheduler.counters.total()
+            return snapshot
+
+    def reset(self) -> None:
+        """fork 之后清空本进程的计数"""
+        self._lock = threading.Lock()
+        self._in_flight_total = 0
+        self._in_flight = {}
+        self._waiters = deque()
@@ -0,0 +1,163 @@
+"""
+首轮会话单飞（singleflight）
+同一个 Open WebUI chat_id 的多个请求同时到达且还没有会话映射时（重试、标题生成、重新生成），
+只让一个请求创建 Dify 会话，其余请求等待映射写入后复用该会话，避免创建多个会话浪费上下文
+
+- 工作进程内：按 chat_id 的锁（gevent monkey patch 后为协程锁），同进程的请求排队
+- 工作进程间：SQLite 中的 chat_locks 表作为带租约的咨询锁，进程崩溃后租约到期自动失效
+"""
+
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+from metrics import REGISTRY
+from sqlite_pool import shared_pool
+
+logger = logging.getLogger(__name__)
+
+SINGLEFLIGHT_WAITS = REGISTRY.counter(
+    "opendify_chat_singleflight_total", "首轮会话单飞的结果（acquired=创建会话，reused=等到映射，timeout=等待超时）",
+    ("result",))
+
+
+def load_singleflight_config() -> dict:
+    """从环境变量读取首轮会话单飞配置"""
+    return {
+        "enabled": os.getenv("CHAT_SINGLEFLIGHT_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on"),
+        # 等待其他请求创建会话的最长时间，超时后不再协调，直接创建新会话
+        "wait_seconds": float(os.getenv("CHAT_LOCK_WAIT", "30")),
+        # 跨进程锁的租约，持有者崩溃时到期释放
+        "lease_seconds": float(os.getenv("CHAT_LOCK_LEASE", "120")),
+        "poll_interval": float(os.getenv("CHAT_LOCK_POLL_INTERVAL", "0.05")),
+    }
+
+
+class ChatLock:
+    """首轮会话锁，release 可重复调用；未加锁时为空操作"""
+
+    def __init__(self, owner: Optional["ChatSingleflight"] = None, chat_id: Optional[str] = None,
+                 token: Optional[str] = None, local_lock: Optional[threading.Lock] = None):
+        self._owner = owner
+        self.chat_id = chat_id
+        self._token = token
+        self._local_lock = local_lock
+        self._released = owner is None
+
+    @property
+    def held(self) -> bool:
+        return not self._released
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._owner._release(self.chat_id, self._token, self._local_lock)
+
+
+class ChatSingleflight:
+    """按 chat_id 协调首轮会话创建"""
+
+    def __init__(self, db_path: str, config: Optional[dict] = None):
+        self.db_path = db_path
+        self.config = config or load_singleflight_config()
+        self._guard = threading.Lock()
+        self._local: Dict[str, list] = {}
+        self._db = shared_pool(db_path, timeout=5.0)
+        self._db.ensure_schema(
+            '''
+            CREATE TABLE IF NOT EXISTS chat_locks (
+                chat_id TEXT PRIMARY KEY,
+                token TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            ''',
+        )
+
+    # ------------------------------------------------------------ 跨进程租约
+
+    def _execute(self, sql: str, params: tuple) -> int:
+        """执行写操作，返回受影响行数；数据库不可用时返回 -1，调用方退化为只做进程内协调"""
+        try:
+            with self._db.connection() as conn:
+                cursor = conn.execute(sql, params)
+                conn.commit()
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Chat lock update failed: {e}")
+            return -1
+
+    def _try_lease(self, chat_id: str, token: str) -> bool:
+        """插入租约行，已存在的行只有过期后才能被接管"""
+        now = time.time()
+        acquired = self._execute('''
+            INSERT INTO chat_locks (chat_id, token, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET token = excluded.token, expires_at = excluded.expires_at
+            WHERE chat_locks.expires_at < ?
+        ''', (chat_id, token, now + self.config["lease_seconds"], now))
+        return acquired != 0
+
+    # ------------------------------------------------------------ 进程内锁
+
+    def _local_lock(self, chat_id: str) -> threading.Lock:
+        with self._guard:
+            entry = self._local.setdefault(chat_id, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _drop_local(self, chat_id: str, lock: threading.Lock, locked: bool) -> None:
+        with self._guard:
+            entry = self._local.get(chat_id)
+            if entry is not None and entry[0] is lock:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self._local[chat_id]
+        if locked:
+            lock.release()
+
+    # ------------------------------------------------------------ 对外接口
+
+    def acquire(self, chat_id: Optional[str], has_mapping: Callable[[str], bool]) -> ChatLock:
+        """
+        会话还没有映射时获取该 chat_id 的首轮锁；
+        等待期间其他请求写入了映射则返回空锁，调用方随后读取映射复用会话。
+        等待超时也返回空锁，退化为不协调，不让请求一直阻塞
+        """
+        if not chat_id or not self.config["enabled"] or has_mapping(chat_id):
+            return ChatLock()
+
+        deadline = time.time() + self.config["wait_seconds"]
+        lock = self._local_lock(chat_id)
+        if lock.acquire(timeout=max(0.0, deadline - time.time())):
+            token = f"{os.getpid()}-{uuid.uuid4().hex}"
+            while True:
+                if has_mapping(chat_id):
+                    self._drop_local(chat_id, lock, locked=True)
+                    SINGLEFLIGHT_WAITS.inc(result="reused")
+                    logger.info(f"🔗 Reusing conversation created by a concurrent request for chat {chat_id[:8]}...")
+                    return ChatLock()
+                if self._try_lease(chat_id, token):
+                    SINGLEFLIGHT_WAITS.inc(result="acquired")
+                    return ChatLock(self, chat_id, token, lock)
+                if time.time() >= deadline:
+                    break
+                time.sleep(self.config["poll_interval"])
+            self._drop_local(chat_id, lock, locked=True)
+        else:
+            self._drop_local(chat_id, lock, locked=False)
+
+        SINGLEFLIGHT_WAITS.inc(result="timeout")
+        logger.warning(f"⏳ Timed out waiting for the first turn of chat {chat_id[:8]}..., creating a new conversation")
+        return ChatLock()
+
+    def _release(self, chat_id: str, token: str, lock: threading.Lock) -> None:
+        self._execute('DELETE FROM chat_locks WHERE chat_id = ? AND token = ?', (chat_id, token))
+        self._drop_local(chat_id, lock, locked=True)
+
+    def reset_local(self) -> None:
+        """fork 之后清空本进程的锁表"""
+        self._guard = threading.Lock()
+        self._local = {}
@@ -0,0 +1,294 @@
+"""
+按上游地址和 API Key 划分的熔断器
+Dify 故障期间直接返回 503 + Retry-After，而不是让每个请求都等待连接或读取超时
+
+状态:
+- closed: 正常放行，在本进程内按滑动窗口统计错误率和慢调用率
+- open: 直接拒绝，冷却时间结束后进入 half-open
+- half-open: 只放行一个探测请求，成功则关闭熔断器，失败则重新打开
+
+熔断状态存放在 SQLite 文件中，多个 gunicorn 工作进程共享；
+各进程只在状态变化时写库，读取时带有短暂的本地缓存，避免给热路径增加数据库开销
+"""
+
+import os
+import math
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import deque
+from typing import Dict, Optional
+
+from metrics import REGISTRY
+from sqlite_pool import shared_pool
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+_STATE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+BREAKER_STATE = REGISTRY.gauge(
+    "opendify_circuit_breaker_state", "熔断器状态 (0=closed, 1=half_open, 2=open)", ("upstream", "key"))
+BREAKER_REJECTIONS = REGISTRY.counter(
+    "opendify_circuit_breaker_rejections_total", "被熔断器直接拒绝的请求数", ("upstream", "key"))
+BREAKER_TRANSITIONS = REGISTRY.counter(
+    "opendify_circuit_breaker_transitions_total", "熔断器状态切换次数", ("upstream", "key", "state"))
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求被拒绝"""
+
+    def __init__(self, upstream: str, retry_after: int):
+        super().__init__(f"Circuit breaker open for {upstream}, retry after {retry_after}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+def key_fingerprint(api_key: str) -> str:
+    """API Key 的指纹，避免在数据库和指标中出现明文密钥"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+def load_breaker_config() -> dict:
+    """从环境变量读取熔断器配置"""
+    return {
+        "enabled": os.getenv("BREAKER_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on"),
+        "window": float(os.getenv("BREAKER_WINDOW", "30")),
+        "min_requests": int(os.getenv("BREAKER_MIN_REQUESTS", "20")),
+        "error_rate": float(os.getenv("BREAKER_ERROR_RATE", "0.5")),
+        "slow_call_seconds": float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "10")),
+        "slow_call_rate": float(os.getenv("BREAKER_SLOW_CALL_RATE", "0.8")),
+        "open_seconds": float(os.getenv("BREAKER_OPEN_SECONDS", "30")),
+        "probe_timeout": float(os.getenv("BREAKER_PROBE_TIMEOUT", "30")),
+        "state_check_interval": float(os.getenv("BREAKER_STATE_CHECK_INTERVAL", "1")),
+    }
+
+
+class BreakerPermit:
+    """一次放行的凭证，记录是否为 half-open 探测请求"""
+
+    def __init__(self, upstream: str, api_key: str, probe: bool = False):
+        self.upstream = upstream
+        self.api_key = api_key
+        self.probe = probe
+        self.started_at = time.time()
+        # 已经 record 或 abandon 过
+        self.settled = False
+
+
+class CircuitBreaker:
+    """熔断器注册表，按 (上游, API Key) 维护状态"""
+
+    def __init__(self, db_path: str, config: Optional[dict] = None):
+        self.db_path = db_path
+        self.config = config or load_breaker_config()
+        self._lock = threading.Lock()
+        self._windows: Dict[str, deque] = {}
+        self._cached: Dict[str, tuple] = {}
+        self._db = shared_pool(db_path, timeout=5.0)
+        self._db.ensure_schema(
+            '''
+            CREATE TABLE IF NOT EXISTS circuit_breakers (
+                breaker_key TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                opened_at REAL NOT NULL DEFAULT 0,
+                probe_until REAL NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )
+            ''',
+        )
+
+    # ------------------------------------------------------------ 共享状态
+
+    def _execute(self, sql: str, params: tuple) -> int:
+        """执行写操作，返回受影响行数；数据库不可用时不影响请求"""
+        try:
+            with self._db.connection() as conn:
+                cursor = conn.execute(sql, params)
+                conn.commit()
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Circuit breaker state update failed: {e}")
+            return 0
+
+    def _shared_state(self, breaker_key: str, force: bool = False) -> tuple:
+        """读取共享状态 (state, opened_at, probe_until)，带本地缓存"""
+        now = time.time()
+        cached = self._cached.get(breaker_key)
+        if cached and not force and now - cached[3] < self.config["state_check_interval"]:
+            return cached[:3]
+        try:
+            with self._db.connection() as conn:
+                row = conn.execute(
+                    'SELECT state, opened_at, probe_until FROM circuit_breakers WHERE breaker_key = ?',
+                    (breaker_key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Circuit breaker state read failed: {e}")
+            row = cached[:3] if cached else None
+        state = tuple(row) if row else (STATE_CLOSED, 0.0, 0.0)
+        self._cached[breaker_key] = state + (now,)
+        return state
+
+    def _transition(self, upstream: str, api_key: str, breaker_key: str, state: str) -> None:
+        fingerprint = key_fingerprint(api_key)
+        BREAKER_STATE.set(_STATE_VALUES[state], upstream=upstream, key=fingerprint)
+        BREAKER_TRANSITIONS.inc(upstream=upstream, key=fingerprint, state=state)
+        self._cached.pop(breaker_key, None)
+        if state == STATE_OPEN:
+            logger.warning(f"🔌 Circuit breaker OPEN for {upstream} (key {fingerprint})")
+        elif state == STATE_CLOSED:
+            logger.info(f"🔌 Circuit breaker CLOSED for {upstream} (key {fingerprint})")
+
+    def _open(self, upstream: str, api_key: str, breaker_key: str, from_probe: bool) -> None:
+        now = time.time()
+        if from_probe:
+            changed = self._execute(
+                'UPDATE circuit_breakers SET state = ?, opened_at = ?, probe_until = 0, updated_at = ? '
+                'WHERE breaker_key = ?',
+                (STATE_OPEN, now, now, breaker_key)
+            )
+        else:
+            # 已经打开时不延长冷却时间
+            changed = self._execute('''
+                INSERT INTO circuit_breakers (breaker_key, state, opened_at, probe_until, updated_at)
+                VALUES (?, ?, ?, 0, ?)
+                ON CONFLICT(breaker_key) DO UPDATE SET
+                    state = excluded.state, opened_at = excluded.opened_at, updated_at = excluded.updated_at
+                WHERE circuit_breakers.state = ?
+            ''', (breaker_key, STATE_OPEN, now, now, STATE_CLOSED))
+        with self._lock:
+            self._windows.pop(breaker_key, None)
+        if changed:
+            self._transition(upstream, api_key, breaker_key, STATE_OPEN)
+
+    # ------------------------------------------------------------ 对外接口
+
+    @staticmethod
+    def breaker_key(upstream: str, api_key: str) -> str:
+        return f"{upstream}|{key_fingerprint(api_key)}"
+
+    def retry_after(self, upstream: str, api_key: str) -> int:
+        _, opened_at, _ = self._shared_state(self.breaker_key(upstream, api_key))
+        remaining = opened_at + self.config["open_seconds"] - time.time()
+        return max(1, math.ceil(remaining))
+
+    def is_available(self, upstream: str, api_key: str) -> bool:
+        """不占用探测名额，判断当前是否可能放行"""
+        if not self.config["enabled"]:
+            return True
+        state, opened_at, probe_until = self._shared_state(self.breaker_key(upstream, api_key))
+        now = time.time()
+        if state == STATE_CLOSED:
+            return True
+        if state == STATE_OPEN:
+            return now >= opened_at + self.config["open_seconds"]
+        return now >= probe_until
+
+    def before_call(self, upstream: str, api_key: str) -> BreakerPermit:
+        """
+        请求上游前调用：放行时返回凭证，熔断时抛出 CircuitOpenError
+        open 冷却结束后，第一个调用者原子地获取探测名额进入 half-open
+        """
+        if not self.config["enabled"]:
+            return BreakerPermit(upstream, api_key)
+
+        breaker_key = self.breaker_key(upstream, api_key)
+        state, opened_at, probe_until = self._shared_state(breaker_key)
+        if state == STATE_CLOSED:
+            return BreakerPermit(upstream, api_key)
+
+        now = time.time()
+        acquired = self._execute('''
+            UPDATE circuit_breakers SET state = ?, probe_until = ?, updated_at = ?
+            WHERE breaker_key = ? AND (
+                (state = ? AND opened_at <= ?) OR (state = ? AND probe_until < ?)
+            )
+        ''', (STATE_HALF_OPEN, now + self.config["probe_timeout"], now,
+              breaker_key, STATE_OPEN, now - self.config["open_seconds"], STATE_HALF_OPEN, now))
+        if acquired:
+            self._transition(upstream, api_key, breaker_key, STATE_HALF_OPEN)
+            logger.info(f"🔌 Circuit breaker probing {upstream} (key {key_fingerprint(api_key)})")
+            return BreakerPermit(upstream, api_key, probe=True)
+
+        # 其他进程可能刚刚关闭了熔断器
+        state, _, _ = self._shared_state(breaker_key, force=True)
+        if state == STATE_CLOSED:
+            return BreakerPermit(upstream, api_key)
+
+        BREAKER_REJECTIONS.inc(upstream=upstream, key=key_fingerprint(api_key))
+        raise CircuitOpenError(upstream, self.retry_after(upstream, api_key))
+
+    def record(self, permit: BreakerPermit, success: bool, latency: Optional[float] = None,
+               timed: bool = True) -> None:
+        """
+        记录调用结果：探测请求决定 half-open 的去向，普通请求进入滑动窗口
+        latency 为首字节延迟，未指定时按放行到现在的时间计算；
+        timed=False 表示调用时间包含整个生成过程（阻塞模式），不参与慢调用统计
+        """
+        if not self.config["enabled"] or permit.settled:
+            return
+        permit.settled = True
+        upstream, api_key = permit.upstream, permit.api_key
+        breaker_key = self.breaker_key(upstream, api_key)
+        if latency is None:
+            latency = time.time() - permit.started_at
+        slow = timed and latency >= self.config["slow_call_seconds"]
+
+        if permit.probe:
+            if success and not slow:
+                now = time.time()
+                self._execute(
+                    'UPDATE circuit_breakers SET state = ?, opened_at = 0, probe_until = 0, updated_at = ? '
+                    'WHERE breaker_key = ?',
+                    (STATE_CLOSED, now, breaker_key)
+                )
+                with self._lock:
+                    self._windows.pop(breaker_key, None)
+                self._transition(upstream, api_key, breaker_key, STATE_CLOSED)
+            else:
+                self._open(upstream, api_key, breaker_key, from_probe=True)
+            return
+
+        now = time.time()
+        cutoff = now - self.config["window"]
+        with self._lock:
+            window = self._windows.setdefault(breaker_key, deque())
+            window.append((now, not success, slow))
+            while window and window[0][0] < cutoff:
+                window.popleft()
+            total = len(window)
+            if total < self.config["min_requests"]:
+                return
+            failures = sum(1 for _, failed, _ in window if failed)
+            slow_calls = sum(1 for _, _, is_slow in window if is_slow)
+
+        if failures / total >= self.config["error_rate"] or slow_calls / total >= self.config["slow_call_rate"]:
+            logger.warning(
+                f"⚠️ Tripping circuit breaker for {upstream}: {failures}/{total} failed, {slow_calls}/{total} slow"
+            )
+            self._open(upstream, api_key, breaker_key, from_probe=False)
+
+    def abandon(self, permit: BreakerPermit) -> None:
+        """
+        调用没有得到上游的结果（本地连接池等待超时、请求截止、客户端断开、请求本身无效）：不计入统计；
+        探测请求立即让出探测名额，而不是等到 BREAKER_PROBE_TIMEOUT 之后
+        """
+        if not self.config["enabled"] or permit.settled:
+            return
+        permit.settled = True
+        if permit.probe:
+            self._execute(
+                'UPDATE circuit_breakers SET probe_until = 0, updated_at = ? WHERE breaker_key = ? AND state = ?',
+                (time.time(), self.breaker_key(permit.upstream, permit.api_key), STATE_HALF_OPEN)
+            )
+
+    def reset_local(self) -> None:
+        """fork 之后清空本进程的窗口和缓存"""
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._cached = {}
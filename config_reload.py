@@ -0,0 +1,135 @@
+"""
+模型配置热更新
+收到 SIGHUP 或配置文件（默认 .env）修改时间变化时重新读取 MODEL_CONFIG / MODEL_FAILOVER_CONFIG，
+校验通过后整体替换配置快照；校验失败保留旧配置。正在处理的请求继续使用开始时的快照，
+不需要重启工作进程，进行中的 SSE 流不受影响
+
+SIGHUP 需要发给工作进程（gunicorn master 收到 SIGHUP 会重建所有工作进程）；
+每个工作进程各自监视配置文件，修改文件即可让所有工作进程更新
+"""
+
+import os
+import time
+import signal
+import logging
+from typing import Callable, List, Optional, Tuple
+
+import gevent
+from dotenv import dotenv_values
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# 可以热更新的配置项
+RELOADABLE_KEYS = ("MODEL_CONFIG", "MODEL_FAILOVER_CONFIG")
+
+CONFIG_RELOADS = REGISTRY.counter(
+    "opendify_config_reloads_total", "模型配置热更新次数（success / rejected / unchanged）", ("result",))
+CONFIG_RELOAD_SECONDS = REGISTRY.histogram(
+    "opendify_config_reload_seconds", "读取、校验并替换配置快照的耗时",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+CONFIG_VERSION = REGISTRY.gauge(
+    "opendify_config_version", "当前生效的配置版本（每次成功更新加一）")
+
+
+def load_reload_config() -> dict:
+    """从环境变量读取热更新配置"""
+    return {
+        "path": os.getenv("CONFIG_RELOAD_FILE", ".env"),
+        # 检查配置文件修改时间的间隔（秒），0 表示只响应 SIGHUP
+        "watch_interval": float(os.getenv("CONFIG_WATCH_INTERVAL", "5")),
+    }
+
+
+class ConfigReloader:
+    """
+    build(values) 根据配置项构建新快照，返回 (快照, 问题列表)；
+    apply(快照) 替换当前快照；current_values() 返回当前生效的配置项，用于判断是否有变化
+    """
+
+    def __init__(self, build: Callable[[dict], Tuple[object, List[str]]], apply: Callable[[object], None],
+                 current_values: Callable[[], dict], config: Optional[dict] = None):
+        self.config = config or load_reload_config()
+        self._build = build
+        self._apply = apply
+        self._current_values = current_values
+        self._mtime = self._file_mtime()
+        self._watcher = None
+        self.version = 0
+
+    def _file_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.config["path"]).st_mtime
+        except OSError:
+            return None
+
+    def read_values(self) -> dict:
+        """配置文件中有的项以文件为准，没有的项使用进程环境变量"""
+        values = {key: os.getenv(key, "") for key in RELOADABLE_KEYS}
+        if os.path.exists(self.config["path"]):
+            file_values = dotenv_values(self.config["path"])
+            values.update({key: file_values[key] or "" for key in RELOADABLE_KEYS if key in file_values})
+        return values
+
+    def reload(self, reason: str = "manual") -> bool:
+        """读取并校验配置，通过时替换快照，返回是否替换"""
+        started = time.perf_counter()
+        try:
+            values = self.read_values()
+            if values == self._current_values():
+                CONFIG_RELOADS.inc(result="unchanged")
+                logger.debug(f"Config reload ({reason}): no changes")
+                return False
+            snapshot, issues = self._build(values)
+            if issues:
+                CONFIG_RELOADS.inc(result="rejected")
+                logger.error(f"❌ Config reload ({reason}) rejected, keeping the current config:")
+                for issue in issues:
+                    logger.error(f"  - {issue}")
+                return False
+            self._apply(snapshot)
+            self.version += 1
+        except Exception as e:
+            CONFIG_RELOADS.inc(result="rejected")
+            logger.error(f"❌ Config reload ({reason}) failed, keeping the current config: {e}")
+            return False
+        finally:
+            CONFIG_RELOAD_SECONDS.observe(time.perf_counter() - started)
+
+        elapsed = time.perf_counter() - started
+        CONFIG_RELOADS.inc(result="success")
+        CONFIG_VERSION.set(self.version)
+        logger.info(f"🔄 Config reloaded ({reason}) in {elapsed * 1000:.1f}ms, version {self.version}")
+        return True
+
+    def check_file(self) -> bool:
+        """配置文件修改时间变化时重新加载"""
+        mtime = self._file_mtime()
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        return self.reload("file change")
+
+    def start(self) -> None:
+        """在工作进程中安装 SIGHUP 处理并启动文件监视（每个工作进程一次）"""
+        if self._watcher is not None:
+            return
+        try:
+            gevent.signal_handler(signal.SIGHUP, lambda: gevent.spawn(self.reload, "SIGHUP"))
+        except (AttributeError, ValueError) as e:
+            logger.warning(f"SIGHUP reload not available: {e}")
+
+        interval = self.config["watch_interval"]
+
+        def _loop():
+            while True:
+                gevent.sleep(interval)
+                self.check_file()
+
+        self._watcher = gevent.spawn(_loop) if interval > 0 else True
+
+    def reset(self) -> None:
+        """以当前的文件修改时间为基准，之后的变化才触发重载；监视循环由 start() 重新启动"""
+        self._watcher = None
+        self._mtime = self._file_mtime()
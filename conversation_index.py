@@ -0,0 +1,213 @@
+"""
+会话指纹索引
+每轮对话结束后，按 (模型, 用户, 客户端 Key, system 消息) 和消息序列（包含本轮回答）计算滚动哈希，记录它属于哪个 Dify 会话：
+- 没有 chat_id 的客户端每轮都携带完整历史，下一轮消息去掉最后一条后的指纹与某个会话的记录相同时，
+  直接继续该会话并只发送新的一轮，Dify 不再重新处理整段历史
+- 有 chat_id 的会话在用户编辑或重新生成之前的消息后，历史与 Dify 会话不再一致，
+  此时不再复用原会话，而是带完整历史开启新的分支
+每个会话只保留最新状态的指纹（Dify 会话无法回到之前的某一轮），所以前缀分叉时必然开启新会话。
+system 消息和客户端 Key 计入指纹的种子：匿名客户端共用默认用户，
+只有 system 提示词不同的两个客户端不能取走对方的会话
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+from typing import List, NamedTuple, Optional
+
+from metrics import REGISTRY
+from file_uploads import message_text
+from sqlite_pool import shared_pool
+
+logger = logging.getLogger(__name__)
+
+INDEX_LOOKUPS = REGISTRY.counter(
+    "opendify_conversation_index_lookups_total", "按历史指纹查找会话的结果 (hit/miss/diverged)", ("model", "result"))
+
+_VERSION = b"opendify-history-v2"
+
+# 每记录这么多轮检查一次总条数
+_PRUNE_EVERY = 256
+
+
+def load_index_config() -> dict:
+    """从环境变量读取会话指纹索引配置"""
+    return {
+        # 没有 chat_id 时按历史指纹继续会话
+        "enabled": os.getenv("CONVERSATION_INDEX", "true").strip().lower() in ("1", "true", "yes", "on"),
+        # 有 chat_id 时校验历史是否仍与 Dify 会话一致，不一致时开启新分支
+        # 默认关闭：会改写助手回复内容（如去掉思考过程）的客户端每轮都会被判定为分叉
+        "verify_chat": os.getenv("CONVERSATION_INDEX_VERIFY_CHAT", "false").strip().lower() in ("1", "true", "yes", "on"),
+        "max_age_days": float(os.getenv("CONVERSATION_INDEX_MAX_AGE_DAYS", "30")),
+        "max_rows": int(os.getenv("CONVERSATION_INDEX_MAX_ROWS", "100000")),
+    }
+
+
+def _step(state: bytes, role: str, content) -> bytes:
+    text = message_text(content).strip()
+    return hashlib.sha256(state + (role or "").encode("utf-8") + b"\0" + text.encode("utf-8")).digest()
+
+
+class ConversationTurn:
+    """一次请求的消息序列的滚动哈希：prefix 为去掉最后一条消息的历史指纹，after() 为加上回答之后的指纹"""
+
+    def __init__(self, model: str, user: str, messages: List[dict], api_key_id: Optional[str] = None):
+        seed = b"\0".join((part or "").encode("utf-8") for part in (model, user, api_key_id))
+        state = hashlib.sha256(_VERSION + b"\0" + seed).digest()
+        for message in messages:
+            if isinstance(message, dict) and message.get("role") == "system":
+                state = _step(state, "system", message.get("content"))
+        self.prefix = None
+        history = 0
+        for index, message in enumerate(messages):
+            if not isinstance(message, dict) or message.get("role") == "system":
+                continue
+            if index == len(messages) - 1 and history:
+                self.prefix = state.hex()
+            state = _step(state, message.get("role"), message.get("content"))
+            history += 1
+        self._state = state
+
+    def after(self, answer: str) -> str:
+        return _step(self._state, "assistant", answer).hex()
+
+
+class IndexedConversation(NamedTuple):
+    conversation_id: str
+    api_key_id: Optional[str]
+    upstream: Optional[str]
+
+
+class ConversationIndex:
+    """历史指纹 -> Dify 会话，存放在与会话映射相同的 SQLite 数据库中，工作进程之间共享"""
+
+    def __init__(self, db_path: str, config: Optional[dict] = None):
+        self.db_path = db_path
+        self.config = config or load_index_config()
+        self._records = 0
+        self._db = shared_pool(db_path, timeout=5.0)
+        self._db.ensure_schema(
+            '''
+            CREATE TABLE IF NOT EXISTS conversation_fingerprints (
+                fingerprint TEXT PRIMARY KEY,
+                dify_conversation_id TEXT NOT NULL,
+                api_key_id TEXT,
+                upstream TEXT,
+                webui_chat_id TEXT,
+                last_used INTEGER NOT NULL
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_fingerprints_conversation ON conversation_fingerprints(dify_conversation_id)',
+            'CREATE INDEX IF NOT EXISTS idx_fingerprints_chat ON conversation_fingerprints(webui_chat_id)',
+            'CREATE INDEX IF NOT EXISTS idx_fingerprints_last_used ON conversation_fingerprints(last_used)',
+        )
+
+    @property
+    def active(self) -> bool:
+        return self.config["enabled"] or self.config["verify_chat"]
+
+    def begin_turn(self, model: str, user: str, messages,
+                   api_key_id: Optional[str] = None) -> Optional[ConversationTurn]:
+        """计算本次请求的历史指纹（api_key_id 为客户端 Key 的指纹），索引关闭时返回 None"""
+        if not self.active or not isinstance(messages, list):
+            return None
+        return ConversationTurn(model, user, messages, api_key_id)
+
+    def claim(self, model: str, turn: Optional[ConversationTurn]) -> Optional[IndexedConversation]:
+        """
+        没有 chat_id 的请求：取走历史与本次消息前缀相同的会话
+        取走后该指纹不再可用，同一历史的并发请求只有一个继续原会话，其他的开启新会话
+        """
+        if not self.config["enabled"] or turn is None or turn.prefix is None:
+            return None
+        try:
+            with self._db.connection() as conn:
+                row = conn.execute(
+                    'SELECT dify_conversation_id, api_key_id, upstream FROM conversation_fingerprints '
+                    'WHERE fingerprint = ? AND webui_chat_id IS NULL AND last_used > ?',
+                    (turn.prefix, time.time() - self.config["max_age_days"] * 86400)
+                ).fetchone()
+                claimed = row is not None and conn.execute(
+                    'DELETE FROM conversation_fingerprints WHERE fingerprint = ? AND dify_conversation_id = ?',
+                    (turn.prefix, row[0])
+                ).rowcount == 1
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Conversation index lookup failed: {e}")
+            return None
+        INDEX_LOOKUPS.inc(model=model, result="hit" if claimed else "miss")
+        return IndexedConversation(*row) if claimed else None
+
+    def diverged(self, model: str, webui_chat_id: str, turn: Optional[ConversationTurn]) -> bool:
+        """
+        有 chat_id 的请求：会话的最新历史指纹与本次消息前缀不同（之前的消息被编辑或重新生成）
+        没有记录的旧会话按一致处理
+        """
+        if not self.config["verify_chat"] or turn is None:
+            return False
+        try:
+            with self._db.connection() as conn:
+                row = conn.execute(
+                    'SELECT fingerprint FROM conversation_fingerprints WHERE webui_chat_id = ?', (webui_chat_id,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Conversation index lookup failed: {e}")
+            return False
+        if row is None:
+            return False
+        diverged = row[0] != turn.prefix
+        INDEX_LOOKUPS.inc(model=model, result="diverged" if diverged else "hit")
+        return diverged
+
+    def record(self, fingerprint: str, conversation_id: str, api_key_id: Optional[str] = None,
+               upstream: Optional[str] = None, webui_chat_id: Optional[str] = None) -> None:
+        """
+        记录会话的最新历史指纹，替换该会话（和该 chat_id）之前的记录
+        有 chat_id 的轮次只在开启 verify_chat 时记录，没有 chat_id 的只在开启 enabled 时记录
+        """
+        if not self.config["verify_chat" if webui_chat_id else "enabled"]:
+            return
+        now = int(time.time())
+        try:
+            with self._db.connection() as conn:
+                conn.execute('DELETE FROM conversation_fingerprints WHERE dify_conversation_id = ?', (conversation_id,))
+                if webui_chat_id:
+                    conn.execute('DELETE FROM conversation_fingerprints WHERE webui_chat_id = ?', (webui_chat_id,))
+                conn.execute(
+                    'INSERT OR REPLACE INTO conversation_fingerprints '
+                    '(fingerprint, dify_conversation_id, api_key_id, upstream, webui_chat_id, last_used) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (fingerprint, conversation_id, api_key_id, upstream, webui_chat_id, now)
+                )
+                self._records += 1
+                if self._records % _PRUNE_EVERY == 0:
+                    self._prune(conn, now)
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Conversation index write failed: {e}")
+
+    def _prune(self, conn: sqlite3.Connection, now: float) -> int:
+        removed = conn.execute('DELETE FROM conversation_fingerprints WHERE last_used < ?',
+                               (now - self.config["max_age_days"] * 86400,)).rowcount
+        removed += conn.execute('''
+            DELETE FROM conversation_fingerprints WHERE rowid IN (
+                SELECT rowid FROM conversation_fingerprints ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.config["max_rows"],)).rowcount
+        return removed
+
+    def cleanup(self, max_age_days: Optional[float] = None) -> int:
+        """删除过期和超出数量的记录，返回删除的条数"""
+        try:
+            with self._db.connection() as conn:
+                cutoff_days = self.config["max_age_days"] if max_age_days is None else max_age_days
+                removed = conn.execute('DELETE FROM conversation_fingerprints WHERE last_used < ?',
+                                       (time.time() - cutoff_days * 86400,)).rowcount
+                removed += self._prune(conn, time.time())
+                conn.commit()
+                return removed
+        except sqlite3.Error as e:
+            logger.error(f"Conversation index cleanup failed: {e}")
+            return 0
@@ -2,28 +2,94 @@ import sqlite3
 import logging
 import os
 import time
-from contextlib import contextmanager
-from typing import Dict, Optional, List, Tuple
+import mmap
+import zlib
+import fcntl
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Tuple
+
+from sqlite_pool import shared_pool
 
 logger = logging.getLogger(__name__)
 
+# 映射版本号的桶数，下标 0 为全局版本（清理映射时递增）
+VERSION_BUCKETS = 65536
+_VERSION_BYTES = VERSION_BUCKETS * 4
+
+
+class MappingVersions:
+    """
+    基于 mmap 文件的跨进程映射版本号
+    写入映射后递增 chat_id 所在桶的计数，缓存命中时比较版本号即可发现其他进程的替换或清理，不需要查询 SQLite
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size != _VERSION_BYTES:
+                os.ftruncate(fd, _VERSION_BYTES)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            self._mm = mmap.mmap(fd, _VERSION_BYTES)
+        finally:
+            os.close(fd)
+        self._counts = memoryview(self._mm).cast("I")
+
+    @staticmethod
+    def _bucket(webui_chat_id: str) -> int:
+        return 1 + zlib.crc32(webui_chat_id.encode("utf-8")) % (VERSION_BUCKETS - 1)
+
+    def get(self, webui_chat_id: str) -> Tuple[int, int]:
+        """(全局版本, chat_id 所在桶的版本)"""
+        return self._counts[0], self._counts[self._bucket(webui_chat_id)]
+
+    def snapshot(self) -> List[int]:
+        """所有桶的版本（预热大量条目时使用）"""
+        return self._counts.tolist()
+
+    def bump(self, webui_chat_id: Optional[str] = None) -> Tuple[int, int]:
+        """递增 chat_id 所在桶（为 None 时递增全局版本），返回递增后的 (全局版本, 该桶的版本)"""
+        index = 0 if webui_chat_id is None else self._bucket(webui_chat_id)
+        # 多个进程可能同时递增同一个桶，用文件锁保证不丢失递增
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self._counts[index] = (self._counts[index] + 1) & 0xFFFFFFFF
+            return self._counts[0], self._counts[index]
+        finally:
+            os.close(fd)
+
 class ConversationMapper:
     """
     基于 SQLite 的会话映射管理器
     解决多进程环境下的并发访问问题
     """
     
-    def __init__(self, db_path="data/conversation_mappings.db"):
-        # 确保数据目录存在
-        dir_path = os.path.dirname(db_path)
-        if dir_path:  # 只有当路径包含目录时才创建
-            os.makedirs(dir_path, exist_ok=True)
+    def __init__(self, db_path="data/conversation_mappings.db", pool_size=None, cache_size=None, cache_ttl=None):
         self.db_path = db_path
+        # 进程内连接池，与使用同一数据库文件的其他模块共用
+        self._db = shared_pool(db_path, pool_size)
+        
+        # 进程内映射缓存：chat_id -> ((conversation_id, api_key_id, upstream), 版本号, 过期时间)
+        # 映射可能被其他进程替换或清理，命中时与共享的版本号核对（与数据库文件放在一起）
+        self._versions = MappingVersions(db_path + "-versions")
+        self.cache_size = cache_size if cache_size is not None else int(os.getenv("MAPPING_CACHE_SIZE", "10000"))
+        self.cache_ttl = cache_ttl if cache_ttl is not None else float(os.getenv("MAPPING_CACHE_TTL", "300"))
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
         
         # 初始化数据库
         self._init_database()
         logger.info(f"✅ ConversationMapper initialized with SQLite database: {db_path}")
     
+    def reinit_after_fork(self) -> None:
+        """fork 之后在子进程中重建连接池和映射缓存"""
+        self._db.reinit_after_fork()
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+    
     def _init_database(self) -> None:
         """初始化数据库表结构，优化多进程并发初始化"""
         max_init_retries = 5
@@ -72,7 +138,9 @@ class ConversationMapper:
                                     dify_conversation_id TEXT NOT NULL,
                                     created_at INTEGER NOT NULL,
                                     last_used INTEGER NOT NULL,
-                                    updated_at INTEGER DEFAULT (strftime('%s', 'now'))
+                                    updated_at INTEGER DEFAULT (strftime('%s', 'now')),
+                                    api_key_id TEXT,
+                                    upstream TEXT
                                 )
                             ''')
                             logger.info("📋 Created conversation_mappings table")
@@ -112,6 +180,19 @@ class ConversationMapper:
                                 # 删除备份表
                                 cursor.execute('DROP TABLE IF EXISTS conversation_mappings_backup')
                     
+                    # 旧版本数据库没有 api_key_id / upstream 列（会话固定到创建它的 Key 和上游），原地补充
+                    cursor.execute('PRAGMA table_info(conversation_mappings)')
+                    existing_columns = [row[1] for row in cursor.fetchall()]
+                    for column in ('api_key_id', 'upstream'):
+                        if column in existing_columns:
+                            continue
+                        try:
+                            cursor.execute(f'ALTER TABLE conversation_mappings ADD COLUMN {column} TEXT')
+                            logger.info(f"📋 Added {column} column to conversation_mappings")
+                        except sqlite3.OperationalError as e:
+                            if "duplicate column" not in str(e):
+                                raise
+
                     # 安全地创建索引
                     try:
                         cursor.execute('''
@@ -141,7 +222,6 @@ class ConversationMapper:
             except sqlite3.OperationalError as e:
                 if "database is locked" in str(e) and retry_count < max_init_retries - 1:
                     retry_count += 1
-                    import time
                     wait_time = 0.2 * (2 ** retry_count)  # 初始化时使用更长的等待时间
                     logger.warning(f"Database locked during initialization, retrying in {wait_time}s (attempt {retry_count}/{max_init_retries})")
                     time.sleep(wait_time)
@@ -153,103 +233,143 @@ class ConversationMapper:
                 logger.error(f"❌ Failed to initialize database: {e}")
                 raise
     
-    @contextmanager
     def _get_connection(self):
+        """从共享连接池获取数据库连接的上下文管理器"""
+        return self._db.connection()
+    
+    def _cache_get(self, webui_chat_id: str,
+                   version: Tuple[int, int]) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+        """从进程内缓存读取映射，过期或版本号已变化（其他进程替换或清理了映射）的条目视为未命中"""
+        if self.cache_size <= 0:
+            return None
+        with self._lock:
+            entry = self._cache.get(webui_chat_id)
+            if entry is None:
+                return None
+            mapping, cached_version, expires_at = entry
+            if cached_version != version or expires_at < time.time():
+                del self._cache[webui_chat_id]
+                return None
+            self._cache.move_to_end(webui_chat_id)
+            return mapping
+
+    def _cache_discard(self, webui_chat_id: str) -> None:
+        with self._lock:
+            self._cache.pop(webui_chat_id, None)
+
+    def _cache_put(self, webui_chat_id: str, version: Tuple[int, int], dify_conversation_id: str,
+                   api_key_id: Optional[str] = None, upstream: Optional[str] = None) -> None:
+        """写入进程内缓存，version 为读取映射之前的版本号；超出容量时淘汰最久未使用的条目"""
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[webui_chat_id] = ((dify_conversation_id, api_key_id, upstream), version,
+                                          time.time() + self.cache_ttl)
+            self._cache.move_to_end(webui_chat_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+    
+    def warm_cache(self, limit: int = 1000) -> int:
+        """用最近使用的映射预热进程内缓存，返回加载的条目数"""
+        limit = min(limit, self.cache_size)
+        if limit <= 0:
+            return 0
+        # 先读取版本号再查询，查询期间被替换的映射在下次命中时失效
+        versions = self._versions.snapshot()
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT webui_chat_id, dify_conversation_id, api_key_id, upstream
+                    FROM conversation_mappings
+                    ORDER BY last_used DESC
+                    LIMIT ?
+                ''', (limit,))
+                rows = cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Failed to warm mapping cache: {e}")
+            return 0
+        # 从旧到新写入，使最近使用的条目位于 LRU 末尾
+        for webui_chat_id, dify_conversation_id, api_key_id, upstream in reversed(rows):
+            version = (versions[0], versions[MappingVersions._bucket(webui_chat_id)])
+            self._cache_put(webui_chat_id, version, dify_conversation_id, api_key_id, upstream)
+        logger.info(f"🔥 Warmed mapping cache with {len(rows)} recent mappings")
+        return len(rows)
+    
+    def get_mapping(self, webui_chat_id: str) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
         """
-        获取数据库连接的上下文管理器
-        确保连接正确关闭，增强多进程并发处理
+        根据 Open WebUI chat_id 获取 (dify_conversation_id, api_key_id, upstream)
+        api_key_id 和 upstream 为创建会话时所用 Key 的标识和上游地址，旧记录中为 None
+        缓存命中时只比较共享的版本号，不查询 SQLite；其他进程替换（换 Key、换上游、分支）或清理了映射时重新读取
         """
-        conn = None
-        max_retries = 3
-        retry_count = 0
-        
-        while retry_count < max_retries:
-            try:
-                conn = sqlite3.connect(
-                    self.db_path,
-                    timeout=60.0,  # 增加到60秒超时
-                    check_same_thread=False  # 允许多线程访问
-                )
-                # 启用 WAL 模式提高并发性能
-                conn.execute('PRAGMA journal_mode=WAL')
-                # 启用外键约束
-                conn.execute('PRAGMA foreign_keys=ON')
-                # 设置更长的忙等待超时
-                conn.execute('PRAGMA busy_timeout=60000')
-                # 设置同步模式为NORMAL以平衡性能和安全性
-                conn.execute('PRAGMA synchronous=NORMAL')
-                
-                try:
-                    yield conn
-                    return  # 成功完成，退出函数
-                except Exception as inner_e:
-                    if conn:
-                        conn.rollback()
-                    raise inner_e
-                finally:
-                    if conn:
-                        conn.close()
-                        
-            except sqlite3.OperationalError as e:
-                if "database is locked" in str(e) and retry_count < max_retries - 1:
-                    retry_count += 1
-                    import time
-                    # 指数退避重试策略
-                    wait_time = 0.1 * (2 ** retry_count)
-                    logger.warning(f"Database locked, retrying in {wait_time}s (attempt {retry_count}/{max_retries})")
-                    time.sleep(wait_time)
-                    if conn:
-                        conn.close()
-                        conn = None
-                    continue
-                else:
-                    logger.error(f"Database connection error after {retry_count + 1} attempts: {e}")
-                    raise
-            except Exception as e:
-                logger.error(f"Database connection error: {e}")
-                raise
-    
-    def get_dify_conversation_id(self, webui_chat_id: str) -> Optional[str]:
-        """根据 Open WebUI chat_id 获取对应的 Dify conversation_id"""
+        # 先读取版本号再查询，查询之后的写入会使缓存条目在下次命中时失效
+        version = self._versions.get(webui_chat_id)
+        cached = self._cache_get(webui_chat_id, version)
+        if cached:
+            return cached
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
-                    'SELECT dify_conversation_id FROM conversation_mappings WHERE webui_chat_id = ?',
+                    'SELECT dify_conversation_id, api_key_id, upstream FROM conversation_mappings '
+                    'WHERE webui_chat_id = ?',
                     (webui_chat_id,)
                 )
                 result = cursor.fetchone()
-                return result[0] if result else None
+                if not result:
+                    return None
+                self._cache_put(webui_chat_id, version, *result)
+                return tuple(result)
         except Exception as e:
             logger.error(f"Failed to get dify_conversation_id for {webui_chat_id[:8]}...: {e}")
             return None
-    
-    def set_mapping(self, webui_chat_id: str, dify_conversation_id: str) -> None:
+
+    def get_dify_conversation_id(self, webui_chat_id: str) -> Optional[str]:
+        """根据 Open WebUI chat_id 获取对应的 Dify conversation_id"""
+        mapping = self.get_mapping(webui_chat_id)
+        return mapping[0] if mapping else None
+
+    def set_mapping(self, webui_chat_id: str, dify_conversation_id: str,
+                    api_key_id: Optional[str] = None, upstream: Optional[str] = None) -> None:
         """设置映射关系，使用 UPSERT 避免重复"""
         try:
             current_time = int(time.time())
+            version = self._versions.get(webui_chat_id)
             with self._get_connection() as conn:
                 cursor = conn.cursor()
                 
                 # 使用 INSERT OR REPLACE 实现 UPSERT
+                # updated_at 每次写入都递增（同一秒内替换也不同）
                 cursor.execute('''
                     INSERT OR REPLACE INTO conversation_mappings 
-                    (webui_chat_id, dify_conversation_id, created_at, last_used, updated_at)
-                    VALUES (?, ?, 
+                    (webui_chat_id, dify_conversation_id, created_at, last_used, updated_at, api_key_id, upstream)
+                    VALUES (?, ?,
                         COALESCE((SELECT created_at FROM conversation_mappings WHERE webui_chat_id = ?), ?),
+                        ?,
+                        MAX(?, COALESCE((SELECT updated_at FROM conversation_mappings WHERE webui_chat_id = ?) + 1, 0)),
                         ?, ?)
                 ''', (
-                    webui_chat_id, 
+                    webui_chat_id,
                     dify_conversation_id,
                     webui_chat_id,  # 用于 COALESCE 查询
                     current_time,   # 新记录的 created_at
                     current_time,   # last_used
-                    current_time    # updated_at
+                    current_time,   # updated_at
+                    webui_chat_id,  # 用于读取之前的 updated_at
+                    api_key_id,     # 创建会话时使用的 Key 标识
+                    upstream        # 创建会话时使用的上游地址
                 ))
-                
+                inserted = cursor.rowcount > 0
                 conn.commit()
+                # 提交之后递增版本号，其他进程缓存的旧映射随之失效；
+                # 期间有其他写入（版本号不只增加 1）时不知道哪个映射更新，不写入本进程缓存
+                bumped = self._versions.bump(webui_chat_id)
+                if bumped == (version[0], (version[1] + 1) & 0xFFFFFFFF):
+                    self._cache_put(webui_chat_id, bumped, dify_conversation_id, api_key_id, upstream)
+                else:
+                    self._cache_discard(webui_chat_id)
                 
-                if cursor.rowcount > 0:
+                if inserted:
                     logger.info(f"🔗 Mapped WebUI chat_id {webui_chat_id[:8]}... to Dify conversation_id {dify_conversation_id[:8]}...")
                 
         except Exception as e:
@@ -269,6 +389,19 @@ class ConversationMapper:
             logger.error(f"Failed to check mapping for {webui_chat_id[:8]}...: {e}")
             return False
     
+    def close(self) -> None:
+        """关闭本进程连接池中的连接（工作进程退出前调用，最后一个连接关闭时 SQLite 会检查点 WAL）"""
+        self._db.close()
+
+    def ping(self) -> bool:
+        """数据库是否可读（供就绪检查使用，失败时不写日志）"""
+        try:
+            with self._get_connection() as conn:
+                conn.execute('SELECT 1 FROM conversation_mappings LIMIT 1').fetchall()
+                return True
+        except Exception:
+            return False
+
     def update_last_used(self, webui_chat_id: str) -> None:
         """更新映射的最后使用时间"""
         try:
@@ -277,9 +410,9 @@ class ConversationMapper:
                 cursor = conn.cursor()
                 cursor.execute('''
                     UPDATE conversation_mappings 
-                    SET last_used = ?, updated_at = ?
+                    SET last_used = ?
                     WHERE webui_chat_id = ?
-                ''', (current_time, current_time, webui_chat_id))
+                ''', (current_time, webui_chat_id))
                 
                 conn.commit()
                 
@@ -322,6 +455,10 @@ class ConversationMapper:
                         (cutoff_time,)
                     )
                     conn.commit()
+                    # 被删除的映射可能仍在各进程的缓存中：递增全局版本号使所有缓存条目失效
+                    self._versions.bump()
+                    with self._lock:
+                        self._cache.clear()
                     
                     logger.info(f"🧹 Cleaned up {count_to_remove} old mappings (older than {max_age_days} days)")
                 
@@ -426,7 +563,9 @@ class ConversationMapper:
                     "database_size_bytes": db_size,
                     "journal_mode": journal_mode,
                     "tables": tables,
-                    "mapping_count": self.get_mapping_count()
+                    "mapping_count": self.get_mapping_count(),
+                    "pooled_connections": self._db.idle,
+                    "cache_entries": len(self._cache)
                 }
                 
         except Exception as e:
@@ -0,0 +1,129 @@
+"""
+请求整体截止时间
+客户端可以通过请求头（默认 X-Request-Timeout）告知愿意等待的时间，也可以按模型配置默认值；
+两者取较早者。剩余时间不足时在调用 Dify 之前快速失败，调用过程中超过截止时间则中止上游请求。
+单次读取的空闲超时由连接池的 read_timeout 负责，这里只限制整个请求的总时长
+"""
+
+import os
+import json
+import time
+import logging
+from typing import Optional
+
+import gevent
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DEADLINE_EXCEEDED = REGISTRY.counter(
+    "opendify_deadline_exceeded_total", "超过整体截止时间的请求数", ("model", "stage"))
+
+# 大于该值的请求头按绝对 Unix 时间戳解释，否则按剩余秒数解释
+_EPOCH_THRESHOLD = 1e9
+
+
+class DeadlineExceeded(Exception):
+    """请求超过了整体截止时间"""
+
+    def __init__(self, model: str, stage: str):
+        super().__init__(f"Request deadline exceeded for model {model} ({stage})")
+        self.model = model
+        self.stage = stage
+
+
+def load_deadline_config() -> dict:
+    """从环境变量读取截止时间配置，0 表示不限制"""
+    model_deadlines = {}
+    deadlines_str = os.getenv("REQUEST_DEADLINE_MODELS", "").strip()
+    if deadlines_str:
+        try:
+            model_deadlines = {k: float(v) for k, v in json.loads(deadlines_str).items()}
+        except (json.JSONDecodeError, AttributeError, ValueError) as e:
+            logger.error(f"Failed to parse REQUEST_DEADLINE_MODELS: {e}")
+    return {
+        "header": os.getenv("REQUEST_DEADLINE_HEADER", "X-Request-Timeout"),
+        "default": float(os.getenv("REQUEST_DEADLINE", "0")),
+        "model_deadlines": model_deadlines,
+        # 剩余时间少于该值时不再调用 Dify
+        "min_budget": float(os.getenv("REQUEST_DEADLINE_MIN_BUDGET", "0.5")),
+        # 非流式请求在内部使用 Dify 流式接口并聚合结果，使空闲超时和截止时间对长时间生成同样生效
+        "aggregate_non_stream": os.getenv("NON_STREAM_VIA_STREAMING", "true").strip().lower() in ("1", "true", "yes", "on"),
+    }
+
+
+class Deadline:
+    """一个请求的截止时间（time.monotonic 时钟），expires_at 为 None 表示不限制"""
+
+    def __init__(self, model: str, expires_at: Optional[float], min_budget: float = 0.0):
+        self.model = model
+        self.expires_at = expires_at
+        self.min_budget = min_budget
+
+    def remaining(self) -> Optional[float]:
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def check(self, stage: str) -> None:
+        """剩余时间不足以调用上游时抛出 DeadlineExceeded"""
+        remaining = self.remaining()
+        if remaining is not None and remaining <= self.min_budget:
+            raise self.exceeded(stage)
+
+    def exceeded(self, stage: str) -> DeadlineExceeded:
+        DEADLINE_EXCEEDED.inc(model=self.model, stage=stage)
+        logger.warning(f"⏰ Request deadline exceeded for model {self.model} ({stage})")
+        return DeadlineExceeded(self.model, stage)
+
+    def call(self, func, *args, **kwargs):
+        """
+        在剩余时间内执行 func，超时时中断它并抛出 DeadlineExceeded
+        gevent.Timeout 作用于当前 greenlet，只应在独立的 greenlet（如 Heartbeats 的后台读取）或同步调用中使用
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return func(*args, **kwargs)
+        timer = gevent.Timeout(remaining)
+        timer.start()
+        try:
+            return func(*args, **kwargs)
+        except gevent.Timeout as t:
+            if t is not timer:
+                raise
+            raise self.exceeded("upstream") from None
+        finally:
+            timer.cancel()
+
+
+class DeadlinePolicy:
+    """根据请求头和模型配置计算每个请求的截止时间"""
+
+    def __init__(self, config: dict):
+        self.config = config
+
+    def for_request(self, model: str, headers, started: Optional[float] = None) -> Deadline:
+        """started 为请求开始处理的 time.monotonic()，准入排队等本地等待也计入截止时间"""
+        started = time.monotonic() if started is None else started
+        budgets = []
+        model_budget = self.config["model_deadlines"].get(model, self.config["default"])
+        if model_budget > 0:
+            budgets.append(model_budget)
+        header_budget = self._parse_header(headers.get(self.config["header"]))
+        if header_budget is not None:
+            budgets.append(header_budget)
+        expires_at = started + min(budgets) if budgets else None
+        return Deadline(model, expires_at, self.config["min_budget"])
+
+    def _parse_header(self, value: Optional[str]) -> Optional[float]:
+        if not value:
+            return None
+        try:
+            budget = float(value)
+        except ValueError:
+            logger.warning(f"Ignoring invalid {self.config['header']} header: {value[:32]}")
+            return None
+        if budget > _EPOCH_THRESHOLD:
+            budget -= time.time()
+        return max(0.0, budget)
@@ -0,0 +1,214 @@
+"""
+工作进程排空（优雅退出）
+gunicorn 回收工作进程（max_requests、内存超限）或关闭时：先停止接收新的对话请求并报告未就绪，
+再等待进行中的请求（主要是长时间的 SSE 流）在截止时间内结束，最后执行收尾操作（关闭数据库连接等）才退出
+
+等待由 gunicorn 的 graceful_timeout 完成（gevent 工作进程关闭监听后等待所有连接结束），
+本模块负责拒绝新请求、统计在途请求、按内存阈值触发回收，以及在 worker_exit 钩子中收尾
+"""
+
+import os
+import time
+import logging
+import threading
+from typing import Callable, List, Optional, Tuple
+
+import gevent
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+WORKER_DRAINS = REGISTRY.counter(
+    "opendify_worker_drains_total", "工作进程排空次数（原因 / 是否在截止时间内排空）", ("reason", "result"))
+DRAIN_SECONDS = REGISTRY.histogram(
+    "opendify_worker_drain_seconds", "从开始排空到在途请求全部结束的耗时",
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+DRAIN_REJECTED = REGISTRY.counter(
+    "opendify_drain_rejected_total", "排空期间拒绝的新对话请求数")
+INFLIGHT_REQUESTS = REGISTRY.gauge(
+    "opendify_inflight_requests", "当前工作进程在途的对话请求数（流式请求到流结束为止）")
+WORKER_RSS_BYTES = REGISTRY.gauge(
+    "opendify_worker_rss_bytes", "当前工作进程的常驻内存")
+
+
+def load_drain_config() -> dict:
+    """从环境变量读取排空配置"""
+    return {
+        # 等待在途请求结束的最长时间（秒），gunicorn_config.py 的 graceful_timeout 使用同一个值
+        "timeout": float(os.getenv("DRAIN_TIMEOUT", "60")),
+        # 常驻内存超过该值（MB）时回收工作进程，0 表示关闭
+        "max_rss_mb": float(os.getenv("WORKER_MAX_RSS_MB", "0")),
+        "rss_check_interval": float(os.getenv("WORKER_RSS_CHECK_INTERVAL", "10")),
+    }
+
+
+def current_rss_bytes() -> int:
+    """当前进程的常驻内存（字节），优先读取 /proc，其他平台退回到峰值 RSS"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 以 KB 为单位，macOS 以字节为单位
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class InflightTicket:
+    """一个在途请求的登记，release 可重复调用"""
+
+    def __init__(self, drain: "WorkerDrain"):
+        self._drain = drain
+        self._released = False
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._drain._release()
+
+
+class WorkerDrain:
+    """
+    记录在途请求并协调排空：begin() 之后 accepting 为 False，新请求应被拒绝；
+    finish() 等待在途请求结束（最多到截止时间）并执行收尾操作，只执行一次
+    """
+
+    def __init__(self, config: Optional[dict] = None, rss_reader: Callable[[], int] = current_rss_bytes):
+        self.config = config or load_drain_config()
+        self._rss_reader = rss_reader
+        self._flush_hooks: List[Tuple[str, Callable[[], None]]] = []
+        self._begin_hooks: List[Tuple[str, Callable[[], None]]] = []
+        self.reset()
+
+    def reset(self) -> None:
+        """工作进程从接受请求、没有在途请求的状态开始，内存监视由 watch_worker() 重新启动"""
+        self._lock = threading.Lock()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._inflight = 0
+        self.reason: Optional[str] = None
+        self._started_at: Optional[float] = None
+        self._finished = False
+        self._watcher = None
+
+    @property
+    def accepting(self) -> bool:
+        return self.reason is None
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    def add_flush_hook(self, name: str, hook: Callable[[], None]) -> None:
+        """注册退出前的收尾操作，按注册顺序执行"""
+        self._flush_hooks.append((name, hook))
+
+    def add_begin_hook(self, name: str, hook: Callable[[], None]) -> None:
+        """注册开始排空时立即执行的操作（如刷新就绪状态），按注册顺序执行"""
+        self._begin_hooks.append((name, hook))
+
+    def track(self) -> InflightTicket:
+        """登记一个在途请求"""
+        with self._lock:
+            self._inflight += 1
+            self._idle.clear()
+            INFLIGHT_REQUESTS.set(self._inflight)
+        return InflightTicket(self)
+
+    def _release(self) -> None:
+        with self._lock:
+            self._inflight -= 1
+            INFLIGHT_REQUESTS.set(self._inflight)
+            if self._inflight <= 0:
+                self._idle.set()
+
+    def reject(self) -> None:
+        """记录一次排空期间被拒绝的请求"""
+        DRAIN_REJECTED.inc()
+
+    def begin(self, reason: str) -> bool:
+        """开始排空，返回是否是第一次调用（重复调用保留第一次的原因）"""
+        with self._lock:
+            if self.reason is not None:
+                return False
+            self.reason = reason
+            self._started_at = time.monotonic()
+        logger.info(f"🚰 Worker {os.getpid()} draining ({reason}), {self._inflight} request(s) in flight")
+        for name, hook in self._begin_hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.error(f"Drain begin step {name} failed: {e}")
+        return True
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等待在途请求全部结束，返回是否在超时前结束"""
+        return self._idle.wait(timeout)
+
+    def finish(self) -> bool:
+        """
+        等待在途请求结束（从 begin 起最多 DRAIN_TIMEOUT 秒）并执行收尾操作，返回是否完全排空
+        在 gunicorn 的 worker_exit 钩子中调用；没有调用过 begin 时按 "shutdown" 处理
+        """
+        if self._finished:
+            return self._idle.is_set()
+        self._finished = True
+        self.begin("shutdown")
+
+        remaining = max(0.0, self._started_at + self.config["timeout"] - time.monotonic())
+        drained = self.wait(remaining)
+        elapsed = time.monotonic() - self._started_at
+        DRAIN_SECONDS.observe(elapsed)
+        WORKER_DRAINS.inc(reason=self.reason, result="drained" if drained else "timeout")
+        if drained:
+            logger.info(f"✅ Worker {os.getpid()} drained in {elapsed:.1f}s")
+        else:
+            logger.warning(f"⚠️ Worker {os.getpid()} drain deadline reached with {self._inflight} request(s) in flight")
+
+        for name, hook in self._flush_hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.error(f"Drain flush step {name} failed: {e}")
+        return drained
+
+    def check_memory(self) -> bool:
+        """常驻内存超过阈值时开始排空，返回是否需要回收"""
+        rss = self._rss_reader()
+        WORKER_RSS_BYTES.set(rss)
+        limit = self.config["max_rss_mb"]
+        if limit <= 0 or rss <= limit * 1024 * 1024:
+            return False
+        if self.begin("memory"):
+            logger.warning(f"🧠 Worker {os.getpid()} RSS {rss / 1024 / 1024:.0f}MB exceeds {limit:.0f}MB, recycling")
+        return True
+
+    def watch_worker(self, worker) -> None:
+        """
+        监视 gunicorn 工作进程（每个工作进程一次）：
+        worker.alive 变为 False（max_requests、SIGTERM、SIGHUP 回收）时开始排空；
+        常驻内存超过阈值时把 worker.alive 置为 False，走与 max_requests 相同的回收流程
+        """
+        if self._watcher is not None:
+            return
+
+        def _loop():
+            next_rss_check = 0.0
+            while worker.alive:
+                now = time.monotonic()
+                if now >= next_rss_check:
+                    next_rss_check = now + self.config["rss_check_interval"]
+                    if self.check_memory():
+                        worker.alive = False
+                        break
+                gevent.sleep(0.5)
+            max_requests = getattr(worker, "max_requests", 0)
+            if max_requests and getattr(worker, "nr", 0) >= max_requests:
+                self.begin("max_requests")
+            else:
+                self.begin("shutdown")
+
+        self._watcher = gevent.spawn(_loop)
@@ -0,0 +1,109 @@
+"""
+流式请求的首字节超时故障转移策略
+当 Dify 在截止时间内没有产生首个 message 事件，或在开始流式输出前返回 5xx/429 时，
+按模型配置依次切换到备用 API Key / 模型 / 上游
+"""
+
+import os
+import ast
+import json
+import logging
+from typing import Dict, List, Optional
+
+from key_pool import primary_key
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+FAILOVER_TOTAL = REGISTRY.counter(
+    "opendify_failover_total", "流式请求故障转移次数", ("model", "reason"))
+FAILOVER_EXHAUSTED = REGISTRY.counter(
+    "opendify_failover_exhausted_total", "所有备用目标均失败的流式请求数", ("model",))
+
+# 开始流式输出前出现这些状态码时触发故障转移
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TTFBDeadlineExceeded(Exception):
+    """首个 message 事件未在截止时间内到达"""
+
+
+def parse_failover_config(config_str: Optional[str] = None) -> Dict[str, dict]:
+    """
+    从环境变量 MODEL_FAILOVER_CONFIG（或给定的字符串）解析故障转移策略
+    格式与 MODEL_CONFIG 一致（Python 字典或 JSON），例如:
+    {"claude": {"ttfb_deadline": 8, "backups": [{"api_key": "app-b"}, {"model": "gpt-4"},
+                                                {"upstream": "https://dify-b/v1", "api_key": "app-c"}]}}
+    """
+    if config_str is None:
+        config_str = os.getenv('MODEL_FAILOVER_CONFIG', '')
+    config_str = config_str.strip()
+    if not config_str:
+        return {}
+    try:
+        result = ast.literal_eval(config_str)
+    except (SyntaxError, ValueError):
+        try:
+            result = json.loads(config_str)
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to parse MODEL_FAILOVER_CONFIG: {e}")
+            return {}
+    if not isinstance(result, dict):
+        logger.error("MODEL_FAILOVER_CONFIG must be a dictionary")
+        return {}
+    return result
+
+
+def validate_failover_config(failover_config: Dict[str, dict], model_to_api_key: Dict[str, str]) -> List[str]:
+    """检查故障转移配置，返回问题列表"""
+    issues = []
+    for model_name, policy in failover_config.items():
+        if model_name not in model_to_api_key:
+            issues.append(f"Failover policy for unknown model: {model_name}")
+            continue
+        if not isinstance(policy, dict):
+            issues.append(f"Failover policy must be a dictionary for model: {model_name}")
+            continue
+        for backup in policy.get("backups", []):
+            if not isinstance(backup, dict):
+                issues.append(f"Failover backup must be a dictionary for model: {model_name}")
+            elif "model" in backup and backup["model"] not in model_to_api_key:
+                issues.append(f"Failover backup references unknown model {backup['model']} for model: {model_name}")
+            elif not backup.get("api_key") and not backup.get("model"):
+                issues.append(f"Failover backup needs 'api_key' or 'model' for model: {model_name}")
+    return issues
+
+
+def build_attempts(model: str, api_key: str, upstream: str,
+                   failover_config: Dict[str, dict], model_to_api_key: Dict[str, str]) -> List[dict]:
+    """
+    生成按顺序尝试的目标列表，第一个始终是主目标
+    每个目标: {"api_key", "upstream", "model", "primary"}
+    """
+    attempts = [{"api_key": api_key, "upstream": upstream, "model": model, "primary": True}]
+    policy = failover_config.get(model) or {}
+    for backup in policy.get("backups", []):
+        backup_model = backup.get("model", model)
+        backup_key = backup.get("api_key") or primary_key(model_to_api_key.get(backup_model))
+        if not backup_key:
+            continue
+        attempts.append({
+            "api_key": backup_key,
+            "upstream": backup.get("upstream", upstream).rstrip("/"),
+            "model": backup_model,
+            "primary": False,
+        })
+    return attempts
+
+
+def ttfb_deadline_for(model: str, failover_config: Dict[str, dict]) -> Optional[float]:
+    """该模型的首字节截止时间（秒），未配置故障转移时返回 None"""
+    policy = failover_config.get(model)
+    if not policy or not policy.get("backups"):
+        return None
+    return float(policy.get("ttfb_deadline", os.getenv("FAILOVER_TTFB_DEADLINE", "10")))
+
+
+def record_failover(model: str, reason: str) -> None:
+    FAILOVER_TOTAL.inc(model=model, reason=reason)
+    logger.warning(f"🔀 Failing over streaming request for model {model}: {reason}")
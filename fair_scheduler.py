@@ -0,0 +1,220 @@
+"""
+按用户和模型的加权公平调度
+准入控制在名额释放时，不再按到达顺序而是按“已占用名额 / 权重”最小的用户优先唤醒，
+并可限制单个用户在全局 Dify 并发中的份额，避免某个用户或 API 集成挤占所有上游名额
+
+各工作进程的在途计数存放在共享内存文件（mmap）中：
+每个进程只写自己的槽位，读取时对所有存活进程的槽位求和；
+进程异常退出后，其槽位会在新进程（如 gunicorn 补起的工作进程）认领槽位时被清零
+"""
+
+import os
+import json
+import math
+import mmap
+import zlib
+import fcntl
+import logging
+from typing import Dict, Optional
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 64
+USER_BUCKETS = 1024
+MODEL_BUCKETS = 256
+_ROW_INTS = 1 + USER_BUCKETS + MODEL_BUCKETS   # [总数, 用户桶..., 模型桶...]
+_HEADER_BYTES = MAX_WORKERS * 8                 # 每个槽位的 pid (int64)
+_FILE_BYTES = _HEADER_BYTES + MAX_WORKERS * _ROW_INTS * 4
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+
+SCHEDULER_USER_CAPPED = REGISTRY.counter(
+    "opendify_scheduler_user_capped_total", "因超出用户份额而排队的次数", ("priority",))
+
+
+def _parse_weights(env_name: str) -> Dict[str, float]:
+    value = os.getenv(env_name, "").strip()
+    if not value:
+        return {}
+    try:
+        return {k: float(v) for k, v in json.loads(value).items()}
+    except (json.JSONDecodeError, AttributeError, ValueError) as e:
+        logger.error(f"Failed to parse {env_name}: {e}")
+        return {}
+
+
+def load_scheduler_config() -> dict:
+    """从环境变量读取调度配置"""
+    class_weights = {PRIORITY_INTERACTIVE: 4.0, PRIORITY_BATCH: 1.0}
+    class_weights.update(_parse_weights("SCHEDULER_CLASS_WEIGHTS"))
+    return {
+        "user_weights": _parse_weights("SCHEDULER_USER_WEIGHTS"),
+        "model_weights": _parse_weights("SCHEDULER_MODEL_WEIGHTS"),
+        "class_weights": class_weights,
+        # 全局（所有工作进程合计）的 Dify 并发预算与单个用户可占的份额，0 表示不限制
+        "global_concurrency": int(os.getenv("SCHEDULER_GLOBAL_CONCURRENCY", "0")),
+        "user_share": float(os.getenv("SCHEDULER_USER_SHARE", "0")),
+        "shm_path": os.getenv("SCHEDULER_SHM_PATH", "data/scheduler.shm"),
+    }
+
+
+class SharedCounters:
+    """基于 mmap 文件的跨进程在途计数"""
+
+    def __init__(self, path: str):
+        self.path = path
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size != _FILE_BYTES:
+                os.ftruncate(fd, _FILE_BYTES)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            self._mm = mmap.mmap(fd, _FILE_BYTES)
+        finally:
+            os.close(fd)
+        self._pids = memoryview(self._mm)[:_HEADER_BYTES].cast("q")
+        self._counts = memoryview(self._mm)[_HEADER_BYTES:].cast("i")
+        self._slot = None
+        self._slot_pid = None
+
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        if pid <= 0:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _clear_slot(self, slot: int) -> None:
+        base = slot * _ROW_INTS
+        for i in range(_ROW_INTS):
+            self._counts[base + i] = 0
+        self._pids[slot] = 0
+
+    def _claim_slot(self) -> int:
+        """为当前进程认领一个槽位，同时清零所有已退出进程遗留的槽位"""
+        pid = os.getpid()
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            free = None
+            for slot in range(MAX_WORKERS):
+                owner = self._pids[slot]
+                if owner and self._alive(owner):
+                    continue
+                if owner:
+                    self._clear_slot(slot)
+                if free is None:
+                    free = slot
+            if free is None:
+                raise RuntimeError(f"No free scheduler slot (more than {MAX_WORKERS} workers?)")
+            self._pids[free] = pid
+            self._slot, self._slot_pid = free, pid
+            return free
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _row_base(self) -> int:
+        if self._slot_pid != os.getpid():
+            self._claim_slot()
+        return self._slot * _ROW_INTS
+
+    def add(self, user_bucket: int, model_bucket: int, delta: int) -> None:
+        """更新本进程的计数（每个进程只写自己的槽位，无需加锁）"""
+        base = self._row_base()
+        self._counts[base] += delta
+        self._counts[base + 1 + user_bucket] += delta
+        self._counts[base + 1 + USER_BUCKETS + model_bucket] += delta
+
+    def _sum(self, offset: int) -> int:
+        total = 0
+        for slot in range(MAX_WORKERS):
+            if self._pids[slot]:
+                total += self._counts[slot * _ROW_INTS + offset]
+        return max(0, total)
+
+    def total(self) -> int:
+        return self._sum(0)
+
+    def user(self, user_bucket: int) -> int:
+        return self._sum(1 + user_bucket)
+
+    def model(self, model_bucket: int) -> int:
+        return self._sum(1 + USER_BUCKETS + model_bucket)
+
+
+class FairScheduler:
+    """为准入控制提供公平选择和用户份额上限"""
+
+    def __init__(self, config: Optional[dict] = None):
+        self.config = config or load_scheduler_config()
+        self.counters = SharedCounters(self.config["shm_path"])
+
+    @staticmethod
+    def _bucket(value: str, buckets: int) -> int:
+        return zlib.crc32((value or "").encode("utf-8")) % buckets
+
+    def user_weight(self, user: str) -> float:
+        return max(self.config["user_weights"].get(user, 1.0), 0.001)
+
+    def model_weight(self, model: str) -> float:
+        return max(self.config["model_weights"].get(model, 1.0), 0.001)
+
+    def class_weight(self, priority: str) -> float:
+        return max(self.config["class_weights"].get(priority, 1.0), 0.001)
+
+    def user_in_flight(self, user: str) -> int:
+        return self.counters.user(self._bucket(user, USER_BUCKETS))
+
+    def model_in_flight(self, model: str) -> int:
+        return self.counters.model(self._bucket(model, MODEL_BUCKETS))
+
+    def user_cap(self, user: str) -> int:
+        """用户在全局并发中的份额上限，0 表示不限制"""
+        budget = self.config["global_concurrency"]
+        share = self.config["user_share"]
+        if budget <= 0 or share <= 0:
+            return 0
+        return max(1, math.ceil(budget * share * self.user_weight(user)))
+
+    def user_capped(self, user: str) -> bool:
+        cap = self.user_cap(user)
+        return bool(cap) and self.user_in_flight(user) >= cap
+
+    def has_capacity(self, user: str, priority: str) -> bool:
+        """检查全局并发预算和用户份额（等待者每次轮询都会调用，不在这里计数）"""
+        budget = self.config["global_concurrency"]
+        if budget > 0 and self.counters.total() >= budget:
+            return False
+        return not self.user_capped(user)
+
+    def on_wait(self, user: str, priority: str) -> None:
+        """请求开始排队时调用一次：因超出用户份额而排队的计入指标"""
+        if self.user_capped(user):
+            SCHEDULER_USER_CAPPED.inc(priority=priority)
+
+    def score(self, user: str, model: str, priority: str) -> tuple:
+        """
+        调度优先级，越小越先被唤醒：
+        先比较用户已占用名额 / (用户权重 × 优先级类别权重)，再比较模型的加权占用
+        """
+        user_score = (self.user_in_flight(user) + 1) / (self.user_weight(user) * self.class_weight(priority))
+        model_score = (self.model_in_flight(model) + 1) / self.model_weight(model)
+        return (user_score, model_score)
+
+    def on_grant(self, user: str, model: str) -> None:
+        self.counters.add(self._bucket(user, USER_BUCKETS), self._bucket(model, MODEL_BUCKETS), 1)
+
+    def on_release(self, user: str, model: str) -> None:
+        self.counters.add(self._bucket(user, USER_BUCKETS), self._bucket(model, MODEL_BUCKETS), -1)
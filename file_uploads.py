@@ -0,0 +1,277 @@
+"""
+多模态消息的图片文件
+OpenAI 格式的消息内容可以是分片数组（text / image_url），Dify 的对话接口只接受文本 query 和 files：
+文本分片拼接为 query；http(s) 图片以 remote_url 方式引用，data URL 图片先上传到 Dify 再以 local_file 方式引用。
+
+上传前按图片内容的 SHA-256 查找已上传的文件（进程内 LRU + 工作进程共享的 SQLite，带 TTL），
+同一张图片对每个 Dify 应用只上传一次，而不是每轮对话都上传。
+base64 按块流式解码到临时文件（较小时留在内存）并同时计算哈希，不在内存中再保留一份完整的解码副本
+"""
+
+import os
+import re
+import time
+import base64
+import sqlite3
+import hashlib
+import logging
+import binascii
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+from metrics import REGISTRY
+from sqlite_pool import shared_pool
+
+logger = logging.getLogger(__name__)
+
+FILE_UPLOADS = REGISTRY.counter(
+    "opendify_file_uploads_total", "消息中 data URL 图片的处理结果（命中已上传文件或新上传）", ("result",))
+
+# 每次解码的 base64 字符数（4 的倍数）
+_DECODE_CHUNK = 64 * 1024
+# 解码结果超过该大小时写入磁盘临时文件
+_SPOOL_MAX_SIZE = 1024 * 1024
+
+# 带正确填充的 base64（与 b64decode(validate=True) 接受的内容一致，不允许空白）
+_BASE64 = re.compile(r"[A-Za-z0-9+/]*={0,2}")
+
+_EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png", "image/gif": "gif", "image/webp": "webp"}
+
+
+def load_upload_config() -> dict:
+    """从环境变量读取图片上传配置"""
+    return {
+        "cache_enabled": os.getenv("FILE_UPLOAD_CACHE", "true").strip().lower() in ("1", "true", "yes", "on"),
+        # Dify 会清理长期未使用的上传文件，缓存的文件 ID 只在该时间内复用
+        "cache_ttl": float(os.getenv("FILE_UPLOAD_CACHE_TTL", "86400")),
+        # 进程内 LRU 的条目数
+        "cache_size": int(os.getenv("FILE_UPLOAD_CACHE_SIZE", "1024")),
+        # SQLite 中保留的条目数，超出时删除最久未使用的
+        "cache_max_rows": int(os.getenv("FILE_UPLOAD_CACHE_MAX_ROWS", "100000")),
+        # 单张图片解码后的大小上限（Dify 默认的图片上传上限为 10MB）
+        "max_image_bytes": int(os.getenv("FILE_UPLOAD_MAX_IMAGE_BYTES", str(10 * 1024 * 1024))),
+    }
+
+
+class InvalidImageError(ValueError):
+    """消息中的图片格式不正确或超过大小上限"""
+
+
+def message_text(content) -> str:
+    """消息内容的文本部分：字符串原样返回，分片数组拼接其中的 text 分片"""
+    if isinstance(content, str):
+        return content
+    if not isinstance(content, list):
+        return "" if content is None else str(content)
+    return "\n".join(
+        part.get("text", "") for part in content
+        if isinstance(part, dict) and part.get("type") == "text"
+    )
+
+
+def image_urls(content) -> List[str]:
+    """消息内容中 image_url 分片的 URL"""
+    if not isinstance(content, list):
+        return []
+    urls = []
+    for part in content:
+        if not isinstance(part, dict) or part.get("type") != "image_url":
+            continue
+        image_url = part.get("image_url")
+        url = image_url.get("url") if isinstance(image_url, dict) else image_url
+        if isinstance(url, str):
+            urls.append(url)
+    return urls
+
+
+def _parse_data_url(url: str) -> Tuple[str, int]:
+    """返回 (MIME 类型, base64 数据的起始位置)"""
+    comma = url.find(",")
+    header = url[len("data:"):comma] if comma > 0 else ""
+    mime, _, encoding = header.partition(";")
+    if comma < 0 or encoding != "base64" or not mime.startswith("image/"):
+        raise InvalidImageError("Image data URLs must be base64 encoded images (data:image/...;base64,...)")
+    return mime, comma + 1
+
+
+def validate_image_urls(messages, max_bytes: int) -> None:
+    """在调用 Dify 之前检查最后一条消息中的图片，格式错误或过大时抛出 InvalidImageError"""
+    if not isinstance(messages, list) or not messages or not isinstance(messages[-1], dict):
+        return
+    for url in image_urls(messages[-1].get("content")):
+        if url.startswith(("http://", "https://")):
+            continue
+        if not url.startswith("data:"):
+            raise InvalidImageError("Image URLs must be http(s) or data URLs")
+        _, start = _parse_data_url(url)
+        if (len(url) - start) * 3 // 4 > max_bytes:
+            raise InvalidImageError(f"Image exceeds the {max_bytes} byte limit")
+        # 上传在开始向客户端输出之后才进行，数据错误必须在这里拒绝，否则流式请求只能在流中报错
+        if (len(url) - start) % 4 or not _BASE64.fullmatch(url, start):
+            raise InvalidImageError("Invalid base64 image data")
+
+
+class DecodedImage:
+    """流式解码后的图片：内容的哈希和可供上传读取的文件对象"""
+
+    def __init__(self, mime: str, digest: str, size: int, file):
+        self.mime = mime
+        self.digest = digest
+        self.size = size
+        self.file = file
+
+    @property
+    def filename(self) -> str:
+        return f"{self.digest[:16]}.{_EXTENSIONS.get(self.mime, 'bin')}"
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def decode_data_url(url: str, max_bytes: int) -> DecodedImage:
+    """按块解码 base64 图片，同时计算 SHA-256"""
+    mime, start = _parse_data_url(url)
+    spool = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        for offset in range(start, len(url), _DECODE_CHUNK):
+            chunk = base64.b64decode(url[offset:offset + _DECODE_CHUNK], validate=True)
+            size += len(chunk)
+            if size > max_bytes:
+                raise InvalidImageError(f"Image exceeds the {max_bytes} byte limit")
+            digest.update(chunk)
+            spool.write(chunk)
+    except InvalidImageError:
+        spool.close()
+        raise
+    except binascii.Error as e:
+        spool.close()
+        raise InvalidImageError(f"Invalid base64 image data: {e}")
+    spool.seek(0)
+    return DecodedImage(mime, digest.hexdigest(), size, spool)
+
+
+class UploadCache:
+    """内容哈希 -> Dify upload_file_id，按应用（上游 + Key）区分"""
+
+    def __init__(self, db_path: str, config: Optional[dict] = None):
+        self.db_path = db_path
+        self.config = config or load_upload_config()
+        self._lock = threading.Lock()
+        # (应用, 哈希) -> (upload_file_id, 上传时间)
+        self._memory: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+        self._db = shared_pool(db_path, timeout=5.0)
+        self._db.ensure_schema(
+            '''
+            CREATE TABLE IF NOT EXISTS file_upload_cache (
+                app TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                upload_file_id TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (app, digest)
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_file_upload_cache_last_used ON file_upload_cache(last_used)',
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.config["cache_enabled"]
+
+    def get(self, app: str, digest: str) -> Optional[str]:
+        """查找未过期的已上传文件，先查进程内 LRU，再查 SQLite（其他工作进程上传的）"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        key = (app, digest)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry[1] < self.config["cache_ttl"]:
+                    self._memory.move_to_end(key)
+                    return entry[0]
+                del self._memory[key]
+
+        try:
+            with self._db.connection() as conn:
+                row = conn.execute(
+                    'SELECT upload_file_id, created_at FROM file_upload_cache WHERE app = ? AND digest = ? AND created_at > ?',
+                    (app, digest, now - self.config["cache_ttl"])
+                ).fetchone()
+                if row:
+                    conn.execute('UPDATE file_upload_cache SET last_used = ? WHERE app = ? AND digest = ?',
+                                 (now, app, digest))
+                    conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ File upload cache lookup failed: {e}")
+            return None
+        if not row:
+            return None
+        self._remember(key, row[0], row[1])
+        return row[0]
+
+    def put(self, app: str, digest: str, upload_file_id: str) -> None:
+        """记录新上传的文件，并清理过期和超出数量的条目"""
+        if not self.enabled:
+            return
+        now = time.time()
+        self._remember((app, digest), upload_file_id, now)
+        try:
+            with self._db.connection() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO file_upload_cache (app, digest, upload_file_id, created_at, last_used) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (app, digest, upload_file_id, now, now)
+                )
+                conn.execute('DELETE FROM file_upload_cache WHERE created_at <= ?', (now - self.config["cache_ttl"],))
+                conn.execute('''
+                    DELETE FROM file_upload_cache WHERE rowid IN (
+                        SELECT rowid FROM file_upload_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                    )
+                ''', (self.config["cache_max_rows"],))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ File upload cache write failed: {e}")
+
+    def _remember(self, key: Tuple[str, str], upload_file_id: str, created_at: float) -> None:
+        with self._lock:
+            self._memory[key] = (upload_file_id, created_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.config["cache_size"]:
+                self._memory.popitem(last=False)
+
+    def clear(self) -> None:
+        """清空进程内缓存（测试或 fork 之后使用）"""
+        with self._lock:
+            self._memory.clear()
+
+
+def resolve_image_files(urls: List[str], app: str, cache: UploadCache,
+                        upload: Callable[[DecodedImage], str]) -> List[dict]:
+    """
+    把图片 URL 转换为 Dify 的 files 参数
+    data URL 先按内容哈希查找已上传的文件，没有时调用 upload 上传并记录返回的 upload_file_id
+    """
+    files = []
+    for url in urls:
+        if not url.startswith("data:"):
+            files.append({"type": "image", "transfer_method": "remote_url", "url": url})
+            continue
+        image = decode_data_url(url, cache.config["max_image_bytes"])
+        try:
+            upload_file_id = cache.get(app, image.digest)
+            if upload_file_id is None:
+                upload_file_id = upload(image)
+                cache.put(app, image.digest, upload_file_id)
+                FILE_UPLOADS.inc(result="uploaded")
+                logger.info(f"🖼️ Uploaded image {image.digest[:12]} ({image.size} bytes) to Dify as {upload_file_id}")
+            else:
+                FILE_UPLOADS.inc(result="cache_hit")
+        finally:
+            image.close()
+        files.append({"type": "image", "transfer_method": "local_file", "upload_file_id": upload_file_id})
+    return files
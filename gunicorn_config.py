@@ -5,6 +5,7 @@ Gunicorn 配置文件
 """
 
 import os
+import sys
 import multiprocessing
 
 # 服务器配置
@@ -15,10 +16,13 @@ backlog = 2048
 workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
 worker_class = "gevent"  # 使用 gevent 异步工作进程，适合 I/O 密集型应用
 worker_connections = 1000
-max_requests = 1000
+# 按请求数回收工作进程，0 表示关闭（可改用 WORKER_MAX_RSS_MB 按内存回收）
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '1000'))
 max_requests_jitter = 50
 timeout = 30
 keepalive = 2
+# 回收或关闭工作进程时等待在途请求（长 SSE 流）结束的时间，与 main.py 的排空截止时间一致
+graceful_timeout = int(os.getenv('DRAIN_TIMEOUT', '60'))
 
 # 重启配置
 preload_app = True
@@ -54,10 +58,39 @@ def on_reload(server):
     """重载时的钩子"""
     server.log.info("🔄 OpenDify 服务重载中...")
 
+def post_fork(server, worker):
+    """工作进程 fork 之后的钩子：重建从 master 继承的进程内资源"""
+    # 仅在 preload_app 模式下应用已在 master 中导入
+    main = sys.modules.get('main')
+    if main is not None:
+        main.reinit_after_fork()
+
+def post_worker_init(worker):
+    """工作进程初始化完成、开始接受请求之前的钩子：执行预热"""
+    main = sys.modules.get('main')
+    if main is None:
+        return
+    try:
+        main.warmup_worker()
+    except Exception as e:
+        worker.log.warning(f"⚠️ 工作进程 {worker.pid} 预热失败: {e}")
+    # 监视回收/关闭信号和内存阈值，开始排空时停止接收新的对话请求
+    main.worker_drain.watch_worker(worker)
+    worker.log.info(f"✅ 工作进程 {worker.pid} 已就绪")
+
 def worker_int(worker):
     """工作进程中断时的钩子"""
     worker.log.info(f"👷 工作进程 {worker.pid} 接收到中断信号")
 
+def worker_exit(server, worker):
+    """工作进程退出前的钩子：等待在途请求结束（最多到排空截止时间）并执行收尾操作"""
+    main = sys.modules.get('main')
+    if main is None:
+        return
+    drained = main.worker_drain.finish()
+    if not drained:
+        worker.log.warning(f"⚠️ 工作进程 {worker.pid} 排空超时，仍有请求未完成")
+
 def on_exit(server):
     """服务器退出时的钩子"""
     server.log.info("👋 OpenDify 服务已停止")
@@ -76,5 +109,5 @@ elif os.getenv('ENVIRONMENT') == 'production':
     # 生产环境配置
     workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
     preload_app = True
-    max_requests = 2000
+    max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '2000'))
     timeout = 60
\ No newline at end of file
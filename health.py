@@ -0,0 +1,90 @@
+"""
+存活与就绪检查
+就绪状态由后台 greenlet 定期计算（数据库可达、预热完成、熔断状态），
+结果预先编码为字节保存在内存中，/readyz 直接返回，不做任何 I/O 也不写日志
+"""
+
+import os
+import json
+import time
+import logging
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import gevent
+
+logger = logging.getLogger(__name__)
+
+
+def load_health_config() -> dict:
+    """从环境变量读取就绪检查配置"""
+    return {
+        "interval": float(os.getenv("READYZ_INTERVAL", "5")),
+        # 所有上游目标都处于熔断状态时是否报告未就绪（默认只在响应中标明，避免所有实例同时被摘除）
+        "require_upstream": os.getenv("READYZ_REQUIRE_UPSTREAM", "false").strip().lower() in ("1", "true", "yes", "on"),
+    }
+
+
+class HealthMonitor:
+    """
+    定期执行检查并缓存结果
+    checks 中的每一项返回 bool，required 中的检查全部通过才算就绪，其余只在响应中展示
+    """
+
+    def __init__(self, checks: Dict[str, Callable[[], bool]], required: Iterable[str],
+                 config: Optional[dict] = None):
+        self.checks = checks
+        self.required = set(required)
+        self.config = config or load_health_config()
+        self._snapshot: Optional[Tuple[bytes, int]] = None
+        self._ready: Optional[bool] = None
+        self._greenlet = None
+
+    def refresh(self) -> Tuple[bytes, int]:
+        """执行一次全部检查并更新缓存的响应"""
+        results = {}
+        for name, check in self.checks.items():
+            try:
+                results[name] = bool(check())
+            except Exception as e:
+                logger.debug(f"Health check {name} failed: {e}")
+                results[name] = False
+        ready = all(results[name] for name in self.required if name in results)
+        body = json.dumps({
+            "status": "ready" if ready else "not_ready",
+            "checks": results,
+            "pid": os.getpid(),
+            "checked_at": int(time.time()),
+        }).encode("utf-8")
+        self._snapshot = (body, 200 if ready else 503)
+
+        # 只在状态变化时写日志
+        if self._ready is not None and ready != self._ready:
+            if ready:
+                logger.info(f"💚 Worker {os.getpid()} is ready again")
+            else:
+                failed = ", ".join(name for name in sorted(self.required) if not results.get(name))
+                logger.warning(f"💔 Worker {os.getpid()} is not ready ({failed})")
+        self._ready = ready
+        return self._snapshot
+
+    def snapshot(self) -> Tuple[bytes, int]:
+        """返回缓存的 (响应体, 状态码)，尚未计算过时同步计算一次"""
+        return self._snapshot or self.refresh()
+
+    def start(self) -> None:
+        """启动后台检查（每个工作进程一次）"""
+        if self._greenlet is not None:
+            return
+
+        def _loop():
+            while True:
+                self.refresh()
+                gevent.sleep(self.config["interval"])
+
+        self._greenlet = gevent.spawn(_loop)
+
+    def reset(self) -> None:
+        """丢弃 master 计算的就绪结果（其中的 pid 不是本进程），检查循环由 start() 重新启动"""
+        self._snapshot = None
+        self._ready = None
+        self._greenlet = None
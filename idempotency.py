@@ -0,0 +1,296 @@
+"""
+/v1/chat/completions 的幂等处理
+客户端或中间代理重试时，相同幂等键的请求不再触发新的 Dify 生成：
+- 流式请求：上游流由后台 greenlet 读取并写入缓冲区，每个客户端都是订阅者，
+  重复请求从头重放缓冲区并继续接收后续分片，原客户端断开不影响其他订阅者
+- 非流式请求：重复请求等待第一个请求的结果
+- 成功完成的结果保留一小段时间，期间的重试直接返回缓存结果
+- 流的输出超过重放缓冲区上限后不再缓存，丢弃所有订阅者都已读取的分片，之后到达的重复请求得到 409
+
+幂等键来自 Idempotency-Key 请求头；IDEMPOTENCY_MODE=auto 时，
+没有请求头的请求用 chat_id + 最后一条消息的哈希作为键。键按用户、模型和流式模式隔离。
+状态只在工作进程内维护，不同工作进程收到的重复请求不会合并
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterator, List, Optional
+
+import gevent
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+MODE_OFF = "off"
+MODE_HEADER = "header"
+MODE_AUTO = "auto"
+
+IDEMPOTENT_REQUESTS = REGISTRY.counter(
+    "opendify_idempotent_requests_total",
+    "带幂等键的请求（leader=触发上游调用，joined=加入进行中的请求，replayed=命中已完成的结果，"
+    "conflict=进行中的流已无法重放）",
+    ("result",))
+
+_ERROR_PREFIX = b'data: {"error"'
+
+
+def load_idempotency_config() -> dict:
+    """从环境变量读取幂等配置"""
+    mode = os.getenv("IDEMPOTENCY_MODE", MODE_HEADER).strip().lower()
+    if mode not in (MODE_OFF, MODE_HEADER, MODE_AUTO):
+        logger.warning(f"Unknown IDEMPOTENCY_MODE '{mode}', using '{MODE_HEADER}'")
+        mode = MODE_HEADER
+    return {
+        "mode": mode,
+        # 成功完成的结果保留时间（秒）
+        "result_ttl": float(os.getenv("IDEMPOTENCY_RESULT_TTL", "30")),
+        # 单个流的重放缓冲区上限，超出后不再接受新的订阅者，也不缓存结果
+        "max_buffer_bytes": int(os.getenv("IDEMPOTENCY_MAX_BUFFER_BYTES", str(1024 * 1024))),
+        # 同时保留的已完成结果数
+        "max_entries": int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "1000")),
+    }
+
+
+def idempotency_key(mode: str, header_key: Optional[str], user: str, model: str, stream: bool,
+                    chat_id: Optional[str] = None, messages: Optional[list] = None) -> Optional[str]:
+    """计算幂等键；不适用时返回 None"""
+    if mode == MODE_OFF:
+        return None
+    if header_key:
+        source = ["header", header_key.strip()]
+    elif mode == MODE_AUTO and chat_id and messages:
+        source = ["chat", chat_id, messages[-1]]
+    else:
+        return None
+    material = json.dumps([user, model, bool(stream)] + source, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    """一次上游调用的结果：流式为分片缓冲区，非流式为单个结果"""
+
+    def __init__(self, key: str, stream: bool, max_buffer_bytes: int):
+        self.key = key
+        self.stream = stream
+        self.max_buffer_bytes = max_buffer_bytes
+        # chunks[0] 的序号：超出缓冲区上限后，所有订阅者都已读取的分片从头部丢弃
+        self.chunks: List[bytes] = []
+        self.offset = 0
+        self.buffered_bytes = 0
+        self.replayable = True
+        self.result = None
+        self.headers = None
+        self.done = False
+        self.failed = False
+        self.completed_at = 0.0
+        self._subscriptions: List["Subscription"] = []
+        self._cond = threading.Condition()
+
+    @property
+    def joinable(self) -> bool:
+        """缓冲区仍完整（可以从头重放）"""
+        return self.replayable
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscriptions)
+
+    @property
+    def abandoned(self) -> bool:
+        """所有订阅者都已断开"""
+        return self.subscribers == 0 and not self.done
+
+    def start(self, headers: list) -> None:
+        """流式响应已建立，记录响应头供后加入的订阅者使用"""
+        with self._cond:
+            self.headers = headers
+            self._cond.notify_all()
+
+    def wait_started(self) -> None:
+        """等待流式响应建立或调用结束（结束时可能只有错误结果）"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.headers is not None or self.done)
+
+    def append(self, chunk) -> None:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        with self._cond:
+            self.chunks.append(chunk)
+            self.buffered_bytes += len(chunk)
+            if self.replayable and self.buffered_bytes > self.max_buffer_bytes:
+                self.replayable = False
+                logger.info(f"📼 Idempotent stream {self.key[:8]} exceeded the replay buffer, "
+                            f"new duplicates will be rejected")
+            if not self.replayable:
+                self._trim()
+            if chunk.startswith(_ERROR_PREFIX):
+                self.failed = True
+            self._cond.notify_all()
+
+    def _trim(self) -> None:
+        """丢弃所有订阅者都已读取的分片（调用方持有锁）"""
+        end = self.offset + len(self.chunks)
+        drop = min((s._index for s in self._subscriptions), default=end) - self.offset
+        if drop > 0:
+            self.buffered_bytes -= sum(len(c) for c in self.chunks[:drop])
+            del self.chunks[:drop]
+            self.offset += drop
+
+    def finish(self, result=None, failed: bool = False) -> None:
+        with self._cond:
+            self.result = result
+            self.failed = self.failed or failed
+            self.done = True
+            self.completed_at = time.time()
+            self._cond.notify_all()
+
+    def wait(self) -> None:
+        with self._cond:
+            self._cond.wait_for(lambda: self.done)
+
+    def subscribe(self) -> Optional["Subscription"]:
+        """从头重放已缓冲的分片，再继续接收新分片直到流结束；缓冲区已不完整时返回 None"""
+        with self._cond:
+            if not self.replayable:
+                return None
+            subscription = Subscription(self)
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription: "Subscription") -> None:
+        with self._cond:
+            self._subscriptions.remove(subscription)
+            if not self.replayable:
+                self._trim()
+
+
+class Subscription:
+    """一个客户端对 Flight 的订阅；WSGI 服务器在响应结束或客户端断开时调用 close"""
+
+    def __init__(self, flight: Flight):
+        self._flight = flight
+        self._index = 0
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        flight = self._flight
+        if not self._closed:
+            with flight._cond:
+                flight._cond.wait_for(lambda: flight.done or self._index < flight.offset + len(flight.chunks))
+                if self._index < flight.offset + len(flight.chunks):
+                    chunk = flight.chunks[self._index - flight.offset]
+                    self._index += 1
+                    if not flight.replayable:
+                        flight._trim()
+                    return chunk
+        self.close()
+        raise StopIteration
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._flight._unsubscribe(self)
+
+
+class IdempotencyStore:
+    """工作进程内的幂等记录：进行中的调用和短期保留的已完成结果"""
+
+    def __init__(self, config: Optional[dict] = None):
+        self.config = config or load_idempotency_config()
+        self._lock = threading.Lock()
+        self._flights: "OrderedDict[str, Flight]" = OrderedDict()
+
+    @property
+    def mode(self) -> str:
+        return self.config["mode"]
+
+    def _usable(self, flight: Flight, now: float) -> bool:
+        if not flight.done:
+            return flight.joinable
+        return not flight.failed and flight.joinable and now - flight.completed_at < self.config["result_ttl"]
+
+    def join_or_start(self, key: str, stream: bool):
+        """
+        返回 (flight, leader)
+        leader=True 时调用方负责执行请求并写入结果，否则直接读取该 flight（flight.subscribe() 可能返回 None）
+        """
+        now = time.time()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and self._usable(flight, now):
+                IDEMPOTENT_REQUESTS.inc(result="joined" if not flight.done else "replayed")
+                return flight, False
+            if flight is not None and not flight.done and not flight.joinable:
+                # 原调用仍在进行但无法从头重放：不能再发起一次生成，由调用方拒绝
+                IDEMPOTENT_REQUESTS.inc(result="conflict")
+                return flight, False
+            flight = Flight(key, stream, self.config["max_buffer_bytes"])
+            self._flights[key] = flight
+            self._flights.move_to_end(key)
+            self._evict(now)
+        IDEMPOTENT_REQUESTS.inc(result="leader")
+        return flight, True
+
+    def _evict(self, now: float) -> None:
+        """清理过期或失败的已完成结果，并限制保留数量（进行中的调用不清理）"""
+        for key in list(self._flights):
+            flight = self._flights[key]
+            if flight.done and not self._usable(flight, now):
+                del self._flights[key]
+        excess = len(self._flights) - self.config["max_entries"]
+        for key in list(self._flights):
+            if excess <= 0:
+                break
+            if self._flights[key].done:
+                del self._flights[key]
+                excess -= 1
+
+    def complete(self, flight: Flight, result=None, failed: bool = False) -> None:
+        """非流式调用结束：唤醒等待者，失败的结果不保留"""
+        flight.finish(result, failed)
+        if failed:
+            self._discard(flight)
+
+    def _discard(self, flight: Flight) -> None:
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def pump(self, flight: Flight, source: Iterator, close: Callable[[], None]) -> gevent.Greenlet:
+        """
+        在后台 greenlet 中读取上游流写入 flight
+        所有订阅者断开后停止读取并调用 close（关闭原生成器，通知 Dify 停止生成并归还名额）
+        """
+        def _run():
+            try:
+                for chunk in source:
+                    flight.append(chunk)
+                    if flight.abandoned:
+                        logger.info(f"🛑 All subscribers of idempotent stream {flight.key[:8]} disconnected")
+                        break
+            except Exception as e:
+                logger.error(f"Idempotent stream {flight.key[:8]} failed: {e}")
+                flight.failed = True
+            finally:
+                try:
+                    close()
+                finally:
+                    flight.finish(failed=flight.abandoned)
+                    if flight.failed:
+                        self._discard(flight)
+
+        return gevent.spawn(_run)
+
+    def reset(self) -> None:
+        """fork 之后清空本进程的记录"""
+        self._lock = threading.Lock()
+        self._flights = OrderedDict()
@@ -0,0 +1,179 @@
+"""
+按模型管理多个 Dify 应用 API Key
+MODEL_CONFIG 中一个模型可以配置多个 Key（各带权重），请求选择加权在途数最少的 Key；
+上游返回 429 时按 Retry-After 暂停（停放）该 Key，并按 Key 统计延迟和错误
+"""
+
+import os
+import math
+import time
+import random
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+from circuit_breaker import key_fingerprint
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+KEY_IN_FLIGHT = REGISTRY.gauge(
+    "opendify_api_key_in_flight", "各 API Key 的在途请求数", ("model", "key"))
+KEY_REQUESTS = REGISTRY.counter(
+    "opendify_api_key_requests_total", "各 API Key 的上游调用结果", ("model", "key", "result"))
+KEY_LATENCY = REGISTRY.histogram(
+    "opendify_api_key_latency_seconds", "各 API Key 的首字节（流式）或完整响应（非流式）延迟", ("model", "key"))
+KEY_PARKED = REGISTRY.counter(
+    "opendify_api_key_parked_total", "因上游 429 暂停 API Key 的次数", ("model", "key"))
+
+
+class KeysExhausted(Exception):
+    """模型的所有 API Key 都因限流暂停"""
+
+    def __init__(self, model: str, retry_after: int):
+        super().__init__(f"All API keys for model {model} are rate limited")
+        self.model = model
+        self.retry_after = retry_after
+
+
+def parse_key_entries(value) -> List[dict]:
+    """
+    将 MODEL_CONFIG 中某个模型的值规范化为 [{"key", "weight"}]
+    支持 "app-xxx"、["app-a", "app-b"] 以及 [{"key": "app-a", "weight": 2}, ...]
+    """
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, (list, tuple)):
+        return []
+    entries = []
+    for item in value:
+        if isinstance(item, str):
+            key, weight = item, 1.0
+        elif isinstance(item, dict):
+            key, weight = item.get("key") or item.get("api_key"), item.get("weight", 1.0)
+        else:
+            continue
+        try:
+            weight = float(weight)
+        except (TypeError, ValueError):
+            continue
+        if isinstance(key, str) and key.strip() and weight > 0:
+            entries.append({"key": key.strip(), "weight": weight})
+    return entries
+
+
+def primary_key(value) -> Optional[str]:
+    """模型的第一个 Key（单 Key 时代创建的会话都属于它）"""
+    entries = parse_key_entries(value)
+    return entries[0]["key"] if entries else None
+
+
+def parse_retry_after(value: Optional[str], default: float) -> float:
+    """解析 Retry-After 头（秒数），无效时使用默认值"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+class KeyLease:
+    """占用某个 Key 的一个在途名额，release 可重复调用"""
+
+    def __init__(self, pool: "KeyPool", model: str, api_key: str, pinned: bool):
+        self._pool = pool
+        self.model = model
+        self.api_key = api_key
+        self.key_id = pool.key_id(api_key)
+        # 是否命中会话原来使用的 Key
+        self.pinned = pinned
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._pool._release(self.model, self.api_key)
+
+
+class KeyPool:
+    """工作进程内的多 Key 选择器"""
+
+    def __init__(self, park_seconds: Optional[float] = None):
+        self.park_seconds = float(park_seconds if park_seconds is not None
+                                  else os.getenv("API_KEY_PARK_SECONDS", "30"))
+        self._lock = threading.Lock()
+        self._outstanding: Dict[str, int] = {}
+        self._parked_until: Dict[str, float] = {}
+        self._fingerprints: Dict[str, str] = {}
+
+    def key_id(self, api_key: str) -> str:
+        """Key 的指纹，用于写入会话映射和指标标签"""
+        fingerprint = self._fingerprints.get(api_key)
+        if fingerprint is None:
+            fingerprint = self._fingerprints[api_key] = key_fingerprint(api_key)
+        return fingerprint
+
+    def parked_for(self, api_key: str) -> float:
+        """Key 剩余的停放时间（秒），0 表示可用"""
+        return max(0.0, self._parked_until.get(api_key, 0.0) - time.time())
+
+    def select(self, model: str, config_value, pinned_key_id: Optional[str] = None,
+               is_available: Optional[Callable[[str], bool]] = None) -> KeyLease:
+        """
+        为请求选择 Key 并占用一个在途名额
+        会话已绑定 Key 时始终使用该 Key（Dify 会话属于创建它的应用）；
+        否则在未停放的 Key 中选择 (在途数 + 1) / 权重 最小者，优先跳过 is_available 判定不可用的 Key
+        """
+        entries = parse_key_entries(config_value)
+        if not entries:
+            raise ValueError(f"No API key configured for model {model}")
+
+        with self._lock:
+            if pinned_key_id:
+                for entry in entries:
+                    if self.key_id(entry["key"]) == pinned_key_id:
+                        return self._lease(model, entry["key"], pinned=True)
+
+            candidates = [e for e in entries if self.parked_for(e["key"]) <= 0]
+            if not candidates:
+                retry_after = min(self.parked_for(e["key"]) for e in entries)
+                raise KeysExhausted(model, max(1, math.ceil(retry_after)))
+            if is_available is not None and len(candidates) > 1:
+                candidates = [e for e in candidates if is_available(e["key"])] or candidates
+
+            best = min(
+                candidates,
+                key=lambda e: ((self._outstanding.get(e["key"], 0) + 1) / e["weight"], random.random())
+            )
+            return self._lease(model, best["key"], pinned=False)
+
+    def _lease(self, model: str, api_key: str, pinned: bool) -> KeyLease:
+        self._outstanding[api_key] = self._outstanding.get(api_key, 0) + 1
+        KEY_IN_FLIGHT.inc(model=model, key=self.key_id(api_key))
+        return KeyLease(self, model, api_key, pinned)
+
+    def _release(self, model: str, api_key: str) -> None:
+        with self._lock:
+            self._outstanding[api_key] = max(0, self._outstanding.get(api_key, 0) - 1)
+            KEY_IN_FLIGHT.dec(model=model, key=self.key_id(api_key))
+
+    def park(self, model: str, api_key: str, retry_after: Optional[str] = None) -> float:
+        """上游返回 429 时暂停该 Key，返回停放秒数"""
+        seconds = parse_retry_after(retry_after, self.park_seconds)
+        with self._lock:
+            self._parked_until[api_key] = max(self._parked_until.get(api_key, 0.0), time.time() + seconds)
+        KEY_PARKED.inc(model=model, key=self.key_id(api_key))
+        logger.warning(f"🅿️ API key {self.key_id(api_key)} for model {model} rate limited, parked for {seconds:.0f}s")
+        return seconds
+
+    def record(self, model: str, api_key: str, result: str, latency: Optional[float] = None) -> None:
+        """记录一次上游调用结果：success / error / rate_limited"""
+        key_id = self.key_id(api_key)
+        KEY_REQUESTS.inc(model=model, key=key_id, result=result)
+        if latency is not None:
+            KEY_LATENCY.observe(latency, model=model, key=key_id)
+
+    def reset(self) -> None:
+        """fork 之后清空本进程的计数"""
+        self._lock = threading.Lock()
+        self._outstanding = {}
+        self._parked_until = {}
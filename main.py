@@ -1,16 +1,26 @@
 # 必须放在所有import之前!
 from gevent import monkey
 # 现在使用 SQLite 数据库，可以安全地 patch 所有模块
-monkey.patch_all()
+# os / signal 除外：preload_app 模式下本模块在 gunicorn master 中导入，patch 后 master 收不到 SIGCHLD，
+# 回收的工作进程要等到 timeout 才被清理和替换；gevent 工作进程 fork 后会自行完整 patch
+monkey.patch_all(os=False, signal=False)
 
 import json
 import logging
-from flask import Flask, request, Response, stream_with_context
+from flask import Flask, request, Response, stream_with_context, g
+from werkzeug.wsgi import ClosingIterator
 import httpx
 import time
 from dotenv import load_dotenv
 import os
 import ast
+import codecs
+import hashlib
+import itertools
+import uuid
+import threading
+import gevent
+from contextlib import ExitStack
 from typing import Dict, Optional
 
 # 配置日志
@@ -28,17 +38,49 @@ load_dotenv()
 
 # 导入SQLite版本的ConversationMapper
 from conversation_mapper_sqlite import ConversationMapper
+from metrics import REGISTRY
+from admission import AdmissionController, AdmissionRejected
+from fair_scheduler import FairScheduler, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from circuit_breaker import CircuitBreaker, CircuitOpenError, key_fingerprint
+from key_pool import KeyPool, KeysExhausted, parse_key_entries, primary_key
+from upstream_balancer import UpstreamBalancer, parse_upstream_list, parse_model_upstreams
+from adaptive_limit import AdaptiveLimiter, ConcurrencyLimitExceeded
+from chat_singleflight import ChatSingleflight, ChatLock
+from idempotency import IdempotencyStore, idempotency_key
+from response_cache import create_response_cache
+from health import HealthMonitor, load_health_config
+from config_reload import ConfigReloader, RELOADABLE_KEYS
+from drain import WorkerDrain
+from sse_heartbeat import (
+    Heartbeats, HEARTBEAT, PING, SSE_HEARTBEATS, load_heartbeat_config, progress_extension, pump_events
+)
+from deadline import DeadlinePolicy, DeadlineExceeded, load_deadline_config
+from output_limits import OutputLimiter, OUTPUT_LIMIT_STOPS
+from usage_accounting import UsageAccounting, usage_from_dify, estimate_usage
+from traffic_capture import TrafficCapture
+from conversation_index import ConversationIndex
+from file_uploads import (
+    UploadCache, InvalidImageError, message_text, image_urls, validate_image_urls, resolve_image_files
+)
+from failover import (
+    TTFBDeadlineExceeded, RETRYABLE_STATUS_CODES, FAILOVER_EXHAUSTED,
+    parse_failover_config, validate_failover_config, build_attempts, ttfb_deadline_for, record_failover
+)
+from upstream_pool import (
+    UpstreamPool, PoolExhaustedError, UPSTREAM_POOL_EXHAUSTED, load_pool_config, parse_upstream_overrides
+)
 
 # 全局会话映射器实例 - 使用SQLite数据库存储
 conversation_mapper = ConversationMapper("data/conversation_mappings.db")
 
-def parse_model_config():
+def parse_model_config(config_str=None):
     """
-    从环境变量解析模型配置
-    返回一个字典 {model_name: api_key}
+    从环境变量（或给定的字符串）解析模型配置
+    返回一个字典 {model_name: api_key}，api_key 也可以是多个 Key 的列表（见 key_pool.parse_key_entries）
     """
     try:
-        config_str = os.getenv('MODEL_CONFIG', '{}')
+        if config_str is None:
+            config_str = os.getenv('MODEL_CONFIG', '{}')
         if not config_str.strip():
             logger.warning("MODEL_CONFIG is empty, no models will be available")
             return {}
@@ -66,6 +108,18 @@ def parse_model_config():
         logger.error(f"Error parsing MODEL_CONFIG: {e}")
         return {}
 
+def collect_model_config_issues(model_to_api_key, failover_config):
+    """检查模型配置和故障转移配置，返回问题列表（启动校验和热更新共用）"""
+    issues = []
+    if not model_to_api_key:
+        issues.append("No valid models configured in MODEL_CONFIG")
+    else:
+        for model_name, api_key in model_to_api_key.items():
+            if not parse_key_entries(api_key):
+                issues.append(f"Empty or invalid API key config for model: {model_name}")
+    issues.extend(validate_failover_config(failover_config, model_to_api_key))
+    return issues
+
 def validate_startup_config():
     """验证启动配置"""
     issues = []
@@ -74,18 +128,12 @@ def validate_startup_config():
     dify_api_base = os.getenv("DIFY_API_BASE", "")
     if not dify_api_base.strip():
         issues.append("DIFY_API_BASE is not set or empty")
-    elif not (dify_api_base.startswith("http://") or dify_api_base.startswith("https://")):
-        issues.append(f"DIFY_API_BASE must be a valid URL, got: {dify_api_base}")
+    for upstream in parse_upstream_list(dify_api_base) + [u for us in MODEL_UPSTREAMS.values() for u in us]:
+        if not (upstream.startswith("http://") or upstream.startswith("https://")):
+            issues.append(f"DIFY_API_BASE must be a valid URL, got: {upstream}")
     
-    # 检查模型配置
-    if not MODEL_TO_API_KEY:
-        issues.append("No valid models configured in MODEL_CONFIG")
-    else:
-        for model_name, api_key in MODEL_TO_API_KEY.items():
-            if not api_key or not api_key.strip():
-                issues.append(f"Empty API key for model: {model_name}")
-            elif not isinstance(api_key, str):
-                issues.append(f"API key must be string for model: {model_name}")
+    # 检查模型配置和故障转移配置
+    issues.extend(collect_model_config_issues(MODEL_TO_API_KEY, FAILOVER_CONFIG))
     
     # 报告问题
     if issues:
@@ -100,59 +148,342 @@ def validate_startup_config():
     logger.info(f"✅ Dify API base: {dify_api_base}")
     return True
 
+def build_available_models(model_to_api_key):
+    """根据模型配置生成模型信息"""
+    return [
+        {
+            "id": model_id,
+            "object": "model",
+            "created": int(time.time()),
+            "owned_by": "dify"
+        }
+        for model_id, api_key in model_to_api_key.items()
+        if api_key is not None  # 只包含配置了API Key的模型
+    ]
+
 # 从环境变量获取配置
+# 以下三项构成模型配置快照，热更新时整体替换（见 apply_model_config_snapshot），不会原地修改
 MODEL_TO_API_KEY = parse_model_config()
 
+# 流式请求的故障转移策略（与 MODEL_CONFIG 并列配置）
+FAILOVER_CONFIG = parse_failover_config()
+
 # 根据MODEL_TO_API_KEY自动生成模型信息
-AVAILABLE_MODELS = [
-    {
-        "id": model_id,
-        "object": "model",
-        "created": int(time.time()),
-        "owned_by": "dify"
-    }
-    for model_id, api_key in MODEL_TO_API_KEY.items()
-    if api_key is not None  # 只包含配置了API Key的模型
-]
+AVAILABLE_MODELS = build_available_models(MODEL_TO_API_KEY)
+
+# 当前快照对应的原始配置字符串，用于判断热更新时配置是否变化
+_model_config_source = {key: os.getenv(key, "") for key in RELOADABLE_KEYS}
 
 app = Flask(__name__)
 
-# 从环境变量获取API基础URL
+# 从环境变量获取API基础URL（可以是逗号分隔的多个 Dify API 副本）
 DIFY_API_BASE = os.getenv("DIFY_API_BASE", "https://mify-be.pt.xiaomi.com/api/v1")
 
-# 全局HTTP客户端配置
-HTTP_CLIENT_CONFIG = {
-    "timeout": 30.0,
-    "limits": httpx.Limits(max_keepalive_connections=20, max_connections=100),
-    "follow_redirects": True
-}
+# 按模型指定的上游列表，未指定的模型使用 DIFY_API_BASE
+MODEL_UPSTREAMS = parse_model_upstreams()
+
+# 全局HTTP客户端配置（可通过 UPSTREAM_* 环境变量调整，UPSTREAM_POOL_CONFIG 按上游覆盖）
+HTTP_CLIENT_CONFIG = load_pool_config()
+
+# 按上游地址管理的 HTTP 客户端（延迟初始化）
+upstream_pool = UpstreamPool(HTTP_CLIENT_CONFIG, parse_upstream_overrides())
 
-# 全局HTTP客户端实例（延迟初始化）
-_http_client = None
+# 工作进程内的准入控制（可通过 /v1/admission 在运行时调整）
+# 排队的请求按用户/模型的加权占用公平唤醒，占用计数通过共享内存文件在工作进程间共享
+admission_controller = AdmissionController(scheduler=FairScheduler())
 
-def get_http_client():
-    """获取或创建全局HTTP客户端"""
-    global _http_client
-    if _http_client is None:
-        _http_client = httpx.Client(**HTTP_CLIENT_CONFIG)
-        logger.info("✅ HTTP client initialized with connection pooling")
-    return _http_client
+# 按上游和 API Key 划分的熔断器，状态通过 SQLite 文件在工作进程间共享
+circuit_breaker = CircuitBreaker(conversation_mapper.db_path)
+
+# 首轮会话单飞：同一 chat_id 的并发首轮请求只创建一个 Dify 会话（跨进程锁同样存放在 SQLite 中）
+chat_singleflight = ChatSingleflight(conversation_mapper.db_path)
+
+# 幂等键相同的重复请求合并到同一次上游调用（工作进程内）
+idempotency_store = IdempotencyStore()
+
+# 非流式、无 chat_id 请求的响应缓存（RESPONSE_CACHE_MODELS 按模型开启）
+response_cache = create_response_cache()
+
+# 多 Key 模型的 Key 选择（加权最少在途、429 停放）
+key_pool = KeyPool()
+
+# 多上游负载均衡（最少在途流、主动健康探测、被动摘除）
+upstream_balancer = UpstreamBalancer(upstream_pool.in_flight)
+
+# 按上游和 API Key 根据首字节延迟自适应调整的并发上限（ADAPTIVE_LIMIT_ENABLED 开启）
+adaptive_limiter = AdaptiveLimiter()
+
+def upstreams_for(model=None):
+    """模型可用的上游列表"""
+    return MODEL_UPSTREAMS.get(model) or parse_upstream_list(DIFY_API_BASE)
+
+def all_upstreams():
+    """所有已配置的上游（用于预连接和健康探测）"""
+    upstreams = list(upstreams_for())
+    for model_upstreams in MODEL_UPSTREAMS.values():
+        upstreams.extend(u for u in model_upstreams if u not in upstreams)
+    return upstreams
+
+def get_http_client(upstream=None):
+    """获取或创建指定上游（默认 DIFY_API_BASE 中的第一个）的 HTTP 客户端"""
+    return upstream_pool.get_client(upstream or upstreams_for()[0])
 
 def cleanup_http_client():
     """清理HTTP客户端资源"""
-    global _http_client
-    if _http_client is not None:
-        _http_client.close()
-        _http_client = None
-        logger.info("✅ HTTP client resources cleaned up")
-
-def get_api_key(model_name):
-    """根据模型名称获取对应的API密钥"""
-    api_key = MODEL_TO_API_KEY.get(model_name)
+    upstream_pool.close()
+
+def circuit_open_response(error):
+    """熔断器打开时的快速失败响应"""
+    logger.warning(f"⚠️ {error}")
+    return {
+        "error": {
+            "message": "Upstream temporarily unavailable (circuit open), please retry later",
+            "type": "server_error",
+            "code": "circuit_open"
+        }
+    }, 503, {"Retry-After": str(error.retry_after)}
+
+def rate_limited_response(error):
+    """准入控制拒绝时的 OpenAI 风格 429 响应"""
+    logger.warning(f"⚠️ {error}")
+    return {
+        "error": {
+            "message": f"{error}, please retry later",
+            "type": "rate_limit_error",
+            "code": "rate_limit_exceeded"
+        }
+    }, 429, {"Retry-After": str(error.retry_after)}
+
+def pool_exhausted_response(error):
+    """上游连接池耗尽时的快速失败响应"""
+    logger.warning(f"⚠️ {error}")
+    return {
+        "error": {
+            "message": "Upstream connection pool exhausted, please retry later",
+            "type": "server_error",
+            "code": "upstream_pool_exhausted"
+        }
+    }, 503, {"Retry-After": "1"}
+
+def upstream_overloaded_response(error):
+    """自适应并发上限已满时的快速失败响应"""
+    logger.warning(f"⚠️ {error}")
+    return {
+        "error": {
+            "message": "Upstream is at its adaptive concurrency limit, please retry later",
+            "type": "server_error",
+            "code": "upstream_overloaded"
+        }
+    }, 503, {"Retry-After": "1"}
+
+def deadline_exceeded_response(error):
+    """请求整体截止时间已到（或剩余时间不足以调用上游）时的快速失败响应"""
+    return {
+        "error": {
+            "message": str(error),
+            "type": "timeout_error",
+            "code": "deadline_exceeded"
+        }
+    }, 504
+
+def idempotency_conflict_response():
+    """同一幂等键的流仍在进行，但输出已超过重放缓冲区、无法从头重放时拒绝重复请求"""
+    return {
+        "error": {
+            "message": "The original request for this idempotency key is still streaming and can no longer be replayed, "
+                       "please retry after it completes",
+            "type": "invalid_request_error",
+            "code": "idempotency_conflict"
+        }
+    }, 409, {"Retry-After": "1"}
+
+def worker_draining_response():
+    """工作进程排空期间拒绝新请求，让客户端或反向代理重试到其他工作进程"""
+    worker_drain.reject()
+    return {
+        "error": {
+            "message": "Worker is shutting down, please retry",
+            "type": "server_error",
+            "code": "worker_draining"
+        }
+    }, 503, {"Retry-After": "1", "Connection": "close"}
+
+# 工作进程预热配置
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "4"))
+WARMUP_CACHE_ROWS = int(os.getenv("WARMUP_CACHE_ROWS", "1000"))
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "5"))
+
+# 当前工作进程是否已完成预热
+_worker_ready = threading.Event()
+
+def reinit_after_fork():
+    """
+    fork 之后在工作进程中重建进程内资源
+    preload_app 模式下 master 中创建的 HTTP 客户端和数据库连接会被继承，不能在工作进程中复用
+    """
+    upstream_pool.reset()
+    admission_controller.reset()
+    circuit_breaker.reset_local()
+    chat_singleflight.reset_local()
+    idempotency_store.reset()
+    response_cache.reset()
+    health_monitor.reset()
+    config_reloader.reset()
+    worker_drain.reset()
+    key_pool.reset()
+    upstream_balancer.reset()
+    adaptive_limiter.reset()
+    usage_accounting.reset()
+    traffic_capture.reset()
+    upload_cache.clear()
+    REGISTRY.reset()
+    conversation_mapper.reinit_after_fork()
+    _worker_ready.clear()
+
+def preconnect_upstream(client, count, upstream=None):
+    """并发向 Dify 发起轻量请求，预先建立 keep-alive 连接（TCP/TLS 握手）"""
+    if count <= 0:
+        return 0
+    upstream = upstream or upstreams_for()[0]
+    
+    def _touch():
+        try:
+            client.head(upstream, timeout=WARMUP_TIMEOUT)
+            return True
+        except httpx.HTTPError as e:
+            logger.debug(f"Upstream pre-connect failed: {e}")
+            return False
+    
+    greenlets = [gevent.spawn(_touch) for _ in range(count)]
+    gevent.joinall(greenlets, timeout=WARMUP_TIMEOUT)
+    return sum(1 for g in greenlets if g.successful() and g.value)
+
+def warmup_worker():
+    """
+    工作进程预热：创建 HTTP 客户端、预连接上游、预热映射缓存
+    完成后才将工作进程标记为就绪
+    """
+    start_time = time.time()
+    try:
+        connected = sum(
+            preconnect_upstream(get_http_client(upstream), WARMUP_CONNECTIONS, upstream)
+            for upstream in all_upstreams()
+        )
+        cached = conversation_mapper.warm_cache(WARMUP_CACHE_ROWS)
+        upstream_balancer.start_health_checks(all_upstreams(), get_http_client)
+    finally:
+        # 预热失败不应阻止工作进程启动，首个请求会按需创建资源
+        _worker_ready.set()
+        health_monitor.start()
+        config_reloader.start()
+        usage_accounting.start()
+        traffic_capture.start()
+    
+    logger.info(
+        f"✅ Worker {os.getpid()} warmed up in {time.time() - start_time:.2f}s "
+        f"({connected}/{WARMUP_CONNECTIONS} upstream connections, {cached} cached mappings)"
+    )
+
+def is_worker_ready():
+    """当前工作进程是否已完成预热"""
+    return _worker_ready.is_set()
+
+def upstream_targets_available():
+    """是否至少有一个 (上游, Key) 组合未处于熔断状态"""
+    return any(
+        circuit_breaker.is_available(upstream, entry["key"])
+        for model, value in MODEL_TO_API_KEY.items()
+        for entry in parse_key_entries(value)
+        for upstream in upstreams_for(model)
+    )
+
+# 就绪检查：后台定期计算，/readyz 直接返回缓存的结果
+HEALTH_CONFIG = load_health_config()
+health_monitor = HealthMonitor(
+    {
+        "database": lambda: conversation_mapper.ping(),
+        "warmup": is_worker_ready,
+        "upstream": upstream_targets_available,
+        "accepting": lambda: worker_drain.accepting,
+    },
+    required=["database", "warmup", "accepting"] + (["upstream"] if HEALTH_CONFIG["require_upstream"] else []),
+    config=HEALTH_CONFIG,
+)
+
+def build_model_config_snapshot(values):
+    """根据原始配置字符串构建模型配置快照，返回 (快照, 问题列表)，复用启动时的校验逻辑"""
+    model_to_api_key = parse_model_config(values["MODEL_CONFIG"])
+    failover_config = parse_failover_config(values["MODEL_FAILOVER_CONFIG"])
+    issues = collect_model_config_issues(model_to_api_key, failover_config)
+    # 解析失败时 parse_failover_config 返回空字典，热更新时不能把它当作"关闭故障转移"
+    if not failover_config and values["MODEL_FAILOVER_CONFIG"].strip() not in ("", "{}"):
+        issues.append("MODEL_FAILOVER_CONFIG could not be parsed")
+    return (model_to_api_key, failover_config, build_available_models(model_to_api_key), dict(values)), issues
+
+def apply_model_config_snapshot(snapshot):
+    """
+    整体替换模型配置快照
+    几次赋值之间没有 I/O，gevent 下不会切换 greenlet，其他请求看不到新旧混合的配置；
+    已经开始的请求持有旧对象的引用，继续使用旧配置
+    """
+    global MODEL_TO_API_KEY, FAILOVER_CONFIG, AVAILABLE_MODELS, _model_config_source
+    MODEL_TO_API_KEY, FAILOVER_CONFIG, AVAILABLE_MODELS, _model_config_source = snapshot
+
+# 模型配置热更新：SIGHUP 或配置文件变化时重新加载
+config_reloader = ConfigReloader(
+    build_model_config_snapshot,
+    apply_model_config_snapshot,
+    lambda: _model_config_source,
+)
+
+# SSE 心跳与进度事件转发
+HEARTBEAT_CONFIG = load_heartbeat_config()
+
+# 请求整体截止时间：请求头或按模型配置，剩余时间不足时不再调用 Dify
+deadline_policy = DeadlinePolicy(load_deadline_config())
+
+# Token 用量统计：按模型、用户和 Key 汇总，批量写入与会话映射相同的 SQLite 数据库
+usage_accounting = UsageAccounting(conversation_mapper.db_path)
+
+# 多模态消息中 data URL 图片的上传缓存：内容哈希 -> Dify upload_file_id，工作进程通过 SQLite 共享
+upload_cache = UploadCache(conversation_mapper.db_path)
+
+# 会话指纹索引：没有 chat_id 时按历史前缀继续会话，chat_id 的历史被编辑时开启新分支
+conversation_index = ConversationIndex(conversation_mapper.db_path)
+
+# 流量采集（默认关闭）：脱敏的请求元数据和上游事件节奏，用于本地回放压测
+traffic_capture = TrafficCapture()
+
+# 工作进程排空：回收或关闭前等待在途请求结束，再关闭数据库连接池和上游连接
+worker_drain = WorkerDrain()
+# 开始排空时立即重新计算就绪状态，/readyz 不再返回间隔内缓存的 200
+worker_drain.add_begin_hook("readiness", health_monitor.refresh)
+worker_drain.add_flush_hook("usage", usage_accounting.flush)
+worker_drain.add_flush_hook("traffic capture", traffic_capture.close)
+worker_drain.add_flush_hook("conversation mapper", lambda: conversation_mapper.close())
+worker_drain.add_flush_hook("upstream clients", cleanup_http_client)
+
+_LIVEZ_BODY = b'{"status": "alive"}'
+
+def get_api_key(model_name, model_config=None):
+    """根据模型名称获取对应的API密钥（多 Key 模型返回第一个）"""
+    if model_config is None:
+        model_config = MODEL_TO_API_KEY
+    api_key = primary_key(model_config.get(model_name))
     if not api_key:
         logger.warning(f"No API key found for model: {model_name}")
     return api_key
 
+def resolve_request_priority(webui_chat_id: Optional[str]) -> str:
+    """
+    确定调度优先级类别：X-Request-Priority 头优先，
+    否则带 Open WebUI chat_id 的请求视为交互式，其余（API 集成）视为批量
+    """
+    priority = (request.headers.get("X-Request-Priority") or "").strip().lower()
+    if priority in (PRIORITY_INTERACTIVE, PRIORITY_BATCH):
+        return priority
+    return PRIORITY_INTERACTIVE if webui_chat_id else PRIORITY_BATCH
+
 def extract_webui_chat_id() -> Optional[str]:
     """从请求中提取 Open WebUI 的 chat_id"""
     # 调试：打印所有请求头
@@ -239,6 +570,13 @@ def extract_webui_user_id() -> Optional[str]:
     logger.debug("🔍 No user_id found in request")
     return None
 
+def extract_client_key_id() -> Optional[str]:
+    """客户端 Authorization 中 API Key 的指纹（不保存明文），用于区分共用默认用户的客户端"""
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return key_fingerprint(token.strip())
+
 def transform_openai_to_dify(openai_request, endpoint, webui_chat_id=None):
     """将OpenAI格式的请求转换为Dify格式"""
     
@@ -268,7 +606,7 @@ def transform_openai_to_dify(openai_request, endpoint, webui_chat_id=None):
         
         dify_request = {
             "inputs": {},
-            "query": messages[-1]["content"] if messages else "",
+            "query": message_text(messages[-1]["content"]) if messages else "",
             "response_mode": "streaming" if stream else "blocking",
             "conversation_id": dify_conversation_id,
             "user": dify_user_id
@@ -280,7 +618,7 @@ def transform_openai_to_dify(openai_request, endpoint, webui_chat_id=None):
             for msg in messages[:-1]:  # 除了最后一条消息
                 history.append({
                     "role": msg["role"],
-                    "content": msg["content"]
+                    "content": message_text(msg["content"])
                 })
             dify_request["conversation_history"] = history
             logger.debug(f"📝 Added {len(history)} history messages (no conversation_id)")
@@ -304,7 +642,7 @@ def transform_dify_to_openai(dify_response, model="claude-3-5-sonnet-v2", stream
                     "role": "assistant",
                     "content": dify_response.get("answer", "")
                 },
-                "finish_reason": "stop"
+                "finish_reason": dify_response.get("finish_reason", "stop")
             }]
         }
     else:
@@ -327,21 +665,553 @@ def create_openai_stream_response(content, message_id, model="claude-3-5-sonnet-
         }]
     }
 
-def update_conversation_mapping(webui_chat_id: str, dify_response: dict) -> None:
-    """从 Dify 响应中提取 conversation_id 并更新映射"""
+class UpstreamStatusError(Exception):
+    """Dify 在开始流式输出前返回了非 200 状态码"""
+
+    def __init__(self, status_code, body):
+        super().__init__(f"Dify API error ({status_code}): {body[:200]}")
+        self.status_code = status_code
+        self.body = body
+
+class FileUploadError(UpstreamStatusError):
+    """上传消息中的图片到 Dify 失败"""
+
+def upload_dify_file(attempt, user, image):
+    """把解码后的图片上传到尝试目标所在的 Dify 应用，返回 upload_file_id"""
+    client = get_http_client(attempt["upstream"])
+    response = client.post(
+        f"{attempt['upstream']}/files/upload",
+        headers={"Authorization": f"Bearer {attempt['api_key']}"},
+        files={"file": (image.filename, image.file, image.mime)},
+        data={"user": user}
+    )
+    if response.status_code not in (200, 201):
+        raise FileUploadError(response.status_code, response.text)
+    return response.json()["id"]
+
+def attach_message_files(payload, openai_request, attempt):
+    """
+    把最后一条消息中的图片作为 Dify files 附加到发往该目标的请求
+    上传的文件属于具体的应用，所以按目标的上游和 Key 查找或上传
+    """
+    messages = openai_request.get("messages") or []
+    urls = image_urls(messages[-1].get("content")) if messages else []
+    if not urls:
+        return payload
+    app = f"{attempt['upstream']}|{key_pool.key_id(attempt['api_key'])}"
+    files = resolve_image_files(urls, app, upload_cache,
+                                lambda image: upload_dify_file(attempt, payload["user"], image))
+    return dict(payload, files=files)
+
+def iter_dify_events(response):
+    """逐个解析 Dify SSE 流中的 data 事件"""
+    # 使用增量解码器，避免多字节字符被拆分到两个网络块时解码失败
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    buffer = ""
+    
+    for raw_bytes in response.iter_raw():
+        if not raw_bytes:
+            continue
+        
+        buffer += decoder.decode(raw_bytes)
+        
+        while '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            line = line.strip()
+            
+            if not line or not line.startswith('data: '):
+                continue
+            
+            json_str = line[6:]
+            try:
+                yield json.loads(json_str)
+            except json.JSONDecodeError as e:
+                logger.warning(f"JSON decode error in streaming response: {str(e)}, line: {json_str[:100]}...")
+                continue
+
+def build_failover_request(dify_request, openai_request):
+    """
+    为备用目标构造请求
+    原 conversation_id 属于主应用，备用目标需要去掉它并携带完整历史
+    """
+    failover_request = dict(dify_request)
+    failover_request["conversation_id"] = None
+    messages = openai_request.get("messages", [])
+    if len(messages) > 1:
+        failover_request["conversation_history"] = [
+            {"role": msg["role"], "content": message_text(msg["content"])} for msg in messages[:-1]
+        ]
+    return failover_request
+
+def continue_indexed_conversation(dify_request, conversation_id):
+    """继续历史前缀相同的会话：Dify 已有这段历史，只发送新的一轮"""
+    continued = dict(dify_request, conversation_id=conversation_id)
+    continued.pop("conversation_history", None)
+    return continued
+
+def conversation_missing(status_code, body):
+    """Dify 找不到请求中的会话（已被删除或清理）"""
+    return status_code == 404 or "Conversation Not Exists" in (body or "")
+
+def record_conversation_turn(conversation_turn, conversation_id, answer, api_key_id, upstream, webui_chat_id):
+    """记录本轮结束后（包含回答）的历史指纹，下一轮据此继续会话或发现历史已被修改"""
+    if conversation_turn is None or not conversation_id:
+        return
+    conversation_index.record(conversation_turn.after(answer), conversation_id, api_key_id, upstream, webui_chat_id)
+
+def resolve_conversation_pin(webui_chat_id, model, dify_request, model_config):
+    """
+    会话已存在时返回创建它所用 (Key 标识, 上游)，否则返回 (None, None)
+    映射中没有记录的旧会话属于模型的第一个 Key 和第一个上游
+    """
+    if not webui_chat_id or not dify_request.get("conversation_id"):
+        return None, None
+    mapping = conversation_mapper.get_mapping(webui_chat_id)
+    if not mapping:
+        return None, None
+    _, api_key_id, upstream = mapping
+    return (
+        api_key_id or key_pool.key_id(primary_key(model_config.get(model))),
+        upstream or upstreams_for(model)[0],
+    )
+
+def record_attempt_result(attempt, status_code=None, latency=None, retry_after=None, error=False, ttft=False):
+    """
+    按 Key 和上游记录调用结果：429 时停放该 Key，
+    连接失败、超时和 5xx 计入上游的被动健康检查，
+    首字节延迟（ttft=True 时的 latency）和过载信号用于调整自适应并发上限
+    """
+    server_error = error or (status_code is not None and status_code >= 500)
+    upstream_balancer.record(attempt["upstream"], not server_error)
+    adaptive_limiter.record(attempt["upstream"], attempt["api_key"], latency if ttft else None,
+                            overloaded=server_error or status_code == 429)
+    if status_code == 429:
+        key_pool.park(attempt["model"], attempt["api_key"], retry_after)
+        key_pool.record(attempt["model"], attempt["api_key"], "rate_limited")
+    elif error or (status_code is not None and status_code != 200):
+        key_pool.record(attempt["model"], attempt["api_key"], "error")
+    else:
+        key_pool.record(attempt["model"], attempt["api_key"], "success", latency)
+
+def open_dify_stream(model, attempts, dify_request, openai_request, failover_config, on_event=None,
+                     resend_history=False, primary_slots=()):
+    """
+    按顺序尝试各目标打开 Dify 流式请求，直到收到首个 message 事件
+    返回 (ExitStack, 使用的目标, 事件迭代器)，调用方负责在 with 中消费事件
+    指定 on_event 时，首个 message 之前的其他事件（workflow_started 等）立即交给它，不再放入返回的迭代器
+    resend_history=True（按历史指纹继续的会话）时，主目标找不到该会话则带完整历史重新发送一次
+    primary_slots 为调用方为主目标占用的在途槽位和自适应名额，切换到备用目标时归还；
+    备用目标占用自己上游的槽位和名额，随返回的 ExitStack 归还
+    """
+    deadline = ttfb_deadline_for(model, failover_config)
+    resend = False
+    
+    for index, attempt in enumerate(attempts):
+        is_last = index == len(attempts) - 1
+        stack = ExitStack()
+        
+        # 备用目标同样受其上游的连接池上限和自适应并发上限约束，名额不足时快速跳过
+        if not attempt["primary"]:
+            for held in primary_slots:
+                held.release()
+            try:
+                stack.callback(upstream_pool.acquire(attempt["upstream"]).release)
+                stack.callback(adaptive_limiter.acquire(attempt["upstream"], attempt["api_key"]).release)
+            except (PoolExhaustedError, ConcurrencyLimitExceeded) as e:
+                stack.close()
+                if is_last:
+                    raise
+                record_failover(model, type(e).__name__)
+                continue
+        
+        # 熔断中的目标直接跳过
+        try:
+            permit = circuit_breaker.before_call(attempt["upstream"], attempt["api_key"])
+        except CircuitOpenError:
+            stack.close()
+            if is_last:
+                raise
+            record_failover(model, "circuit_open")
+            continue
+        
+        payload = dify_request if attempt["primary"] else build_failover_request(dify_request, openai_request)
+        client = get_http_client(attempt["upstream"])
+        # 最后一个目标不再设截止时间，按正常流程等待
+        timer = gevent.Timeout(None if is_last else deadline, TTFBDeadlineExceeded)
+        timer.start()
+        started = time.time()
+        try:
+            payload = attach_message_files(payload, openai_request, attempt)
+            response = stack.enter_context(client.stream(
+                'POST',
+                f"{attempt['upstream']}/chat-messages",
+                json=payload,
+                headers={
+                    "Authorization": f"Bearer {attempt['api_key']}",
+                    "Content-Type": "application/json",
+                    'Accept': 'text/event-stream',
+                    'Cache-Control': 'no-cache',
+                    'Connection': 'keep-alive'
+                }
+            ))
+            
+            if response.status_code != 200:
+                body = response.read().decode('utf-8', errors='replace')
+                stack.close()
+                circuit_breaker.record(permit, success=response.status_code not in RETRYABLE_STATUS_CODES)
+                record_attempt_result(attempt, response.status_code, retry_after=response.headers.get("Retry-After"))
+                if resend_history and attempt["primary"] and conversation_missing(response.status_code, body):
+                    # 在 finally 取消本目标的首字节计时之后再重新发送
+                    resend = True
+                    break
+                if response.status_code in RETRYABLE_STATUS_CODES and not is_last:
+                    record_failover(model, f"status_{response.status_code}")
+                    continue
+                raise UpstreamStatusError(response.status_code, body)
+            
+            # 预读到首个带内容的 message 事件（或流结束）为止
+            events = iter_dify_events(response)
+            prefetched = []
+            for dify_chunk in events:
+                event = dify_chunk.get("event")
+                terminal = (event == "message" and dify_chunk.get("answer")) or event in ("message_end", "error")
+                if on_event is not None and not terminal:
+                    on_event(dify_chunk)
+                    continue
+                prefetched.append(dify_chunk)
+                if terminal:
+                    break
+            circuit_breaker.record(permit, success=True)
+            record_attempt_result(attempt, latency=time.time() - started, ttft=True)
+            
+            if not attempt["primary"]:
+                logger.info(f"🔀 Streaming request for model {model} served by backup {attempt['model']} @ {attempt['upstream']}")
+            return stack, attempt, itertools.chain(prefetched, events)
+        
+        except FileUploadError as e:
+            stack.close()
+            circuit_breaker.record(permit, success=e.status_code not in RETRYABLE_STATUS_CODES)
+            record_attempt_result(attempt, e.status_code)
+            if e.status_code in RETRYABLE_STATUS_CODES and not is_last:
+                record_failover(model, f"status_{e.status_code}")
+                continue
+            raise
+        except TTFBDeadlineExceeded:
+            stack.close()
+            circuit_breaker.record(permit, success=False)
+            record_attempt_result(attempt, error=True)
+            record_failover(model, "ttfb_deadline")
+        except httpx.RequestError as e:
+            stack.close()
+            # 本地连接池等待超时不是上游故障
+            if isinstance(e, httpx.PoolTimeout):
+                circuit_breaker.abandon(permit)
+            else:
+                circuit_breaker.record(permit, success=False)
+                record_attempt_result(attempt, error=True)
+            if is_last:
+                raise
+            record_failover(model, type(e).__name__)
+        except BaseException:
+            stack.close()
+            circuit_breaker.abandon(permit)
+            raise
+        finally:
+            timer.cancel()
+    
+    if resend:
+        logger.warning(f"🧬 Indexed Dify conversation {dify_request.get('conversation_id', '')[:8]}... no longer exists, "
+                       f"resending with full history")
+        return open_dify_stream(model, attempts, build_failover_request(dify_request, openai_request),
+                                openai_request, failover_config, on_event, primary_slots=primary_slots)
+    
+    # 仅当最后一个目标也超时时到达这里（理论上最后一个目标没有截止时间）
+    FAILOVER_EXHAUSTED.inc(model=model)
+    raise UpstreamStatusError(504, "No upstream produced a response before the deadline")
+
+def aggregate_dify_events(events, progress, output_limiter, capture=None):
+    """
+    把 Dify 流式事件聚合成与阻塞模式相同的响应结构
+    progress 中记录已看到的 task_id，中途超时时用于通知 Dify 停止生成；
+    达到 max_tokens 或遇到 stop 时立即结束读取，并在响应中记录 finish_reason
+    """
+    dify_response = {"event": "message", "answer": ""}
+    answer = []
+    for dify_chunk in events:
+        for field in ("task_id", "message_id", "conversation_id", "created_at"):
+            if field not in dify_response and dify_chunk.get(field):
+                dify_response[field] = dify_chunk[field]
+        if dify_chunk.get("task_id"):
+            progress.setdefault("task_id", dify_chunk["task_id"])
+        event = dify_chunk.get("event")
+        if event in ("message", "agent_message"):
+            if capture is not None:
+                capture.upstream_event(len(dify_chunk.get("answer", "")))
+            text, finish_reason = output_limiter.feed(dify_chunk.get("answer", ""))
+            answer.append(text)
+            if finish_reason:
+                dify_response["finish_reason"] = finish_reason
+                break
+        elif event == "message_end":
+            answer.append(output_limiter.flush())
+            dify_response["metadata"] = dify_chunk.get("metadata", {})
+        elif event == "error":
+            raise UpstreamStatusError(dify_chunk.get("status", 500), dify_chunk.get("message", ""))
+    dify_response["answer"] = "".join(answer)
+    return dify_response
+
+def collect_dify_response(model, attempts, dify_request, openai_request, failover_config, request_deadline,
+                          output_limiter, capture=None, resend_history=False):
+    """
+    非流式请求在内部使用 Dify 流式接口并聚合结果：
+    生成时间再长也不会触发读取超时，只有上游停止发送数据超过空闲超时才失败；
+    整体截止时间到达时中止读取并通知 Dify 停止生成
+    """
+    progress = {}
+    
+    def _collect():
+        stream_stack, attempt, events = open_dify_stream(
+            model, attempts, dict(dify_request, response_mode="streaming"), openai_request, failover_config,
+            resend_history=resend_history
+        )
+        progress["attempt"] = attempt
+        with stream_stack:
+            return aggregate_dify_events(events, progress, output_limiter, capture)
+    
+    try:
+        dify_response = request_deadline.call(_collect)
+    except DeadlineExceeded:
+        if progress.get("attempt") and progress.get("task_id"):
+            attempt = progress["attempt"]
+            cancel_dify_task(attempt["upstream"], attempt["api_key"], progress["task_id"], dify_request["user"])
+        raise
+    if output_limiter.finish_reason:
+        stop_limited_generation(model, progress.get("attempt"), progress.get("task_id"),
+                                dify_request["user"], output_limiter.finish_reason)
+    return dify_response
+
+def apply_output_limits(dify_response, output_limiter):
+    """阻塞模式下 Dify 已经生成完整回答，只能截断结果"""
+    if not output_limiter.active:
+        return dify_response
+    answer, finish_reason = output_limiter.feed(dify_response.get("answer", ""))
+    if not finish_reason:
+        answer += output_limiter.flush()
+    return dict(dify_response, answer=answer, finish_reason=finish_reason or "stop")
+
+def prompt_text(dify_request):
+    """发送给 Dify 的提示文本（查询和携带的历史），用于估算 prompt token"""
+    history = dify_request.get("conversation_history") or []
+    parts = [m.get("content") for m in history] + [dify_request.get("query")]
+    return "\n".join(part for part in parts if isinstance(part, str))
+
+def resolve_usage(dify_metadata, dify_request, answer):
+    """OpenAI 格式的用量：优先使用 Dify 返回的 usage，没有时（如提前停止生成）按近似分词估算"""
+    return usage_from_dify((dify_metadata or {}).get("usage")) or estimate_usage(prompt_text(dify_request), answer)
+
+def complete_chat_response(dify_response, model, dify_request, webui_chat_id, api_key_id, upstream,
+                           remap_conversation, cache_key, conversation_turn=None):
+    """把 Dify 的完整响应转换为 OpenAI 格式，同时更新会话映射、历史指纹、用量统计和响应缓存"""
+    logger.info(f"Received response from Dify: {json.dumps(dify_response, ensure_ascii=False)}")
+    logger.debug(f"📋 Dify Complete Response: {json.dumps(dify_response, ensure_ascii=False, indent=2)}")
+    
+    # 更新会话映射
+    update_conversation_mapping(webui_chat_id, dify_response, api_key_id, upstream,
+                                replace=remap_conversation)
+    record_conversation_turn(conversation_turn, dify_response.get("conversation_id"),
+                             dify_response.get("answer", ""), api_key_id, upstream, webui_chat_id)
+    
+    openai_response = transform_dify_to_openai(dify_response, model=model)
+    openai_response["usage"] = resolve_usage(dify_response.get("metadata"), dify_request, dify_response.get("answer", ""))
+    usage_accounting.record(model, dify_request["user"], api_key_id, openai_response["usage"])
+    if cache_key:
+        body = json.dumps(openai_response).encode("utf-8")
+        response_cache.put(cache_key, body)
+        return Response(body, mimetype="application/json", headers={"X-Cache": "MISS"})
+    return openai_response
+
+def upstream_request_error_response(model, upstream, e):
+    """非流式请求调用 Dify 时的连接池、超时和连接错误"""
+    if isinstance(e, httpx.PoolTimeout):
+        UPSTREAM_POOL_EXHAUSTED.inc(upstream=upstream)
+        return pool_exhausted_response(e)
+    if isinstance(e, httpx.TimeoutException):
+        error_msg = f"Request timeout: {str(e)}"
+        logger.error(f"Timeout error for model {model}: {error_msg}")
+        return {
+            "error": {
+                "message": error_msg,
+                "type": "timeout_error",
+                "code": "request_timeout"
+            }
+        }, 408
+    if isinstance(e, httpx.ConnectError):
+        error_msg = f"Failed to connect to Dify API: {str(e)}"
+        logger.error(f"Connection error for model {model}: {error_msg}")
+        return {
+            "error": {
+                "message": error_msg,
+                "type": "connection_error", 
+                "code": "connection_failed"
+            }
+        }, 503
+    error_msg = f"Request failed: {str(e)}"
+    logger.error(f"Request error for model {model}: {error_msg}")
+    return {
+        "error": {
+            "message": error_msg,
+            "type": "api_error",
+            "code": "request_failed"
+        }
+    }, 503
+
+def stop_limited_generation(model, attempt, task_id, user, reason):
+    """max_tokens / stop 提前结束输出后停止 Dify 生成，释放上游容量"""
+    OUTPUT_LIMIT_STOPS.inc(model=model, reason=reason)
+    logger.info(f"✂️ Output limit reached ({reason}), stopping Dify task {task_id or 'unknown'}")
+    if attempt and task_id:
+        cancel_dify_task(attempt["upstream"], attempt["api_key"], task_id, user)
+
+STREAM_CANCELLATIONS = REGISTRY.counter(
+    "opendify_stream_cancellations_total", "客户端断开导致取消的流式请求数", ("model",))
+STOP_REQUESTS = REGISTRY.counter(
+    "opendify_dify_stop_requests_total", "发送给 Dify 的停止生成请求数", ("result",))
+
+def cancel_dify_task(upstream, api_key, task_id, user):
+    """在后台调用 Dify 的停止接口，尽力终止仍在进行的生成，不阻塞当前请求"""
+    def _stop():
+        try:
+            response = get_http_client(upstream).post(
+                f"{upstream}/chat-messages/{task_id}/stop",
+                json={"user": user},
+                headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+                timeout=5.0
+            )
+            result = "ok" if response.status_code == 200 else f"status_{response.status_code}"
+        except httpx.HTTPError as e:
+            logger.warning(f"Failed to stop Dify task {task_id}: {e}")
+            result = "error"
+        STOP_REQUESTS.inc(result=result)
+        logger.debug(f"🛑 Dify stop for task {task_id}: {result}")
+    
+    return gevent.spawn(_stop)
+
+def update_conversation_mapping(webui_chat_id: str, dify_response: dict, api_key_id: Optional[str] = None,
+                                upstream: Optional[str] = None, replace: bool = False) -> None:
+    """
+    从 Dify 响应中提取 conversation_id 并更新映射，同时记录创建会话所用的 Key 和上游
+    replace=True 时覆盖已有映射（原会话所属的 Key 或上游已不在配置中）
+    """
     if not webui_chat_id:
         return
     
     # 提取 conversation_id
     dify_conversation_id = dify_response.get("conversation_id")
-    if dify_conversation_id and not conversation_mapper.has_mapping(webui_chat_id):
-        conversation_mapper.set_mapping(webui_chat_id, dify_conversation_id)
+    if dify_conversation_id and (replace or not conversation_mapper.has_mapping(webui_chat_id)):
+        conversation_mapper.set_mapping(webui_chat_id, dify_conversation_id, api_key_id, upstream)
         logger.info(f"🆕 New conversation mapping established")
     elif dify_conversation_id:
         logger.debug(f"✅ Conversation mapping already exists")
 
+def resolve_idempotency_key() -> Optional[str]:
+    """根据 Idempotency-Key 请求头（或 auto 模式下的 chat_id + 最后一条消息）计算幂等键"""
+    header_key = request.headers.get("Idempotency-Key")
+    if not header_key and idempotency_store.mode != "auto":
+        return None
+    openai_request = request.get_json(silent=True) or {}
+    return idempotency_key(
+        idempotency_store.mode, header_key,
+        openai_request.get("user") or extract_webui_user_id() or "",
+        openai_request.get("model", ""), openai_request.get("stream", False),
+        extract_webui_chat_id(), openai_request.get("messages")
+    )
+
+def replay_idempotent_flight(flight):
+    """重复请求：流式从头重放进行中的流，非流式等待并返回第一个请求的结果"""
+    if flight.stream:
+        flight.wait_started()
+        if flight.headers is not None:
+            subscription = flight.subscribe()
+            if subscription is None:
+                logger.info(f"🔁 Idempotent stream {flight.key[:8]} exceeded the replay buffer, rejecting duplicate")
+                return idempotency_conflict_response()
+            return Response(subscription, headers=flight.headers, direct_passthrough=True)
+    flight.wait()
+    if flight.result is None:
+        return {
+            "error": {
+                "message": "The original request for this idempotency key failed",
+                "type": "internal_error",
+            }
+        }, 500
+    body, status, headers = flight.result
+    return Response(body, status=status, headers=headers)
+
+@app.before_request
+def begin_traffic_capture():
+    """按采样率为对话请求创建采集记录（流量采集关闭时不做任何事）"""
+    if traffic_capture.enabled and request.endpoint == "chat_completions":
+        g.traffic_capture = traffic_capture.begin(request.get_json(silent=True), bool(extract_webui_chat_id()))
+
+@app.after_request
+def finish_traffic_capture(response):
+    """响应发送完（流式响应为流结束或客户端断开）后提交采集记录"""
+    capture = g.pop("traffic_capture", None)
+    if capture is not None:
+        status = response.status_code
+        submit = lambda: traffic_capture.submit(capture, status)
+        if response.direct_passthrough:
+            # 流式响应由服务器直接迭代，不会调用 Response.close，改为在迭代器关闭时提交
+            response.response = ClosingIterator(response.response, submit)
+        else:
+            response.call_on_close(submit)
+    return response
+
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
+    """
+    带幂等键的重复请求加入进行中的调用或直接使用刚完成的结果，不再触发新的 Dify 生成；
+    第一个请求的流式输出由后台 greenlet 读取，所有客户端（包括第一个）都作为订阅者接收
+    """
+    if not worker_drain.accepting:
+        return worker_draining_response()
+
+    key = resolve_idempotency_key()
+    if not key:
+        return process_chat_completion()
+
+    stream = bool((request.get_json(silent=True) or {}).get("stream", False))
+    flight, leader = idempotency_store.join_or_start(key, stream)
+    if not leader:
+        logger.info(f"🔁 Duplicate request attached to idempotent call {key[:8]}")
+        return replay_idempotent_flight(flight)
+
+    try:
+        response = app.make_response(process_chat_completion())
+    except BaseException:
+        idempotency_store.complete(flight, failed=True)
+        raise
+    if flight.stream and response.mimetype == "text/event-stream":
+        flight.start(list(response.headers.items()))
+        subscription = flight.subscribe()
+        # 原响应的 close 会关闭生成器（通知 Dify 停止生成）并归还名额，只在所有订阅者断开或流结束后调用
+        idempotency_store.pump(flight, iter(response.response), response.close)
+        return Response(subscription, headers=flight.headers, direct_passthrough=True)
+
+    idempotency_store.complete(
+        flight, (response.get_data(), response.status_code, list(response.headers.items())),
+        failed=response.status_code != 200
+    )
+    return response
+
+def process_chat_completion():
+    # 本次请求使用开始时的模型配置快照，处理期间的热更新不影响它（包括进行中的流）
+    model_config, failover_config = MODEL_TO_API_KEY, FAILOVER_CONFIG
+    received_at = time.monotonic()
+    chat_lock = ChatLock()
+    lock_handed_off = False
+    # 在途登记：工作进程排空时等待它结束，流式请求到流结束（或客户端断开）为止
+    drain_ticket = worker_drain.track()
     try:
         openai_request = request.get_json()
         logger.info(f"Received request: {json.dumps(openai_request, ensure_ascii=False)}")
@@ -357,11 +1227,22 @@ def chat_completions():
         
         model = openai_request.get("model", "claude-3-5-sonnet-v2")
         logger.info(f"Using model: {model}")
+        # Dify 不支持 max_tokens / stop，由 OpenDify 在转发时执行
+        output_limiter = OutputLimiter.from_request(openai_request)
+        # 被采样时记录上游事件节奏（见 begin_traffic_capture）
+        capture = g.get("traffic_capture")
+        
+        # 整体截止时间从收到请求开始计算，已经耗尽时直接失败
+        request_deadline = deadline_policy.for_request(model, request.headers, received_at)
+        try:
+            request_deadline.check("received")
+        except DeadlineExceeded as e:
+            return deadline_exceeded_response(e)
         
         # 验证模型是否支持
-        api_key = get_api_key(model)
+        api_key = get_api_key(model, model_config)
         if not api_key:
-            error_msg = f"Model {model} is not supported. Available models: {', '.join(MODEL_TO_API_KEY.keys())}"
+            error_msg = f"Model {model} is not supported. Available models: {', '.join(model_config.keys())}"
             logger.error(error_msg)
             return {
                 "error": {
@@ -371,6 +1252,21 @@ def chat_completions():
                 }
             }, 404
             
+        # 消息中的图片格式错误或过大时在调用 Dify 之前拒绝
+        try:
+            validate_image_urls(openai_request.get("messages"), upload_cache.config["max_image_bytes"])
+        except InvalidImageError as e:
+            return {
+                "error": {
+                    "message": str(e),
+                    "type": "invalid_request_error",
+                    "code": "invalid_image"
+                }
+            }, 400
+
+        # 首轮会话单飞：没有映射时只让一个请求创建 Dify 会话，并发的其他请求等待映射写入后复用
+        chat_lock = chat_singleflight.acquire(webui_chat_id, conversation_mapper.has_mapping)
+
         dify_request = transform_openai_to_dify(openai_request, "/chat/completions", webui_chat_id)
         logger.info(f"Transformed request: {json.dumps(dify_request, ensure_ascii=False)}")
         
@@ -383,19 +1279,132 @@ def chat_completions():
                 }
             }, 400
 
+        # 无会话上下文的非流式请求（标题、标签等后台任务）先查响应缓存
+        cache_key = None
+        if not webui_chat_id and not openai_request.get("stream", False) and response_cache.enabled_for(model):
+            cache_key = response_cache.key(model, openai_request.get("messages", []), dify_request["user"],
+                                           output_limiter.options)
+            cached = response_cache.lookup(model, cache_key)
+            if cached is not None:
+                logger.info(f"💾 Response cache hit for model {model}")
+                return Response(cached, mimetype="application/json", headers={"X-Cache": "HIT"})
+
+        # 历史指纹：没有 chat_id 时继续历史与本次消息前缀相同的会话，只发送新的一轮；
+        # chat_id 对应会话的历史与本次消息不一致（编辑或重新生成了之前的消息）时带完整历史开启新分支
+        conversation_turn = conversation_index.begin_turn(model, dify_request["user"], openai_request.get("messages"),
+                                                          extract_client_key_id())
+        indexed_conversation = None
+        branch_conversation = False
+        if not webui_chat_id:
+            indexed_conversation = conversation_index.claim(model, conversation_turn)
+            if indexed_conversation:
+                logger.info(f"🧬 Continuing Dify conversation {indexed_conversation.conversation_id[:8]}... matched by history fingerprint")
+                dify_request = continue_indexed_conversation(dify_request, indexed_conversation.conversation_id)
+        elif dify_request.get("conversation_id") and conversation_index.diverged(model, webui_chat_id, conversation_turn):
+            logger.info(f"🌿 History of chat {webui_chat_id[:8]}... no longer matches its Dify conversation, branching")
+            branch_conversation = True
+            dify_request = build_failover_request(dify_request, openai_request)
+
+        # 已有会话固定使用创建它的 Key 和上游；新会话选择加权在途最少的 Key、在途流最少的健康上游
+        if indexed_conversation:
+            pinned_key_id = indexed_conversation.api_key_id or key_pool.key_id(primary_key(model_config.get(model)))
+            pinned_upstream = indexed_conversation.upstream or upstreams_for(model)[0]
+        else:
+            pinned_key_id, pinned_upstream = resolve_conversation_pin(webui_chat_id, model, dify_request, model_config)
+        model_upstreams = upstreams_for(model)
+        try:
+            key_lease = key_pool.select(
+                model, model_config.get(model), pinned_key_id,
+                is_available=lambda key: any(circuit_breaker.is_available(u, key) for u in model_upstreams)
+            )
+        except KeysExhausted as e:
+            return rate_limited_response(e)
+        api_key = key_lease.api_key
+        upstream = upstream_balancer.select(
+            model_upstreams, pinned_upstream,
+            is_available=lambda u: circuit_breaker.is_available(u, api_key)
+        )
+        # 会话所属的 Key 或上游已从配置中移除时，改用完整历史开启新会话
+        remap_conversation = (bool(pinned_key_id) and not key_lease.pinned) or \
+            (bool(pinned_upstream) and upstream_balancer.config["pin_conversations"] and upstream != pinned_upstream)
+        if remap_conversation:
+            logger.warning(f"🔑 API key or upstream of conversation {dify_request.get('conversation_id', '')[:8]}... is no longer configured, starting a new conversation")
+            dify_request = build_failover_request(dify_request, openai_request)
+        # 分支会话替换 chat_id 原有的映射
+        remap_conversation = remap_conversation or branch_conversation
+
         headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
 
         stream = openai_request.get("stream", False)
-        dify_endpoint = f"{DIFY_API_BASE}/chat-messages"
+        dify_endpoint = f"{upstream}/chat-messages"
         logger.info(f"Sending request to Dify endpoint: {dify_endpoint}, stream={stream}")
 
+        # 所有目标都处于熔断状态时直接返回 503，不再等待上游超时
+        attempts = build_attempts(model, api_key, upstream, failover_config, model_config)
+        if not stream:
+            attempts = attempts[:1]
+        if not any(circuit_breaker.is_available(a["upstream"], a["api_key"]) for a in attempts):
+            key_lease.release()
+            return circuit_open_response(
+                CircuitOpenError(upstream, circuit_breaker.retry_after(upstream, api_key))
+            )
+
+        # 准入控制：超出并发上限时在有界队列中等待，队列满或等待超时返回 429
+        try:
+            admission_ticket = admission_controller.acquire(
+                model, dify_request["user"], resolve_request_priority(webui_chat_id)
+            )
+        except AdmissionRejected as e:
+            key_lease.release()
+            return rate_limited_response(e)
+
+        # 占用上游在途槽位，连接池耗尽时快速返回 503 而不是在 httpx 内部排队
+        try:
+            upstream_slot = upstream_pool.acquire(upstream)
+        except PoolExhaustedError as e:
+            admission_ticket.release()
+            key_lease.release()
+            return pool_exhausted_response(e)
+
+        # 自适应并发上限：Dify 开始排队（首字节延迟膨胀）时收缩，快速失败而不是加剧排队
+        try:
+            limit_permit = adaptive_limiter.acquire(upstream, api_key)
+        except ConcurrencyLimitExceeded as e:
+            upstream_slot.release()
+            admission_ticket.release()
+            key_lease.release()
+            return upstream_overloaded_response(e)
+
+        # 准入排队可能耗尽了剩余时间，此时不再调用 Dify
+        try:
+            request_deadline.check("queued")
+        except DeadlineExceeded as e:
+            upstream_slot.release()
+            admission_ticket.release()
+            key_lease.release()
+            limit_permit.release()
+            return deadline_exceeded_response(e)
+
         if stream:
+            include_usage = bool((openai_request.get("stream_options") or {}).get("include_usage"))
+            # 整个流使用同一个 id（首个 role 分片发出时还没有 Dify 的 message_id）
+            stream_id = f"chatcmpl-{uuid.uuid4().hex}"
+            role_chunk = {
+                "id": stream_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": ""},
+                    "finish_reason": None
+                }]
+            }
+
             def generate():
-                client = get_http_client()
-                
                 def flush_chunk(chunk_data):
                     """Helper function to flush chunks immediately"""
                     return chunk_data.encode('utf-8')
@@ -432,110 +1441,220 @@ def chat_completions():
                     chunk_data = f"data: {json.dumps(openai_chunk)}\n\n"
                     return flush_chunk(chunk_data)
                 
+                def progress_chunk(dify_chunk):
+                    """把 Dify 进度事件作为扩展字段 dify_event 放在一个空 delta 分片中转发"""
+                    chunk = {
+                        "id": stream_id,
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{"index": 0, "delta": {}, "finish_reason": None}],
+                        "dify_event": progress_extension(dify_chunk),
+                    }
+                    return flush_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+                
+                def finish_chunks(finish_reason):
+                    """带 finish_reason 的最后一个分片和 [DONE]"""
+                    final_chunk = {
+                        "id": stream_id,
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{
+                            "index": 0,
+                            "delta": {},
+                            "finish_reason": finish_reason
+                        }]
+                    }
+                    yield flush_chunk(f"data: {json.dumps(final_chunk)}\n\n")
+                    if include_usage:
+                        # stream_options.include_usage：[DONE] 之前的最后一个分片携带整个请求的用量
+                        usage_chunk = {
+                            "id": stream_id,
+                            "object": "chat.completion.chunk",
+                            "created": int(time.time()),
+                            "model": model,
+                            "choices": [],
+                            "usage": current_usage()
+                        }
+                        yield flush_chunk(f"data: {json.dumps(usage_chunk)}\n\n")
+                    yield flush_chunk("data: [DONE]\n\n")
+                
+                def current_usage():
+                    return resolve_usage(dify_metadata, dify_request, "".join(completion_parts))
+                
+                def persist_first_message():
+                    """写入首个 message 事件带来的会话映射，然后放行等待同一 chat_id 的请求"""
+                    nonlocal first_message
+                    dify_chunk, first_message = first_message, None
+                    # 备用目标创建的会话属于其他应用，不能写入映射
+                    if attempt["primary"]:
+                        update_conversation_mapping(
+                            webui_chat_id, dify_chunk, key_lease.key_id, upstream,
+                            replace=remap_conversation
+                        )
+                    chat_lock.release()
+                
                 # 初始化缓冲区
                 output_buffer = []
+                # 用于客户端断开时通知 Dify 停止生成
+                attempt = None
+                task_id = None
+                completed = False
+                # 首个 message 事件：映射在首个分片发出之后再写入，SQLite 写入不占用首字延迟
+                first_message = None
+                dify_conversation_id = None
+                # 用量：message_end 中的 metadata，以及已输出的文本（Dify 没有返回 usage 时用于估算）
+                dify_metadata = None
+                completion_parts = []
                 
                 try:
+                    # 先提交响应头并发出 OpenAI 标准的首个 role 分片，
+                    # 客户端在 Dify 建连、排队和生成首字期间就能收到首字节
+                    yield flush_chunk(f"data: {json.dumps(role_chunk)}\n\n")
+                    
                     # 移除预连接检查，直接进行流式请求
                     # 预连接检查可能过于严格，影响正常流式响应
+                    # 首个 message 事件超时或上游 5xx/429 时按策略切换到备用目标
+                    # 上游在后台 greenlet 中打开和读取，静默期间按间隔写出心跳（可选转发进度事件）
+                    forward_events = HEARTBEAT_CONFIG["forward_events"]
+                    # 整体截止时间在后台 greenlet 中生效，到达时中止上游读取
+                    opening = Heartbeats(
+                        lambda emit: request_deadline.call(
+                            open_dify_stream, model, attempts, dify_request, openai_request, failover_config,
+                            on_event=emit if forward_events else None, resend_history=bool(indexed_conversation),
+                            primary_slots=(upstream_slot, limit_permit)
+                        ),
+                        HEARTBEAT_CONFIG["interval"]
+                    )
+                    for item in opening:
+                        if item is HEARTBEAT:
+                            SSE_HEARTBEATS.inc(model=model)
+                            yield PING
+                        elif item.get("event") in forward_events:
+                            yield progress_chunk(item)
+                    stream_stack, attempt, events = opening.result()
+                    events = Heartbeats(
+                        lambda emit, upstream_events=events: request_deadline.call(pump_events, upstream_events, emit),
+                        HEARTBEAT_CONFIG["interval"]
+                    )
+                    # 先停止后台读取，再关闭上游响应
+                    stream_stack.callback(events.close)
                     
-                    with client.stream(
-                        'POST',
-                        dify_endpoint,
-                        json=dify_request,
-                        headers={
-                            **headers,
-                            'Accept': 'text/event-stream',
-                            'Cache-Control': 'no-cache',
-                            'Connection': 'keep-alive'
-                        }
-                    ) as response:
+                    with stream_stack:
                         generate.message_id = None
-                        buffer = ""
                         
-                        for raw_bytes in response.iter_raw():
-                            if not raw_bytes:
+                        for dify_chunk in events:
+                            if dify_chunk is HEARTBEAT:
+                                SSE_HEARTBEATS.inc(model=model)
+                                yield PING
                                 continue
+                            
+                            if not task_id and dify_chunk.get("task_id"):
+                                task_id = dify_chunk["task_id"]
+                            
+                            if dify_chunk.get("event") == "message" and "answer" in dify_chunk:
+                                current_answer = dify_chunk["answer"]
+                                if not current_answer:
+                                    continue
+                                if capture is not None:
+                                    capture.upstream_event(len(current_answer))
+                                    
+                                if not generate.message_id:
+                                    generate.message_id = dify_chunk.get("message_id", "")
+                                    dify_conversation_id = dify_chunk.get("conversation_id")
+                                    # 在流式响应的第一个消息中更新映射（首个分片发出之后）
+                                    first_message = dify_chunk
+                                    logger.debug(f"📋 Dify Stream Chunk (first): {json.dumps(dify_chunk, ensure_ascii=False, indent=2)}")
+                                else:
+                                    logger.debug(f"📋 Dify Stream Chunk: {json.dumps(dify_chunk, ensure_ascii=False)}")
                                 
-                            try:
-                                buffer += raw_bytes.decode('utf-8')
+                                # max_tokens / stop：只输出限制之内的部分，可能是停止序列开头的尾部暂缓输出
+                                current_answer, limit_reason = output_limiter.feed(current_answer)
+                                completion_parts.append(current_answer)
                                 
-                                while '\n' in buffer:
-                                    line, buffer = buffer.split('\n', 1)
-                                    line = line.strip()
-                                    
-                                    if not line or not line.startswith('data: '):
-                                        continue
-                                        
-                                    try:
-                                        json_str = line[6:]
-                                        dify_chunk = json.loads(json_str)
-                                        
-                                        if dify_chunk.get("event") == "message" and "answer" in dify_chunk:
-                                            current_answer = dify_chunk["answer"]
-                                            if not current_answer:
-                                                continue
-                                                
-                                            message_id = dify_chunk.get("message_id", "")
-                                            if not generate.message_id:
-                                                generate.message_id = message_id
-                                                # 在流式响应的第一个消息中更新映射
-                                                update_conversation_mapping(webui_chat_id, dify_chunk)
-                                                logger.debug(f"📋 Dify Stream Chunk (first): {json.dumps(dify_chunk, ensure_ascii=False, indent=2)}")
-                                            else:
-                                                logger.debug(f"📋 Dify Stream Chunk: {json.dumps(dify_chunk, ensure_ascii=False)}")
-                                            
-                                            # 将当前批次的字符添加到输出缓冲区
-                                            for char in current_answer:
-                                                output_buffer.append((char, generate.message_id))
-                                            
-                                            # 根据缓冲区大小动态调整输出速度
-                                            while output_buffer:
-                                                char, msg_id = output_buffer.pop(0)
-                                                yield send_char(char, msg_id)
-                                                # 根据剩余缓冲区大小计算延迟
-                                                delay = calculate_delay(len(output_buffer))
-                                                time.sleep(delay)
-                                            
-                                            # 立即继续处理下一个请求
-                                            continue
-                                        
-                                        elif dify_chunk.get("event") == "message_end":
-                                            logger.debug(f"📋 Dify Stream End: {json.dumps(dify_chunk, ensure_ascii=False, indent=2)}")
-                                            
-                                            # 快速输出剩余内容
-                                            while output_buffer:
-                                                char, msg_id = output_buffer.pop(0)
-                                                yield send_char(char, msg_id)
-                                                time.sleep(0.001)  # 固定使用最小延迟快速输出剩余内容
-                                            
-                                            final_chunk = {
-                                                "id": generate.message_id,
-                                                "object": "chat.completion.chunk",
-                                                "created": int(time.time()),
-                                                "model": model,
-                                                "choices": [{
-                                                    "index": 0,
-                                                    "delta": {},
-                                                    "finish_reason": "stop"
-                                                }]
-                                            }
-                                            yield flush_chunk(f"data: {json.dumps(final_chunk)}\n\n")
-                                            yield flush_chunk("data: [DONE]\n\n")
-                                        
-                                        else:
-                                            # 打印其他类型的chunk用于调试
-                                            if dify_chunk.get("event"):
-                                                logger.debug(f"📋 Dify Stream Other Event [{dify_chunk.get('event')}]: {json.dumps(dify_chunk, ensure_ascii=False)}")
-                                        
-                                    except json.JSONDecodeError as e:
-                                        logger.warning(f"JSON decode error in streaming response: {str(e)}, line: {json_str[:100]}...")
-                                        continue
-                                        
-                            except Exception as e:
-                                logger.error(f"Error processing chunk: {str(e)}")
+                                # 将当前批次的字符添加到输出缓冲区
+                                for char in current_answer:
+                                    output_buffer.append((char, stream_id))
+                                
+                                # 根据缓冲区大小动态调整输出速度
+                                while output_buffer:
+                                    char, msg_id = output_buffer.pop(0)
+                                    yield send_char(char, msg_id)
+                                    if first_message is not None:
+                                        persist_first_message()
+                                    # 根据剩余缓冲区大小计算延迟
+                                    delay = calculate_delay(len(output_buffer))
+                                    time.sleep(delay)
+                                
+                                if limit_reason:
+                                    # 按 OpenAI 语义结束输出，并停止 Dify 继续生成
+                                    completed = True
+                                    yield from finish_chunks(limit_reason)
+                                    stop_limited_generation(model, attempt, task_id, dify_request["user"], limit_reason)
+                                    break
+                                
+                                # 立即继续处理下一个请求
                                 continue
+                            
+                            elif dify_chunk.get("event") == "message_end":
+                                logger.debug(f"📋 Dify Stream End: {json.dumps(dify_chunk, ensure_ascii=False, indent=2)}")
+                                
+                                dify_metadata = dify_chunk.get("metadata")
+                                
+                                # 暂缓输出的尾部文本已确认不是停止序列
+                                tail = output_limiter.flush()
+                                completion_parts.append(tail)
+                                for char in tail:
+                                    output_buffer.append((char, stream_id))
+                                
+                                # 快速输出剩余内容
+                                while output_buffer:
+                                    char, msg_id = output_buffer.pop(0)
+                                    yield send_char(char, msg_id)
+                                    time.sleep(0.001)  # 固定使用最小延迟快速输出剩余内容
+                                
+                                completed = True
+                                yield from finish_chunks(output_limiter.finish_reason or "stop")
+                            
+                            else:
+                                # 打印其他类型的chunk用于调试
+                                if dify_chunk.get("event"):
+                                    logger.debug(f"📋 Dify Stream Other Event [{dify_chunk.get('event')}]: {json.dumps(dify_chunk, ensure_ascii=False)}")
+                                if dify_chunk.get("event") in forward_events:
+                                    yield progress_chunk(dify_chunk)
 
+                except GeneratorExit:
+                    # 客户端断开：上游流已随 with 退出关闭，再尽力通知 Dify 停止生成
+                    if not completed:
+                        STREAM_CANCELLATIONS.inc(model=model)
+                        logger.info(f"🛑 Client disconnected, cancelling Dify task {task_id or 'unknown'}")
+                        if attempt and task_id:
+                            cancel_dify_task(attempt["upstream"], attempt["api_key"], task_id, dify_request["user"])
+                    raise
+                except DeadlineExceeded as e:
+                    if attempt and task_id:
+                        cancel_dify_task(attempt["upstream"], attempt["api_key"], task_id, dify_request["user"])
+                    yield flush_chunk(f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n")
+                    yield flush_chunk("data: [DONE]\n\n")
+                except CircuitOpenError as e:
+                    logger.error(f"Stream rejected by circuit breaker: {e}")
+                    yield flush_chunk(f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n")
+                    yield flush_chunk("data: [DONE]\n\n")
+                except UpstreamStatusError as e:
+                    logger.error(f"Stream upstream error: {e}")
+                    yield flush_chunk(f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n")
+                    yield flush_chunk("data: [DONE]\n\n")
+                except (PoolExhaustedError, ConcurrencyLimitExceeded) as e:
+                    # 故障转移到的最后一个备用目标也没有空闲名额
+                    logger.error(f"Stream backup upstream saturated: {e}")
+                    yield flush_chunk(f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n")
+                    yield flush_chunk("data: [DONE]\n\n")
+                except httpx.PoolTimeout as e:
+                    UPSTREAM_POOL_EXHAUSTED.inc(upstream=upstream)
+                    logger.error(f"Stream pool timeout: {e}")
+                    yield flush_chunk(f"data: {{\"error\": \"Upstream connection pool exhausted: {str(e)}\"}}\n\n")
+                    yield flush_chunk("data: [DONE]\n\n")
                 except httpx.ConnectTimeout as e:
                     logger.error(f"Stream connection timeout: {e}")
                     yield flush_chunk(f"data: {{\"error\": \"Connection timeout: {str(e)}\"}}\n\n")
@@ -549,30 +1668,127 @@ def chat_completions():
                     yield flush_chunk(f"data: {{\"error\": \"Internal error: {str(e)}\"}}\n\n")
                     yield flush_chunk("data: [DONE]\n\n")
                 finally:
-                    # 使用全局客户端，不需要手动关闭
-                    pass
+                    # 首个分片发出时客户端已断开：Dify 会话已经创建，仍然写入映射
+                    if first_message is not None:
+                        persist_first_message()
+                    # 完整结束的一轮记录历史指纹（备用目标的会话属于其他应用，不记录）；
+                    # 被 max_tokens / stop 截断时 Dify 会话中的回答与客户端看到的不同，也不记录
+                    if completed and not output_limiter.finish_reason and attempt is not None and attempt["primary"]:
+                        record_conversation_turn(conversation_turn, dify_conversation_id, "".join(completion_parts),
+                                                 key_lease.key_id, upstream, webui_chat_id)
+                    # 调用过 Dify 的请求都计入用量（包括客户端断开和提前停止的）
+                    if attempt is not None:
+                        usage_accounting.record(model, dify_request["user"], key_pool.key_id(attempt["api_key"]),
+                                                current_usage())
+                    # 使用全局客户端，不需要手动关闭，只归还在途槽位、准入名额、Key 名额和自适应名额
+                    upstream_slot.release()
+                    admission_ticket.release()
+                    key_lease.release()
+                    limit_permit.release()
+                    chat_lock.release()
+                    drain_ticket.release()
 
-            return Response(
+            stream_response = Response(
                 stream_with_context(generate()),
                 content_type='text/event-stream',
                 headers={
                     'Cache-Control': 'no-cache, no-transform',
                     'Connection': 'keep-alive',
-                    'Transfer-Encoding': 'chunked',
                     'X-Accel-Buffering': 'no',
                     'Content-Encoding': 'none'
                 },
                 direct_passthrough=True
             )
+            # 客户端在生成器开始前断开时也要归还槽位
+            stream_response.call_on_close(upstream_slot.release)
+            stream_response.call_on_close(admission_ticket.release)
+            stream_response.call_on_close(key_lease.release)
+            stream_response.call_on_close(limit_permit.release)
+            stream_response.call_on_close(chat_lock.release)
+            stream_response.call_on_close(drain_ticket.release)
+            lock_handed_off = True
+            return stream_response
+        elif deadline_policy.config["aggregate_non_stream"]:
+            # 内部使用 Dify 流式接口并聚合结果，空闲超时和整体截止时间对非流式请求同样生效
+            try:
+                dify_response = collect_dify_response(
+                    model, attempts, dify_request, openai_request, failover_config, request_deadline, output_limiter,
+                    capture, resend_history=bool(indexed_conversation)
+                )
+            except CircuitOpenError as e:
+                return circuit_open_response(e)
+            except DeadlineExceeded as e:
+                return deadline_exceeded_response(e)
+            except UpstreamStatusError as e:
+                logger.error(f"Request failed: {e}")
+                return {
+                    "error": {
+                        "message": str(e),
+                        "type": "api_error",
+                        "code": e.status_code
+                    }
+                }, e.status_code
+            except httpx.RequestError as e:
+                return upstream_request_error_response(model, upstream, e)
+            finally:
+                upstream_slot.release()
+                admission_ticket.release()
+                key_lease.release()
+                limit_permit.release()
+            # 被截断的回答与 Dify 会话中的不同，不记录历史指纹
+            return complete_chat_response(
+                dify_response, model, dify_request, webui_chat_id, key_lease.key_id, upstream,
+                remap_conversation, cache_key, None if output_limiter.finish_reason else conversation_turn
+            )
         else:
             # 使用同步客户端处理非流式响应
             try:
-                client = get_http_client()
-                response = client.post(
-                    dify_endpoint,
-                    json=dify_request,
-                    headers=headers
-                )
+                permit = circuit_breaker.before_call(upstream, api_key)
+            except CircuitOpenError as e:
+                upstream_slot.release()
+                admission_ticket.release()
+                key_lease.release()
+                limit_permit.release()
+                return circuit_open_response(e)
+            
+            try:
+                client = get_http_client(upstream)
+                started = time.time()
+                try:
+                    payload = request_deadline.call(attach_message_files, dify_request, openai_request, attempts[0])
+                    response = request_deadline.call(
+                        client.post,
+                        dify_endpoint,
+                        json=payload,
+                        headers=headers
+                    )
+                except httpx.PoolTimeout:
+                    circuit_breaker.abandon(permit)
+                    raise
+                except (httpx.RequestError, DeadlineExceeded, FileUploadError):
+                    circuit_breaker.record(permit, success=False)
+                    record_attempt_result(attempts[0], error=True)
+                    raise
+                except BaseException:
+                    circuit_breaker.abandon(permit)
+                    raise
+                # 阻塞模式的耗时包含整个生成过程，较长的正常回答不应计为慢调用
+                circuit_breaker.record(permit, success=response.status_code not in RETRYABLE_STATUS_CODES,
+                                       timed=False)
+                record_attempt_result(attempts[0], response.status_code, time.time() - started,
+                                      response.headers.get("Retry-After"))
+                
+                # 按历史指纹继续的会话在 Dify 中已不存在：带完整历史重新发送一次
+                if indexed_conversation and response.status_code != 200 and \
+                        conversation_missing(response.status_code, response.text):
+                    logger.warning(f"🧬 Indexed Dify conversation {indexed_conversation.conversation_id[:8]}... "
+                                   f"no longer exists, resending with full history")
+                    dify_request = build_failover_request(dify_request, openai_request)
+                    payload = request_deadline.call(attach_message_files, dify_request, openai_request, attempts[0])
+                    started = time.time()
+                    response = request_deadline.call(client.post, dify_endpoint, json=payload, headers=headers)
+                    record_attempt_result(attempts[0], response.status_code, time.time() - started,
+                                          response.headers.get("Retry-After"))
                 
                 if response.status_code != 200:
                     error_msg = f"Dify API error: {response.text}"
@@ -585,46 +1801,31 @@ def chat_completions():
                         }
                     }, response.status_code
 
-                dify_response = response.json()
-                logger.info(f"Received response from Dify: {json.dumps(dify_response, ensure_ascii=False)}")
-                logger.debug(f"📋 Dify Complete Response: {json.dumps(dify_response, ensure_ascii=False, indent=2)}")
-                
-                # 更新会话映射
-                update_conversation_mapping(webui_chat_id, dify_response)
-                
-                openai_response = transform_dify_to_openai(dify_response, model=model)
-                return openai_response
+                dify_response = apply_output_limits(response.json(), output_limiter)
+                # 被截断的回答与 Dify 会话中的不同，不记录历史指纹
+                return complete_chat_response(
+                    dify_response, model, dify_request, webui_chat_id, key_lease.key_id, upstream,
+                    remap_conversation, cache_key, None if output_limiter.finish_reason else conversation_turn
+                )
                 
-            except httpx.TimeoutException as e:
-                error_msg = f"Request timeout: {str(e)}"
-                logger.error(f"Timeout error for model {model}: {error_msg}")
-                return {
-                    "error": {
-                        "message": error_msg,
-                        "type": "timeout_error",
-                        "code": "request_timeout"
-                    }
-                }, 408
-            except httpx.ConnectError as e:
-                error_msg = f"Failed to connect to Dify API: {str(e)}"
-                logger.error(f"Connection error for model {model}: {error_msg}")
-                return {
-                    "error": {
-                        "message": error_msg,
-                        "type": "connection_error", 
-                        "code": "connection_failed"
-                    }
-                }, 503
-            except httpx.RequestError as e:
-                error_msg = f"Request failed: {str(e)}"
-                logger.error(f"Request error for model {model}: {error_msg}")
+            except DeadlineExceeded as e:
+                return deadline_exceeded_response(e)
+            except FileUploadError as e:
+                logger.error(f"Request failed: {e}")
                 return {
                     "error": {
-                        "message": error_msg,
+                        "message": str(e),
                         "type": "api_error",
-                        "code": "request_failed"
+                        "code": e.status_code
                     }
-                }, 503
+                }, e.status_code
+            except httpx.RequestError as e:
+                return upstream_request_error_response(model, upstream, e)
+            finally:
+                upstream_slot.release()
+                admission_ticket.release()
+                key_lease.release()
+                limit_permit.release()
 
     except Exception as e:
         logger.exception("Unexpected error occurred")
@@ -634,23 +1835,111 @@ def chat_completions():
                 "type": "internal_error",
             }
         }, 500
+    finally:
+        # 流式响应的首轮锁和在途登记由生成器释放，其余路径在这里释放
+        if not lock_handed_off:
+            chat_lock.release()
+            drain_ticket.release()
+
+# 预编码的模型列表：(MODEL_TO_API_KEY, AVAILABLE_MODELS, 响应体, ETag)
+_models_response = None
+
+def models_response_body():
+    """返回预编码的模型列表和 ETag，只在模型配置对象被替换时重新生成"""
+    global _models_response
+    cached = _models_response
+    if cached is None or cached[0] is not MODEL_TO_API_KEY or cached[1] is not AVAILABLE_MODELS:
+        # 过滤掉没有API密钥的模型
+        available_models = [
+            model for model in AVAILABLE_MODELS
+            if MODEL_TO_API_KEY.get(model["id"])
+        ]
+        body = json.dumps({"object": "list", "data": available_models}, ensure_ascii=False).encode("utf-8")
+        cached = _models_response = (MODEL_TO_API_KEY, AVAILABLE_MODELS, body, hashlib.sha256(body).hexdigest()[:16])
+        logger.info(f"📋 Model list rebuilt ({len(available_models)} models)")
+    return cached[2], cached[3]
 
 @app.route('/v1/models', methods=['GET'])
 def list_models():
-    """返回可用的模型列表"""
-    logger.info("Listing available models")
-    # 过滤掉没有API密钥的模型
-    available_models = [
-        model for model in AVAILABLE_MODELS 
-        if MODEL_TO_API_KEY.get(model["id"])
-    ]
-    
-    response = {
-        "object": "list",
-        "data": available_models
+    """返回可用的模型列表（支持 If-None-Match）"""
+    body, etag = models_response_body()
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+@app.route('/livez', methods=['GET'])
+def livez():
+    """存活检查：进程能处理请求即返回 200"""
+    return Response(_LIVEZ_BODY, mimetype='application/json')
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """就绪检查：返回后台计算好的结果，未就绪时为 503"""
+    body, status = health_monitor.snapshot()
+    return Response(body, status=status, mimetype='application/json')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """以 Prometheus 文本格式导出当前工作进程的指标"""
+    return Response(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/v1/admission', methods=['GET'])
+def get_admission_state():
+    """获取当前工作进程的准入控制状态"""
+    return {
+        **admission_controller.snapshot(),
+        "pid": os.getpid(),
+        "timestamp": int(time.time())
+    }
+
+@app.route('/v1/admission', methods=['POST'])
+def update_admission_limits():
+    """运行时调整当前工作进程的准入限制"""
+    changes = request.get_json(silent=True) or {}
+    try:
+        config = admission_controller.update_limits(**{
+            key: changes.get(key) for key in
+            ("max_concurrent", "default_model_limit", "model_limits", "max_queue", "max_wait", "retry_after")
+        })
+    except (TypeError, ValueError, AttributeError) as e:
+        return {
+            "error": {
+                "message": f"Invalid admission limits: {e}",
+                "type": "invalid_request_error",
+            }
+        }, 400
+    return {
+        "config": config,
+        "pid": os.getpid(),
+        "timestamp": int(time.time())
+    }
+
+@app.route('/v1/usage', methods=['GET'])
+def get_usage():
+    """
+    按分钟或小时读取 token 用量汇总（容量规划用）
+    参数: resolution=minute|hour, since=Unix 时间戳, group_by=model,user,key_id 的子集
+    """
+    resolution = request.args.get('resolution', default='hour')
+    since = request.args.get('since', default=time.time() - 86400, type=float)
+    group_by = tuple(c.strip() for c in request.args.get('group_by', default='model,user,key_id').split(',') if c.strip())
+    # 先写入本工作进程尚未写入的用量
+    usage_accounting.flush()
+    try:
+        rows = usage_accounting.query(resolution, since, group_by)
+    except ValueError as e:
+        return {
+            "error": {
+                "message": str(e),
+                "type": "invalid_request_error",
+            }
+        }, 400
+    return {
+        "resolution": resolution,
+        "since": int(since),
+        "rows": rows,
+        "timestamp": int(time.time())
     }
-    logger.info(f"Available models: {json.dumps(response, ensure_ascii=False)}")
-    return response
 
 @app.route('/v1/conversation/mappings', methods=['GET'])
 def get_conversation_mappings():
@@ -669,8 +1958,10 @@ def cleanup_old_conversations():
     """清理旧的会话映射"""
     max_age_days = request.json.get('max_age_days', 30) if request.is_json else 30
     removed_count = conversation_mapper.cleanup_old_mappings(max_age_days)
+    removed_fingerprints = conversation_index.cleanup(max_age_days)
     return {
         "removed_count": removed_count,
+        "removed_fingerprints": removed_fingerprints,
         "max_age_days": max_age_days,
         "timestamp": int(time.time())
     }
@@ -730,6 +2021,8 @@ if __name__ == '__main__':
     host = os.getenv("SERVER_HOST", "127.0.0.1")
     port = int(os.getenv("SERVER_PORT", 5000))
     logger.info(f"🚀 Starting OpenDify server on http://{host}:{port}")
+    # 没有 gunicorn 的 post_worker_init 钩子，直接在本进程预热，否则 /readyz 一直返回 503
+    warmup_worker()
     
     try:
         app.run(debug=True, host=host, port=port)
@@ -0,0 +1,142 @@
+"""
+服务端的 max_tokens / stop 约束
+Dify 的对话接口不支持 OpenAI 的 max_tokens 和 stop 参数，Dify 总是生成完整回答。
+OpenDify 在转发时用近似分词器计算已输出的 token 数，并跨分片增量匹配停止序列；
+达到上限或遇到停止序列时按 OpenAI 语义结束输出（finish_reason 为 length / stop），调用方随后停止 Dify 生成
+"""
+
+import re
+import logging
+from typing import List, Optional, Tuple
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_LIMIT_STOPS = REGISTRY.counter(
+    "opendify_output_limit_stops_total", "因 max_tokens 或 stop 提前结束并停止 Dify 生成的请求数", ("model", "reason"))
+
+FINISH_STOP = "stop"
+FINISH_LENGTH = "length"
+
+# OpenAI 最多接受 4 个停止序列
+MAX_STOP_SEQUENCES = 4
+
+# 近似分词：CJK 字符各算一个 token，连续的字母数字按每 4 个字符一个 token，其余非空白字符各算一个
+_TOKEN_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]|[A-Za-z0-9]+|[^\sA-Za-z0-9]")
+_CHARS_PER_WORD_TOKEN = 4
+
+
+def _match_tokens(match: str) -> int:
+    return -(-len(match) // _CHARS_PER_WORD_TOKEN)
+
+
+def approx_token_count(text: str) -> int:
+    """快速估算文本的 token 数（不依赖具体模型的分词表）"""
+    return sum(_match_tokens(m.group()) for m in _TOKEN_PATTERN.finditer(text))
+
+
+def truncate_to_tokens(text: str, budget: int) -> Tuple[str, int]:
+    """返回 text 中不超过 budget 个 token 的最长前缀及其 token 数"""
+    used = 0
+    for m in _TOKEN_PATTERN.finditer(text):
+        tokens = _match_tokens(m.group())
+        if used + tokens > budget:
+            # 长单词按字符数截断到剩余的 token
+            cut = m.start() + (budget - used) * _CHARS_PER_WORD_TOKEN if tokens > 1 else m.start()
+            return text[:cut], budget if cut > m.start() else used
+        used += tokens
+    return text, used
+
+
+def parse_output_limits(openai_request: dict) -> Tuple[Optional[int], List[str]]:
+    """从 OpenAI 请求中读取 max_tokens（或 max_completion_tokens）和 stop，无效值按未设置处理"""
+    max_tokens = openai_request.get("max_completion_tokens", openai_request.get("max_tokens"))
+    if not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens <= 0:
+        max_tokens = None
+    stop = openai_request.get("stop")
+    if isinstance(stop, str):
+        stop = [stop]
+    if not isinstance(stop, list):
+        stop = []
+    stop = [s for s in stop if isinstance(s, str) and s][:MAX_STOP_SEQUENCES]
+    return max_tokens, stop
+
+
+class OutputLimiter:
+    """
+    对逐段到达的回答施加 max_tokens 和 stop 约束
+    feed() 返回可以立即输出的文本和结束原因（未结束时为 None）；
+    可能是停止序列开头的尾部文本会暂缓输出，直到确认不匹配，流结束时由 flush() 取出
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None, stop: Optional[List[str]] = None):
+        self.max_tokens = max_tokens
+        self.stop = list(stop or [])
+        self.tokens = 0
+        self.finish_reason = None
+        self._pending = ""
+        self._holdback = max((len(s) for s in self.stop), default=1) - 1
+
+    @classmethod
+    def from_request(cls, openai_request: dict) -> "OutputLimiter":
+        return cls(*parse_output_limits(openai_request))
+
+    @property
+    def active(self) -> bool:
+        return self.max_tokens is not None or bool(self.stop)
+
+    @property
+    def options(self) -> Optional[dict]:
+        """影响输出的参数，用于区分响应缓存；未设置时为 None"""
+        if not self.active:
+            return None
+        return {"max_tokens": self.max_tokens, "stop": self.stop}
+
+    def feed(self, text: str) -> Tuple[str, Optional[str]]:
+        if self.finish_reason:
+            return "", self.finish_reason
+        if not self.active:
+            return text, None
+
+        self._pending += text
+        emit, finish = self._pending, None
+        stop_at = self._find_stop(emit)
+        if stop_at is not None:
+            emit, finish = emit[:stop_at], FINISH_STOP
+            self._pending = ""
+        else:
+            keep = self._partial_stop_length(emit)
+            emit, self._pending = emit[:len(emit) - keep], emit[len(emit) - keep:]
+        return self._count(emit, finish)
+
+    def flush(self) -> str:
+        """流正常结束：输出暂缓的尾部文本"""
+        if self.finish_reason:
+            return ""
+        emit, self._pending = self._pending, ""
+        return self._count(emit, None)[0]
+
+    def _count(self, emit: str, finish: Optional[str]) -> Tuple[str, Optional[str]]:
+        if self.max_tokens is not None:
+            tokens = approx_token_count(emit)
+            if self.tokens + tokens >= self.max_tokens:
+                if self.tokens + tokens > self.max_tokens or not finish:
+                    emit, tokens = truncate_to_tokens(emit, self.max_tokens - self.tokens)
+                    finish = FINISH_LENGTH
+                self._pending = ""
+            self.tokens += tokens
+        self.finish_reason = finish
+        return emit, finish
+
+    def _find_stop(self, text: str) -> Optional[int]:
+        positions = [i for i in (text.find(s) for s in self.stop) if i >= 0]
+        return min(positions) if positions else None
+
+    def _partial_stop_length(self, text: str) -> int:
+        """text 末尾与某个停止序列开头相同的最长长度"""
+        for length in range(min(self._holdback, len(text)), 0, -1):
+            tail = text[-length:]
+            if any(s.startswith(tail) for s in self.stop):
+                return length
+        return 0
@@ -0,0 +1,196 @@
+"""
+非流式、无会话上下文请求的响应缓存
+Open WebUI 的后台任务（标题、标签、追问建议）不带 chat_id 且经常完全相同，
+按模型、消息和用户范围的规范化哈希缓存 OpenAI 格式的响应，命中时不再调用 Dify
+
+- memory: 每个工作进程内的 LRU + TTL 缓存，按字节预算淘汰
+- sqlite: 存放在 SQLite 文件中，所有工作进程共享，同样按 TTL 和字节预算淘汰
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+from metrics import REGISTRY
+from sqlite_pool import shared_pool
+
+logger = logging.getLogger(__name__)
+
+CACHE_REQUESTS = REGISTRY.counter(
+    "opendify_response_cache_requests_total", "响应缓存查询次数", ("model", "result"))
+CACHE_BYTES = REGISTRY.gauge(
+    "opendify_response_cache_bytes", "响应缓存占用的字节数")
+
+
+def load_cache_config() -> dict:
+    """从环境变量读取响应缓存配置"""
+    models = os.getenv("RESPONSE_CACHE_MODELS", "").strip()
+    return {
+        # 启用缓存的模型：逗号分隔的列表，"*" 表示所有模型，留空表示关闭
+        "models": {m.strip() for m in models.split(",") if m.strip()},
+        "backend": os.getenv("RESPONSE_CACHE_BACKEND", "memory").strip().lower(),
+        "path": os.getenv("RESPONSE_CACHE_PATH", "data/response_cache.db"),
+        "ttl": float(os.getenv("RESPONSE_CACHE_TTL", "300")),
+        "max_bytes": int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+        # user: 不同用户的缓存互相隔离；global: 所有用户共享
+        "scope": os.getenv("RESPONSE_CACHE_SCOPE", "user").strip().lower(),
+    }
+
+
+class ResponseCache(ABC):
+    """缓存的公共部分：启用判断和键的计算，存储由子类的 get / put 实现"""
+
+    def __init__(self, config: dict):
+        self.config = config
+
+    def enabled_for(self, model: str) -> bool:
+        models = self.config["models"]
+        return "*" in models or model in models
+
+    def key(self, model: str, messages: list, user: str, options: Optional[dict] = None) -> str:
+        """模型、消息、用户范围和影响输出的参数（max_tokens、stop）的规范化哈希"""
+        scope = user if self.config["scope"] == "user" else ""
+        parts = [model, messages, scope] + ([options] if options else [])
+        material = json.dumps(parts, ensure_ascii=False, sort_keys=True,
+                              separators=(",", ":"), default=str)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def lookup(self, model: str, key: str) -> Optional[bytes]:
+        body = self.get(key)
+        CACHE_REQUESTS.inc(model=model, result="hit" if body is not None else "miss")
+        return body
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """未过期的缓存响应，没有时返回 None"""
+
+    @abstractmethod
+    def put(self, key: str, body: bytes) -> None:
+        """写入缓存响应"""
+
+    def reset(self) -> None:
+        """fork 之后重建本进程的状态"""
+
+
+class MemoryResponseCache(ResponseCache):
+    """工作进程内的 LRU + TTL 缓存"""
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, body = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return body
+
+    def put(self, key: str, body: bytes) -> None:
+        if len(body) > self.config["max_bytes"]:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + self.config["ttl"], body)
+            self._bytes += len(body)
+            while self._bytes > self.config["max_bytes"]:
+                self._remove(next(iter(self._entries)))
+            CACHE_BYTES.set(self._bytes)
+
+    def _remove(self, key: str) -> None:
+        _, body = self._entries.pop(key)
+        self._bytes -= len(body)
+
+    def reset(self) -> None:
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+
+class SQLiteResponseCache(ResponseCache):
+    """存放在 SQLite 文件中、所有工作进程共享的缓存"""
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.db_path = config["path"]
+        self._db = shared_pool(self.db_path, timeout=5.0)
+        self._db.ensure_schema(
+            '''
+            CREATE TABLE IF NOT EXISTS response_cache (
+                cache_key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache(last_used)',
+        )
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        try:
+            with self._db.connection() as conn:
+                row = conn.execute(
+                    'SELECT body FROM response_cache WHERE cache_key = ? AND expires_at > ?', (key, now)
+                ).fetchone()
+                if row is not None:
+                    conn.execute('UPDATE response_cache SET last_used = ? WHERE cache_key = ?', (now, key))
+                    conn.commit()
+                return bytes(row[0]) if row is not None else None
+        except sqlite3.Error as e:
+            logger.error(f"Response cache lookup failed: {e}")
+            return None
+
+    def put(self, key: str, body: bytes) -> None:
+        if len(body) > self.config["max_bytes"]:
+            return
+        now = time.time()
+        try:
+            with self._db.connection() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO response_cache (cache_key, body, size, expires_at, last_used) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (key, body, len(body), now + self.config["ttl"], now)
+                )
+                conn.execute('DELETE FROM response_cache WHERE expires_at <= ?', (now,))
+                total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM response_cache').fetchone()[0]
+                # 超出字节预算时按最近使用时间淘汰
+                if total > self.config["max_bytes"]:
+                    rows = conn.execute('SELECT cache_key, size FROM response_cache ORDER BY last_used').fetchall()
+                    evict = []
+                    for cache_key, size in rows:
+                        if total <= self.config["max_bytes"]:
+                            break
+                        evict.append((cache_key,))
+                        total -= size
+                    conn.executemany('DELETE FROM response_cache WHERE cache_key = ?', evict)
+                conn.commit()
+                CACHE_BYTES.set(total)
+        except sqlite3.Error as e:
+            logger.error(f"Response cache update failed: {e}")
+
+
+def create_response_cache(config: Optional[dict] = None) -> ResponseCache:
+    """按 RESPONSE_CACHE_BACKEND 创建缓存"""
+    config = config or load_cache_config()
+    if config["backend"] == "sqlite":
+        return SQLiteResponseCache(config)
+    if config["backend"] != "memory":
+        logger.warning(f"Unknown RESPONSE_CACHE_BACKEND '{config['backend']}', using memory")
+    return MemoryResponseCache(config)
@@ -50,7 +50,7 @@ exec gunicorn \
     --worker-class sync \
     --timeout 60 \
     --keepalive 2 \
-    --max-requests 2000 \
+    --max-requests ${GUNICORN_MAX_REQUESTS:-2000} \
     --max-requests-jitter 100 \
     --preload \
     --log-level $LOG_LEVEL \
@@ -0,0 +1,166 @@
+"""
+工作进程内共享的 SQLite 连接池
+会话映射、熔断器、上传缓存、用量统计等模块的表都放在同一个数据库文件中，
+同一进程内按数据库路径共用一个连接池，不再各自为每次操作打开连接并执行 PRAGMA
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SQLitePool:
+    """进程内 SQLite 连接池：WAL 模式，连接用完后回滚未提交事务并放回池中"""
+
+    def __init__(self, db_path: str, pool_size: Optional[int] = None, timeout: float = 60.0):
+        # 确保数据目录存在
+        dir_path = os.path.dirname(db_path)
+        if dir_path:  # 只有当路径包含目录时才创建
+            os.makedirs(dir_path, exist_ok=True)
+        self.db_path = db_path
+        # 等待数据库锁的秒数：会话映射允许等待较久，熔断器、单飞锁等在请求路径上的表应尽快失败
+        self.timeout = timeout
+        # 避免每次操作都重新打开连接并执行 PRAGMA
+        self.pool_size = pool_size if pool_size is not None else int(os.getenv("SQLITE_POOL_SIZE", "8"))
+        self._inherited_connections = []
+        self.reinit_after_fork()
+
+    def reinit_after_fork(self) -> None:
+        """
+        fork 之后在子进程中重建连接池
+        SQLite 连接不能跨 fork 使用，继承来的连接只保留引用、不关闭，
+        以免关闭文件描述符时释放父进程持有的锁
+        """
+        pool = getattr(self, "_pool", None)
+        if pool:
+            self._inherited_connections.extend(pool)
+        self._pool = []
+        self._pool_pid = os.getpid()
+        self._lock = threading.Lock()
+
+    @property
+    def idle(self) -> int:
+        """池中空闲的连接数"""
+        return len(self._pool)
+
+    def _open_connection(self) -> sqlite3.Connection:
+        """打开新的数据库连接，数据库被锁定时指数退避重试"""
+        max_retries = 3
+        retry_count = 0
+
+        while True:
+            conn = None
+            try:
+                conn = sqlite3.connect(
+                    self.db_path,
+                    timeout=self.timeout,
+                    check_same_thread=False  # 允许多线程访问
+                )
+                # 启用 WAL 模式提高并发性能
+                conn.execute('PRAGMA journal_mode=WAL')
+                # 启用外键约束
+                conn.execute('PRAGMA foreign_keys=ON')
+                # 设置更长的忙等待超时
+                conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+                # 设置同步模式为NORMAL以平衡性能和安全性
+                conn.execute('PRAGMA synchronous=NORMAL')
+                return conn
+
+            except sqlite3.OperationalError as e:
+                if conn:
+                    conn.close()
+                if "database is locked" in str(e) and retry_count < max_retries - 1:
+                    retry_count += 1
+                    # 指数退避重试策略
+                    wait_time = 0.1 * (2 ** retry_count)
+                    logger.warning(f"Database locked, retrying in {wait_time}s (attempt {retry_count}/{max_retries})")
+                    time.sleep(wait_time)
+                    continue
+                logger.error(f"Database connection error after {retry_count + 1} attempts: {e}")
+                raise
+            except Exception as e:
+                if conn:
+                    conn.close()
+                logger.error(f"Database connection error: {e}")
+                raise
+
+    def _acquire(self) -> sqlite3.Connection:
+        """从连接池取出连接，池为空时新建"""
+        if self._pool_pid != os.getpid():
+            self.reinit_after_fork()
+        with self._lock:
+            if self._pool:
+                return self._pool.pop()
+        return self._open_connection()
+
+    def _release(self, conn: sqlite3.Connection) -> None:
+        """归还连接到连接池，池已满或已跨进程时直接关闭"""
+        if self._pool_pid == os.getpid():
+            with self._lock:
+                if len(self._pool) < self.pool_size:
+                    self._pool.append(conn)
+                    return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """
+        获取数据库连接的上下文管理器
+        连接来自连接池，使用完毕后回滚未提交事务并归还
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+        except Exception:
+            # 出错的连接可能处于未知状态，直接丢弃
+            try:
+                conn.rollback()
+            finally:
+                conn.close()
+            raise
+        else:
+            if conn.in_transaction:
+                conn.rollback()
+            self._release(conn)
+
+    def ensure_schema(self, *statements: str) -> None:
+        """执行建表、建索引语句（应使用 IF NOT EXISTS，多个进程可能同时执行）"""
+        with self.connection() as conn:
+            for statement in statements:
+                conn.execute(statement)
+            conn.commit()
+
+    def close(self) -> None:
+        """关闭本进程连接池中的连接（工作进程退出前调用，最后一个连接关闭时 SQLite 会检查点 WAL）"""
+        if self._pool_pid != os.getpid():
+            return
+        with self._lock:
+            pool, self._pool = self._pool, []
+        for conn in pool:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.debug(f"Failed to close pooled connection: {e}")
+
+
+_pools: Dict[Tuple[str, float], SQLitePool] = {}
+_pools_lock = threading.Lock()
+
+
+def shared_pool(db_path: str, pool_size: Optional[int] = None, timeout: float = 60.0) -> SQLitePool:
+    """
+    返回该数据库文件在本进程内的共享连接池（pool_size 只在首次创建时生效）
+    锁等待时间不同的模块使用不同的连接池，各自的连接保留自己的 busy_timeout
+    """
+    key = (os.path.abspath(db_path), timeout)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SQLitePool(db_path, pool_size, timeout)
+        return pool
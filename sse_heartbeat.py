@@ -0,0 +1,116 @@
+"""
+SSE 心跳与进度事件转发
+Dify 的 Agent / 工作流应用在调用工具、检索时可能几十秒只发送我们不转发的事件（agent_thought、node_started 等），
+期间客户端收不到任何数据，中间代理会按空闲超时断开连接，客户端重连后整个生成重新开始。
+
+上游读取放在后台 greenlet 中，由定时器驱动：超过 SSE_HEARTBEAT_INTERVAL 秒没有数据可写时
+写出一个 SSE 注释行（": ping"），OpenAI 客户端会忽略它；也可以把选定的 Dify 进度事件作为扩展字段转发
+"""
+
+import os
+import logging
+from typing import Any, Callable, Optional
+
+import gevent
+from gevent.queue import Queue, Empty
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# 迭代 Heartbeats 时表示需要写出心跳
+HEARTBEAT = object()
+PING = b": ping\n\n"
+
+SSE_HEARTBEATS = REGISTRY.counter(
+    "opendify_sse_heartbeats_total", "上游静默期间写出的 SSE 心跳数", ("model",))
+FORWARDED_EVENTS = REGISTRY.counter(
+    "opendify_sse_forwarded_events_total", "作为扩展字段转发给客户端的 Dify 进度事件数", ("event",))
+
+# 转发进度事件时去掉的字段（客户端用不到的 Dify 内部标识）
+_INTERNAL_FIELDS = ("task_id", "message_id", "conversation_id")
+
+_DONE = object()
+
+# 等待写出的数据上限：客户端读得慢时 emit 阻塞，上游读取随之暂停，不在内存中堆积
+MAX_PENDING = 64
+
+
+def load_heartbeat_config() -> dict:
+    """从环境变量读取心跳配置"""
+    return {
+        # 没有数据可写超过该秒数时写出心跳，0 表示关闭
+        "interval": float(os.getenv("SSE_HEARTBEAT_INTERVAL", "15")),
+        # 作为扩展字段转发的 Dify 事件，逗号分隔（如 agent_thought,node_started），默认不转发
+        "forward_events": {e.strip() for e in os.getenv("SSE_FORWARD_EVENTS", "").split(",") if e.strip()},
+    }
+
+
+def progress_extension(dify_chunk: dict) -> dict:
+    """转发给客户端的进度事件内容"""
+    FORWARDED_EVENTS.inc(event=dify_chunk.get("event", ""))
+    return {key: value for key, value in dify_chunk.items() if key not in _INTERNAL_FIELDS}
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class Heartbeats:
+    """
+    在后台 greenlet 中执行 producer(emit)，迭代时依次产出 producer 通过 emit 交出的数据，
+    等待超过 interval 秒没有数据时产出 HEARTBEAT；producer 返回后迭代结束，result() 返回其返回值或抛出其异常。
+    提前关闭迭代器（客户端断开）时结束后台 greenlet，producer 中的 finally / except BaseException 负责关闭上游。
+    队列最多缓存 max_pending 项，写满后 emit 阻塞直到迭代方取走数据
+    """
+
+    def __init__(self, producer: Callable[[Callable[[Any], None]], Any], interval: float,
+                 max_pending: int = MAX_PENDING):
+        self._producer = producer
+        self._timeout = interval if interval > 0 else None
+        self._queue = Queue(maxsize=max_pending)
+        self._greenlet = None
+        self._result = None
+
+    def _run(self):
+        try:
+            self._result = self._producer(self._queue.put)
+        except gevent.GreenletExit:
+            # 迭代方已关闭，没有人再读取队列，写入结束标记会在满队列上永久阻塞
+            raise
+        except BaseException as e:
+            self._queue.put(_Failure(e))
+        self._queue.put(_DONE)
+
+    def __iter__(self):
+        self._greenlet = gevent.spawn(self._run)
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=self._timeout)
+                except Empty:
+                    yield HEARTBEAT
+                    continue
+                if item is _DONE:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            if not self._greenlet.dead:
+                self._greenlet.kill()
+
+    def close(self) -> None:
+        """结束后台 greenlet（可重复调用）"""
+        if self._greenlet is not None and not self._greenlet.dead:
+            self._greenlet.kill()
+
+    def result(self) -> Optional[Any]:
+        return self._result
+
+
+def pump_events(events, emit) -> None:
+    """依次把 events 交给 emit，作为 Heartbeats 的 producer 使用"""
+    for event in events:
+        emit(event)
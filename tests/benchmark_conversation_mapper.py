@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+ConversationMapper 微基准测试
+
+测量 get_dify_conversation_id / set_mapping / update_last_used /
+cleanup_old_mappings / 统计查询 在不同表规模和并发进程数下的
+吞吐量 (ops/sec) 与延迟分位数，并可与保存的基线比较，
+超过允许的回退百分比时以非零状态码退出。
+
+用法:
+    python tests/benchmark_conversation_mapper.py
+    python tests/benchmark_conversation_mapper.py --sizes 1000,1000000,10000000 --processes 1,4,16,32
+    python tests/benchmark_conversation_mapper.py --save-baseline tests/benchmark_baseline.json
+    python tests/benchmark_conversation_mapper.py --baseline tests/benchmark_baseline.json --max-regression 15
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import zlib
+import logging
+import argparse
+import tempfile
+import multiprocessing
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_mapper_sqlite import ConversationMapper
+
+# 配置日志
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - PID:%(process)d - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# 基准测试中 ConversationMapper 自身的日志会淹没结果，只保留警告以上
+logging.getLogger("conversation_mapper_sqlite").setLevel(logging.WARNING)
+
+DEFAULT_SIZES = [1_000, 1_000_000, 10_000_000]
+DEFAULT_PROCESSES = [1, 2, 4, 8, 16, 32]
+
+
+def _op_get(mapper, rows, rng):
+    mapper.get_dify_conversation_id(f"bench-chat-{rng.randrange(rows)}")
+
+
+def _op_set(mapper, rows, rng):
+    # 对已有行做 UPSERT，保持表规模不变
+    n = rng.randrange(rows)
+    mapper.set_mapping(f"bench-chat-{n}", f"bench-conv-{n}")
+
+
+def _op_update(mapper, rows, rng):
+    mapper.update_last_used(f"bench-chat-{rng.randrange(rows)}")
+
+
+def _op_cleanup(mapper, rows, rng):
+    # 截止时间早于所有种子数据，只测量扫描成本而不真正删除
+    mapper.cleanup_old_mappings(max_age_days=3650)
+
+
+def _op_stats(mapper, rows, rng):
+    mapper.get_mapping_stats()
+
+
+def _op_count(mapper, rows, rng):
+    mapper.get_mapping_count()
+
+
+def _op_recent(mapper, rows, rng):
+    mapper.get_recent_mappings(10)
+
+
+OPERATIONS = {
+    "get_dify_conversation_id": _op_get,
+    "set_mapping": _op_set,
+    "update_last_used": _op_update,
+    "cleanup_old_mappings": _op_cleanup,
+    "get_mapping_stats": _op_stats,
+    "get_mapping_count": _op_count,
+    "get_recent_mappings": _op_recent,
+}
+
+
+def seed_database(data_dir: str, rows: int) -> str:
+    """
+    生成（或复用）包含指定行数的种子数据库
+    使用递归 CTE 在单个事务中批量插入，1000 万行也只需几十秒
+    """
+    db_path = os.path.join(data_dir, f"bench_{rows}.db")
+
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(db_path)
+        try:
+            existing = conn.execute('SELECT COUNT(*) FROM conversation_mappings').fetchone()[0]
+        except sqlite3.OperationalError:
+            existing = -1
+        finally:
+            conn.close()
+        if existing == rows:
+            logger.info(f"♻️  复用已有种子数据库: {db_path} ({rows} 行)")
+            return db_path
+        os.remove(db_path)
+
+    # 由 ConversationMapper 创建表结构和索引，保证与生产一致
+    ConversationMapper(db_path)
+
+    logger.info(f"🌱 生成种子数据库: {db_path} ({rows} 行)...")
+    start = time.time()
+    now = int(time.time())
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute('''
+            WITH RECURSIVE seq(n) AS (
+                SELECT 0 UNION ALL SELECT n + 1 FROM seq WHERE n < ?
+            )
+            INSERT INTO conversation_mappings
+                (webui_chat_id, dify_conversation_id, created_at, last_used, updated_at)
+            SELECT
+                'bench-chat-' || n,
+                'bench-conv-' || n,
+                ? - (n % 2592000),
+                ? - (n % 2592000),
+                ?
+            FROM seq
+        ''', (rows - 1, now, now, now))
+        conn.commit()
+        conn.execute('ANALYZE conversation_mappings')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        conn.close()
+    logger.info(f"✅ 种子数据库生成完成，耗时 {time.time() - start:.1f} 秒")
+    return db_path
+
+
+def _worker(args):
+    """
+    工作进程：在 start_at 时刻同时开始，持续 duration 秒反复执行同一操作
+    返回每次操作的延迟（秒）
+    """
+    db_path, op_name, rows, duration, start_at, seed = args
+    mapper = ConversationMapper(db_path)
+    operation = OPERATIONS[op_name]
+    rng = random.Random(seed)
+    latencies = []
+
+    # 等待所有进程就绪后同时开始
+    delay = start_at - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+    deadline = time.perf_counter() + duration
+    while True:
+        t0 = time.perf_counter()
+        if t0 >= deadline:
+            break
+        operation(mapper, rows, rng)
+        latencies.append(time.perf_counter() - t0)
+
+    return latencies
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_case(db_path: str, op_name: str, rows: int, processes: int, duration: float) -> dict:
+    """运行单个 (操作, 表规模, 进程数) 组合并汇总结果"""
+    # 给所有进程留出启动和打开数据库的时间
+    start_at = time.time() + 1.0 + 0.05 * processes
+    # 固定的种子（hash() 受 PYTHONHASHSEED 影响，每次运行不同），两次运行的负载可以直接比较
+    tasks = [
+        (db_path, op_name, rows, duration, start_at, zlib.crc32(f"{op_name}:{rows}:{processes}:{i}".encode()))
+        for i in range(processes)
+    ]
+
+    with multiprocessing.Pool(processes=processes) as pool:
+        per_worker = pool.map(_worker, tasks)
+
+    latencies = sorted(lat for worker in per_worker for lat in worker)
+    total_ops = len(latencies)
+
+    return {
+        "operation": op_name,
+        "rows": rows,
+        "processes": processes,
+        "duration_s": duration,
+        "total_ops": total_ops,
+        "ops_per_sec": total_ops / duration if duration > 0 else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p95_ms": _percentile(latencies, 95) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "max_ms": (latencies[-1] * 1000) if latencies else 0.0,
+    }
+
+
+def case_key(result: dict) -> str:
+    return f"{result['operation']}|{result['rows']}|{result['processes']}"
+
+
+def compare_with_baseline(results, baseline: dict, max_regression_pct: float):
+    """
+    与基线比较：吞吐量下降或 p99 延迟上升超过 max_regression_pct 视为回退
+    返回回退描述列表
+    """
+    regressions = []
+    for result in results:
+        key = case_key(result)
+        base = baseline.get(key)
+        if not base:
+            logger.info(f"ℹ️  基线中没有 {key}，跳过比较")
+            continue
+
+        if base["ops_per_sec"] > 0:
+            drop = (base["ops_per_sec"] - result["ops_per_sec"]) / base["ops_per_sec"] * 100
+            if drop > max_regression_pct:
+                regressions.append(
+                    f"{key}: ops/sec {result['ops_per_sec']:.1f} vs 基线 {base['ops_per_sec']:.1f} (下降 {drop:.1f}%)"
+                )
+
+        if base["p99_ms"] > 0:
+            rise = (result["p99_ms"] - base["p99_ms"]) / base["p99_ms"] * 100
+            if rise > max_regression_pct:
+                regressions.append(
+                    f"{key}: p99 {result['p99_ms']:.3f}ms vs 基线 {base['p99_ms']:.3f}ms (上升 {rise:.1f}%)"
+                )
+
+    return regressions
+
+
+def _parse_int_list(value: str):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ConversationMapper 微基准测试")
+    parser.add_argument("--sizes", type=_parse_int_list, default=DEFAULT_SIZES,
+                        help="表规模列表，逗号分隔 (默认: 1000,1000000,10000000)")
+    parser.add_argument("--processes", type=_parse_int_list, default=DEFAULT_PROCESSES,
+                        help="并发进程数列表，逗号分隔 (默认: 1,2,4,8,16,32)")
+    parser.add_argument("--operations", type=lambda v: [o for o in v.split(',') if o],
+                        default=list(OPERATIONS.keys()),
+                        help=f"要测量的操作，逗号分隔 (可选: {','.join(OPERATIONS.keys())})")
+    parser.add_argument("--duration", type=float, default=5.0,
+                        help="每个组合的测量时长（秒）")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "opendify_bench"),
+                        help="种子数据库存放目录（可复用以避免重复生成）")
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="与该基线文件比较")
+    parser.add_argument("--save-baseline", help="将本次结果保存为基线文件")
+    parser.add_argument("--max-regression", type=float,
+                        default=float(os.getenv("BENCH_MAX_REGRESSION_PCT", "10")),
+                        help="允许的最大回退百分比 (默认: 10，可用 BENCH_MAX_REGRESSION_PCT 覆盖)")
+    args = parser.parse_args()
+
+    unknown = [op for op in args.operations if op not in OPERATIONS]
+    if unknown:
+        parser.error(f"未知操作: {', '.join(unknown)}")
+
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    results = []
+    for rows in args.sizes:
+        db_path = seed_database(args.data_dir, rows)
+        for op_name in args.operations:
+            for processes in args.processes:
+                result = run_case(db_path, op_name, rows, processes, args.duration)
+                results.append(result)
+                logger.info(
+                    f"📊 {op_name:<26} rows={rows:<9} procs={processes:<3} "
+                    f"{result['ops_per_sec']:>10.1f} ops/s  "
+                    f"p50={result['p50_ms']:.3f}ms p95={result['p95_ms']:.3f}ms p99={result['p99_ms']:.3f}ms"
+                )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"💾 结果已写入 {args.output}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({case_key(r): r for r in results}, f, indent=2, sort_keys=True)
+        logger.info(f"💾 基线已保存到 {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.max_regression)
+        if regressions:
+            logger.error(f"❌ 检测到 {len(regressions)} 项性能回退 (阈值 {args.max_regression}%):")
+            for regression in regressions:
+                logger.error(f"  - {regression}")
+            return False
+        logger.info(f"✅ 与基线相比无超过 {args.max_regression}% 的回退")
+
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+流式响应首字节 / 首字延迟基准测试
+
+在进程内启动 OpenDify（gevent WSGI 服务器）和模拟 Dify，
+并发发起流式请求，测量客户端看到的：
+  - TTFB: 收到第一个响应字节（响应头和首个分片）的时间
+  - TTFT: 收到第一个内容分片（delta.content 非空）的时间
+模拟 Dify 的首字节延迟（排队 + 生成首字）可以配置多个值分别测量。
+
+用法:
+    python tests/benchmark_ttfb.py
+    python tests/benchmark_ttfb.py --dify-ttfb 0,0.2,1 --requests 200 --concurrency 20
+    python tests/benchmark_ttfb.py --output ttfb.json
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main  # noqa: E402  （main 会先执行 gevent monkey patch）
+import httpx  # noqa: E402
+from gevent.pool import Pool  # noqa: E402
+from gevent.pywsgi import WSGIServer  # noqa: E402
+
+from fake_dify import FakeDify  # noqa: E402
+
+# 基准测试中请求日志会淹没结果，只保留警告以上
+logging.getLogger().setLevel(logging.WARNING)
+logger = logging.getLogger("benchmark_ttfb")
+logger.setLevel(logging.INFO)
+
+BENCH_MODEL = "bench-model"
+BENCH_KEY = "app-bench-ttfb"
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _one_request(client, url, index):
+    """发起一个流式请求，返回 (TTFB, TTFT, 是否完整)"""
+    started = time.perf_counter()
+    ttfb = ttft = None
+    completed = False
+    with client.stream("POST", url, json={
+        "model": BENCH_MODEL,
+        "stream": True,
+        "messages": [{"role": "user", "content": f"benchmark {index}"}],
+    }, headers={"X-OpenWebUI-Chat-Id": f"bench-ttfb-{index}-{time.time_ns()}"}) as response:
+        for line in response.iter_lines():
+            if ttfb is None:
+                ttfb = time.perf_counter() - started
+            if not line.startswith("data: "):
+                continue
+            payload = line[len("data: "):]
+            if payload == "[DONE]":
+                completed = True
+                continue
+            if ttft is None:
+                delta = json.loads(payload).get("choices", [{}])[0].get("delta", {})
+                if delta.get("content"):
+                    ttft = time.perf_counter() - started
+    return ttfb, ttft, completed
+
+
+def run_case(base_url: str, fake: FakeDify, dify_ttfb: float, requests: int, concurrency: int) -> dict:
+    """以给定的 Dify 首字节延迟运行一组请求并汇总结果"""
+    fake.configure(BENCH_KEY, ttfb=dify_ttfb, chunks=["Hello", " bench"])
+    url = f"{base_url}/v1/chat/completions"
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    with httpx.Client(timeout=60, limits=limits) as client:
+        pool = Pool(concurrency)
+        results = pool.map(lambda i: _one_request(client, url, i), range(requests))
+
+    ttfbs = sorted(r[0] for r in results if r[0] is not None)
+    ttfts = sorted(r[1] for r in results if r[1] is not None)
+    return {
+        "dify_ttfb_s": dify_ttfb,
+        "requests": requests,
+        "concurrency": concurrency,
+        "completed": sum(1 for r in results if r[2]),
+        "ttfb_p50_ms": _percentile(ttfbs, 50) * 1000,
+        "ttfb_p95_ms": _percentile(ttfbs, 95) * 1000,
+        "ttfb_p99_ms": _percentile(ttfbs, 99) * 1000,
+        "ttft_p50_ms": _percentile(ttfts, 50) * 1000,
+        "ttft_p95_ms": _percentile(ttfts, 95) * 1000,
+        "ttft_p99_ms": _percentile(ttfts, 99) * 1000,
+    }
+
+
+def start_harness(model_keys: dict):
+    """启动模拟 Dify 和进程内 OpenDify，返回 (fake, server, base_url)"""
+    fake = FakeDify().start()
+    main.DIFY_API_BASE = fake.base_url
+    main.MODEL_TO_API_KEY = dict(model_keys)
+    main.FAILOVER_CONFIG = {}
+    server = WSGIServer(("127.0.0.1", 0), main.app, log=None)
+    server.start()
+    return fake, server, f"http://127.0.0.1:{server.server_port}"
+
+
+def _parse_float_list(value: str):
+    return [float(v) for v in value.split(',') if v.strip()]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="流式响应首字节 / 首字延迟基准测试")
+    parser.add_argument("--dify-ttfb", type=_parse_float_list, default=[0.0, 0.2, 1.0],
+                        help="模拟 Dify 的首字节延迟列表（秒），逗号分隔 (默认: 0,0.2,1)")
+    parser.add_argument("--requests", type=int, default=100, help="每组请求数")
+    parser.add_argument("--concurrency", type=int, default=10, help="并发请求数")
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    fake, server, base_url = start_harness({BENCH_MODEL: BENCH_KEY})
+
+    results = []
+    try:
+        for dify_ttfb in args.dify_ttfb:
+            result = run_case(base_url, fake, dify_ttfb, args.requests, args.concurrency)
+            results.append(result)
+            logger.info(
+                f"📊 dify_ttfb={dify_ttfb:<5} completed={result['completed']}/{args.requests}  "
+                f"TTFB p50={result['ttfb_p50_ms']:.1f}ms p95={result['ttfb_p95_ms']:.1f}ms  "
+                f"TTFT p50={result['ttft_p50_ms']:.1f}ms p95={result['ttft_p95_ms']:.1f}ms"
+            )
+    finally:
+        server.stop()
+        fake.stop()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"💾 结果已写入 {args.output}")
+    return all(r["completed"] == args.requests for r in results)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(0 if main_cli() else 1)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+集成测试的公共部分 - 启动模拟 Dify 并把 main 指向它的测试基类，以及测试配置的构造函数
+
+用法:
+    class TestSomething(FakeDifyTestCase):
+        MODEL_CONFIG = {"test-model": "app-test"}
+
+        def setUp(self):
+            super().setUp()
+            self.patch_main("response_cache", MemoryResponseCache(...))
+            self.fake.configure("app-test", chunks=["Hi"])
+"""
+
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from fake_dify import FakeDify
+
+
+def config_factory(base, **defaults):
+    """
+    返回 make_config(**overrides)：以 base（load_*_config 函数或配置字典）为基础，
+    依次叠加测试默认值和每个测试的覆盖值
+    """
+    def make_config(**overrides):
+        config = base() if callable(base) else dict(base)
+        config.update(defaults)
+        config.update(overrides)
+        return config
+    return make_config
+
+
+class FakeDifyTestCase(unittest.TestCase):
+    """
+    每个测试类启动一个模拟 Dify；每个测试重置指标，并把 main 的 Dify 地址、模型配置和故障转移配置指向它
+    补丁在测试结束后自动撤销（addCleanup），子类不需要自己 stop
+    """
+
+    # main.MODEL_TO_API_KEY，为 None 时不替换
+    MODEL_CONFIG = None
+    FAILOVER_CONFIG = {}
+    # 启动的模拟 Dify 个数，多于一个时 DIFY_API_BASE 为逗号分隔的多个上游
+    FAKE_UPSTREAMS = 1
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fakes = [FakeDify().start() for _ in range(cls.FAKE_UPSTREAMS)]
+        cls.fake = cls.fakes[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        for fake in cls.fakes:
+            fake.stop()
+
+    def setUp(self):
+        main.REGISTRY.reset()
+        self.patch_main("DIFY_API_BASE", ",".join(fake.base_url for fake in self.fakes))
+        if self.MODEL_CONFIG is not None:
+            self.patch_main("MODEL_TO_API_KEY", self.MODEL_CONFIG)
+        self.patch_main("FAILOVER_CONFIG", self.FAILOVER_CONFIG)
+        self.client = main.app.test_client()
+
+    def patch_main(self, name, value):
+        """在本测试期间替换 main 中的全局对象"""
+        patcher = patch.object(main, name, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return value
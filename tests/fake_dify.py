@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+本地模拟 Dify 服务 - 供集成测试和基准测试使用
+
+按 API Key 配置行为（首字节延迟、状态码、回答分片、分片间隔），
+并记录收到的请求、上传的文件和 stop 调用，便于断言。
+
+用法:
+    fake = FakeDify().start()
+    fake.configure("app-primary", ttfb=2.0)
+    ... 请求 fake.base_url ...
+    fake.stop()
+"""
+
+import json
+import time
+import uuid
+import threading
+
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+
+DEFAULT_BEHAVIOR = {
+    "status": 200,            # 返回的 HTTP 状态码
+    "ttfb": 0.0,              # 首个 message 事件之前的延迟（秒）
+    "chunks": ["Hello", " from", " fake", " Dify"],
+    "chunk_delay": 0.0,       # 分片之间的延迟（秒）
+    "pre_events": [],         # 首个 message 之前发送的其他事件（如 workflow_started）
+    "usage": {"prompt_tokens": 5, "completion_tokens": 4, "total_tokens": 9},
+    "headers": {},            # 错误响应附带的头（如 Retry-After）
+    "capacity": 0,            # 同时处理的流式请求数上限，超出的请求排队等待（0 表示不限）
+    "script": None,           # callable(payload) -> [(延迟秒数, 分片), ...]，设置时代替 ttfb / chunks（流量回放使用）
+}
+
+
+class FakeDify:
+    """在后台线程中运行的最小 Dify chat-messages 实现"""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.behaviors = {}
+        self.requests = []
+        self.stopped_tasks = []
+        self.uploads = []
+        # 已删除的会话：携带这些 conversation_id 的请求与 Dify 一样返回 404
+        self.deleted_conversations = set()
+        self.active_streams = 0
+        self.max_active_streams = 0
+        self._lock = threading.Lock()
+        self._capacity_cond = threading.Condition(self._lock)
+        self._busy = {}
+        self._server = make_server(host, port, self._wsgi_app, threaded=True)
+        self.base_url = f"http://{host}:{self._server.server_port}/v1"
+        self._thread = None
+
+    def configure(self, api_key, **behavior):
+        """设置某个 API Key 的行为，未指定的字段使用默认值"""
+        merged = dict(DEFAULT_BEHAVIOR)
+        merged.update(behavior)
+        self.behaviors[api_key] = merged
+        with self._capacity_cond:
+            self._capacity_cond.notify_all()
+        return self
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def requests_for(self, api_key):
+        return [r for r in self.requests if r["api_key"] == api_key]
+
+    # ------------------------------------------------------------------ WSGI
+
+    def _wsgi_app(self, environ, start_response):
+        request = Request(environ)
+        api_key = request.headers.get("Authorization", "").replace("Bearer ", "")
+        behavior = self.behaviors.get(api_key, DEFAULT_BEHAVIOR)
+        path = request.path
+
+        if request.method == "POST" and path.endswith("/stop"):
+            task_id = path.split("/")[-2]
+            with self._lock:
+                self.stopped_tasks.append(task_id)
+            response = Response(json.dumps({"result": "success"}), mimetype="application/json")
+        elif request.method == "POST" and path.endswith("/files/upload"):
+            upload = request.files.get("file")
+            file_id = f"file-{uuid.uuid4().hex[:12]}"
+            with self._lock:
+                self.uploads.append({"api_key": api_key, "id": file_id, "filename": upload.filename,
+                                     "mime": upload.mimetype, "data": upload.read(), "user": request.form.get("user")})
+            response = Response(json.dumps({"id": file_id, "name": upload.filename}),
+                                status=201, mimetype="application/json")
+        elif request.method == "POST" and path.endswith("/chat-messages"):
+            payload = request.get_json(silent=True) or {}
+            with self._lock:
+                self.requests.append({"api_key": api_key, "payload": payload, "time": time.time()})
+            response = self._chat_messages(api_key, payload, behavior)
+        else:
+            response = Response("", status=200)
+        return response(environ, start_response)
+
+    def _chat_messages(self, api_key, payload, behavior):
+        if payload.get("conversation_id") in self.deleted_conversations:
+            return Response(json.dumps({"code": "not_found", "message": "Conversation Not Exists.", "status": 404}),
+                            status=404, mimetype="application/json")
+        if behavior["status"] != 200:
+            return Response(json.dumps({"code": "fake_error", "message": "fake upstream error"}),
+                            status=behavior["status"], headers=behavior["headers"],
+                            mimetype="application/json")
+
+        conversation_id = payload.get("conversation_id") or f"conv-{uuid.uuid4().hex[:12]}"
+        message_id = f"msg-{uuid.uuid4().hex[:12]}"
+        task_id = f"task-{uuid.uuid4().hex[:12]}"
+
+        if payload.get("response_mode") != "streaming":
+            time.sleep(behavior["ttfb"])
+            return Response(json.dumps({
+                "event": "message",
+                "task_id": task_id,
+                "message_id": message_id,
+                "conversation_id": conversation_id,
+                "answer": "".join(behavior["chunks"]),
+                "metadata": {"usage": behavior["usage"]},
+                "created_at": int(time.time()),
+            }), mimetype="application/json")
+
+        def events():
+            with self._lock:
+                self.active_streams += 1
+                self.max_active_streams = max(self.max_active_streams, self.active_streams)
+            admitted = False
+            try:
+                base = {"task_id": task_id, "message_id": message_id, "conversation_id": conversation_id}
+                for event in behavior["pre_events"]:
+                    yield self._sse({**base, "event": event})
+                # 模拟 Dify 内部排队：容量每次重新读取，测试中途调整容量立即生效
+                with self._capacity_cond:
+                    while 0 < self.behaviors.get(api_key, behavior)["capacity"] <= self._busy.get(api_key, 0):
+                        self._capacity_cond.wait(0.05)
+                    self._busy[api_key] = self._busy.get(api_key, 0) + 1
+                    admitted = True
+                if behavior["script"] is not None:
+                    for delay, chunk in behavior["script"](payload):
+                        time.sleep(delay)
+                        yield self._sse({**base, "event": "message", "answer": chunk})
+                else:
+                    time.sleep(behavior["ttfb"])
+                    for i, chunk in enumerate(behavior["chunks"]):
+                        if i and behavior["chunk_delay"]:
+                            time.sleep(behavior["chunk_delay"])
+                        yield self._sse({**base, "event": "message", "answer": chunk})
+                yield self._sse({**base, "event": "message_end", "metadata": {"usage": behavior["usage"]}})
+            finally:
+                with self._capacity_cond:
+                    self.active_streams -= 1
+                    if admitted:
+                        self._busy[api_key] -= 1
+                        self._capacity_cond.notify_all()
+
+        return Response(events(), mimetype="text/event-stream")
+
+    @staticmethod
+    def _sse(data):
+        return f"data: {json.dumps(data)}\n\n".encode("utf-8")
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+流量回放
+
+读取流量采集文件（TRAFFIC_CAPTURE=true 时写入 data/traffic，见 traffic_capture.py），
+在进程内的 OpenDify 和模拟 Dify 上按记录的到达间隔以 N 倍速重放：
+  - 请求：相同的模型、消息数量和每条消息的长度、是否流式、max_tokens（消息内容用占位字符填充）
+  - 上游：模拟 Dify 按记录的 message 事件时间和长度输出分片
+输出回放的 TTFT / 总耗时分位数，与按倍速换算后的记录值对比。
+
+用法:
+    python tests/replay_traffic.py data/traffic/capture-*.jsonl*
+    python tests/replay_traffic.py data/traffic/*.gz --speed 10 --limit 500 --output replay.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main  # noqa: E402  （main 会先执行 gevent monkey patch）
+import gevent  # noqa: E402
+import httpx  # noqa: E402
+
+from traffic_capture import read_capture  # noqa: E402
+from benchmark_ttfb import start_harness, _percentile  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+logger = logging.getLogger("replay_traffic")
+logger.setLevel(logging.INFO)
+
+REPLAY_KEY = "app-replay"
+
+# 最后一条消息以该标记开头，模拟 Dify 据此找到对应的记录
+_MARKER = re.compile(r"^rid:(\d+) ")
+
+
+def build_request(index: int, record: dict) -> dict:
+    """按记录的形态构造 OpenAI 请求（内容为占位字符）"""
+    messages = [{"role": m.get("role") or "user", "content": "x" * m.get("chars", 0)}
+                for m in record.get("messages") or []]
+    if not messages:
+        messages = [{"role": "user", "content": ""}]
+    marker = f"rid:{index} "
+    messages[-1]["content"] = marker + "x" * max(len(messages[-1]["content"]) - len(marker), 0)
+    openai_request = {"model": record.get("model"), "stream": record.get("stream", False), "messages": messages}
+    if record.get("max_tokens"):
+        openai_request["max_tokens"] = record["max_tokens"]
+    return openai_request
+
+
+def make_script(records: list, speed: float):
+    """模拟 Dify 的分片脚本：按记录的事件时间（除以倍速）和长度输出"""
+    def script(payload):
+        match = _MARKER.match(payload.get("query") or "")
+        if not match:
+            return [(0, "replay")]
+        steps, previous = [], 0.0
+        for offset, chars in records[int(match.group(1))].get("events", []):
+            steps.append((max(offset - previous, 0) / speed, "w" * max(chars, 1)))
+            previous = offset
+        return steps
+    return script
+
+
+def _replay_one(client, url, index, record):
+    """发起一个回放请求，返回 (TTFT, 总耗时, 是否成功)"""
+    openai_request = build_request(index, record)
+    headers = {"X-OpenWebUI-Chat-Id": f"replay-{index}-{time.time_ns()}"} if record.get("chat") else {}
+    started = time.perf_counter()
+    if not openai_request["stream"]:
+        response = client.post(url, json=openai_request, headers=headers)
+        elapsed = time.perf_counter() - started
+        return None, elapsed, response.status_code == 200
+
+    ttft, completed = None, False
+    with client.stream("POST", url, json=openai_request, headers=headers) as response:
+        for line in response.iter_lines():
+            if not line.startswith("data: "):
+                continue
+            payload = line[len("data: "):]
+            if payload == "[DONE]":
+                completed = True
+                continue
+            if ttft is None:
+                choices = json.loads(payload).get("choices") or [{}]
+                if choices[0].get("delta", {}).get("content"):
+                    ttft = time.perf_counter() - started
+    return ttft, time.perf_counter() - started, completed and response.status_code == 200
+
+
+def _summary(prefix: str, ttfts: list, durations: list) -> dict:
+    ttfts, durations = sorted(ttfts), sorted(durations)
+    return {
+        f"{prefix}_ttft_p50_ms": _percentile(ttfts, 50) * 1000,
+        f"{prefix}_ttft_p95_ms": _percentile(ttfts, 95) * 1000,
+        f"{prefix}_duration_p50_ms": _percentile(durations, 50) * 1000,
+        f"{prefix}_duration_p95_ms": _percentile(durations, 95) * 1000,
+    }
+
+
+def replay(base_url: str, fake, records: list, speed: float = 1.0) -> dict:
+    """按记录的到达间隔（除以倍速）重放所有请求并汇总结果"""
+    fake.configure(REPLAY_KEY, script=make_script(records, speed))
+    url = f"{base_url}/v1/chat/completions"
+    t0 = min(r["ts"] for r in records)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    with httpx.Client(timeout=600, limits=limits) as client:
+        jobs = [gevent.spawn_later((r["ts"] - t0) / speed, _replay_one, client, url, i, r)
+                for i, r in enumerate(records)]
+        gevent.joinall(jobs)
+    results = [job.value if job.successful() else (None, None, False) for job in jobs]
+
+    recorded_ttfts = [r["events"][0][0] / speed for r in records if r.get("stream") and r.get("events")]
+    recorded_durations = [r["duration"] / speed for r in records if "duration" in r]
+    return {
+        "requests": len(records),
+        "speed": speed,
+        "completed": sum(1 for r in results if r[2]),
+        **_summary("replay", [r[0] for r in results if r[0] is not None],
+                   [r[1] for r in results if r[1] is not None]),
+        **_summary("recorded", recorded_ttfts, recorded_durations),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="按 N 倍速回放采集的流量")
+    parser.add_argument("paths", nargs="+", help="采集文件（.jsonl 或 .jsonl.gz）")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速 (默认: 1)")
+    parser.add_argument("--limit", type=int, default=0, help="最多回放的请求数（0 表示全部）")
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    records = sorted(read_capture(args.paths), key=lambda r: r["ts"])
+    if args.limit > 0:
+        records = records[:args.limit]
+    if not records:
+        logger.error("❌ 没有可回放的记录")
+        return False
+
+    fake, server, base_url = start_harness({r["model"]: REPLAY_KEY for r in records})
+    try:
+        result = replay(base_url, fake, records, args.speed)
+    finally:
+        server.stop()
+        fake.stop()
+
+    logger.info(
+        f"📊 speed={args.speed}x completed={result['completed']}/{result['requests']}  "
+        f"TTFT p50={result['replay_ttft_p50_ms']:.1f}ms (recorded {result['recorded_ttft_p50_ms']:.1f}ms)  "
+        f"duration p95={result['replay_duration_p95_ms']:.1f}ms (recorded {result['recorded_duration_p95_ms']:.1f}ms)"
+    )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        logger.info(f"💾 结果已写入 {args.output}")
+    return result["completed"] == result["requests"]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(0 if main_cli() else 1)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+自适应并发上限测试 - 验证 AIMD 调整，并对容量可变的模拟 Dify 做并发仿真
+"""
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+import httpx
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from adaptive_limit import (AdaptiveLimiter, ConcurrencyLimitExceeded, ADAPTIVE_LIMIT,
+                            load_adaptive_config)
+from circuit_breaker import key_fingerprint
+from fake_dify import FakeDify
+from dify_test_case import FakeDifyTestCase, config_factory
+
+
+make_config = config_factory(load_adaptive_config, enabled=True, initial_limit=4, min_limit=1, max_limit=50,
+                             backoff=0.7, tolerance=1.5)
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    """测试 AdaptiveLimiter 的增减规则"""
+
+    def setUp(self):
+        main.REGISTRY.reset()
+
+    def test_disabled_is_noop(self):
+        """测试未启用时不做限制"""
+        limiter = AdaptiveLimiter(make_config(enabled=False, initial_limit=1))
+        permits = [limiter.acquire("u", "k") for _ in range(5)]
+        for permit in permits:
+            permit.release()
+
+    def test_rejects_at_limit(self):
+        """测试达到上限时拒绝，释放后恢复"""
+        limiter = AdaptiveLimiter(make_config(initial_limit=2))
+        first = limiter.acquire("u", "k")
+        limiter.acquire("u", "k")
+        with self.assertRaises(ConcurrencyLimitExceeded):
+            limiter.acquire("u", "k")
+        first.release()
+        first.release()  # 重复释放不影响计数
+        limiter.acquire("u", "k")
+
+    def test_grows_only_when_utilized(self):
+        """测试延迟接近基线时，只有上限被用满一半以上才增长"""
+        limiter = AdaptiveLimiter(make_config(initial_limit=4))
+        for _ in range(10):
+            limiter.record("u", "k", 0.1)
+        self.assertEqual(limiter.limit("u", "k"), 4)
+
+        permits = [limiter.acquire("u", "k") for _ in range(4)]
+        for _ in range(10):
+            limiter.record("u", "k", 0.1)
+        self.assertGreater(limiter.limit("u", "k"), 4)
+        self.assertGreater(ADAPTIVE_LIMIT.get(upstream="u", key=key_fingerprint("k")), 4)
+        for permit in permits:
+            permit.release()
+
+    def test_decreases_on_inflation_and_overload(self):
+        """测试首字节延迟膨胀和过载信号触发乘性收缩"""
+        limiter = AdaptiveLimiter(make_config(initial_limit=10))
+        limiter.record("u", "k", 0.01)
+        limiter.record("u", "k", 0.05)
+        self.assertEqual(limiter.limit("u", "k"), 7)
+
+        time.sleep(0.02)
+        limiter.record("u", "k", overloaded=True)
+        self.assertEqual(limiter.limit("u", "k"), 4)
+
+        for _ in range(20):
+            time.sleep(0.011)
+            limiter.record("u", "k", overloaded=True)
+        self.assertEqual(limiter.limit("u", "k"), 1)
+
+
+class TestAdaptiveLimitSimulation(unittest.TestCase):
+    """对容量可变的模拟 Dify 施加持续并发压力，观察上限跟随容量变化"""
+
+    API_KEY = "app-adaptive"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeDify().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.stop()
+
+    def setUp(self):
+        main.REGISTRY.reset()
+        self.limiter = AdaptiveLimiter(make_config(initial_limit=16))
+        self.client = httpx.Client(limits=httpx.Limits(max_connections=64, max_keepalive_connections=64))
+        self.stop = threading.Event()
+
+    def tearDown(self):
+        self.stop.set()
+        self.client.close()
+
+    def _worker(self):
+        while not self.stop.is_set():
+            try:
+                permit = self.limiter.acquire(self.fake.base_url, self.API_KEY)
+            except ConcurrencyLimitExceeded:
+                time.sleep(0.005)
+                continue
+            try:
+                started = time.time()
+                with self.client.stream("POST", f"{self.fake.base_url}/chat-messages",
+                                        headers={"Authorization": f"Bearer {self.API_KEY}"},
+                                        json={"query": "hi", "response_mode": "streaming"}) as response:
+                    lines = response.iter_lines()
+                    for line in lines:
+                        if '"event": "message"' in line:
+                            self.limiter.record(self.fake.base_url, self.API_KEY, time.time() - started)
+                            break
+                    for _ in lines:
+                        pass
+            finally:
+                permit.release()
+
+    def _limit_during(self, capacity, seconds):
+        self.fake.configure(self.API_KEY, ttfb=0.03, capacity=capacity)
+        samples = []
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            time.sleep(0.05)
+            samples.append(self.limiter.limit(self.fake.base_url, self.API_KEY))
+        return samples
+
+    def test_limit_tracks_capacity(self):
+        """测试容量小时上限收缩到容量附近，容量扩大后上限随之增长"""
+        threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(24)]
+        for t in threads:
+            t.start()
+        try:
+            low = self._limit_during(capacity=4, seconds=1.5)
+            high = self._limit_during(capacity=16, seconds=2.0)
+        finally:
+            self.stop.set()
+            for t in threads:
+                t.join(timeout=5)
+
+        settled_low = low[len(low) // 2:]
+        self.assertLess(max(settled_low), 12)
+        self.assertGreater(high[-1], max(settled_low))
+        self.assertGreaterEqual(self.fake.max_active_streams, 4)
+
+
+class TestAdaptiveLimitRequests(FakeDifyTestCase):
+    """测试代理请求路径上的自适应上限"""
+
+    MODEL_CONFIG = {"test-model": "app-limited"}
+
+    def setUp(self):
+        super().setUp()
+        self.limiter = AdaptiveLimiter(make_config(initial_limit=1))
+        self.patch_main("adaptive_limiter", self.limiter)
+        self.fake.configure("app-limited")
+
+    def _post(self):
+        return self.client.post("/v1/chat/completions", json={
+            "model": "test-model",
+            "messages": [{"role": "user", "content": "hi"}],
+        })
+
+    def test_over_limit_fails_fast(self):
+        """测试上限已满时直接返回 503，名额释放后恢复"""
+        held = self.limiter.acquire(self.fake.base_url, "app-limited")
+        response = self._post()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get("Retry-After"), "1")
+        self.assertEqual(response.get_json()["error"]["code"], "upstream_overloaded")
+        self.assertEqual(len(self.fake.requests_for("app-limited")), 0)
+
+        held.release()
+        self.assertEqual(self._post().status_code, 200)
+        self.assertEqual(self._post().status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+准入控制测试 - 验证并发上限、有界排队、429 拒绝和运行时调整
+"""
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from admission import AdmissionController, AdmissionRejected, ADMISSION_QUEUE_DEPTH
+from metrics import REGISTRY
+from dify_test_case import config_factory
+
+
+make_config = config_factory({
+    "max_concurrent": 2, "default_model_limit": 0, "model_limits": {},
+    "max_queue": 1, "max_wait": 0.2, "retry_after": 3,
+})
+
+
+def make_controller(**overrides):
+    return AdmissionController(make_config(**overrides))
+
+
+class TestAdmissionController(unittest.TestCase):
+    """测试 AdmissionController"""
+
+    def setUp(self):
+        REGISTRY.reset()
+
+    def test_queue_then_admit_on_release(self):
+        """测试满载时排队，名额释放后被唤醒"""
+        controller = make_controller(max_wait=2.0)
+        first = controller.acquire("m")
+        controller.acquire("m")
+
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(controller.acquire("m")))
+        waiter.start()
+        time.sleep(0.05)
+        self.assertEqual(controller.snapshot()["queue_depth"], 1)
+        self.assertEqual(ADMISSION_QUEUE_DEPTH.get(), 1)
+
+        first.release()
+        waiter.join(1.0)
+        self.assertEqual(len(admitted), 1)
+        self.assertEqual(controller.snapshot()["in_flight_total"], 2)
+
+    def test_reject_when_queue_full_or_timeout(self):
+        """测试队列已满立即拒绝，等待超时也拒绝"""
+        controller = make_controller(max_concurrent=1)
+        controller.acquire("m")
+
+        errors = []
+
+        def wait_in_queue():
+            try:
+                controller.acquire("m")
+            except AdmissionRejected as e:
+                errors.append(e)
+
+        waiter = threading.Thread(target=wait_in_queue)
+        waiter.start()
+        time.sleep(0.05)
+        with self.assertRaises(AdmissionRejected) as ctx:
+            controller.acquire("m")
+        self.assertEqual(ctx.exception.reason, "queue_full")
+        self.assertEqual(ctx.exception.retry_after, 3)
+
+        waiter.join(1.0)
+        self.assertEqual(errors[0].reason, "queue_timeout")
+        self.assertEqual(controller.snapshot()["queue_depth"], 0)
+
+    def test_per_model_limit(self):
+        """测试单个模型的上限不影响其他模型"""
+        controller = make_controller(max_concurrent=10, model_limits={"slow": 1}, max_queue=0)
+        controller.acquire("slow")
+        with self.assertRaises(AdmissionRejected):
+            controller.acquire("slow")
+        controller.acquire("fast")
+
+    def test_free_model_not_blocked_by_waiters(self):
+        """测试其他模型排队时，有空闲名额的模型立即准入，不需要等待任何释放"""
+        controller = make_controller(max_concurrent=10, model_limits={"slow": 1}, max_wait=2.0)
+        held = controller.acquire("slow")
+        waiter = threading.Thread(target=lambda: controller.acquire("slow").release())
+        waiter.start()
+        time.sleep(0.05)
+        self.assertEqual(controller.snapshot()["queue_depth"], 1)
+
+        started = time.time()
+        controller.acquire("fast").release()
+        self.assertLess(time.time() - started, 0.1)
+
+        held.release()
+        waiter.join(1.0)
+
+    def test_runtime_update_wakes_waiters(self):
+        """测试运行时放宽限制会立即唤醒等待者"""
+        controller = make_controller(max_concurrent=1, max_wait=2.0)
+        controller.acquire("m")
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(controller.acquire("m")))
+        waiter.start()
+        time.sleep(0.05)
+        controller.update_limits(max_concurrent=2)
+        waiter.join(1.0)
+        self.assertEqual(len(admitted), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
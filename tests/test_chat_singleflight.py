@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+首轮会话单飞测试 - 验证同一 chat_id 的并发首轮请求只创建一个 Dify 会话
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from chat_singleflight import ChatSingleflight, load_singleflight_config
+from conversation_mapper_sqlite import ConversationMapper
+from dify_test_case import FakeDifyTestCase, config_factory
+
+
+make_config = config_factory(load_singleflight_config, enabled=True, wait_seconds=5, lease_seconds=60,
+                             poll_interval=0.01)
+
+
+class TestChatSingleflight(unittest.TestCase):
+    """测试进程内锁和跨进程租约"""
+
+    def setUp(self):
+        main.REGISTRY.reset()
+        self.temp_dir = tempfile.mkdtemp(prefix="opendify_singleflight_test_")
+        self.db_path = os.path.join(self.temp_dir, "mappings.db")
+        self.mappings = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_existing_mapping_skips_lock(self):
+        """测试已有映射或没有 chat_id 时不加锁"""
+        flight = ChatSingleflight(self.db_path, make_config())
+        self.mappings.add("chat-known")
+        self.assertFalse(flight.acquire("chat-known", self.mappings.__contains__).held)
+        self.assertFalse(flight.acquire(None, self.mappings.__contains__).held)
+
+    def test_cross_worker_lease(self):
+        """测试两个实例（模拟两个工作进程）共享 SQLite 租约"""
+        worker_a = ChatSingleflight(self.db_path, make_config())
+        worker_b = ChatSingleflight(self.db_path, make_config(wait_seconds=0.1))
+        lock = worker_a.acquire("chat-x", self.mappings.__contains__)
+        self.assertTrue(lock.held)
+
+        # 持有期间另一进程等待超时，退化为不协调
+        started = time.time()
+        self.assertFalse(worker_b.acquire("chat-x", self.mappings.__contains__).held)
+        self.assertGreaterEqual(time.time() - started, 0.1)
+
+        lock.release()
+        lock.release()  # 重复释放不影响
+        lock_b = worker_b.acquire("chat-x", self.mappings.__contains__)
+        self.assertTrue(lock_b.held)
+        lock_b.release()
+
+    def test_expired_lease_taken_over(self):
+        """测试持有者崩溃（租约过期）后可以被接管"""
+        crashed = ChatSingleflight(self.db_path, make_config(lease_seconds=0.05))
+        crashed.acquire("chat-y", self.mappings.__contains__)
+        survivor = ChatSingleflight(self.db_path, make_config())
+        lock = survivor.acquire("chat-y", self.mappings.__contains__)
+        self.assertTrue(lock.held)
+        lock.release()
+
+    def test_waiter_reuses_mapping(self):
+        """测试等待者在持有者写入映射后直接复用，不再加锁"""
+        flight = ChatSingleflight(self.db_path, make_config())
+        lock = flight.acquire("chat-z", self.mappings.__contains__)
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(flight.acquire("chat-z", self.mappings.__contains__).held))
+        waiter.start()
+        time.sleep(0.05)
+        self.mappings.add("chat-z")
+        lock.release()
+        waiter.join(timeout=5)
+        self.assertEqual(results, [False])
+        self.assertEqual(flight._local, {})
+
+
+class TestConcurrentFirstTurn(FakeDifyTestCase):
+    """使用模拟 Dify 测试并发首轮请求"""
+
+    MODEL_CONFIG = {"test-model": "app-singleflight"}
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp(prefix="opendify_singleflight_test_")
+        db_path = os.path.join(self.temp_dir, "mappings.db")
+        self.mapper = ConversationMapper(db_path)
+        self.patch_main("conversation_mapper", self.mapper)
+        self.patch_main("chat_singleflight", ChatSingleflight(db_path, make_config()))
+        self.fake.configure("app-singleflight", ttfb=0.2)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _burst(self, chat_id, count, stream):
+        statuses = []
+
+        def _post():
+            response = main.app.test_client().post(
+                "/v1/chat/completions", headers={"X-OpenWebUI-Chat-Id": chat_id},
+                json={"model": "test-model", "stream": stream,
+                      "messages": [{"role": "user", "content": "hi"}]})
+            response.get_data()
+            statuses.append(response.status_code)
+
+        threads = [threading.Thread(target=_post) for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=30)
+        return statuses
+
+    def _assert_single_conversation(self, chat_id, count):
+        requests = self.fake.requests_for("app-singleflight")[-count:]
+        created = [r for r in requests if not r["payload"].get("conversation_id")]
+        self.assertEqual(len(created), 1)
+        conversation_id = self.mapper.get_dify_conversation_id(chat_id)
+        self.assertIsNotNone(conversation_id)
+        for r in requests:
+            if r is not created[0]:
+                self.assertEqual(r["payload"]["conversation_id"], conversation_id)
+
+    def test_streaming_burst_creates_one_conversation(self):
+        """测试并发流式首轮请求只创建一个 Dify 会话，其余复用它"""
+        self.assertEqual(self._burst("chat-burst-stream", 5, stream=True), [200] * 5)
+        self._assert_single_conversation("chat-burst-stream", 5)
+
+    def test_blocking_burst_creates_one_conversation(self):
+        """测试并发非流式首轮请求只创建一个 Dify 会话"""
+        self.assertEqual(self._burst("chat-burst-blocking", 4, stream=False), [200] * 4)
+        self._assert_single_conversation("chat-burst-blocking", 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+熔断器测试 - 验证状态切换、跨进程共享、503 快速失败和阻塞调用的慢调用统计
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from circuit_breaker import CircuitBreaker, CircuitOpenError, load_breaker_config
+from dify_test_case import FakeDifyTestCase
+
+UPSTREAM = "http://dify.test/v1"
+API_KEY = "app-test"
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """测试 CircuitBreaker"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="opendify_breaker_test_")
+        self.db_path = os.path.join(self.temp_dir, "breaker.db")
+        self.config = load_breaker_config()
+        self.config.update({
+            "enabled": True, "window": 10, "min_requests": 4, "error_rate": 0.5,
+            "slow_call_seconds": 1.0, "slow_call_rate": 0.8,
+            "open_seconds": 0.2, "probe_timeout": 5, "state_check_interval": 0,
+        })
+        # 两个实例共享同一个数据库文件，模拟两个工作进程
+        self.worker_a = CircuitBreaker(self.db_path, self.config)
+        self.worker_b = CircuitBreaker(self.db_path, self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _fail(self, breaker, times):
+        for _ in range(times):
+            breaker.record(breaker.before_call(UPSTREAM, API_KEY), success=False, latency=0.01)
+
+    def test_trips_on_error_rate_and_shares_state(self):
+        """测试错误率超过阈值后打开，并对其他进程生效"""
+        self._fail(self.worker_a, 4)
+        with self.assertRaises(CircuitOpenError) as ctx:
+            self.worker_b.before_call(UPSTREAM, API_KEY)
+        self.assertGreaterEqual(ctx.exception.retry_after, 1)
+        self.assertFalse(self.worker_b.is_available(UPSTREAM, API_KEY))
+
+        # 其他 API Key 不受影响
+        self.worker_b.before_call(UPSTREAM, "app-other")
+
+    def test_trips_on_slow_calls(self):
+        """测试慢调用比例超过阈值后打开"""
+        for _ in range(4):
+            self.worker_a.record(self.worker_a.before_call(UPSTREAM, API_KEY), success=True, latency=2.0)
+        with self.assertRaises(CircuitOpenError):
+            self.worker_a.before_call(UPSTREAM, API_KEY)
+
+    def test_untimed_calls_not_slow(self):
+        """测试阻塞模式的调用（耗时包含整个生成过程）不计为慢调用"""
+        for _ in range(4):
+            self.worker_a.record(self.worker_a.before_call(UPSTREAM, API_KEY), success=True, latency=60.0,
+                                 timed=False)
+        self.worker_a.before_call(UPSTREAM, API_KEY)
+
+    def test_half_open_single_probe(self):
+        """测试冷却结束后只放行一个探测请求，成功后关闭"""
+        self._fail(self.worker_a, 4)
+        time.sleep(0.25)
+        self.assertTrue(self.worker_b.is_available(UPSTREAM, API_KEY))
+
+        probe = self.worker_b.before_call(UPSTREAM, API_KEY)
+        self.assertTrue(probe.probe)
+        with self.assertRaises(CircuitOpenError):
+            self.worker_a.before_call(UPSTREAM, API_KEY)
+
+        self.worker_b.record(probe, success=True, latency=0.01)
+        permit = self.worker_a.before_call(UPSTREAM, API_KEY)
+        self.assertFalse(permit.probe)
+
+    def test_failed_probe_reopens(self):
+        """测试探测失败后重新打开"""
+        self._fail(self.worker_a, 4)
+        time.sleep(0.25)
+        probe = self.worker_a.before_call(UPSTREAM, API_KEY)
+        self.worker_a.record(probe, success=False)
+        with self.assertRaises(CircuitOpenError):
+            self.worker_b.before_call(UPSTREAM, API_KEY)
+
+    def test_abandoned_probe_released(self):
+        """测试没有上游结果的探测请求立即让出名额，且之后的 record 不再生效"""
+        self._fail(self.worker_a, 4)
+        time.sleep(0.25)
+        probe = self.worker_a.before_call(UPSTREAM, API_KEY)
+        self.worker_a.abandon(probe)
+        self.worker_a.record(probe, success=False)
+        next_probe = self.worker_b.before_call(UPSTREAM, API_KEY)
+        self.assertTrue(next_probe.probe)
+
+
+class TestCircuitOpenResponse(unittest.TestCase):
+    """测试熔断时接口直接返回 503"""
+
+    def test_chat_completions_returns_503(self):
+        temp_dir = tempfile.mkdtemp(prefix="opendify_breaker_test_")
+        try:
+            config = load_breaker_config()
+            config.update({"min_requests": 1, "error_rate": 0.5, "open_seconds": 30, "state_check_interval": 0})
+            breaker = CircuitBreaker(os.path.join(temp_dir, "breaker.db"), config)
+            breaker.record(breaker.before_call(main.DIFY_API_BASE, "app-test"), success=False)
+
+            with patch.object(main, "circuit_breaker", breaker), \
+                    patch.object(main, "MODEL_TO_API_KEY", {"test-model": "app-test"}), \
+                    patch.object(main, "FAILOVER_CONFIG", {}):
+                response = main.app.test_client().post("/v1/chat/completions", json={
+                    "model": "test-model",
+                    "messages": [{"role": "user", "content": "hi"}],
+                    "stream": True,
+                })
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.json["error"]["code"], "circuit_open")
+            self.assertGreater(int(response.headers["Retry-After"]), 1)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+class TestBlockingSlowCalls(FakeDifyTestCase):
+    """测试阻塞模式的长回答不会打开熔断器"""
+
+    MODEL_CONFIG = {"blocking-model": "app-blocking"}
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp(prefix="opendify_breaker_test_")
+        config = load_breaker_config()
+        config.update({"min_requests": 1, "slow_call_seconds": 0.05, "slow_call_rate": 0.5,
+                       "state_check_interval": 0})
+        self.breaker = CircuitBreaker(os.path.join(self.temp_dir, "breaker.db"), config)
+        self.patch_main("circuit_breaker", self.breaker)
+        self.fake.configure("app-blocking", ttfb=0.2, chunks=["long", " answer"])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_long_blocking_generation_not_slow(self):
+        """测试 NON_STREAM_VIA_STREAMING=false 时，超过慢调用阈值的正常生成不计为慢调用"""
+        with patch.dict(main.deadline_policy.config, {"aggregate_non_stream": False}):
+            for _ in range(2):
+                response = self.client.post("/v1/chat/completions", json={
+                    "model": "blocking-model", "messages": [{"role": "user", "content": "hi"}],
+                })
+                self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.breaker.is_available(main.DIFY_API_BASE, "app-blocking"))
+
+
+if __name__ == '__main__':
+    unittest.main()
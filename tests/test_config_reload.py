@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+模型配置热更新测试 - 验证校验失败时保留旧配置、进行中的流使用开始时的快照，以及文件变化/SIGHUP 触发更新
+"""
+
+import os
+import sys
+import time
+import signal
+import shutil
+import tempfile
+import unittest
+
+import gevent
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from config_reload import ConfigReloader
+from dify_test_case import FakeDifyTestCase
+
+
+class TestConfigReload(FakeDifyTestCase):
+    """使用模拟 Dify 测试热更新"""
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp(prefix="opendify_config_reload_test_")
+        self.env_path = os.path.join(self.temp_dir, ".env")
+        self._write_env("{'reload-model': 'app-reload-old'}")
+        model_config = self.patch_main("MODEL_TO_API_KEY", {"reload-model": "app-reload-old"})
+        self.patch_main("AVAILABLE_MODELS", main.build_available_models(model_config))
+        self.patch_main("_model_config_source", {
+            "MODEL_CONFIG": "{'reload-model': 'app-reload-old'}", "MODEL_FAILOVER_CONFIG": "",
+        })
+        self.reloader = ConfigReloader(
+            main.build_model_config_snapshot,
+            main.apply_model_config_snapshot,
+            lambda: main._model_config_source,
+            config={"path": self.env_path, "watch_interval": 0},
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _write_env(self, model_config, failover_config=""):
+        with open(self.env_path, "w") as f:
+            f.write(f'MODEL_CONFIG="{model_config}"\n')
+            f.write(f'MODEL_FAILOVER_CONFIG="{failover_config}"\n')
+
+    def _post(self, stream=False, buffered=True):
+        return self.client.post("/v1/chat/completions", json={
+            "model": "reload-model", "stream": stream,
+            "messages": [{"role": "user", "content": "hi"}],
+        }, buffered=buffered)
+
+    def test_stream_survives_reload(self):
+        """测试更新前开始的流继续使用旧 Key 完整输出，更新后的请求使用新 Key"""
+        self.fake.configure("app-reload-old", chunk_delay=0.05)
+        self.fake.configure("app-reload-new")
+        old_before = len(self.fake.requests_for("app-reload-old"))
+
+        response = self._post(stream=True, buffered=False)
+        chunks = iter(response.response)
+        body = next(chunks)
+
+        self._write_env("{'reload-model': 'app-reload-new'}")
+        self.assertTrue(self.reloader.reload())
+        self.assertEqual(main.MODEL_TO_API_KEY, {"reload-model": "app-reload-new"})
+
+        body += b"".join(chunks)
+        response.close()
+        self.assertIn(b"[DONE]", body)
+        self.assertEqual(body.count(b'"delta": {"content"'), len("Hello from fake Dify"))
+        self.assertEqual(len(self.fake.requests_for("app-reload-old")) - old_before, 1)
+
+        new_before = len(self.fake.requests_for("app-reload-new"))
+        self.assertEqual(self._post().status_code, 200)
+        self.assertEqual(len(self.fake.requests_for("app-reload-new")) - new_before, 1)
+        self.assertEqual(main.REGISTRY.get("opendify_config_reloads_total").get(result="success"), 1)
+
+    def test_invalid_config_is_rejected(self):
+        """测试校验失败（未知模型的故障转移策略、无法解析）时保留旧配置"""
+        self._write_env("{'reload-model': 'app-reload-old'}", "{'missing-model': {'backups': []}}")
+        self.assertFalse(self.reloader.reload())
+        self._write_env("{'reload-model': 'app-reload-old'}", "not a dict")
+        self.assertFalse(self.reloader.reload())
+        self._write_env("{}")
+        self.assertFalse(self.reloader.reload())
+
+        self.assertEqual(main.MODEL_TO_API_KEY, {"reload-model": "app-reload-old"})
+        self.assertEqual(main.REGISTRY.get("opendify_config_reloads_total").get(result="rejected"), 3)
+        self.assertEqual(self.reloader.version, 0)
+
+    def test_unchanged_and_models_list(self):
+        """测试配置未变化时不替换快照，更新后 /v1/models 返回新的模型列表"""
+        self.assertFalse(self.reloader.reload())
+        self.assertEqual(main.REGISTRY.get("opendify_config_reloads_total").get(result="unchanged"), 1)
+        etag = self.client.get("/v1/models").headers["ETag"]
+
+        self._write_env("{'reload-model': 'app-reload-old', 'added-model': 'app-reload-new'}")
+        self.assertTrue(self.reloader.reload())
+        response = self.client.get("/v1/models", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(m["id"] for m in response.get_json()["data"]), ["added-model", "reload-model"])
+
+    def test_file_change_and_sighup(self):
+        """测试配置文件修改时间变化和 SIGHUP 都会触发更新"""
+        self.assertFalse(self.reloader.check_file())
+        self._write_env("{'reload-model': 'app-reload-new'}")
+        later = time.time() + 10
+        os.utime(self.env_path, (later, later))
+        self.assertTrue(self.reloader.check_file())
+        self.assertEqual(main.MODEL_TO_API_KEY, {"reload-model": "app-reload-new"})
+
+        previous = signal.getsignal(signal.SIGHUP)
+        try:
+            self.reloader.start()
+            self._write_env("{'reload-model': 'app-reload-old'}")
+            os.kill(os.getpid(), signal.SIGHUP)
+            for _ in range(50):
+                gevent.sleep(0.02)
+                if self.reloader.version == 2:
+                    break
+            self.assertEqual(self.reloader.version, 2)
+            self.assertEqual(main.MODEL_TO_API_KEY, {"reload-model": "app-reload-old"})
+        finally:
+            signal.signal(signal.SIGHUP, previous)
+
+
+if __name__ == '__main__':
+    unittest.main()
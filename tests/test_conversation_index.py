@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+会话指纹索引测试 - 验证历史指纹的计算、没有 chat_id 时按历史继续 Dify 会话（只发送新的一轮），
+以及 chat_id 的历史被编辑或重新生成后开启新分支
+"""
+
+import os
+import sys
+import json
+import uuid
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from conversation_index import ConversationIndex, ConversationTurn
+from dify_test_case import FakeDifyTestCase, config_factory
+
+
+make_config = config_factory({"enabled": True, "verify_chat": False, "max_age_days": 30, "max_rows": 100})
+
+
+def user(text):
+    return {"role": "user", "content": text}
+
+
+def assistant(text):
+    return {"role": "assistant", "content": text}
+
+
+class TestConversationTurn(unittest.TestCase):
+    """测试历史指纹"""
+
+    def test_answer_continues_history(self):
+        """测试本轮加上回答后的指纹等于下一轮的历史前缀"""
+        system = {"role": "system", "content": "you are a poet"}
+        first = ConversationTurn("m", "u", [system, user("hi")])
+        self.assertIsNone(first.prefix)
+        second = ConversationTurn("m", "u", [system, user("hi"), assistant("hello "), user("again")])
+        self.assertEqual(first.after("hello"), second.prefix)
+
+    def test_seed_is_part_of_fingerprint(self):
+        """测试模型、用户、客户端 Key 和 system 消息都参与指纹"""
+        messages = [user("hi"), assistant("hello"), user("again")]
+        prefix = ConversationTurn("m", "u", messages).prefix
+        self.assertNotEqual(prefix, ConversationTurn("m", "other", messages).prefix)
+        self.assertNotEqual(prefix, ConversationTurn("other", "u", messages).prefix)
+        self.assertNotEqual(prefix, ConversationTurn("m", "u", messages, "client-key").prefix)
+        self.assertNotEqual(prefix, ConversationTurn("m", "u", [{"role": "system", "content": "be brief"}] + messages).prefix)
+
+
+class TestConversationIndex(unittest.TestCase):
+    """测试索引的查找和记录"""
+
+    def setUp(self):
+        main.REGISTRY.reset()
+        self.work_dir = tempfile.mkdtemp(prefix="opendify_index_test_")
+        self.db_path = os.path.join(self.work_dir, "index.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_claim_once(self):
+        """测试同一历史只有一个请求能继续原会话"""
+        index = ConversationIndex(self.db_path, make_config())
+        index.record(ConversationTurn("m", "u", [user("hi")]).after("hello"), "conv-1", "key-a", "up-a")
+        turn = ConversationTurn("m", "u", [user("hi"), assistant("hello"), user("again")])
+        self.assertEqual(tuple(index.claim("m", turn)), ("conv-1", "key-a", "up-a"))
+        self.assertIsNone(ConversationIndex(self.db_path, make_config()).claim("m", turn))
+        lookups = main.REGISTRY.get("opendify_conversation_index_lookups_total")
+        self.assertEqual((lookups.get(model="m", result="hit"), lookups.get(model="m", result="miss")), (1, 1))
+
+    def test_chat_turns_recorded_only_when_verified(self):
+        """测试关闭 verify_chat 时不记录有 chat_id 的轮次，关闭 enabled 时不记录无状态的轮次"""
+        fingerprint = ConversationTurn("m", "u", [user("hi")]).after("hello")
+        ConversationIndex(self.db_path, make_config()).record(fingerprint, "conv-1", webui_chat_id="chat-1")
+        ConversationIndex(self.db_path, make_config(enabled=False, verify_chat=True)).record(fingerprint, "conv-2")
+        self.assertEqual(ConversationIndex(self.db_path, make_config()).cleanup(max_age_days=-1), 0)
+
+    def test_diverged_and_cleanup(self):
+        """测试 chat_id 的历史与记录不同时判定为分叉，没有记录时不分叉；过期记录被清理"""
+        index = ConversationIndex(self.db_path, make_config(verify_chat=True))
+        turn = ConversationTurn("m", "u", [user("hi"), assistant("hello"), user("again")])
+        self.assertFalse(index.diverged("m", "chat-1", turn))
+        index.record(ConversationTurn("m", "u", [user("hi")]).after("hello"), "conv-1", webui_chat_id="chat-1")
+        self.assertFalse(index.diverged("m", "chat-1", turn))
+        edited = ConversationTurn("m", "u", [user("hi"), assistant("hello!"), user("again")])
+        self.assertTrue(index.diverged("m", "chat-1", edited))
+        # 有 chat_id 的记录不会被无状态请求取走
+        self.assertIsNone(index.claim("m", turn))
+        with patch("conversation_index.time.time", return_value=0):
+            index.record("old", "conv-old")
+        self.assertEqual(index.cleanup(), 1)
+
+
+class TestConversationIndexEndpoint(FakeDifyTestCase):
+    """使用模拟 Dify 测试请求路径上的会话继续和分支"""
+
+    MODEL_CONFIG = {"index-model": "app-index"}
+
+    def setUp(self):
+        super().setUp()
+        self.work_dir = tempfile.mkdtemp(prefix="opendify_index_test_")
+        self.index = ConversationIndex(os.path.join(self.work_dir, "index.db"), make_config(verify_chat=True))
+        self.patch_main("conversation_index", self.index)
+        self.fake.configure("app-index", chunks=["Hel", "lo"])
+        self.requests_before = len(self.fake.requests_for("app-index"))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _post(self, stream, messages, headers=None):
+        response = self.client.post("/v1/chat/completions", json={
+            "model": "index-model", "stream": stream, "messages": messages,
+        }, headers=headers or {})
+        b"".join(response.response)
+        response.close()
+        self.assertEqual(response.status_code, 200)
+
+    def _answer(self, stream, body):
+        """客户端收到的回答文本"""
+        if not stream:
+            return json.loads(body)["choices"][0]["message"]["content"]
+        chunks = [json.loads(line[6:]) for line in body.splitlines()
+                  if line.startswith("data: {") and '"choices"' in line]
+        return "".join(chunk["choices"][0]["delta"].get("content") or "" for chunk in chunks)
+
+    def _payloads(self):
+        return [r["payload"] for r in self.fake.requests_for("app-index")[self.requests_before:]]
+
+    def test_stateless_client_continues_conversation(self):
+        """测试没有 chat_id 的客户端第二轮继续第一轮的会话且不再发送历史，历史被修改时开启新会话"""
+        self._post(True, [user("first question")])
+        self._post(False, [user("first question"), assistant("Hello"), user("second question")])
+        self._post(True, [user("first question"), assistant("Hello"), user("second question"),
+                          assistant("Hello"), user("third question")])
+        self._post(True, [user("first question"), assistant("edited"), user("second question")])
+        first, second, third, edited = self._payloads()
+        self.assertFalse(first.get("conversation_id"))
+        self.assertTrue(second.get("conversation_id"))
+        self.assertNotIn("conversation_history", second)
+        self.assertEqual(second["query"], "second question")
+        self.assertEqual(third.get("conversation_id"), second["conversation_id"])
+        self.assertFalse(edited.get("conversation_id"))
+        self.assertEqual(len(edited["conversation_history"]), 2)
+
+    def test_other_client_does_not_continue_conversation(self):
+        """测试共用默认用户的客户端，system 提示词或 API Key 不同时不会继续对方的会话"""
+        history = [user("shared question"), assistant("Hello"), user("again")]
+        for first, second in (
+            ({"system": "be brief"}, {"system": "be verbose"}),
+            ({"key": "client-a"}, {"key": "client-b"}),
+        ):
+            with self.subTest(first=first, second=second):
+                self.requests_before = len(self.fake.requests_for("app-index"))
+                for client, messages in ((first, history[:1]), (second, history)):
+                    if "system" in client:
+                        messages = [{"role": "system", "content": client["system"]}] + messages
+                    headers = {"Authorization": f"Bearer {client['key']}"} if "key" in client else None
+                    self._post(True, messages, headers)
+                self.assertFalse(self._payloads()[-1].get("conversation_id"))
+
+    def test_deleted_conversation_resent_with_history(self):
+        """测试按指纹继续的会话在 Dify 中已被删除时，带完整历史重新发送一次，并记录新会话"""
+        for stream, aggregate in ((True, True), (False, True), (False, False)):
+            with self.subTest(stream=stream, aggregate=aggregate), \
+                    patch.dict(main.deadline_policy.config, {"aggregate_non_stream": aggregate}):
+                self.requests_before = len(self.fake.requests_for("app-index"))
+                history = [user(f"question {stream} {aggregate}"), assistant("Hello"), user("again")]
+                self._post(stream, history[:1])
+                self._post(stream, history)
+                continued = self._payloads()[1]
+                self.fake.deleted_conversations.add(continued["conversation_id"])
+                history += [assistant("Hello"), user("more")]
+                self._post(stream, history)
+                missing, resent = self._payloads()[2:]
+                self.assertEqual(missing["conversation_id"], continued["conversation_id"])
+                self.assertFalse(resent.get("conversation_id"))
+                self.assertEqual(len(resent["conversation_history"]), 4)
+                self.assertEqual(resent["query"], "more")
+                # 重新发送创建的会话被记录，下一轮继续它
+                self._post(stream, history + [assistant("Hello"), user("last")])
+                self.assertTrue(self._payloads()[-1].get("conversation_id"))
+                self.assertNotIn("conversation_history", self._payloads()[-1])
+
+    def test_truncated_turn_not_continued(self):
+        """测试被 max_tokens / stop 截断的一轮不记录指纹，下一轮带完整历史开启新会话"""
+        for stream, aggregate in ((True, True), (False, True), (False, False)):
+            for limits in ({"stop": ["lo"]}, {"max_tokens": 1}):
+                with self.subTest(stream=stream, aggregate=aggregate, limits=limits), \
+                        patch.dict(main.deadline_policy.config, {"aggregate_non_stream": aggregate}):
+                    self.requests_before = len(self.fake.requests_for("app-index"))
+                    question = user(f"limited {stream} {aggregate} {limits}")
+                    response = self.client.post("/v1/chat/completions", json=dict(
+                        limits, model="index-model", stream=stream, messages=[question]))
+                    answer = self._answer(stream, b"".join(response.response).decode())
+                    response.close()
+                    self.assertNotEqual(answer, "Hello")
+                    # 客户端按收到的回答发送下一轮
+                    self._post(stream, [question, assistant(answer), user("again")])
+                    _, next_turn = self._payloads()
+                    self.assertFalse(next_turn.get("conversation_id"))
+                    self.assertEqual(len(next_turn["conversation_history"]), 2)
+
+    def test_regenerated_chat_branches(self):
+        """测试 chat_id 的之前回答被修改后带完整历史开启新会话，并替换 chat_id 的映射"""
+        headers = {"X-OpenWebUI-Chat-Id": f"index-chat-{uuid.uuid4().hex}"}
+        self._post(True, [user("q1")], headers)
+        self._post(True, [user("q1"), assistant("Hello"), user("q2")], headers)
+        self._post(True, [user("q1"), assistant("Hello"), user("q2"), assistant("different"), user("q3")], headers)
+        self._post(True, [user("q1"), assistant("Hello"), user("q2"), assistant("Hello"), user("q3")], headers)
+        first, second, branched, after_branch = self._payloads()
+        self.assertTrue(second.get("conversation_id"))
+        self.assertFalse(branched.get("conversation_id"))
+        self.assertEqual(len(branched["conversation_history"]), 4)
+        # 分支之后 chat_id 指向新会话：按原来的回答发送的请求与新会话不一致，再次分支
+        self.assertFalse(after_branch.get("conversation_id"))
+        self.assertEqual(main.REGISTRY.get("opendify_conversation_index_lookups_total").get(
+            model="index-model", result="diverged"), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
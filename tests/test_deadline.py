@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+请求截止时间测试 - 验证截止时间的计算、耗尽时不调用 Dify 快速失败、调用中超时时中止并停止 Dify 生成，
+以及非流式请求在内部使用流式接口聚合结果
+"""
+
+import os
+import sys
+import json
+import time
+import unittest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from deadline import DeadlinePolicy, DeadlineExceeded
+from dify_test_case import FakeDifyTestCase, config_factory
+
+
+make_config = config_factory({"header": "X-Request-Timeout", "default": 0, "model_deadlines": {},
+                              "min_budget": 0.1, "aggregate_non_stream": True})
+
+
+def make_policy(**overrides):
+    return DeadlinePolicy(make_config(**overrides))
+
+
+def wait_for(predicate, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+class TestDeadlinePolicy(unittest.TestCase):
+    """测试截止时间的计算"""
+
+    def setUp(self):
+        main.REGISTRY.reset()
+
+    def test_no_deadline_by_default(self):
+        """测试没有请求头和模型配置时不限制"""
+        deadline = make_policy().for_request("m", {})
+        self.assertIsNone(deadline.remaining())
+        deadline.check("received")
+
+    def test_earliest_of_header_and_model(self):
+        """测试请求头（剩余秒数或绝对时间戳）和模型配置取较早者"""
+        policy = make_policy(default=60, model_deadlines={"slow": 300})
+        self.assertAlmostEqual(policy.for_request("m", {}).remaining(), 60, delta=0.5)
+        self.assertAlmostEqual(policy.for_request("slow", {}).remaining(), 300, delta=0.5)
+        self.assertAlmostEqual(policy.for_request("m", {"X-Request-Timeout": "5"}).remaining(), 5, delta=0.5)
+        absolute = str(time.time() + 10)
+        self.assertAlmostEqual(policy.for_request("slow", {"X-Request-Timeout": absolute}).remaining(), 10, delta=0.5)
+        self.assertAlmostEqual(policy.for_request("m", {"X-Request-Timeout": "bogus"}).remaining(), 60, delta=0.5)
+
+    def test_check_fails_when_budget_is_too_small(self):
+        """测试剩余时间不足 min_budget 时抛出并计数"""
+        deadline = make_policy(min_budget=0.5).for_request("m", {"X-Request-Timeout": "0.2"})
+        with self.assertRaises(DeadlineExceeded):
+            deadline.check("queued")
+        self.assertEqual(main.REGISTRY.get("opendify_deadline_exceeded_total").get(model="m", stage="queued"), 1)
+
+    def test_call_interrupts_slow_function(self):
+        """测试 call 在截止时间到达时中断正在执行的函数"""
+        deadline = make_policy().for_request("m", {"X-Request-Timeout": "0.2"})
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            deadline.call(time.sleep, 5)
+        self.assertLess(time.monotonic() - started, 1)
+
+
+class TestDeadlineEndpoints(FakeDifyTestCase):
+    """使用模拟 Dify 测试截止时间在请求中的效果"""
+
+    MODEL_CONFIG = {"deadline-model": "app-deadline"}
+
+    def setUp(self):
+        super().setUp()
+        self.patch_main("deadline_policy", make_policy())
+
+    def _post(self, stream=False, timeout=None, **kwargs):
+        headers = {"X-Request-Timeout": timeout} if timeout is not None else {}
+        return self.client.post("/v1/chat/completions", json={
+            "model": "deadline-model", "stream": stream,
+            "messages": [{"role": "user", "content": "hi"}],
+        }, headers=headers, **kwargs)
+
+    def test_exhausted_deadline_fails_before_calling_dify(self):
+        """测试截止时间已耗尽时返回 504，不调用 Dify"""
+        self.fake.configure("app-deadline", chunks=["ok"])
+        calls_before = len(self.fake.requests_for("app-deadline"))
+        response = self._post(timeout="0.05")
+        self.assertEqual(response.status_code, 504)
+        self.assertEqual(response.get_json()["error"]["code"], "deadline_exceeded")
+        self.assertEqual(len(self.fake.requests_for("app-deadline")), calls_before)
+
+    def test_non_stream_aggregates_streaming_events(self):
+        """测试非流式请求在内部使用流式接口，结果与阻塞模式一致"""
+        self.fake.configure("app-deadline", chunks=["Hello", " from", " stream"], chunk_delay=0.05)
+        response = self._post()
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual(body["choices"][0]["message"]["content"], "Hello from stream")
+        self.assertTrue(body["id"].startswith("msg-"))
+        self.assertEqual(self.fake.requests_for("app-deadline")[-1]["payload"]["response_mode"], "streaming")
+
+    def test_non_stream_deadline_stops_generation(self):
+        """测试非流式请求在生成中途到达截止时间时返回 504 并停止 Dify 生成"""
+        self.fake.configure("app-deadline", chunks=["word "] * 50, chunk_delay=0.1)
+        stopped_before = len(self.fake.stopped_tasks)
+        started = time.monotonic()
+        response = self._post(timeout="0.5")
+        self.assertEqual(response.status_code, 504)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertTrue(wait_for(lambda: len(self.fake.stopped_tasks) == stopped_before + 1))
+        self.assertTrue(wait_for(lambda: self.fake.active_streams == 0))
+
+    def test_stream_deadline_ends_stream_with_error(self):
+        """测试流式请求到达截止时间时输出错误分片和 [DONE]，并停止 Dify 生成"""
+        self.fake.configure("app-deadline", chunks=["word "] * 50, chunk_delay=0.1)
+        stopped_before = len(self.fake.stopped_tasks)
+        response = self._post(stream=True, timeout="0.5")
+        body = b"".join(response.response)
+        response.close()
+        payloads = [line[len("data: "):] for line in body.decode().split("\n") if line.startswith("data: ")]
+        self.assertEqual(payloads[-1], "[DONE]")
+        self.assertIn("deadline exceeded", json.loads(payloads[-2])["error"])
+        self.assertTrue(wait_for(lambda: len(self.fake.stopped_tasks) == stopped_before + 1))
+        self.assertEqual(main.REGISTRY.get("opendify_deadline_exceeded_total").get(
+            model="deadline-model", stage="upstream"), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+工作进程排空测试 - 验证排空期间拒绝新请求、在途流在截止时间内完成、内存阈值触发回收，
+以及真实 gunicorn 工作进程在 max_requests 回收和 SIGTERM 关闭时不截断进行中的 SSE 流
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+import unittest
+from types import SimpleNamespace
+
+import httpx
+
+# 添加项目根目录到 Python 路径
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from drain import WorkerDrain
+from fake_dify import FakeDify
+from dify_test_case import FakeDifyTestCase, config_factory
+
+ANSWER = "Hello from fake Dify"
+
+
+make_config = config_factory({"timeout": 5, "max_rss_mb": 0, "rss_check_interval": 0.1})
+
+
+def make_drain(rss=0, **overrides):
+    return WorkerDrain(make_config(**overrides), rss_reader=lambda: rss)
+
+
+class TestWorkerDrain(unittest.TestCase):
+    """测试在途登记与排空流程"""
+
+    def setUp(self):
+        main.REGISTRY.reset()
+
+    def test_finish_waits_for_inflight_and_flushes_once(self):
+        """测试 finish 等待在途请求结束后才执行收尾，重复调用不再执行"""
+        drain = make_drain()
+        flushed = []
+        drain.add_flush_hook("first", lambda: flushed.append("first"))
+        drain.add_flush_hook("broken", lambda: 1 / 0)
+        drain.add_flush_hook("last", lambda: flushed.append("last"))
+
+        ticket = drain.track()
+        self.assertTrue(drain.begin("max_requests"))
+        self.assertFalse(drain.begin("shutdown"))
+        self.assertFalse(drain.accepting)
+
+        threading.Timer(0.2, ticket.release).start()
+        started = time.monotonic()
+        self.assertTrue(drain.finish())
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+        self.assertEqual(flushed, ["first", "last"])
+
+        ticket.release()  # 重复释放不影响计数
+        self.assertEqual(drain.inflight, 0)
+        drain.finish()
+        self.assertEqual(flushed, ["first", "last"])
+        self.assertEqual(main.REGISTRY.get("opendify_worker_drains_total").get(reason="max_requests", result="drained"), 1)
+
+    def test_finish_gives_up_at_deadline(self):
+        """测试在途请求超过截止时间时仍然执行收尾并报告超时"""
+        drain = make_drain(timeout=0.1)
+        flushed = []
+        drain.add_flush_hook("flush", lambda: flushed.append(True))
+        drain.track()
+        self.assertFalse(drain.finish())
+        self.assertEqual(flushed, [True])
+        self.assertEqual(main.REGISTRY.get("opendify_worker_drains_total").get(reason="shutdown", result="timeout"), 1)
+
+    def test_memory_threshold_recycles_worker(self):
+        """测试常驻内存超过阈值时把 worker.alive 置为 False 并以 memory 为原因排空"""
+        self.assertFalse(make_drain(rss=900 * 1024 * 1024).check_memory())  # 阈值为 0 表示关闭
+
+        drain = make_drain(rss=300 * 1024 * 1024, max_rss_mb=256)
+        worker = SimpleNamespace(alive=True, nr=3, max_requests=1000)
+        drain.watch_worker(worker)
+        for _ in range(50):
+            time.sleep(0.02)
+            if not worker.alive:
+                break
+        self.assertFalse(worker.alive)
+        self.assertEqual(drain.reason, "memory")
+
+    def test_watch_worker_reports_max_requests(self):
+        """测试 gunicorn 达到 max_requests 时以 max_requests 为原因排空"""
+        drain = make_drain(rss=10 * 1024 * 1024, max_rss_mb=256)
+        worker = SimpleNamespace(alive=True, nr=0, max_requests=5)
+        drain.watch_worker(worker)
+        worker.nr, worker.alive = 5, False
+        for _ in range(100):
+            time.sleep(0.02)
+            if not drain.accepting:
+                break
+        self.assertEqual(drain.reason, "max_requests")
+
+
+class TestDrainingEndpoints(FakeDifyTestCase):
+    """使用模拟 Dify 测试排空期间的请求处理"""
+
+    MODEL_CONFIG = {"drain-model": "app-drain"}
+
+    def setUp(self):
+        super().setUp()
+        self.drain = make_drain()
+        # 与 main 的排空对象注册相同的开始钩子（立即刷新就绪状态）
+        for name, hook in main.worker_drain._begin_hooks:
+            self.drain.add_begin_hook(name, hook)
+        self.patch_main("worker_drain", self.drain)
+        self.fake.configure("app-drain", chunk_delay=0.05)
+
+    def _post(self, **kwargs):
+        return self.client.post("/v1/chat/completions", json={
+            "model": "drain-model", "stream": True,
+            "messages": [{"role": "user", "content": "hi"}],
+        }, **kwargs)
+
+    def test_inflight_stream_finishes_and_new_requests_rejected(self):
+        """测试排空开始后在途流完整输出，新请求返回 503，readyz 立即报告未就绪"""
+        response = self._post(buffered=False)
+        chunks = iter(response.response)
+        body = [next(chunks)]
+        self.assertEqual(self.drain.inflight, 1)
+        main.health_monitor.refresh()
+        self.assertTrue(self.client.get("/readyz").get_json()["checks"]["accepting"])
+
+        self.drain.begin("shutdown")
+        rejected = self._post()
+        self.assertEqual(rejected.status_code, 503)
+        self.assertEqual(rejected.get_json()["error"]["code"], "worker_draining")
+        self.assertEqual(rejected.headers["Connection"], "close")
+        # 不等待后台检查循环，缓存的就绪结果已在 begin() 时刷新
+        readyz = self.client.get("/readyz")
+        self.assertEqual(readyz.status_code, 503)
+        self.assertFalse(readyz.get_json()["checks"]["accepting"])
+
+        # 在后台等待排空，同时在当前线程读完流（流的生成器依赖当前线程的请求上下文）
+        drained = []
+        waiter = threading.Thread(target=lambda: drained.append(self.drain.finish()))
+        waiter.start()
+        body.extend(chunks)
+        response.close()
+        waiter.join(timeout=10)
+        self.assertEqual(drained, [True])
+        body = b"".join(body)
+        self.assertIn(b"[DONE]", body)
+        self.assertEqual(body.count(b'"delta": {"content"'), len(ANSWER))
+        self.assertEqual(self.drain.inflight, 0)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@unittest.skipUnless(shutil.which("gunicorn"), "gunicorn is not installed")
+class TestGunicornDrain(unittest.TestCase):
+    """在真实的 gunicorn gevent 工作进程上测试回收和关闭时的排空"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeDify().start()
+        cls.fake.configure("app-gunicorn-drain", chunks=["Hello", " from", " fake", " Dify"], chunk_delay=0.4)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.stop()
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="opendify_drain_test_")
+        self.port = _free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.log_path = os.path.join(self.work_dir, "gunicorn.log")
+        self.process = None
+
+    def tearDown(self):
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _start(self, *args):
+        env = dict(os.environ)
+        env.update({
+            "PYTHONPATH": ROOT,
+            "DIFY_API_BASE": self.fake.base_url,
+            "MODEL_CONFIG": "{'drain-model': 'app-gunicorn-drain'}",
+            "MODEL_FAILOVER_CONFIG": "",
+            "GUNICORN_WORKERS": "1",
+            "DRAIN_TIMEOUT": "20",
+            "WARMUP_CONNECTIONS": "0",
+            "ENVIRONMENT": "",
+        })
+        with open(self.log_path, "wb") as log:
+            self.process = subprocess.Popen(
+                ["gunicorn", "--config", os.path.join(ROOT, "gunicorn_config.py"),
+                 "--bind", f"127.0.0.1:{self.port}", *args, "main:app"],
+                cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+            )
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                if httpx.get(f"{self.base_url}/livez", timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                time.sleep(0.2)
+        self.fail(f"gunicorn did not start: {self._log()}")
+
+    def _log(self):
+        with open(self.log_path, encoding="utf-8", errors="replace") as f:
+            return f.read()
+
+    def _stream(self, started):
+        """发起流式请求，收到第一块数据后设置 started，返回完整的响应体"""
+        body = b""
+        with httpx.stream("POST", f"{self.base_url}/v1/chat/completions", timeout=30, json={
+            "model": "drain-model", "stream": True,
+            "messages": [{"role": "user", "content": "hi"}],
+        }) as response:
+            for chunk in response.iter_bytes():
+                body += chunk
+                started.set()
+        return body
+
+    def _stream_in_background(self):
+        started = threading.Event()
+        result = {}
+        thread = threading.Thread(target=lambda: result.setdefault("body", self._stream(started)))
+        thread.start()
+        self.assertTrue(started.wait(15), self._log())
+        return thread, result
+
+    def test_max_requests_recycle_keeps_stream(self):
+        """测试 max_requests 回收时进行中的流完整输出，之后由新的工作进程继续服务"""
+        # 启动检查的 /livez 算第一个请求，流式请求是第二个，开始处理时工作进程即进入回收
+        self._start("--max-requests", "2", "--max-requests-jitter", "0")
+        thread, result = self._stream_in_background()
+        thread.join(timeout=30)
+
+        self.assertIn(b"[DONE]", result["body"])
+        self.assertEqual(result["body"].count(b'"delta": {"content"'), len(ANSWER))
+
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                if httpx.get(f"{self.base_url}/readyz", timeout=1).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        time.sleep(0.5)
+        log = self._log()
+        self.assertIn("draining (max_requests)", log)
+        self.assertIn("drained in", log)
+        # master 及时回收退出的工作进程并启动新的（不等到 timeout）
+        self.assertGreaterEqual(log.count("Booting worker"), 2)
+        self.assertNotIn("WORKER TIMEOUT", log)
+
+    def test_sigterm_waits_for_stream(self):
+        """测试 SIGTERM 关闭时等待进行中的流结束后才退出"""
+        self._start()
+        thread, result = self._stream_in_background()
+        self.process.send_signal(signal.SIGTERM)
+        thread.join(timeout=30)
+
+        self.assertIn(b"[DONE]", result["body"])
+        self.assertEqual(result["body"].count(b'"delta": {"content"'), len(ANSWER))
+        self.assertEqual(self.process.wait(timeout=30), 0)
+        self.assertIn("draining (shutdown)", self._log())
+
+
+if __name__ == '__main__':
+    unittest.main()
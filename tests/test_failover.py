@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+流式故障转移测试 - 使用本地模拟 Dify 验证首字节超时和 5xx/429 切换
+"""
+
+import os
+import sys
+import json
+import unittest
+from unittest.mock import patch
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from failover import FAILOVER_TOTAL
+from dify_test_case import FakeDifyTestCase
+
+
+def collect_stream(response):
+    """解析 SSE 响应，返回 (拼接后的内容, 所有 data 负载)"""
+    payloads = []
+    for line in response.get_data(as_text=True).split("\n"):
+        if line.startswith("data: "):
+            payloads.append(line[6:])
+    content = ""
+    for payload in payloads:
+        if payload == "[DONE]":
+            continue
+        chunk = json.loads(payload)
+        for choice in chunk.get("choices", []):
+            content += choice.get("delta", {}).get("content") or ""
+    return content, payloads
+
+
+class TestStreamingFailover(FakeDifyTestCase):
+    """测试流式请求的故障转移"""
+
+    MODEL_CONFIG = {"test-model": "app-primary", "backup-model": "app-backup-model"}
+    FAILOVER_CONFIG = {
+        "test-model": {"ttfb_deadline": 0.3, "backups": [{"api_key": "app-backup"}]}
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.fake.configure("app-backup", chunks=["from", " backup"])
+
+    def _stream(self):
+        return self.client.post("/v1/chat/completions", json={
+            "model": "test-model",
+            "messages": [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "yo"},
+                         {"role": "user", "content": "again"}],
+            "stream": True,
+        }, headers={"X-OpenWebUI-Chat-Id": "failover-chat"})
+
+    def test_primary_within_deadline(self):
+        """测试主目标按时返回时不切换"""
+        self.fake.configure("app-primary", chunks=["primary"])
+        content, payloads = collect_stream(self._stream())
+        self.assertEqual(content, "primary")
+        self.assertEqual(payloads[-1], "[DONE]")
+        self.assertEqual(FAILOVER_TOTAL.get(model="test-model", reason="ttfb_deadline"), 0)
+
+    def test_failover_on_ttfb_deadline(self):
+        """测试首字节超时切换到备用 Key，客户端只看到一个流"""
+        self.fake.configure("app-primary", ttfb=2.0, chunks=["late"])
+        content, payloads = collect_stream(self._stream())
+        self.assertEqual(content, "from backup")
+        self.assertEqual(payloads.count("[DONE]"), 1)
+        self.assertEqual(FAILOVER_TOTAL.get(model="test-model", reason="ttfb_deadline"), 1)
+
+        # 备用目标不携带主应用的 conversation_id，而是携带完整历史
+        backup_payload = self.fake.requests_for("app-backup")[-1]["payload"]
+        self.assertIsNone(backup_payload["conversation_id"])
+        self.assertEqual(len(backup_payload["conversation_history"]), 2)
+
+    def test_failover_on_retryable_status(self):
+        """测试开始输出前的 5xx/429 触发切换"""
+        for status in (503, 429):
+            self.fake.configure("app-primary", status=status)
+            content, _ = collect_stream(self._stream())
+            self.assertEqual(content, "from backup")
+            self.assertEqual(FAILOVER_TOTAL.get(model="test-model", reason=f"status_{status}"), 1)
+
+    def test_all_targets_fail(self):
+        """测试所有目标都失败时返回错误事件"""
+        self.fake.configure("app-primary", status=503)
+        self.fake.configure("app-backup", status=500)
+        _, payloads = collect_stream(self._stream())
+        # 首个分片是连接上游之前发出的 role 分片
+        self.assertEqual(json.loads(payloads[0])["choices"][0]["delta"]["role"], "assistant")
+        self.assertIn("error", json.loads(payloads[1]))
+        self.assertEqual(payloads[-1], "[DONE]")
+
+
+class TestBackupUpstreamSlots(FakeDifyTestCase):
+    """测试切换到其他上游的备用目标时，在途槽位计入备用上游"""
+
+    MODEL_CONFIG = {"test-model": "app-slots-primary"}
+    FAKE_UPSTREAMS = 2
+
+    def setUp(self):
+        super().setUp()
+        self.primary, self.backup = (fake.base_url for fake in self.fakes)
+        self.patch_main("DIFY_API_BASE", self.primary)
+        self.patch_main("FAILOVER_CONFIG", {
+            "test-model": {"backups": [{"api_key": "app-slots-backup", "upstream": self.backup}]}
+        })
+        self.fake.configure("app-slots-primary", status=503)
+        self.fakes[1].configure("app-slots-backup", chunks=["from", " backup"], chunk_delay=0.05)
+
+    def _stream(self):
+        return self.client.post("/v1/chat/completions", json={
+            "model": "test-model", "messages": [{"role": "user", "content": "hi"}], "stream": True,
+        })
+
+    def test_backup_holds_its_own_slot(self):
+        """测试备用目标输出期间占用备用上游的槽位，主上游的槽位已归还"""
+        response = self._stream()
+        chunks = iter(response.response)
+        # 备用目标的首个内容分片（逐字输出）
+        while b'"f"' not in next(chunks):
+            pass
+        self.assertEqual((main.upstream_pool.in_flight(self.primary), main.upstream_pool.in_flight(self.backup)),
+                         (0, 1))
+        b"".join(chunks)
+        response.close()
+        self.assertEqual(main.upstream_pool.in_flight(self.backup), 0)
+
+    def test_saturated_backup_upstream_fails_fast(self):
+        """测试备用上游的连接池已满时不再调用它，返回错误事件"""
+        requests_before = len(self.fakes[1].requests_for("app-slots-backup"))
+        with patch.object(main.upstream_pool, "limit_for", lambda upstream: 0 if upstream == self.backup else 10):
+            _, payloads = collect_stream(self._stream())
+        self.assertIn("pool", json.loads(payloads[-2])["error"])
+        self.assertEqual(len(self.fakes[1].requests_for("app-slots-backup")), requests_before)
+        self.assertEqual(main.upstream_pool.in_flight(self.primary), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+公平调度测试 - 验证按用户加权唤醒、用户份额上限和跨进程共享计数
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import multiprocessing
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController, AdmissionRejected
+from fair_scheduler import FairScheduler, SharedCounters, load_scheduler_config
+from metrics import REGISTRY
+
+
+def hold_slot(shm_path, granted, done):
+    """子进程：占用一个名额直到父进程通知退出"""
+    scheduler = FairScheduler(dict(load_scheduler_config(), shm_path=shm_path))
+    scheduler.on_grant("heavy", "m")
+    granted.set()
+    done.wait(5)
+
+
+class TestFairScheduler(unittest.TestCase):
+    """测试 FairScheduler 与 AdmissionController 的配合"""
+
+    def setUp(self):
+        REGISTRY.reset()
+        self.temp_dir = tempfile.mkdtemp(prefix="opendify_scheduler_test_")
+        self.shm_path = os.path.join(self.temp_dir, "scheduler.shm")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def make_scheduler(self, **overrides):
+        config = load_scheduler_config()
+        config.update({"shm_path": self.shm_path, "global_concurrency": 0, "user_share": 0})
+        config.update(overrides)
+        return FairScheduler(config)
+
+    def make_controller(self, scheduler, **overrides):
+        config = {
+            "max_concurrent": 2, "default_model_limit": 0, "model_limits": {},
+            "max_queue": 10, "max_wait": 2.0, "retry_after": 1,
+        }
+        config.update(overrides)
+        return AdmissionController(config, scheduler=scheduler)
+
+    def _queue(self, controller, user, priority, admitted):
+        thread = threading.Thread(
+            target=lambda: admitted.append((user, controller.acquire("m", user, priority))))
+        thread.start()
+        time.sleep(0.05)
+        return thread
+
+    def test_light_user_jumps_heavy_backlog(self):
+        """测试名额释放时，占用较少的用户先于更早排队的重度用户被唤醒"""
+        controller = self.make_controller(self.make_scheduler())
+        first = controller.acquire("m", "heavy", "batch")
+        second = controller.acquire("m", "heavy", "batch")
+
+        admitted = []
+        threads = [self._queue(controller, "heavy", "batch", admitted) for _ in range(2)]
+        threads.append(self._queue(controller, "light", "batch", admitted))
+
+        first.release()
+        time.sleep(0.1)
+        self.assertEqual([user for user, _ in admitted], ["light"])
+
+        second.release()
+        admitted[0][1].release()
+        for thread in threads:
+            thread.join(1.0)
+        self.assertEqual(len(admitted), 3)
+
+    def test_interactive_preferred_over_batch(self):
+        """测试同等占用下交互式请求优先于批量请求"""
+        controller = self.make_controller(self.make_scheduler(), max_concurrent=1)
+        ticket = controller.acquire("m", "owner", "interactive")
+
+        admitted = []
+        threads = [
+            self._queue(controller, "api", "batch", admitted),
+            self._queue(controller, "webui", "interactive", admitted),
+        ]
+        ticket.release()
+        time.sleep(0.1)
+        self.assertEqual([user for user, _ in admitted], ["webui"])
+
+        admitted[0][1].release()
+        for thread in threads:
+            thread.join(1.0)
+
+    def test_user_share_cap(self):
+        """测试重度用户最多占用其份额，其他用户仍可立即准入"""
+        scheduler = self.make_scheduler(global_concurrency=4, user_share=0.5,
+                                        user_weights={"vip": 2})
+        controller = self.make_controller(scheduler, max_concurrent=10, max_wait=0.2)
+        controller.acquire("m", "heavy", "batch")
+        controller.acquire("m", "heavy", "batch")
+        with self.assertRaises(AdmissionRejected) as ctx:
+            controller.acquire("m", "heavy", "batch")
+        self.assertEqual(ctx.exception.reason, "queue_timeout")
+        # 排队期间的每次轮询不重复计数
+        self.assertEqual(REGISTRY.get("opendify_scheduler_user_capped_total").get(priority="batch"), 1)
+
+        controller.acquire("m", "light", "batch")
+        # 权重为 2 的用户份额翻倍，但仍受全局预算限制
+        self.assertEqual(scheduler.user_cap("vip"), 4)
+        controller.acquire("m", "vip", "batch")
+        with self.assertRaises(AdmissionRejected):
+            controller.acquire("m", "vip", "batch")
+
+    def test_counts_shared_across_processes(self):
+        """测试其他进程的占用可见，进程退出后遗留计数被清理"""
+        ctx = multiprocessing.get_context("fork")
+        granted, done = ctx.Event(), ctx.Event()
+        child = ctx.Process(target=hold_slot, args=(self.shm_path, granted, done))
+        child.start()
+        try:
+            self.assertTrue(granted.wait(5))
+            scheduler = self.make_scheduler()
+            self.assertEqual(scheduler.user_in_flight("heavy"), 1)
+            self.assertEqual(scheduler.counters.total(), 1)
+        finally:
+            done.set()
+            child.join(5)
+
+        # 新进程认领槽位时清零已退出进程的计数
+        counters = SharedCounters(self.shm_path)
+        counters.add(0, 0, 0)
+        self.assertEqual(counters.total(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
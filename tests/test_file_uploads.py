@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+多模态图片测试 - 验证内容分片的文本提取、data URL 的流式解码和校验、
+按内容哈希复用已上传文件（进程内 LRU、SQLite 共享、TTL），以及图片作为 Dify files 发送
+"""
+
+import os
+import sys
+import base64
+import hashlib
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+import file_uploads
+from file_uploads import (
+    UploadCache, InvalidImageError, message_text, image_urls, validate_image_urls, decode_data_url,
+    resolve_image_files
+)
+from dify_test_case import FakeDifyTestCase, config_factory
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 40
+
+
+def data_url(data=PNG, mime="image/png"):
+    return f"data:{mime};base64,{base64.b64encode(data).decode()}"
+
+
+def image_message(text, url):
+    return {"role": "user", "content": [
+        {"type": "text", "text": text},
+        {"type": "image_url", "image_url": {"url": url}},
+    ]}
+
+
+make_config = config_factory({"cache_enabled": True, "cache_ttl": 3600, "cache_size": 16, "cache_max_rows": 100,
+                              "max_image_bytes": 1024 * 1024})
+
+
+class TestContentParts(unittest.TestCase):
+    """测试内容分片的解析和 data URL 解码"""
+
+    def test_message_text_and_image_urls(self):
+        message = image_message("what is this?", "https://example.com/a.png")
+        self.assertEqual(message_text(message["content"]), "what is this?")
+        self.assertEqual(image_urls(message["content"]), ["https://example.com/a.png"])
+        self.assertEqual(message_text("plain"), "plain")
+        self.assertEqual(image_urls("plain"), [])
+
+    def test_decode_in_chunks(self):
+        """测试跨多个解码块的图片内容和哈希正确"""
+        data = os.urandom(200 * 1024)
+        with patch.object(file_uploads, "_DECODE_CHUNK", 4096):
+            image = decode_data_url(data_url(data), 1024 * 1024)
+        self.assertEqual(image.digest, hashlib.sha256(data).hexdigest())
+        self.assertEqual(image.file.read(), data)
+        self.assertEqual(image.filename[-4:], ".png")
+        image.close()
+
+    def test_invalid_images(self):
+        """测试非 base64、非图片、非法字符和过大的图片被拒绝"""
+        for url in ("data:image/png,raw", "data:text/plain;base64,aGk=", "ftp://example.com/a.png",
+                    "data:image/png;base64,@@@@not-base64", "data:image/png;base64,aGk", "data:image/png;base64,a==="):
+            with self.subTest(url=url), self.assertRaises(InvalidImageError):
+                validate_image_urls([image_message("x", url)], 1024)
+        with self.assertRaises(InvalidImageError):
+            validate_image_urls([image_message("x", data_url())], 100)
+        with self.assertRaises(InvalidImageError):
+            decode_data_url("data:image/png;base64,@@@@", 1024)
+        validate_image_urls([image_message("x", data_url())], 1024 * 1024)
+
+
+class TestUploadCache(unittest.TestCase):
+    """测试上传缓存"""
+
+    def setUp(self):
+        main.REGISTRY.reset()
+        self.work_dir = tempfile.mkdtemp(prefix="opendify_upload_test_")
+        self.db_path = os.path.join(self.work_dir, "uploads.db")
+        self.uploaded = []
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _upload(self, image):
+        self.uploaded.append(image.file.read())
+        return f"file-{len(self.uploaded)}"
+
+    def test_same_image_uploaded_once_per_app(self):
+        """测试同一张图片对同一个应用只上传一次，不同应用分别上传"""
+        cache = UploadCache(self.db_path, make_config())
+        urls = [data_url()]
+        first = resolve_image_files(urls, "app-a", cache, self._upload)
+        second = resolve_image_files(urls, "app-a", cache, self._upload)
+        self.assertEqual(first, second)
+        self.assertEqual(first[0], {"type": "image", "transfer_method": "local_file", "upload_file_id": "file-1"})
+        self.assertEqual(self.uploaded, [PNG])
+        resolve_image_files(urls, "app-b", cache, self._upload)
+        self.assertEqual(len(self.uploaded), 2)
+        self.assertEqual(main.REGISTRY.get("opendify_file_uploads_total").get(result="cache_hit"), 1)
+
+    def test_shared_across_workers_through_sqlite(self):
+        """测试另一个进程（另一个缓存实例）上传的文件可以复用"""
+        UploadCache(self.db_path, make_config()).put("app-a", "abc", "file-shared")
+        self.assertEqual(UploadCache(self.db_path, make_config()).get("app-a", "abc"), "file-shared")
+
+    def test_ttl_and_size_limits(self):
+        """测试过期的条目不再复用，SQLite 只保留最近使用的条目"""
+        cache = UploadCache(self.db_path, make_config(cache_ttl=60, cache_size=1, cache_max_rows=2))
+        with patch("file_uploads.time.time", return_value=1000.0):
+            cache.put("app", "old", "file-old")
+        self.assertIsNone(cache.get("app", "old"))
+        for digest in ("d1", "d2", "d3"):
+            cache.put("app", digest, f"file-{digest}")
+        fresh = UploadCache(self.db_path, make_config(cache_max_rows=2))
+        self.assertIsNone(fresh.get("app", "d1"))
+        self.assertEqual(fresh.get("app", "d3"), "file-d3")
+
+    def test_remote_url_is_not_uploaded(self):
+        cache = UploadCache(self.db_path, make_config())
+        files = resolve_image_files(["https://example.com/a.png"], "app", cache, self._upload)
+        self.assertEqual(files, [{"type": "image", "transfer_method": "remote_url", "url": "https://example.com/a.png"}])
+        self.assertEqual(self.uploaded, [])
+
+
+class TestMultimodalEndpoint(FakeDifyTestCase):
+    """使用模拟 Dify 测试图片作为 files 发送"""
+
+    MODEL_CONFIG = {"vision-model": "app-vision"}
+
+    def setUp(self):
+        super().setUp()
+        self.work_dir = tempfile.mkdtemp(prefix="opendify_upload_test_")
+        self.patch_main("upload_cache", UploadCache(os.path.join(self.work_dir, "uploads.db"), make_config()))
+        self.fake.configure("app-vision")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _post(self, stream, messages):
+        response = self.client.post("/v1/chat/completions", json={
+            "model": "vision-model", "stream": stream, "messages": messages,
+        })
+        b"".join(response.response)
+        response.close()
+        return response
+
+    def test_image_uploaded_once_across_turns(self):
+        """测试两轮对话携带同一张图片时只上传一次，两次请求都引用同一个文件"""
+        uploads_before = len(self.fake.uploads)
+        requests_before = len(self.fake.requests_for("app-vision"))
+        self._post(True, [image_message("describe", data_url())])
+        self._post(False, [
+            image_message("describe", data_url()),
+            {"role": "assistant", "content": "a picture"},
+            image_message("and now?", data_url()),
+        ])
+        uploads = self.fake.uploads[uploads_before:]
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(uploads[0]["data"], PNG)
+        self.assertEqual(uploads[0]["mime"], "image/png")
+
+        first, second = [r["payload"] for r in self.fake.requests_for("app-vision")[requests_before:]]
+        self.assertEqual(first["query"], "describe")
+        self.assertEqual(second["query"], "and now?")
+        self.assertEqual(second["conversation_history"][0]["content"], "describe")
+        for payload in (first, second):
+            self.assertEqual(payload["files"], [
+                {"type": "image", "transfer_method": "local_file", "upload_file_id": uploads[0]["id"]}
+            ])
+
+    def test_invalid_image_rejected(self):
+        """测试格式错误的图片（包括非法的 base64 数据）在流式和非流式请求中都返回 400，不调用 Dify"""
+        requests_before = len(self.fake.requests_for("app-vision"))
+        uploads_before = len(self.fake.uploads)
+        for url in ("data:image/png,raw", "data:image/png;base64,@@@@not-base64"):
+            for stream in (False, True):
+                with self.subTest(url=url, stream=stream):
+                    response = self.client.post("/v1/chat/completions", json={
+                        "model": "vision-model", "stream": stream, "messages": [image_message("x", url)],
+                    })
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(response.get_json()["error"]["code"], "invalid_image")
+        self.assertEqual(len(self.fake.requests_for("app-vision")), requests_before)
+        self.assertEqual(len(self.fake.uploads), uploads_before)
+
+
+if __name__ == '__main__':
+    unittest.main()
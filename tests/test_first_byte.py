@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+首字节测试 - 验证流式响应在连接 Dify 之前就发出响应头和 role 分片，且整个流使用同一个 id
+"""
+
+import os
+import sys
+import json
+import time
+import unittest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from dify_test_case import FakeDifyTestCase
+
+
+class TestFirstByte(FakeDifyTestCase):
+    """测试流式响应的首个分片"""
+
+    MODEL_CONFIG = {"ttfb-model": "app-ttfb"}
+
+    def test_role_chunk_before_upstream_responds(self):
+        """测试 Dify 首字节很慢时客户端立即收到 role 分片，映射在首个内容分片之后写入"""
+        self.fake.configure("app-ttfb", ttfb=0.5, chunks=["Hi", " there"])
+        chat_id = f"first-byte-{time.time_ns()}"
+        started = time.monotonic()
+        response = self.client.post("/v1/chat/completions", json={
+            "model": "ttfb-model", "stream": True,
+            "messages": [{"role": "user", "content": "hi"}],
+        }, headers={"X-OpenWebUI-Chat-Id": chat_id}, buffered=False)
+        chunks = iter(response.response)
+
+        first = next(chunks)
+        self.assertLess(time.monotonic() - started, 0.4)
+        role = json.loads(first.decode()[len("data: "):])
+        self.assertEqual(role["choices"][0]["delta"], {"role": "assistant", "content": ""})
+        self.assertTrue(role["id"].startswith("chatcmpl-"))
+
+        body = first + b"".join(chunks)
+        response.close()
+        payloads = [line[len("data: "):] for line in body.decode().split("\n") if line.startswith("data: ")]
+        self.assertEqual(payloads[-1], "[DONE]")
+        events = [json.loads(p) for p in payloads[:-1]]
+        self.assertEqual({e["id"] for e in events}, {role["id"]})
+        self.assertEqual("".join(e["choices"][0]["delta"].get("content", "") for e in events), "Hi there")
+        self.assertTrue(main.conversation_mapper.has_mapping(chat_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
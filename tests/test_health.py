@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+存活/就绪检查与模型列表测试 - 验证 /livez、/readyz 的缓存结果和 /v1/models 的 ETag
+"""
+
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from health import HealthMonitor
+
+
+class TestHealthMonitor(unittest.TestCase):
+    """测试就绪状态的计算"""
+
+    def test_required_checks_gate_readiness(self):
+        """测试只有必需检查决定就绪，检查抛出异常视为失败"""
+        state = {"db": True, "extra": False}
+
+        def broken():
+            raise RuntimeError("boom")
+
+        monitor = HealthMonitor({"db": lambda: state["db"], "extra": lambda: state["extra"], "broken": broken},
+                                required=["db"], config={"interval": 60})
+        body, status = monitor.snapshot()
+        self.assertEqual(status, 200)
+        self.assertIn(b'"broken": false', body)
+
+        # 结果被缓存，直到下一次刷新
+        state["db"] = False
+        self.assertEqual(monitor.snapshot()[1], 200)
+        self.assertEqual(monitor.refresh()[1], 503)
+        self.assertEqual(monitor.snapshot()[1], 503)
+
+
+class TestHealthEndpoints(unittest.TestCase):
+    """测试 HTTP 端点"""
+
+    def setUp(self):
+        self.client = main.app.test_client()
+
+    def test_livez(self):
+        """测试存活检查总是返回 200"""
+        response = self.client.get("/livez")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["status"], "alive")
+
+    def test_readyz_follows_warmup_and_database(self):
+        """测试预热完成且数据库可用时就绪，否则返回 503"""
+        monitor = HealthMonitor(dict(main.health_monitor.checks), required=["database", "warmup"],
+                                config={"interval": 60})
+        with patch.object(main, "health_monitor", monitor):
+            main._worker_ready.clear()
+            monitor.refresh()
+            response = self.client.get("/readyz")
+            self.assertEqual(response.status_code, 503)
+            self.assertFalse(response.get_json()["checks"]["warmup"])
+
+            main._worker_ready.set()
+            try:
+                monitor.refresh()
+                response = self.client.get("/readyz")
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.get_json()["checks"]["database"])
+
+                with patch.object(main.conversation_mapper, "ping", return_value=False):
+                    monitor.refresh()
+                self.assertEqual(self.client.get("/readyz").status_code, 503)
+            finally:
+                main._worker_ready.clear()
+
+    def test_models_etag(self):
+        """测试模型列表预编码并带 ETag，If-None-Match 命中返回 304，配置替换后重新生成"""
+        models = {"model-a": "app-a", "model-b": None}
+        available = [{"id": m, "object": "model", "created": 0, "owned_by": "dify"} for m in models]
+        with patch.object(main, "MODEL_TO_API_KEY", models), patch.object(main, "AVAILABLE_MODELS", available):
+            response = self.client.get("/v1/models")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([m["id"] for m in response.get_json()["data"]], ["model-a"])
+            etag = response.headers["ETag"]
+
+            self.assertEqual(self.client.get("/v1/models", headers={"If-None-Match": etag}).status_code, 304)
+            self.assertIs(main.models_response_body()[0], main.models_response_body()[0])
+
+        with patch.object(main, "MODEL_TO_API_KEY", {"model-c": "app-c"}), \
+                patch.object(main, "AVAILABLE_MODELS", [{"id": "model-c", "object": "model", "created": 0, "owned_by": "dify"}]):
+            response = self.client.get("/v1/models", headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers["ETag"], etag)
+
+
+if __name__ == '__main__':
+    unittest.main()
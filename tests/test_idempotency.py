@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+幂等键测试 - 验证重复请求合并到同一次 Dify 调用、流式重放和结果缓存
+"""
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from dify_test_case import FakeDifyTestCase, config_factory
+from idempotency import IdempotencyStore, idempotency_key, load_idempotency_config
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+make_config = config_factory(load_idempotency_config, mode="header", result_ttl=30)
+
+
+def make_store(**overrides):
+    return IdempotencyStore(make_config(**overrides))
+
+
+class TestIdempotencyKey(unittest.TestCase):
+    """测试幂等键的来源和隔离"""
+
+    def test_header_and_auto_modes(self):
+        """测试请求头优先，auto 模式下用 chat_id + 最后一条消息"""
+        header = idempotency_key("header", "retry-1", "u", "m", True)
+        self.assertIsNotNone(header)
+        self.assertIsNone(idempotency_key("header", None, "u", "m", True, "chat", MESSAGES))
+        self.assertIsNone(idempotency_key("off", "retry-1", "u", "m", True))
+
+        auto = idempotency_key("auto", None, "u", "m", True, "chat", MESSAGES)
+        self.assertEqual(auto, idempotency_key("auto", None, "u", "m", True, "chat", [{"role": "user", "content": "hi"}]))
+        self.assertNotEqual(auto, idempotency_key("auto", None, "u", "m", True, "chat", [{"role": "user", "content": "bye"}]))
+
+    def test_scoped_by_user_model_and_mode(self):
+        """测试相同的请求头在不同用户、模型或流式模式下互不影响"""
+        base = idempotency_key("header", "retry-1", "u", "m", True)
+        self.assertNotEqual(base, idempotency_key("header", "retry-1", "other", "m", True))
+        self.assertNotEqual(base, idempotency_key("header", "retry-1", "u", "other", True))
+        self.assertNotEqual(base, idempotency_key("header", "retry-1", "u", "m", False))
+
+
+class TestIdempotentRequests(FakeDifyTestCase):
+    """使用模拟 Dify 测试重复请求合并"""
+
+    MODEL_CONFIG = {"test-model": "app-idem"}
+
+    def setUp(self):
+        super().setUp()
+        self.store = make_store()
+        self.patch_main("idempotency_store", self.store)
+        self.fake.configure("app-idem", ttfb=0.1, chunk_delay=0.05)
+        self.upstream_before = len(self.fake.requests_for("app-idem"))
+
+    def _upstream_calls(self):
+        return len(self.fake.requests_for("app-idem")) - self.upstream_before
+
+    def _post(self, key, stream, buffered=True):
+        return main.app.test_client().post(
+            "/v1/chat/completions", headers={"Idempotency-Key": key}, buffered=buffered,
+            json={"model": "test-model", "stream": stream, "messages": MESSAGES})
+
+    def _concurrently(self, *calls):
+        results = [None] * len(calls)
+
+        def _run(i, call):
+            results[i] = call()
+
+        threads = []
+        for i, call in enumerate(calls):
+            threads.append(threading.Thread(target=_run, args=(i, call)))
+            threads[-1].start()
+            time.sleep(0.15)
+        for t in threads:
+            t.join(timeout=30)
+        return results
+
+    def test_duplicate_stream_attaches_to_running_call(self):
+        """测试流式重复请求从头重放进行中的流，客户端看到的内容一致"""
+        def call():
+            response = self._post("stream-dup", stream=True)
+            return response.status_code, response.get_data()
+
+        first, second = self._concurrently(call, call)
+        self.assertEqual(first[0], 200)
+        self.assertEqual(first, second)
+        self.assertIn(b"[DONE]", first[1])
+        self.assertEqual(self._upstream_calls(), 1)
+
+        # 完成后的重试直接重放缓存的结果
+        self.assertEqual(call(), first)
+        self.assertEqual(self._upstream_calls(), 1)
+
+    def test_stream_survives_original_client_disconnect(self):
+        """测试原客户端断开后，重试的客户端仍能收到完整的流，Dify 不会被停止"""
+        stopped_before = list(self.fake.stopped_tasks)
+        original = self._post("stream-retry", stream=True, buffered=False)
+        chunks = iter(original.response)
+        next(chunks)
+        retry_result = []
+        retry = threading.Thread(target=lambda: retry_result.append(
+            self._post("stream-retry", stream=True).get_data()))
+        retry.start()
+        time.sleep(0.05)
+        original.close()
+        retry.join(timeout=30)
+
+        self.assertIn(b"[DONE]", retry_result[0])
+        self.assertEqual(retry_result[0].count(b'"delta": {"content"'), len("Hello from fake Dify"))
+        self.assertEqual(self._upstream_calls(), 1)
+        self.assertEqual(self.fake.stopped_tasks, stopped_before)
+
+    def test_abandoned_stream_cancels_dify(self):
+        """测试所有订阅者断开后停止读取并通知 Dify 停止生成"""
+        self.fake.configure("app-idem", ttfb=0.0, chunk_delay=0.2, chunks=["a"] * 20)
+        stopped_before = len(self.fake.stopped_tasks)
+        response = self._post("stream-abandon", stream=True, buffered=False)
+        next(iter(response.response))
+        response.close()
+
+        deadline = time.time() + 5
+        while len(self.fake.stopped_tasks) == stopped_before and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(self.fake.stopped_tasks), stopped_before + 1)
+
+    def test_duplicate_blocking_request_shares_result(self):
+        """测试非流式重复请求等待并共享第一个请求的结果"""
+        def call():
+            response = self._post("blocking-dup", stream=False)
+            return response.status_code, response.get_json()
+
+        first, second = self._concurrently(call, call)
+        self.assertEqual(first[0], 200)
+        self.assertEqual(first, second)
+        self.assertEqual(self._upstream_calls(), 1)
+
+    def test_failed_result_not_cached(self):
+        """测试失败的结果不缓存，重试会重新调用上游"""
+        self.fake.configure("app-idem", status=502)
+        self.assertEqual(self._post("blocking-fail", stream=False).status_code, 502)
+        self.fake.configure("app-idem")
+        self.assertEqual(self._post("blocking-fail", stream=False).status_code, 200)
+        self.assertEqual(self._upstream_calls(), 2)
+
+    def test_overflowed_stream_rejects_late_duplicates(self):
+        """测试流超过重放缓冲区后不再缓存已读取的分片，之后的重复请求得到 409，原客户端仍收到完整输出"""
+        store = self.patch_main("idempotency_store", make_store(max_buffer_bytes=200))
+        original = self._post("stream-big", stream=True, buffered=False)
+        chunks = iter(original.response)
+        body = [next(chunks) for _ in range(8)]
+        (key, flight), = store._flights.items()
+        self.assertFalse(flight.joinable)
+        self.assertLessEqual(flight.buffered_bytes, 200)
+
+        duplicate = self._post("stream-big", stream=True)
+        self.assertEqual(duplicate.status_code, 409)
+        self.assertEqual(duplicate.get_json()["error"]["code"], "idempotency_conflict")
+        self.assertEqual(main.REGISTRY.get("opendify_idempotent_requests_total").get(result="conflict"), 1)
+
+        body.extend(chunks)
+        original.close()
+        self.assertIn(b"[DONE]", b"".join(body))
+        self.assertEqual(b"".join(body).count(b'"delta": {"content"'), len("Hello from fake Dify"))
+        self.assertEqual(self._upstream_calls(), 1)
+        # 完成后的结果不完整，不作为缓存结果重放
+        self.assertFalse(store._usable(store._flights[key], time.time()))
+
+
+if __name__ == '__main__':
+    unittest.main()
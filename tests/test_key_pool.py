@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+多 Key 测试 - 验证加权最少在途选择、429 停放和会话粘滞
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from circuit_breaker import key_fingerprint
+from conversation_mapper_sqlite import ConversationMapper
+from dify_test_case import FakeDifyTestCase
+from key_pool import KeyPool, KeysExhausted, KEY_PARKED, parse_key_entries
+
+
+class TestKeyPool(unittest.TestCase):
+    """测试 KeyPool 的选择逻辑"""
+
+    def setUp(self):
+        main.REGISTRY.reset()
+        self.pool = KeyPool(park_seconds=30)
+        self.keys = ["app-a", {"key": "app-b", "weight": 2}]
+
+    def test_parse_key_entries(self):
+        """测试单 Key、列表和带权重的配置"""
+        self.assertEqual(parse_key_entries("app-x"), [{"key": "app-x", "weight": 1.0}])
+        self.assertEqual([e["key"] for e in parse_key_entries(self.keys)], ["app-a", "app-b"])
+        self.assertEqual(parse_key_entries(["", {"key": "app-c", "weight": 0}]), [])
+
+    def test_weighted_least_outstanding(self):
+        """测试按 (在途数 + 1) / 权重 选择，释放后名额归还"""
+        leases = [self.pool.select("m", self.keys) for _ in range(3)]
+        chosen = sorted(lease.api_key for lease in leases)
+        self.assertEqual(chosen, ["app-a", "app-b", "app-b"])
+
+        for lease in leases:
+            if lease.api_key == "app-b":
+                lease.release()
+                lease.release()  # 重复释放不影响计数
+        self.assertEqual(self.pool.select("m", self.keys).api_key, "app-b")
+
+    def test_parked_key_skipped_until_all_parked(self):
+        """测试 429 停放的 Key 被跳过，全部停放时抛出 KeysExhausted"""
+        self.pool.park("m", "app-b", "12")
+        for _ in range(3):
+            self.assertEqual(self.pool.select("m", self.keys).api_key, "app-a")
+
+        self.pool.park("m", "app-a")
+        with self.assertRaises(KeysExhausted) as ctx:
+            self.pool.select("m", self.keys)
+        self.assertEqual(ctx.exception.retry_after, 12)
+        self.assertEqual(KEY_PARKED.get(model="m", key=key_fingerprint("app-b")), 1)
+
+    def test_pinned_key_wins(self):
+        """测试会话绑定的 Key 优先，即使它更忙或已停放"""
+        for _ in range(3):
+            self.pool.select("m", self.keys, pinned_key_id=key_fingerprint("app-a"))
+        self.pool.park("m", "app-a")
+        lease = self.pool.select("m", self.keys, pinned_key_id=key_fingerprint("app-a"))
+        self.assertEqual(lease.api_key, "app-a")
+        self.assertTrue(lease.pinned)
+
+        lease = self.pool.select("m", self.keys, pinned_key_id=key_fingerprint("app-removed"))
+        self.assertFalse(lease.pinned)
+
+
+class TestMultiKeyRequests(FakeDifyTestCase):
+    """使用模拟 Dify 测试多 Key 请求路径"""
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp(prefix="opendify_key_pool_test_")
+        self.mapper = ConversationMapper(os.path.join(self.temp_dir, "mappings.db"))
+        self.patch_main("conversation_mapper", self.mapper)
+        self.patch_main("key_pool", KeyPool(park_seconds=30))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _post(self, chat_id=None):
+        headers = {"X-OpenWebUI-Chat-Id": chat_id} if chat_id else {}
+        return self.client.post("/v1/chat/completions", headers=headers, json={
+            "model": "multi-model",
+            "messages": [{"role": "user", "content": "hi"}],
+        })
+
+    def test_rate_limited_key_is_parked(self):
+        """测试上游 429 后该 Key 被停放，后续请求改用其他 Key"""
+        self.fake.configure("app-limited", status=429, headers={"Retry-After": "60"})
+        self.fake.configure("app-spare")
+        keys = [{"key": "app-limited", "weight": 10}, "app-spare"]
+        with patch.object(main, "MODEL_TO_API_KEY", {"multi-model": keys}):
+            self.assertEqual(self._post().status_code, 429)
+            for _ in range(3):
+                self.assertEqual(self._post().status_code, 200)
+
+        self.assertEqual(len(self.fake.requests_for("app-limited")), 1)
+        self.assertEqual(len(self.fake.requests_for("app-spare")), 3)
+        self.assertAlmostEqual(main.key_pool.parked_for("app-limited"), 60, delta=2)
+
+    def test_conversation_sticks_to_key(self):
+        """测试会话映射记录创建它的 Key，后续轮次固定使用该 Key"""
+        self.fake.configure("app-s1")
+        self.fake.configure("app-s2")
+        with patch.object(main, "MODEL_TO_API_KEY", {"multi-model": ["app-s1", "app-s2"]}):
+            self.assertEqual(self._post("chat-sticky").status_code, 200)
+            conversation_id, key_id, _ = self.mapper.get_mapping("chat-sticky")
+            first_key = "app-s1" if key_id == key_fingerprint("app-s1") else "app-s2"
+            self.assertEqual(key_id, key_fingerprint(first_key))
+
+            for _ in range(4):
+                self.assertEqual(self._post("chat-sticky").status_code, 200)
+
+        follow_ups = self.fake.requests_for(first_key)[-4:]
+        self.assertEqual(len(follow_ups), 4)
+        for r in follow_ups:
+            self.assertEqual(r["payload"]["conversation_id"], conversation_id)
+
+    def test_removed_key_starts_new_conversation(self):
+        """测试会话所属 Key 被移除后，用新 Key 开启新会话并更新映射"""
+        self.fake.configure("app-old")
+        self.fake.configure("app-new")
+        with patch.object(main, "MODEL_TO_API_KEY", {"multi-model": ["app-old"]}):
+            self._post("chat-moved")
+        with patch.object(main, "MODEL_TO_API_KEY", {"multi-model": ["app-new"]}):
+            self.assertEqual(self._post("chat-moved").status_code, 200)
+
+        self.assertIsNone(self.fake.requests_for("app-new")[-1]["payload"]["conversation_id"])
+        self.assertEqual(self.mapper.get_mapping("chat-moved")[1], key_fingerprint("app-new"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+映射缓存测试 - 验证缓存命中不查询数据库，一个工作进程替换或清理映射后，其他工作进程不再使用缓存中的旧映射
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_mapper_sqlite import ConversationMapper
+
+
+class TestMappingCache(unittest.TestCase):
+    """两个映射器实例共享同一个数据库，模拟两个工作进程"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="opendify_mapping_cache_test_")
+        db_path = os.path.join(self.work_dir, "mappings.db")
+        self.writer = ConversationMapper(db_path)
+        self.reader = ConversationMapper(db_path)
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_replaced_mapping_visible_to_other_worker(self):
+        """测试同一秒内替换映射（换 Key、换上游或分支）后，另一个实例读到新会话"""
+        with patch("conversation_mapper_sqlite.time.time", return_value=1000.0):
+            self.writer.set_mapping("chat-1", "conv-old", "key-a", "up-a")
+            self.assertEqual(self.reader.get_mapping("chat-1"), ("conv-old", "key-a", "up-a"))
+            self.writer.set_mapping("chat-1", "conv-new", "key-b", "up-b")
+            self.assertEqual(self.reader.get_mapping("chat-1"), ("conv-new", "key-b", "up-b"))
+            # 只更新使用时间不会使缓存失效
+            self.writer.update_last_used("chat-1")
+            self.assertEqual(self.reader.get_mapping("chat-1"), ("conv-new", "key-b", "up-b"))
+
+    def test_cache_hit_skips_sqlite(self):
+        """测试映射未变化时缓存命中不查询数据库"""
+        self.writer.set_mapping("chat-4", "conv-4")
+        self.assertEqual(self.reader.get_dify_conversation_id("chat-4"), "conv-4")
+        with patch.object(self.reader._db, "connection", side_effect=AssertionError("queried SQLite")):
+            self.assertEqual(self.reader.get_mapping("chat-4"), ("conv-4", None, None))
+            self.assertEqual(self.writer.get_mapping("chat-4"), ("conv-4", None, None))
+
+    def test_cleaned_mapping_not_served_from_cache(self):
+        """测试另一个实例清理过期映射后，缓存中的映射不再返回"""
+        with patch("conversation_mapper_sqlite.time.time", return_value=1000.0):
+            self.writer.set_mapping("chat-2", "conv-2")
+        self.assertEqual(self.reader.get_dify_conversation_id("chat-2"), "conv-2")
+        self.assertEqual(self.writer.cleanup_old_mappings(1), 1)
+        self.assertIsNone(self.reader.get_mapping("chat-2"))
+
+    def test_warm_cache_is_checked(self):
+        self.writer.set_mapping("chat-3", "conv-old")
+        self.assertEqual(self.reader.warm_cache(10), 1)
+        self.writer.set_mapping("chat-3", "conv-new")
+        self.assertEqual(self.reader.get_dify_conversation_id("chat-3"), "conv-new")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+max_tokens / stop 测试 - 验证近似 token 计数、跨分片的停止序列匹配，
+以及达到限制时以正确的 finish_reason 结束输出并停止 Dify 生成
+"""
+
+import os
+import sys
+import json
+import time
+import unittest
+from unittest.mock import patch
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from output_limits import OutputLimiter, approx_token_count, parse_output_limits
+from dify_test_case import FakeDifyTestCase
+
+
+def run_limiter(limiter, chunks):
+    """依次喂入分片，返回 (输出文本, finish_reason)"""
+    output = []
+    for chunk in chunks:
+        text, finish_reason = limiter.feed(chunk)
+        output.append(text)
+        if finish_reason:
+            return "".join(output), finish_reason
+    output.append(limiter.flush())
+    return "".join(output), limiter.finish_reason
+
+
+def wait_for(predicate, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+class TestOutputLimiter(unittest.TestCase):
+    """测试 OutputLimiter"""
+
+    def test_approx_token_count(self):
+        """测试英文按每 4 个字符一个 token、CJK 字符和标点各算一个"""
+        self.assertEqual(approx_token_count(""), 0)
+        self.assertEqual(approx_token_count("Hello world"), 4)
+        self.assertEqual(approx_token_count("你好，世界"), 5)
+
+    def test_stop_split_across_every_boundary(self):
+        """测试停止序列在任意位置被拆到两个分片时都能匹配，且不输出停止序列本身"""
+        text = "The answer is 42.\nObservation: ignored"
+        for split in range(1, len(text)):
+            with self.subTest(split=split):
+                output, reason = run_limiter(OutputLimiter(stop=["\nObservation:"]), [text[:split], text[split:]])
+                self.assertEqual(output, "The answer is 42.")
+                self.assertEqual(reason, "stop")
+
+    def test_stop_split_across_many_chunks(self):
+        """测试停止序列被拆成单个字符逐个到达"""
+        output, reason = run_limiter(OutputLimiter(stop=["END", "###"]), list("abc #E#EN###tail"))
+        self.assertEqual(output, "abc #E#EN")
+        self.assertEqual(reason, "stop")
+
+    def test_partial_stop_prefix_is_released(self):
+        """测试暂缓输出的前缀在确认不匹配后输出，流结束时输出剩余尾部"""
+        limiter = OutputLimiter(stop=["\n\n"])
+        self.assertEqual(limiter.feed("line\n"), ("line", None))
+        self.assertEqual(limiter.feed("next"), ("\nnext", None))
+        self.assertEqual(limiter.feed("\n"), ("", None))
+        self.assertEqual(limiter.flush(), "\n")
+        self.assertIsNone(limiter.finish_reason)
+
+    def test_max_tokens(self):
+        """测试达到 max_tokens 时截断并返回 length"""
+        output, reason = run_limiter(OutputLimiter(max_tokens=3), ["one ", "two ", "three ", "four"])
+        self.assertEqual(reason, "length")
+        self.assertLessEqual(approx_token_count(output), 3)
+        self.assertTrue(output.startswith("one two"))
+        output, reason = run_limiter(OutputLimiter(max_tokens=100), ["short ", "answer"])
+        self.assertEqual((output, reason), ("short answer", None))
+
+    def test_parse_output_limits(self):
+        """测试解析 max_tokens / max_completion_tokens 和字符串或列表形式的 stop"""
+        self.assertEqual(parse_output_limits({}), (None, []))
+        self.assertEqual(parse_output_limits({"max_tokens": 10, "stop": "x"}), (10, ["x"]))
+        self.assertEqual(parse_output_limits({"max_completion_tokens": 5, "max_tokens": 10}), (5, []))
+        self.assertEqual(parse_output_limits({"max_tokens": 0, "stop": ["a", "", 3, "b", "c", "d", "e"]}),
+                         (None, ["a", "b", "c", "d"]))
+        self.assertFalse(OutputLimiter.from_request({}).active)
+
+
+class TestOutputLimitEndpoints(FakeDifyTestCase):
+    """使用模拟 Dify 测试限制在请求中的效果"""
+
+    MODEL_CONFIG = {"limit-model": "app-limit"}
+
+    def setUp(self):
+        super().setUp()
+        # 停止序列 "STOP" 被拆在两个分片之间，之后 Dify 还会继续生成很久
+        self.fake.configure("app-limit", chunks=["Hello wor", "ld ST", "OP never"] + ["more "] * 50, chunk_delay=0.05)
+
+    def _post(self, stream, **limits):
+        return self.client.post("/v1/chat/completions", json={
+            "model": "limit-model", "stream": stream,
+            "messages": [{"role": "user", "content": "hi"}], **limits,
+        })
+
+    def test_stream_stop_split_across_chunks(self):
+        """测试流式请求遇到跨分片的停止序列时以 stop 结束，并停止 Dify 生成"""
+        stopped_before = len(self.fake.stopped_tasks)
+        response = self._post(True, stop=["STOP"])
+        body = b"".join(response.response)
+        response.close()
+        payloads = [line[len("data: "):] for line in body.decode().split("\n") if line.startswith("data: ")]
+        self.assertEqual(payloads[-1], "[DONE]")
+        events = [json.loads(p) for p in payloads[:-1]]
+        self.assertEqual("".join(e["choices"][0]["delta"].get("content", "") for e in events), "Hello world ")
+        self.assertEqual(events[-1]["choices"][0]["finish_reason"], "stop")
+        self.assertTrue(wait_for(lambda: len(self.fake.stopped_tasks) == stopped_before + 1))
+        self.assertTrue(wait_for(lambda: self.fake.active_streams == 0))
+        self.assertEqual(main.OUTPUT_LIMIT_STOPS.get(model="limit-model", reason="stop"), 1)
+        self.assertEqual(main.STREAM_CANCELLATIONS.get(model="limit-model"), 0)
+
+    def test_non_stream_max_tokens(self):
+        """测试非流式请求达到 max_tokens 时返回 length 并停止 Dify 生成"""
+        stopped_before = len(self.fake.stopped_tasks)
+        response = self._post(False, max_tokens=2)
+        self.assertEqual(response.status_code, 200)
+        choice = response.get_json()["choices"][0]
+        self.assertEqual(choice["finish_reason"], "length")
+        self.assertEqual(choice["message"]["content"], "Hello ")
+        self.assertTrue(wait_for(lambda: len(self.fake.stopped_tasks) == stopped_before + 1))
+
+    def test_blocking_mode_truncates(self):
+        """测试关闭内部流式聚合时仍按 stop 截断结果"""
+        with patch.dict(main.deadline_policy.config, {"aggregate_non_stream": False}):
+            response = self._post(False, stop="STOP")
+        choice = response.get_json()["choices"][0]
+        self.assertEqual(choice["message"]["content"], "Hello world ")
+        self.assertEqual(choice["finish_reason"], "stop")
+
+
+if __name__ == '__main__':
+    unittest.main()
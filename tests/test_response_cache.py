@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+响应缓存测试 - 验证 LRU + TTL + 字节预算淘汰、SQLite 共享缓存和请求路径上的命中
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from dify_test_case import FakeDifyTestCase, config_factory
+from response_cache import (MemoryResponseCache, ResponseCache, SQLiteResponseCache, create_response_cache,
+                            load_cache_config)
+
+
+make_config = config_factory(load_cache_config, models={"cached-model"}, backend="memory", ttl=60, max_bytes=1024,
+                             scope="user")
+
+
+class TestResponseCache(unittest.TestCase):
+    """测试缓存的键和淘汰"""
+
+    def setUp(self):
+        main.REGISTRY.reset()
+        self.temp_dir = tempfile.mkdtemp(prefix="opendify_response_cache_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_key_and_model_flags(self):
+        """测试键与字段顺序无关、按用户隔离，以及按模型开启"""
+        cache = MemoryResponseCache(make_config())
+        messages = [{"role": "user", "content": "title?"}]
+        self.assertEqual(cache.key("m", messages, "u1"), cache.key("m", [{"content": "title?", "role": "user"}], "u1"))
+        self.assertNotEqual(cache.key("m", messages, "u1"), cache.key("m", messages, "u2"))
+        self.assertEqual(MemoryResponseCache(make_config(scope="global")).key("m", messages, "u1"),
+                         MemoryResponseCache(make_config(scope="global")).key("m", messages, "u2"))
+
+        self.assertTrue(cache.enabled_for("cached-model"))
+        self.assertFalse(cache.enabled_for("other-model"))
+        self.assertTrue(MemoryResponseCache(make_config(models={"*"})).enabled_for("other-model"))
+        self.assertFalse(MemoryResponseCache(make_config(models=set())).enabled_for("cached-model"))
+
+    def test_backend_must_implement_storage(self):
+        """测试缺少 get / put 的后端在创建时失败"""
+        class IncompleteCache(ResponseCache):
+            def get(self, key):
+                return None
+
+        with self.assertRaises(TypeError):
+            IncompleteCache(make_config())
+
+    def test_memory_lru_ttl_and_budget(self):
+        """测试超出字节预算时淘汰最久未使用的条目，过期条目不再返回"""
+        cache = MemoryResponseCache(make_config(max_bytes=300))
+        cache.put("a", b"x" * 100)
+        cache.put("b", b"y" * 100)
+        cache.put("c", b"z" * 100)
+        self.assertIsNotNone(cache.get("a"))  # a 变为最近使用
+        cache.put("d", b"w" * 100)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"x" * 100)
+
+        cache.put("huge", b"h" * 400)  # 超过整个预算的条目不缓存
+        self.assertIsNone(cache.get("huge"))
+
+        short = MemoryResponseCache(make_config(ttl=0.05))
+        short.put("a", b"x")
+        time.sleep(0.1)
+        self.assertIsNone(short.get("a"))
+
+    def test_sqlite_shared_between_workers(self):
+        """测试 SQLite 后端在两个实例（模拟两个工作进程）之间共享，并按字节预算淘汰"""
+        config = make_config(backend="sqlite", path=os.path.join(self.temp_dir, "cache.db"), max_bytes=250)
+        worker_a = create_response_cache(config)
+        worker_b = create_response_cache(config)
+        self.assertIsInstance(worker_a, SQLiteResponseCache)
+
+        worker_a.put("a", b"x" * 100)
+        self.assertEqual(worker_b.get("a"), b"x" * 100)
+        time.sleep(0.01)
+        worker_b.put("b", b"y" * 100)
+        time.sleep(0.01)
+        worker_a.put("c", b"z" * 100)
+        self.assertIsNone(worker_b.get("a"))
+        self.assertEqual(worker_b.get("c"), b"z" * 100)
+
+
+class TestCachedRequests(FakeDifyTestCase):
+    """使用模拟 Dify 测试请求路径上的缓存"""
+
+    MODEL_CONFIG = {"cached-model": "app-cache", "other-model": "app-cache"}
+
+    def setUp(self):
+        super().setUp()
+        self.patch_main("response_cache", MemoryResponseCache(make_config(max_bytes=1024 * 1024)))
+        self.fake.configure("app-cache")
+        self.before = len(self.fake.requests_for("app-cache"))
+
+    def _post(self, model="cached-model", content="Generate a title", headers=None, stream=False):
+        return self.client.post("/v1/chat/completions", headers=headers or {}, json={
+            "model": model, "stream": stream,
+            "messages": [{"role": "user", "content": content}],
+        })
+
+    def _upstream_calls(self):
+        return len(self.fake.requests_for("app-cache")) - self.before
+
+    def test_hit_and_miss_headers(self):
+        """测试首次请求 MISS 并写入缓存，相同请求 HIT 且不再调用 Dify"""
+        first = self._post()
+        self.assertEqual(first.headers.get("X-Cache"), "MISS")
+        second = self._post()
+        self.assertEqual(second.headers.get("X-Cache"), "HIT")
+        self.assertEqual(first.get_json(), second.get_json())
+        self.assertEqual(self._upstream_calls(), 1)
+
+        self.assertEqual(self._post(content="Generate tags").headers.get("X-Cache"), "MISS")
+        self.assertEqual(self._upstream_calls(), 2)
+
+    def test_bypassed_requests(self):
+        """测试带 chat_id、流式和未开启缓存的模型不走缓存"""
+        for _ in range(2):
+            self.assertIsNone(self._post(headers={"X-OpenWebUI-Chat-Id": "chat-cache"}).headers.get("X-Cache"))
+            self.assertIsNone(self._post(model="other-model").headers.get("X-Cache"))
+            self._post(stream=True).get_data()
+        self.assertEqual(self._upstream_calls(), 6)
+
+    def test_errors_not_cached(self):
+        """测试上游错误不写入缓存"""
+        self.fake.configure("app-cache", status=502)
+        self.assertEqual(self._post(content="fails").status_code, 502)
+        self.fake.configure("app-cache")
+        self.assertEqual(self._post(content="fails").headers.get("X-Cache"), "MISS")
+        self.assertEqual(self._upstream_calls(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
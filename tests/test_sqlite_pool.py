@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+SQLite 连接池测试 - 验证同一数据库文件上锁等待时间相同的模块共用一个连接池、连接被复用，出错的连接被丢弃
+"""
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_singleflight import ChatSingleflight
+from circuit_breaker import CircuitBreaker
+from conversation_mapper_sqlite import ConversationMapper
+from sqlite_pool import shared_pool
+
+
+class TestSQLitePool(unittest.TestCase):
+    """测试 SQLitePool 和 shared_pool"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="opendify_pool_test_")
+        self.db_path = os.path.join(self.work_dir, "data", "shared.db")
+
+    def tearDown(self):
+        shared_pool(self.db_path).close()
+        shared_pool(self.db_path, timeout=5.0).close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_modules_share_pool_by_timeout(self):
+        """测试锁等待时间相同的模块共用一个连接池，熔断器保留 5 秒的锁等待，表建在同一个文件中"""
+        mapper = ConversationMapper(self.db_path)
+        breaker = CircuitBreaker(os.path.join(self.work_dir, "data", "..", "data", "shared.db"))
+        singleflight = ChatSingleflight(self.db_path)
+        self.assertIs(breaker._db, singleflight._db)
+        self.assertIsNot(mapper._db, breaker._db)
+        with breaker._db.connection() as conn:
+            self.assertEqual(conn.execute("PRAGMA busy_timeout").fetchone()[0], 5000)
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        self.assertTrue({"conversation_mappings", "circuit_breakers", "chat_locks"} <= tables)
+        with mapper._db.connection() as conn:
+            self.assertEqual(conn.execute("PRAGMA busy_timeout").fetchone()[0], 60000)
+
+    def test_connections_reused_and_failed_ones_discarded(self):
+        """测试连接用完后放回池中复用，语句出错的连接不再放回"""
+        pool = shared_pool(self.db_path)
+        with pool.connection() as conn:
+            first = conn
+        with pool.connection() as conn:
+            self.assertIs(conn, first)
+        with self.assertRaises(sqlite3.OperationalError):
+            with pool.connection() as conn:
+                conn.execute("SELECT * FROM missing_table")
+        self.assertEqual(pool.idle, 0)
+        with pool.connection() as conn:
+            self.assertIsNot(conn, first)
+
+
+if __name__ == '__main__':
+    unittest.main()
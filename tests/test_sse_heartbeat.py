@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+SSE 心跳测试 - 验证上游静默期间按间隔写出 ": ping"、可选转发 Dify 进度事件，且断开后仍能清理上游
+"""
+
+import os
+import sys
+import json
+import time
+import unittest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+import gevent
+from sse_heartbeat import Heartbeats, HEARTBEAT
+from dify_test_case import FakeDifyTestCase
+
+
+def wait_for(predicate, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+class TestHeartbeats(unittest.TestCase):
+    """测试定时器驱动的心跳迭代器"""
+
+    def test_heartbeat_while_producer_is_silent(self):
+        """测试 producer 静默超过间隔时产出心跳，结束后返回其返回值"""
+        def producer(emit):
+            gevent.sleep(0.25)
+            emit("a")
+            return "done"
+
+        beats = Heartbeats(producer, 0.1)
+        items = list(beats)
+        self.assertEqual(items[-1], "a")
+        self.assertGreaterEqual(items.count(HEARTBEAT), 2)
+        self.assertEqual(beats.result(), "done")
+
+    def test_producer_error_is_raised(self):
+        """测试 producer 的异常在迭代处抛出"""
+        def producer(emit):
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            list(Heartbeats(producer, 0.1))
+
+    def test_close_kills_producer(self):
+        """测试提前关闭迭代器时结束后台 greenlet"""
+        cleaned = []
+
+        def producer(emit):
+            try:
+                while True:
+                    emit("x")
+                    gevent.sleep(0.01)
+            finally:
+                cleaned.append(True)
+
+        beats = Heartbeats(producer, 0)
+        iterator = iter(beats)
+        self.assertEqual(next(iterator), "x")
+        iterator.close()
+        self.assertEqual(cleaned, [True])
+
+    def test_slow_reader_blocks_producer(self):
+        """测试迭代方不读取时 producer 在队列写满后阻塞，关闭后不会卡住"""
+        emitted = []
+
+        def producer(emit):
+            for i in range(100):
+                emit(i)
+                emitted.append(i)
+
+        beats = Heartbeats(producer, 0, max_pending=4)
+        iterator = iter(beats)
+        self.assertEqual(next(iterator), 0)
+        gevent.sleep(0.05)
+        self.assertLessEqual(len(emitted), 6)
+        iterator.close()
+        self.assertTrue(beats._greenlet.dead)
+
+
+class TestStreamHeartbeats(FakeDifyTestCase):
+    """使用模拟 Dify 测试流式响应中的心跳与进度事件"""
+
+    MODEL_CONFIG = {"agent-model": "app-agent"}
+
+    def setUp(self):
+        super().setUp()
+        self.heartbeat_config = {"interval": 0.1, "forward_events": set()}
+        self.patch_main("HEARTBEAT_CONFIG", self.heartbeat_config)
+
+    def _open_stream(self):
+        return main.app.test_client().post("/v1/chat/completions", json={
+            "model": "agent-model", "stream": True,
+            "messages": [{"role": "user", "content": "search the web"}],
+        }, buffered=False)
+
+    def _payloads(self, body):
+        return [line[len("data: "):] for line in body.decode().split("\n") if line.startswith("data: ")]
+
+    def test_ping_while_upstream_is_silent(self):
+        """测试 Dify 首字节和分片间隔较长时写出心跳，内容不受影响"""
+        self.fake.configure("app-agent", pre_events=["workflow_started", "agent_thought"],
+                            ttfb=0.35, chunks=["Hi", " there"], chunk_delay=0.35)
+        response = self._open_stream()
+        body = b"".join(response.response)
+        response.close()
+
+        self.assertGreaterEqual(body.count(b": ping\n\n"), 4)
+        self.assertGreaterEqual(main.SSE_HEARTBEATS.get(model="agent-model"), 4)
+        payloads = self._payloads(body)
+        self.assertEqual(payloads[-1], "[DONE]")
+        events = [json.loads(p) for p in payloads[:-1]]
+        self.assertNotIn("dify_event", body.decode())
+        self.assertEqual("".join(e["choices"][0]["delta"].get("content", "") for e in events), "Hi there")
+
+    def test_forward_selected_progress_events(self):
+        """测试只转发配置的进度事件，并去掉 Dify 内部标识"""
+        self.heartbeat_config["forward_events"] = {"agent_thought"}
+        self.fake.configure("app-agent", pre_events=["workflow_started", "agent_thought"], chunks=["ok"])
+        response = self._open_stream()
+        body = b"".join(response.response)
+        response.close()
+
+        events = [json.loads(p) for p in self._payloads(body)[:-1]]
+        progress = [e for e in events if "dify_event" in e]
+        self.assertEqual(len(progress), 1)
+        self.assertEqual(progress[0]["dify_event"], {"event": "agent_thought"})
+        self.assertEqual(progress[0]["choices"][0]["delta"], {})
+        self.assertEqual(len({e["id"] for e in events}), 1)
+        self.assertEqual("".join(e["choices"][0]["delta"].get("content", "") for e in events), "ok")
+        self.assertEqual(main.REGISTRY.get("opendify_sse_forwarded_events_total").get(event="agent_thought"), 1)
+
+    def test_disconnect_during_heartbeats_stops_upstream(self):
+        """测试心跳期间客户端断开时仍关闭上游流并发送 stop"""
+        self.fake.configure("app-agent", chunks=["word "] * 100, chunk_delay=0.3)
+        stopped_before = len(self.fake.stopped_tasks)
+        response = self._open_stream()
+        chunks = iter(response.response)
+        next(chunks)  # role 分片
+        # 首个内容分片之前也可能先写出心跳
+        first = next(chunks)
+        while first == b": ping\n\n":
+            first = next(chunks)
+        self.assertIn(b'"content": "w"', first)
+        while next(chunks) != b": ping\n\n":
+            pass
+        response.close()
+
+        self.assertTrue(wait_for(lambda: len(self.fake.stopped_tasks) == stopped_before + 1))
+        self.assertTrue(wait_for(lambda: self.fake.active_streams == 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+客户端断开测试 - 验证断开后关闭上游流并调用 Dify 停止接口
+"""
+
+import os
+import sys
+import time
+import unittest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from dify_test_case import FakeDifyTestCase
+
+
+def wait_for(predicate, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+class TestStreamCancellation(FakeDifyTestCase):
+    """测试客户端断开后的上游取消"""
+
+    MODEL_CONFIG = {"test-model": "app-cancel"}
+
+    def _open_stream(self):
+        return main.app.test_client().post("/v1/chat/completions", json={
+            "model": "test-model",
+            "messages": [{"role": "user", "content": "write a long story"}],
+            "stream": True,
+        }, buffered=False)
+
+    def test_disconnect_stops_dify_task(self):
+        """测试中途断开时发送 stop 并计数"""
+        self.fake.configure("app-cancel", chunks=["word "] * 200, chunk_delay=0.05)
+        response = self._open_stream()
+        body = iter(response.response)
+        self.assertIn(b'"role": "assistant"', next(body))  # 连接上游之前发出的 role 分片
+        first = next(body)
+        self.assertIn(b'"content": "w"', first)
+
+        # 模拟客户端关闭标签页
+        response.close()
+
+        self.assertTrue(wait_for(lambda: len(self.fake.stopped_tasks) == 1))
+        self.assertTrue(self.fake.stopped_tasks[0].startswith("task-"))
+        self.assertEqual(main.STREAM_CANCELLATIONS.get(model="test-model"), 1)
+        # 上游流被及时关闭
+        self.assertTrue(wait_for(lambda: self.fake.active_streams == 0))
+
+    def test_completed_stream_is_not_cancelled(self):
+        """测试正常结束的流不会触发 stop"""
+        self.fake.configure("app-cancel", chunks=["done"])
+        stopped_before = len(self.fake.stopped_tasks)
+        response = self._open_stream()
+        data = b"".join(response.response)
+        response.close()
+        self.assertIn(b"[DONE]", data)
+        time.sleep(0.1)
+        self.assertEqual(len(self.fake.stopped_tasks), stopped_before)
+        self.assertEqual(main.STREAM_CANCELLATIONS.get(model="test-model"), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+流量采集测试 - 验证采样、缓冲区满时丢弃、按大小轮转并压缩、
+对话请求记录的元数据（不含消息内容）和上游事件节奏，以及按记录回放
+"""
+
+import os
+import sys
+import glob
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from gevent.pywsgi import WSGIServer
+from traffic_capture import TrafficCapture, read_capture
+from dify_test_case import FakeDifyTestCase, config_factory
+import replay_traffic
+
+REQUEST = {"model": "m", "stream": True, "messages": [{"role": "user", "content": "secret question"}]}
+
+
+make_config = config_factory({"enabled": True, "sample_rate": 1.0, "max_bytes": 1 << 20,
+                              "max_files": 20, "max_pending": 100, "flush_interval": 60})
+
+
+class TestTrafficCapture(unittest.TestCase):
+    """测试采样、缓冲和文件轮转"""
+
+    def setUp(self):
+        main.REGISTRY.reset()
+        self.work_dir = tempfile.mkdtemp(prefix="opendify_capture_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_sampling(self):
+        """测试关闭或采样率为 0 时不记录"""
+        self.assertIsNone(TrafficCapture(make_config(dir=self.work_dir, enabled=False)).begin(REQUEST))
+        self.assertIsNone(TrafficCapture(make_config(dir=self.work_dir, sample_rate=0)).begin(REQUEST))
+        self.assertIsNotNone(TrafficCapture(make_config(dir=self.work_dir)).begin(REQUEST))
+
+    def test_record_has_no_content(self):
+        """测试记录只包含长度等元数据，不包含消息内容"""
+        capture = TrafficCapture(make_config(dir=self.work_dir))
+        record = capture.begin(REQUEST, has_chat_id=True)
+        record.upstream_event(5)
+        capture.submit(record, 200)
+        self.assertEqual(capture.flush(), 1)
+        [data] = list(read_capture([capture.path]))
+        self.assertEqual(data["messages"], [{"role": "user", "chars": len("secret question")}])
+        self.assertTrue(data["chat"])
+        self.assertEqual(data["status"], 200)
+        self.assertEqual(data["events"][0][1], 5)
+        self.assertNotIn("secret", json.dumps(data))
+
+    def test_full_buffer_drops(self):
+        """测试缓冲区满时丢弃记录而不是等待"""
+        capture = TrafficCapture(make_config(dir=self.work_dir, max_pending=2))
+        with patch.object(capture, "start"):
+            for _ in range(3):
+                capture.submit(capture.begin(REQUEST), 200)
+        self.assertEqual(main.REGISTRY.get("opendify_traffic_capture_records_total").get(result="dropped"), 1)
+        self.assertEqual(capture.flush(), 2)
+
+    def test_rotation_and_compression(self):
+        """测试超过大小后轮转为 gzip 文件，只保留 max_files 个，读取时包含全部记录"""
+        capture = TrafficCapture(make_config(dir=self.work_dir, max_bytes=1, max_files=2))
+        for _ in range(4):
+            capture.submit(capture.begin(REQUEST), 200)
+            capture.flush()
+        archives = glob.glob(os.path.join(self.work_dir, "capture-*.jsonl.gz"))
+        self.assertEqual(len(archives), 2)
+        self.assertFalse(os.path.exists(capture.path))
+        self.assertEqual(len(list(read_capture(archives))), 2)
+
+    def test_close_rotates_and_leftovers_count(self):
+        """测试退出前轮转当前文件；已退出进程遗留的 .jsonl 参与保留数量的清理，正在写入的文件不参与"""
+        capture = TrafficCapture(make_config(dir=self.work_dir, max_files=2))
+        leftover = os.path.join(self.work_dir, "capture-999999999.jsonl")
+        with open(leftover, "w") as f:
+            f.write("{}\n")
+        os.utime(leftover, (0, 0))
+        capture.submit(capture.begin(REQUEST), 200)
+        capture.close()
+        self.assertFalse(os.path.exists(capture.path))
+        self.assertEqual(len(glob.glob(os.path.join(self.work_dir, "capture-*.jsonl.gz"))), 1)
+        self.assertTrue(os.path.exists(leftover))
+
+        # 另一个工作进程的文件仍在写入，不会被清理
+        live = os.path.join(self.work_dir, f"capture-{os.getppid()}.jsonl")
+        with open(live, "w") as f:
+            f.write("{}\n")
+        os.utime(live, (0, 0))
+        capture.submit(capture.begin(REQUEST), 200)
+        capture.close()
+        self.assertFalse(os.path.exists(leftover))
+        self.assertTrue(os.path.exists(live))
+        self.assertEqual(len(glob.glob(os.path.join(self.work_dir, "capture-*.jsonl.gz"))), 2)
+
+
+class TestTrafficCaptureEndpoint(FakeDifyTestCase):
+    """使用模拟 Dify 测试请求路径上的采集和回放"""
+
+    MODEL_CONFIG = {"capture-model": "app-capture"}
+
+    def setUp(self):
+        super().setUp()
+        self.work_dir = tempfile.mkdtemp(prefix="opendify_capture_test_")
+        self.capture = TrafficCapture(make_config(dir=self.work_dir))
+        self.patch_main("traffic_capture", self.capture)
+        self.fake.configure("app-capture", chunks=["Hello", " captured"], chunk_delay=0.05)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _post(self, stream):
+        return self.client.post("/v1/chat/completions", json={
+            "model": "capture-model", "stream": stream,
+            "messages": [{"role": "system", "content": "be brief"}, {"role": "user", "content": "hi"}],
+        })
+
+    def test_stream_and_non_stream_are_captured(self):
+        """测试两条路径都在响应结束后提交记录，并带有上游事件的时间和长度"""
+        for stream in (True, False):
+            response = self._post(stream)
+            b"".join(response.response)
+            response.close()
+        self.assertEqual(self.capture.flush(), 2)
+        stream, blocking = read_capture([self.capture.path])
+        self.assertTrue(stream["stream"])
+        self.assertFalse(blocking["stream"])
+        self.assertEqual([m["chars"] for m in stream["messages"]], [8, 2])
+        self.assertEqual([e[1] for e in stream["events"]], [5, 9])
+        self.assertGreaterEqual(stream["events"][1][0] - stream["events"][0][0], 0.04)
+        self.assertGreaterEqual(stream["duration"], stream["events"][-1][0])
+        self.assertEqual(len(blocking["events"]), 2)
+
+    def test_models_endpoint_not_captured(self):
+        self.client.get("/v1/models")
+        self.assertEqual(self.capture.flush(), 0)
+
+    def test_replay(self):
+        """测试回放工具按记录的形态和节奏重放请求"""
+        for stream in (True, False):
+            response = self._post(stream)
+            b"".join(response.response)
+            response.close()
+        self.capture.flush()
+        records = list(read_capture([self.capture.path]))
+
+        server = WSGIServer(("127.0.0.1", 0), main.app, log=None)
+        server.start()
+        try:
+            with patch.object(main, "MODEL_TO_API_KEY", {"capture-model": replay_traffic.REPLAY_KEY}):
+                result = replay_traffic.replay(f"http://127.0.0.1:{server.server_port}", self.fake, records, 10.0)
+        finally:
+            server.stop()
+        self.assertEqual(result["completed"], 2)
+        self.assertGreater(result["replay_ttft_p50_ms"], 0)
+        replayed = self.fake.requests_for(replay_traffic.REPLAY_KEY)
+        self.assertEqual(len(replayed), 2)
+        self.assertTrue(all(r["payload"]["query"].startswith("rid:") for r in replayed))
+
+
+if __name__ == '__main__':
+    unittest.main()
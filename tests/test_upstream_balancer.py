@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+多上游负载均衡测试 - 验证最少在途选择、被动摘除、主动探测和会话固定上游
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import httpx
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from conversation_mapper_sqlite import ConversationMapper
+from dify_test_case import FakeDifyTestCase, config_factory
+from key_pool import KeyPool
+from upstream_balancer import UpstreamBalancer, load_balancer_config, parse_upstream_list
+
+UPSTREAMS = ["http://dify-a/v1", "http://dify-b/v1", "http://dify-c/v1"]
+
+
+make_config = config_factory(load_balancer_config, eject_failures=2, eject_seconds=30, unhealthy_threshold=1)
+
+
+class StubClient:
+    """按上游返回固定结果的探测客户端"""
+
+    def __init__(self, status=None):
+        self.status = status
+
+    def get(self, url, timeout=None):
+        if self.status is None:
+            raise httpx.ConnectError("connection refused")
+        return httpx.Response(self.status)
+
+
+class TestUpstreamBalancer(unittest.TestCase):
+    """测试 UpstreamBalancer 的选择逻辑"""
+
+    def setUp(self):
+        main.REGISTRY.reset()
+        self.in_flight = {}
+        self.balancer = UpstreamBalancer(lambda u: self.in_flight.get(u, 0), make_config())
+
+    def test_parse_upstream_list(self):
+        """测试逗号分隔的地址列表"""
+        self.assertEqual(parse_upstream_list("http://dify-a/v1/, http://dify-b/v1"), UPSTREAMS[:2])
+        self.assertEqual(parse_upstream_list("http://dify-a/v1"), UPSTREAMS[:1])
+
+    def test_least_outstanding(self):
+        """测试选择在途流最少的上游，相同时按配置顺序"""
+        self.assertEqual(self.balancer.select(UPSTREAMS), UPSTREAMS[0])
+        self.in_flight.update({UPSTREAMS[0]: 3, UPSTREAMS[1]: 1, UPSTREAMS[2]: 2})
+        self.assertEqual(self.balancer.select(UPSTREAMS), UPSTREAMS[1])
+        # 会话绑定的上游优先，即使它更忙
+        self.assertEqual(self.balancer.select(UPSTREAMS, pinned=UPSTREAMS[0]), UPSTREAMS[0])
+
+    def test_passive_ejection(self):
+        """测试连续失败后摘除，成功会重置失败计数"""
+        self.balancer.record(UPSTREAMS[0], False)
+        self.balancer.record(UPSTREAMS[0], True)
+        self.balancer.record(UPSTREAMS[0], False)
+        self.assertTrue(self.balancer.is_usable(UPSTREAMS[0]))
+
+        self.balancer.record(UPSTREAMS[0], False)
+        self.assertFalse(self.balancer.is_usable(UPSTREAMS[0]))
+        self.assertEqual(self.balancer.select(UPSTREAMS), UPSTREAMS[1])
+
+    def test_active_probe(self):
+        """测试探测失败标记为不健康，恢复后重新参与选择"""
+        self.assertFalse(self.balancer.probe(UPSTREAMS[0], StubClient(None)))
+        self.assertFalse(self.balancer.probe(UPSTREAMS[1], StubClient(502)))
+        self.assertEqual(self.balancer.select(UPSTREAMS), UPSTREAMS[2])
+
+        # 404 等非 5xx 响应说明服务存活
+        self.assertTrue(self.balancer.probe(UPSTREAMS[0], StubClient(404)))
+        self.assertEqual(self.balancer.select(UPSTREAMS), UPSTREAMS[0])
+
+        # 全部不健康时退化为在所有上游中选择
+        for upstream in UPSTREAMS:
+            self.balancer.probe(upstream, StubClient(None))
+        self.assertEqual(self.balancer.select(UPSTREAMS), UPSTREAMS[0])
+
+
+class TestMultiUpstreamRequests(FakeDifyTestCase):
+    """使用两个模拟 Dify 测试多上游请求路径"""
+
+    MODEL_CONFIG = {"test-model": "app-lb"}
+    FAKE_UPSTREAMS = 2
+
+    def setUp(self):
+        super().setUp()
+        self.fake_a, self.fake_b = self.fakes
+        self.temp_dir = tempfile.mkdtemp(prefix="opendify_balancer_test_")
+        self.mapper = ConversationMapper(os.path.join(self.temp_dir, "mappings.db"))
+        self.balancer = UpstreamBalancer(main.upstream_pool.in_flight, make_config())
+        self.patch_main("conversation_mapper", self.mapper)
+        self.patch_main("key_pool", KeyPool())
+        self.patch_main("upstream_balancer", self.balancer)
+        self.fake_a.configure("app-lb")
+        self.fake_b.configure("app-lb")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _post(self, chat_id=None):
+        headers = {"X-OpenWebUI-Chat-Id": chat_id} if chat_id else {}
+        return self.client.post("/v1/chat/completions", headers=headers, json={
+            "model": "test-model",
+            "messages": [{"role": "user", "content": "hi"}],
+        })
+
+    def test_busy_upstream_avoided_and_conversation_pinned(self):
+        """测试避开在途流较多的上游，后续轮次固定在创建会话的上游"""
+        busy = main.upstream_pool.acquire(self.fake_a.base_url)
+        try:
+            self.assertEqual(self._post("chat-pinned").status_code, 200)
+        finally:
+            busy.release()
+        self.assertEqual(len(self.fake_b.requests), 1)
+        self.assertEqual(self.mapper.get_mapping("chat-pinned")[2], self.fake_b.base_url)
+
+        requests_a = len(self.fake_a.requests)
+        for _ in range(3):
+            self.assertEqual(self._post("chat-pinned").status_code, 200)
+        self.assertEqual(len(self.fake_a.requests), requests_a)
+        self.assertEqual(len(self.fake_b.requests), 4)
+
+    def test_failing_upstream_ejected(self):
+        """测试持续返回 5xx 的上游被摘除，后续请求转到其他上游"""
+        self.fake_a.configure("app-lb", status=502)
+        requests_b = len(self.fake_b.requests)
+        self.assertEqual(self._post().status_code, 502)
+        self.assertEqual(self._post().status_code, 502)
+        self.assertFalse(self.balancer.is_usable(self.fake_a.base_url))
+
+        for _ in range(3):
+            self.assertEqual(self._post().status_code, 200)
+        self.assertEqual(len(self.fake_b.requests), requests_b + 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
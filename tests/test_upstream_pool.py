@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+上游连接池测试 - 验证按上游配置、在途计数和快速失败
+"""
+
+import os
+import sys
+import unittest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import REGISTRY
+from upstream_pool import UpstreamPool, PoolExhaustedError, UPSTREAM_POOL_EXHAUSTED, load_pool_config
+
+UPSTREAM = "http://dify-a.test/v1"
+
+
+class TestUpstreamPool(unittest.TestCase):
+    """测试 UpstreamPool"""
+
+    def setUp(self):
+        REGISTRY.reset()
+        config = load_pool_config()
+        config.update({"max_connections": 2, "http2": False})
+        self.pool = UpstreamPool(config, {"http://dify-b.test/v1": {"max_connections": 5, "read_timeout": 120.0}})
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_per_upstream_overrides(self):
+        """测试按上游覆盖配置"""
+        self.assertEqual(self.pool.limit_for(UPSTREAM), 2)
+        self.assertEqual(self.pool.limit_for("http://dify-b.test/v1/"), 5)
+        client = self.pool.get_client("http://dify-b.test/v1")
+        self.assertEqual(client.timeout.read, 120.0)
+        self.assertIs(client, self.pool.get_client("http://dify-b.test/v1"))
+
+    def test_exhaustion_fails_fast(self):
+        """测试超过上限时立即拒绝并计数"""
+        first = self.pool.acquire(UPSTREAM)
+        second = self.pool.acquire(UPSTREAM)
+        with self.assertRaises(PoolExhaustedError):
+            self.pool.acquire(UPSTREAM)
+        self.assertEqual(UPSTREAM_POOL_EXHAUSTED.get(upstream=UPSTREAM), 1)
+
+        # 重复释放只归还一次
+        first.release()
+        first.release()
+        self.assertEqual(self.pool.in_flight(UPSTREAM), 1)
+        with self.pool.acquire(UPSTREAM):
+            self.assertEqual(self.pool.in_flight(UPSTREAM), 2)
+        second.release()
+        self.assertEqual(self.pool.in_flight(UPSTREAM), 0)
+
+    def test_metrics_rendering(self):
+        """测试指标以 Prometheus 文本格式导出"""
+        with self.pool.acquire(UPSTREAM):
+            text = REGISTRY.render()
+        self.assertIn(f'opendify_upstream_in_flight{{upstream="{UPSTREAM}"}} 1.0', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
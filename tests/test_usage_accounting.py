@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Token 用量测试 - 验证 usage 的提取与估算、stream_options.include_usage 的最后一个用量分片、
+以及按模型 / 用户 / Key 的内存累加和分钟 / 小时粒度的 SQLite 汇总
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+# 添加项目根目录到 Python 路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from usage_accounting import UsageAccounting, usage_from_dify, estimate_usage
+from dify_test_case import FakeDifyTestCase, config_factory
+
+
+make_config = config_factory({"enabled": True, "flush_interval": 10, "minute_retention_hours": 48,
+                              "hour_retention_days": 90})
+
+
+class TestUsageConversion(unittest.TestCase):
+    """测试 usage 的转换和估算"""
+
+    def test_usage_from_dify(self):
+        """测试 Dify usage 转换为 OpenAI 格式，缺失时返回 None"""
+        self.assertEqual(
+            usage_from_dify({"prompt_tokens": 5, "completion_tokens": 4, "total_tokens": 9, "currency": "USD"}),
+            {"prompt_tokens": 5, "completion_tokens": 4, "total_tokens": 9})
+        self.assertEqual(usage_from_dify({"prompt_tokens": 3, "completion_tokens": 2})["total_tokens"], 5)
+        self.assertIsNone(usage_from_dify(None))
+        self.assertIsNone(usage_from_dify({}))
+
+    def test_estimate_usage(self):
+        """测试按近似分词估算"""
+        usage = estimate_usage("你好", "Hello world")
+        self.assertEqual(usage, {"prompt_tokens": 2, "completion_tokens": 4, "total_tokens": 6})
+
+
+class TestUsageRollup(unittest.TestCase):
+    """测试内存累加和 SQLite 汇总"""
+
+    def setUp(self):
+        main.REGISTRY.reset()
+        self.work_dir = tempfile.mkdtemp(prefix="opendify_usage_test_")
+        self.db_path = os.path.join(self.work_dir, "usage.db")
+        self.usage = UsageAccounting(self.db_path, make_config())
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_flush_accumulates_minute_and_hour(self):
+        """测试同一分钟的请求合并为一行，重复写入时累加，小时粒度包含所有分钟"""
+        usage = {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+        self.usage.record("m1", "u1", "k1", usage)
+        self.usage.record("m1", "u1", "k1", usage)
+        self.usage.record("m2", "u2", "k1", usage)
+        self.assertEqual(self.usage.flush(), 2)
+        self.assertEqual(self.usage.flush(), 0)
+        self.usage.record("m1", "u1", "k1", usage)
+        self.usage.flush()
+
+        minute = {r["model"]: r for r in self.usage.query("minute", group_by=("model",))}
+        self.assertEqual(minute["m1"]["requests"], 3)
+        self.assertEqual(minute["m1"]["total_tokens"], 45)
+        hour = self.usage.query("hour", group_by=())
+        self.assertEqual(len(hour), 1)
+        self.assertEqual(hour[0]["requests"], 4)
+        self.assertEqual(hour[0]["prompt_tokens"], 40)
+        self.assertEqual(main.REGISTRY.get("opendify_tokens_total").get(model="m1", type="completion"), 15)
+
+    def test_old_minute_rows_are_downsampled(self):
+        """测试超过保留期的分钟数据被删除，小时数据保留"""
+        old = int(time.time()) - 3 * 86400
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany(
+            "INSERT INTO usage_rollup VALUES (?, ?, 'm', 'u', 'k', 1, 1, 1, 2)",
+            [("minute", old // 60 * 60), ("hour", old // 3600 * 3600)])
+        conn.commit()
+        conn.close()
+
+        self.usage.record("m", "u", "k", {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2})
+        self.usage.flush()
+        self.assertEqual(len(self.usage.query("minute", group_by=())), 1)
+        self.assertEqual(len(self.usage.query("hour", group_by=())), 2)
+
+    def test_query_rejects_unknown_resolution(self):
+        with self.assertRaises(ValueError):
+            self.usage.query("day")
+
+
+class TestUsageEndpoints(FakeDifyTestCase):
+    """使用模拟 Dify 测试响应中的 usage 和用量汇总接口"""
+
+    MODEL_CONFIG = {"usage-model": "app-usage"}
+
+    def setUp(self):
+        super().setUp()
+        self.work_dir = tempfile.mkdtemp(prefix="opendify_usage_test_")
+        self.usage = UsageAccounting(os.path.join(self.work_dir, "usage.db"), make_config())
+        self.patch_main("usage_accounting", self.usage)
+        self.fake.configure("app-usage", usage={"prompt_tokens": 7, "completion_tokens": 3, "total_tokens": 10})
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _post(self, stream, **extra):
+        return self.client.post("/v1/chat/completions", json={
+            "model": "usage-model", "stream": stream, "user": "alice",
+            "messages": [{"role": "user", "content": "hi"}], **extra,
+        })
+
+    def _stream_events(self, response):
+        body = b"".join(response.response)
+        response.close()
+        payloads = [line[len("data: "):] for line in body.decode().split("\n") if line.startswith("data: ")]
+        self.assertEqual(payloads[-1], "[DONE]")
+        return [json.loads(p) for p in payloads[:-1]]
+
+    def test_non_stream_usage(self):
+        """测试非流式响应带有 Dify 返回的 usage"""
+        body = self._post(False).get_json()
+        self.assertEqual(body["usage"], {"prompt_tokens": 7, "completion_tokens": 3, "total_tokens": 10})
+
+    def test_stream_include_usage(self):
+        """测试 include_usage 时 [DONE] 之前有一个 choices 为空、带 usage 的分片"""
+        events = self._stream_events(self._post(True, stream_options={"include_usage": True}))
+        self.assertEqual(events[-1]["choices"], [])
+        self.assertEqual(events[-1]["usage"]["total_tokens"], 10)
+        self.assertEqual(events[-2]["choices"][0]["finish_reason"], "stop")
+        self.assertEqual(len({e["id"] for e in events}), 1)
+
+        events = self._stream_events(self._post(True))
+        self.assertFalse(any("usage" in e for e in events))
+
+    def test_stopped_stream_estimates_usage(self):
+        """测试提前停止生成（Dify 没有发送 message_end）时按输出文本估算用量"""
+        events = self._stream_events(self._post(True, stop="fake", stream_options={"include_usage": True}))
+        self.assertEqual(events[-2]["choices"][0]["finish_reason"], "stop")
+        self.assertEqual(events[-1]["usage"]["completion_tokens"], 3)  # "Hello from "
+
+    def test_usage_endpoint_groups_by_model_and_user(self):
+        """测试两条路径的用量都计入汇总，并可按模型和用户分组读取"""
+        self._post(False)
+        self._stream_events(self._post(True))
+        response = self.client.get("/v1/usage?resolution=hour&group_by=model,user")
+        self.assertEqual(response.status_code, 200)
+        rows = response.get_json()["rows"]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["model"], "usage-model")
+        self.assertEqual(rows[0]["user"], "open_webui_alice")
+        self.assertEqual(rows[0]["requests"], 2)
+        self.assertEqual(rows[0]["total_tokens"], 20)
+        self.assertNotIn("key_id", rows[0])
+        self.assertEqual(self.client.get("/v1/usage?resolution=day").status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+"""
+流量采集
+按采样率记录脱敏的请求元数据（模型、消息数量和长度、是否流式、耗时、上游事件节奏），不记录消息内容和用户标识，
+用于在本地按真实的流量形态回放压测（见 tests/replay_traffic.py）。
+
+请求路径上只做一次内存追加：缓冲区已满时直接丢弃记录；
+写文件、按大小轮转和 gzip 压缩都在后台 greenlet 交给 gevent 线程池执行，不阻塞事件循环
+"""
+
+import os
+import re
+import glob
+import gzip
+import json
+import time
+import random
+import shutil
+import logging
+from collections import deque
+from typing import List, Optional
+
+import gevent
+from gevent.lock import Semaphore
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_RECORDS = REGISTRY.counter(
+    "opendify_traffic_capture_records_total", "流量采集的记录数", ("result",))
+
+# 每个请求最多记录的上游事件数，超出部分只计数
+MAX_EVENTS = 4096
+
+# 工作进程正在写入的未压缩文件
+_CURRENT_FILE = re.compile(r"capture-(\d+)\.jsonl$")
+
+
+def load_capture_config() -> dict:
+    """从环境变量读取流量采集配置（默认关闭）"""
+    return {
+        "enabled": os.getenv("TRAFFIC_CAPTURE", "false").strip().lower() in ("1", "true", "yes", "on"),
+        "dir": os.getenv("TRAFFIC_CAPTURE_DIR", "data/traffic"),
+        "sample_rate": float(os.getenv("TRAFFIC_CAPTURE_SAMPLE_RATE", "1.0")),
+        # 单个文件超过该大小时轮转并压缩
+        "max_bytes": int(os.getenv("TRAFFIC_CAPTURE_MAX_BYTES", str(64 * 1024 * 1024))),
+        # 保留的采集文件数（所有工作进程合计，包括已退出进程遗留的未压缩文件）
+        "max_files": int(os.getenv("TRAFFIC_CAPTURE_MAX_FILES", "20")),
+        # 内存中等待写入的记录上限，超出时丢弃
+        "max_pending": int(os.getenv("TRAFFIC_CAPTURE_MAX_PENDING", "1000")),
+        "flush_interval": float(os.getenv("TRAFFIC_CAPTURE_FLUSH_INTERVAL", "1")),
+    }
+
+
+def _content_chars(content) -> int:
+    """消息内容的长度（多模态内容按其 JSON 长度计算）"""
+    if isinstance(content, str):
+        return len(content)
+    return len(json.dumps(content, ensure_ascii=False)) if content is not None else 0
+
+
+class CaptureRecord:
+    """一个被采样请求的元数据，由请求处理过程逐步补充"""
+
+    __slots__ = ("started", "data", "events", "dropped_events")
+
+    def __init__(self, openai_request: dict, has_chat_id: bool):
+        self.started = time.monotonic()
+        messages = openai_request.get("messages") or []
+        stop = openai_request.get("stop")
+        self.data = {
+            "ts": round(time.time(), 3),
+            "model": openai_request.get("model"),
+            "stream": bool(openai_request.get("stream", False)),
+            "messages": [
+                {"role": m.get("role"), "chars": _content_chars(m.get("content"))}
+                for m in messages if isinstance(m, dict)
+            ],
+            "chat": has_chat_id,
+            "max_tokens": openai_request.get("max_tokens"),
+            "stop": len(stop) if isinstance(stop, list) else int(bool(stop)),
+        }
+        # 上游 message 事件：[相对请求开始的秒数, 字符数]
+        self.events: List[list] = []
+        self.dropped_events = 0
+
+    def upstream_event(self, chars: int) -> None:
+        if len(self.events) < MAX_EVENTS:
+            self.events.append([round(time.monotonic() - self.started, 4), chars])
+        else:
+            self.dropped_events += 1
+
+    def finish(self, status: int) -> dict:
+        self.data["status"] = status
+        self.data["duration"] = round(time.monotonic() - self.started, 4)
+        self.data["events"] = self.events
+        if self.dropped_events:
+            self.data["dropped_events"] = self.dropped_events
+        return self.data
+
+
+class TrafficCapture:
+    """采样、缓冲并在后台批量写入 JSONL"""
+
+    def __init__(self, config: Optional[dict] = None):
+        self.config = config or load_capture_config()
+        self._pending = deque()
+        self._greenlet = None
+        # 同一时间只有一个批次在线程池中写入（后台循环和排空时的 flush 可能同时调用）
+        self._write_lock = Semaphore()
+
+    @property
+    def enabled(self) -> bool:
+        return self.config["enabled"] and self.config["sample_rate"] > 0
+
+    @property
+    def path(self) -> str:
+        """当前工作进程写入的文件（每个进程独立，避免多进程交错写入）"""
+        return os.path.join(self.config["dir"], f"capture-{os.getpid()}.jsonl")
+
+    def begin(self, openai_request: Optional[dict], has_chat_id: bool = False) -> Optional[CaptureRecord]:
+        """按采样率决定是否记录该请求，不记录时返回 None"""
+        if not self.enabled or not isinstance(openai_request, dict):
+            return None
+        if random.random() >= self.config["sample_rate"]:
+            return None
+        return CaptureRecord(openai_request, has_chat_id)
+
+    def submit(self, record: CaptureRecord, status: int) -> None:
+        """请求结束时提交记录：只追加到内存，缓冲区满时丢弃"""
+        if len(self._pending) >= self.config["max_pending"]:
+            CAPTURE_RECORDS.inc(result="dropped")
+            return
+        self._pending.append(record.finish(status))
+        CAPTURE_RECORDS.inc(result="captured")
+        if self._greenlet is None:
+            self.start()
+
+    def start(self) -> None:
+        """启动后台写入（每个工作进程一次）"""
+        if self._greenlet is not None or not self.enabled:
+            return
+
+        def _loop():
+            while True:
+                gevent.sleep(self.config["flush_interval"])
+                self.flush()
+
+        self._greenlet = gevent.spawn(_loop)
+
+    def flush(self) -> int:
+        """把缓冲的记录交给线程池写入文件，返回写入的记录数"""
+        batch = []
+        while self._pending:
+            batch.append(self._pending.popleft())
+        if not batch:
+            return 0
+        try:
+            with self._write_lock:
+                gevent.get_hub().threadpool.apply(self._write, (batch,))
+        except OSError as e:
+            CAPTURE_RECORDS.inc(len(batch), result="failed")
+            logger.error(f"Traffic capture write failed: {e}")
+            return 0
+        return len(batch)
+
+    def _write(self, batch: List[dict]) -> None:
+        """在线程池中执行：追加写入，超过大小时轮转"""
+        os.makedirs(self.config["dir"], exist_ok=True)
+        data = "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in batch)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+            size = f.tell()
+        if size >= self.config["max_bytes"]:
+            self._rotate()
+
+    def close(self) -> None:
+        """工作进程退出前写入剩余记录，并把当前文件轮转压缩（回收后新进程的 pid 不同，不会再续写该文件）"""
+        self.flush()
+        with self._write_lock:
+            try:
+                gevent.get_hub().threadpool.apply(self._rotate_if_exists)
+            except OSError as e:
+                logger.error(f"Traffic capture rotation failed: {e}")
+
+    def _rotate_if_exists(self) -> None:
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        base = f"{self.path[:-len('.jsonl')]}-{time.strftime('%Y%m%d-%H%M%S')}"
+        rotated, n = f"{base}.jsonl.gz", 1
+        while os.path.exists(rotated):
+            rotated, n = f"{base}.{n}.jsonl.gz", n + 1
+        with open(self.path, "rb") as src, gzip.open(rotated, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(self.path)
+        logger.info(f"🗜️ Traffic capture rotated to {rotated}")
+        self._apply_retention()
+
+    def _apply_retention(self) -> None:
+        """按修改时间只保留最新的 max_files 个文件：压缩文件，以及已退出进程没有轮转的 capture-<pid>.jsonl"""
+        if self.config["max_files"] <= 0:
+            return
+        files = glob.glob(os.path.join(self.config["dir"], "capture-*.jsonl.gz"))
+        for path in glob.glob(os.path.join(self.config["dir"], "capture-*.jsonl")):
+            match = _CURRENT_FILE.search(path)
+            if match and not _pid_alive(int(match.group(1))):
+                files.append(path)
+        files.sort(key=os.path.getmtime)
+        for old in files[:-self.config["max_files"]]:
+            os.remove(old)
+
+    def reset(self) -> None:
+        """丢弃从 master 继承的待写记录和写入锁，写入循环由 start() 重新启动"""
+        self._pending = deque()
+        self._greenlet = None
+        self._write_lock = Semaphore()
+
+
+def _pid_alive(pid: int) -> bool:
+    """pid 对应的进程是否仍在运行（正在写入的文件不参与清理）"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # 进程存在但属于其他用户
+        pass
+    return True
+
+
+def read_capture(paths: List[str]):
+    """按文件顺序读取采集记录，支持 .jsonl 和 .jsonl.gz"""
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
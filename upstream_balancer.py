@@ -0,0 +1,183 @@
+"""
+多个 Dify 上游之间的负载均衡
+DIFY_API_BASE 可以是逗号分隔的多个地址，MODEL_UPSTREAMS 可按模型覆盖；
+请求选择在途流最少的健康上游，后台主动探测健康状态，连续失败的上游被被动摘除一段时间
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional
+
+import gevent
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_HEALTHY = REGISTRY.gauge(
+    "opendify_upstream_healthy", "上游健康状态（1=健康，0=不健康或已摘除）", ("upstream",))
+UPSTREAM_EJECTIONS = REGISTRY.counter(
+    "opendify_upstream_ejections_total", "上游因连续失败被摘除的次数", ("upstream",))
+UPSTREAM_SELECTED = REGISTRY.counter(
+    "opendify_upstream_selected_total", "负载均衡选中各上游的次数", ("upstream",))
+
+
+@lru_cache(maxsize=64)
+def _split_upstreams(value: str) -> tuple:
+    return tuple(u.strip().rstrip("/") for u in value.replace("\n", ",").split(",") if u.strip())
+
+
+def parse_upstream_list(value) -> List[str]:
+    """将逗号分隔的字符串或列表规范化为上游地址列表"""
+    if isinstance(value, str):
+        return list(_split_upstreams(value))
+    if isinstance(value, (list, tuple)):
+        return [u.strip().rstrip("/") for u in value if isinstance(u, str) and u.strip()]
+    return []
+
+
+def parse_model_upstreams() -> Dict[str, List[str]]:
+    """
+    从 MODEL_UPSTREAMS 解析按模型指定的上游
+    格式: {"gpt-4": ["https://dify-a/v1", "https://dify-b/v1"], "claude": "https://dify-c/v1"}
+    """
+    config_str = os.getenv("MODEL_UPSTREAMS", "").strip()
+    if not config_str:
+        return {}
+    try:
+        result = json.loads(config_str)
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse MODEL_UPSTREAMS as JSON: {e}")
+        return {}
+    if not isinstance(result, dict):
+        logger.error("MODEL_UPSTREAMS must be a dictionary")
+        return {}
+    return {model: parse_upstream_list(value) for model, value in result.items()}
+
+
+def load_balancer_config() -> dict:
+    """从环境变量读取负载均衡配置"""
+    return {
+        "eject_failures": int(os.getenv("UPSTREAM_EJECT_FAILURES", "5")),
+        "eject_seconds": float(os.getenv("UPSTREAM_EJECT_SECONDS", "30")),
+        "health_interval": float(os.getenv("UPSTREAM_HEALTH_INTERVAL", "10")),
+        "health_timeout": float(os.getenv("UPSTREAM_HEALTH_TIMEOUT", "3")),
+        "health_path": os.getenv("UPSTREAM_HEALTH_PATH", ""),
+        "unhealthy_threshold": int(os.getenv("UPSTREAM_UNHEALTHY_THRESHOLD", "2")),
+        "pin_conversations": os.getenv("UPSTREAM_PIN_CONVERSATIONS", "true").strip().lower() in ("1", "true", "yes", "on"),
+    }
+
+
+class UpstreamBalancer:
+    """
+    工作进程内的上游选择器
+    在途数来自 UpstreamPool（in_flight 回调），健康状态和摘除状态在本进程内维护
+    """
+
+    def __init__(self, in_flight: Callable[[str], int], config: Optional[dict] = None):
+        self.config = config or load_balancer_config()
+        self._in_flight = in_flight
+        self._lock = threading.Lock()
+        self._consecutive_failures: Dict[str, int] = {}
+        self._ejected_until: Dict[str, float] = {}
+        self._probe_failures: Dict[str, int] = {}
+        self._unhealthy = set()
+        self._health_greenlet = None
+
+    def is_usable(self, upstream: str) -> bool:
+        """上游未被摘除且主动探测认为健康"""
+        return upstream not in self._unhealthy and self._ejected_until.get(upstream, 0.0) <= time.time()
+
+    def select(self, upstreams: List[str], pinned: Optional[str] = None,
+               is_available: Optional[Callable[[str], bool]] = None) -> str:
+        """
+        选择上游：会话已绑定且该上游仍在配置中时固定使用它；
+        否则在健康上游中选择在途流最少者，全部不健康时退化为在所有上游中选择
+        """
+        if not upstreams:
+            raise ValueError("No upstream configured")
+        if pinned and self.config["pin_conversations"] and pinned in upstreams:
+            UPSTREAM_SELECTED.inc(upstream=pinned)
+            return pinned
+        if len(upstreams) == 1:
+            return upstreams[0]
+
+        candidates = [u for u in upstreams if self.is_usable(u)]
+        if is_available is not None:
+            candidates = [u for u in candidates if is_available(u)] or candidates
+        candidates = candidates or upstreams
+        # 在途数相同时按配置顺序，保持选择稳定
+        best = min(candidates, key=lambda u: (self._in_flight(u), upstreams.index(u)))
+        UPSTREAM_SELECTED.inc(upstream=best)
+        return best
+
+    def record(self, upstream: str, success: bool) -> None:
+        """被动健康检查：连续失败达到阈值时摘除上游一段时间"""
+        with self._lock:
+            if success:
+                self._consecutive_failures[upstream] = 0
+                return
+            failures = self._consecutive_failures.get(upstream, 0) + 1
+            self._consecutive_failures[upstream] = failures
+            threshold = self.config["eject_failures"]
+            if threshold <= 0 or failures < threshold:
+                return
+            self._consecutive_failures[upstream] = 0
+            self._ejected_until[upstream] = time.time() + self.config["eject_seconds"]
+        UPSTREAM_EJECTIONS.inc(upstream=upstream)
+        UPSTREAM_HEALTHY.set(0, upstream=upstream)
+        logger.warning(f"⏏️ Upstream {upstream} ejected for {self.config['eject_seconds']:.0f}s after {failures} consecutive failures")
+
+    def probe(self, upstream: str, client) -> bool:
+        """主动探测一次：能收到非 5xx 的 HTTP 响应即认为健康"""
+        try:
+            response = client.get(f"{upstream}{self.config['health_path']}",
+                                  timeout=self.config["health_timeout"])
+            healthy = response.status_code < 500
+        except Exception as e:
+            logger.debug(f"Health probe for {upstream} failed: {e}")
+            healthy = False
+
+        with self._lock:
+            if healthy:
+                self._probe_failures[upstream] = 0
+                if upstream in self._unhealthy:
+                    self._unhealthy.discard(upstream)
+                    logger.info(f"💚 Upstream {upstream} is healthy again")
+            else:
+                failures = self._probe_failures.get(upstream, 0) + 1
+                self._probe_failures[upstream] = failures
+                if failures >= self.config["unhealthy_threshold"] and upstream not in self._unhealthy:
+                    self._unhealthy.add(upstream)
+                    logger.warning(f"💔 Upstream {upstream} marked unhealthy after {failures} failed probes")
+        UPSTREAM_HEALTHY.set(1 if self.is_usable(upstream) else 0, upstream=upstream)
+        return healthy
+
+    def start_health_checks(self, upstreams: Iterable[str], get_client: Callable[[str], object]) -> None:
+        """在后台 greenlet 中定期探测所有上游，只有多个上游时才启动"""
+        upstreams = sorted(set(upstreams))
+        interval = self.config["health_interval"]
+        if len(upstreams) < 2 or interval <= 0 or self._health_greenlet is not None:
+            return
+
+        def _loop():
+            while True:
+                for upstream in upstreams:
+                    self.probe(upstream, get_client(upstream))
+                gevent.sleep(interval)
+
+        self._health_greenlet = gevent.spawn(_loop)
+        logger.info(f"🩺 Health checks started for {len(upstreams)} upstreams (every {interval:.0f}s)")
+
+    def reset(self) -> None:
+        """fork 之后清空本进程的状态（后台探测 greenlet 不会被 fork 继承）"""
+        self._lock = threading.Lock()
+        self._consecutive_failures = {}
+        self._ejected_until = {}
+        self._probe_failures = {}
+        self._unhealthy = set()
+        self._health_greenlet = None
@@ -0,0 +1,202 @@
+"""
+上游 Dify HTTP 连接池管理
+为每个上游地址维护独立的 httpx 客户端，支持可选的 HTTP/2 多路复用，
+并对在途请求计数，在连接池耗尽时快速失败而不是在 httpx 内部无声排队
+"""
+
+import os
+import json
+import logging
+import threading
+from typing import Dict, Optional
+
+import httpx
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+UPSTREAM_IN_FLIGHT = REGISTRY.gauge(
+    "opendify_upstream_in_flight", "当前在途的上游请求数", ("upstream",))
+UPSTREAM_POOL_LIMIT = REGISTRY.gauge(
+    "opendify_upstream_pool_limit", "上游允许的最大在途请求数", ("upstream",))
+UPSTREAM_POOL_EXHAUSTED = REGISTRY.counter(
+    "opendify_upstream_pool_exhausted_total", "因上游连接池耗尽而被拒绝的请求数", ("upstream",))
+
+
+class PoolExhaustedError(Exception):
+    """上游连接池已满，请求被快速拒绝"""
+
+    def __init__(self, upstream: str, limit: int):
+        super().__init__(f"Upstream connection pool exhausted ({limit} in flight) for {upstream}")
+        self.upstream = upstream
+        self.limit = limit
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).strip().lower() in ("1", "true", "yes", "on")
+
+
+def load_pool_config() -> dict:
+    """从环境变量读取默认的上游连接池配置"""
+    return {
+        "http2": _env_bool("UPSTREAM_HTTP2", False),
+        "max_connections": int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100")),
+        "max_keepalive_connections": int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20")),
+        "keepalive_expiry": float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "5")),
+        "max_streams_per_connection": int(os.getenv("UPSTREAM_HTTP2_MAX_STREAMS", "100")),
+        # 建立连接的超时：死掉的上游应尽快失败
+        "connect_timeout": float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5")),
+        # 单次读取的空闲超时（两次收到数据之间的最长间隔），不限制整个生成的时长
+        "read_timeout": float(os.getenv("UPSTREAM_READ_TIMEOUT", "30")),
+        "write_timeout": float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "30")),
+        "pool_timeout": float(os.getenv("UPSTREAM_POOL_TIMEOUT", "1")),
+    }
+
+
+def parse_upstream_overrides() -> Dict[str, dict]:
+    """
+    从 UPSTREAM_POOL_CONFIG 解析按上游地址覆盖的连接池配置
+    格式: {"https://dify-a/v1": {"http2": true, "max_connections": 200}}
+    """
+    config_str = os.getenv("UPSTREAM_POOL_CONFIG", "").strip()
+    if not config_str:
+        return {}
+    try:
+        result = json.loads(config_str)
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse UPSTREAM_POOL_CONFIG as JSON: {e}")
+        return {}
+    if not isinstance(result, dict):
+        logger.error("UPSTREAM_POOL_CONFIG must be a dictionary")
+        return {}
+    return {upstream.rstrip("/"): overrides for upstream, overrides in result.items() if isinstance(overrides, dict)}
+
+
+class UpstreamSlot:
+    """在途请求占用的槽位，release 可重复调用"""
+
+    def __init__(self, pool: "UpstreamPool", upstream: str):
+        self._pool = pool
+        self.upstream = upstream
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._pool._release(self.upstream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class UpstreamPool:
+    """按上游地址管理 httpx 客户端和在途请求计数"""
+
+    def __init__(self, default_config: dict, overrides: Optional[Dict[str, dict]] = None):
+        self.default_config = default_config
+        self.overrides = overrides or {}
+        self._lock = threading.Lock()
+        self._configs: Dict[str, dict] = {}
+        self._clients: Dict[str, httpx.Client] = {}
+        self._in_flight: Dict[str, int] = {}
+
+    def config_for(self, upstream: str) -> dict:
+        """合并默认配置和该上游的覆盖配置"""
+        config = self._configs.get(upstream)
+        if config is None:
+            config = dict(self.default_config)
+            config.update(self.overrides.get(upstream.rstrip("/"), {}))
+            if config["http2"] and not HTTP2_AVAILABLE:
+                logger.warning(f"⚠️ HTTP/2 requested for {upstream} but 'h2' is not installed, falling back to HTTP/1.1")
+                config["http2"] = False
+            self._configs[upstream] = config
+        return config
+
+    def limit_for(self, upstream: str) -> int:
+        """上游允许的最大在途请求数：HTTP/2 下每个连接可承载多个流"""
+        config = self.config_for(upstream)
+        if config["http2"]:
+            return config["max_connections"] * config["max_streams_per_connection"]
+        return config["max_connections"]
+
+    def _create_client(self, upstream: str) -> httpx.Client:
+        config = self.config_for(upstream)
+        client = httpx.Client(
+            http2=config["http2"],
+            timeout=httpx.Timeout(
+                connect=config["connect_timeout"],
+                read=config["read_timeout"],
+                write=config["write_timeout"],
+                pool=config["pool_timeout"],
+            ),
+            limits=httpx.Limits(
+                max_connections=config["max_connections"],
+                max_keepalive_connections=config["max_keepalive_connections"],
+                keepalive_expiry=config["keepalive_expiry"],
+            ),
+            follow_redirects=True,
+        )
+        UPSTREAM_POOL_LIMIT.set(self.limit_for(upstream), upstream=upstream)
+        protocol = "HTTP/2" if config["http2"] else "HTTP/1.1"
+        logger.info(f"✅ HTTP client initialized for {upstream} ({protocol}, max_connections={config['max_connections']})")
+        return client
+
+    def get_client(self, upstream: str) -> httpx.Client:
+        """获取或创建该上游的 HTTP 客户端"""
+        client = self._clients.get(upstream)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(upstream)
+                if client is None:
+                    client = self._create_client(upstream)
+                    self._clients[upstream] = client
+        return client
+
+    def acquire(self, upstream: str) -> UpstreamSlot:
+        """
+        占用一个在途请求槽位
+        超过上限时立即抛出 PoolExhaustedError，而不是在 httpx 连接池中等待
+        """
+        limit = self.limit_for(upstream)
+        with self._lock:
+            current = self._in_flight.get(upstream, 0)
+            if current >= limit:
+                UPSTREAM_POOL_EXHAUSTED.inc(upstream=upstream)
+                raise PoolExhaustedError(upstream, limit)
+            self._in_flight[upstream] = current + 1
+        UPSTREAM_IN_FLIGHT.inc(upstream=upstream)
+        return UpstreamSlot(self, upstream)
+
+    def _release(self, upstream: str) -> None:
+        with self._lock:
+            self._in_flight[upstream] = max(0, self._in_flight.get(upstream, 0) - 1)
+        UPSTREAM_IN_FLIGHT.dec(upstream=upstream)
+
+    def in_flight(self, upstream: str) -> int:
+        return self._in_flight.get(upstream, 0)
+
+    def reset(self) -> None:
+        """fork 之后丢弃继承来的客户端（不关闭，避免影响父进程的 socket）"""
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._in_flight = {}
+
+    def close(self) -> None:
+        """关闭所有客户端"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients = {}
+        for client in clients:
+            client.close()
+        if clients:
+            logger.info("✅ HTTP client resources cleaned up")
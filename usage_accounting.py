@@ -0,0 +1,194 @@
+"""
+Token 用量统计
+从 Dify 的 message_end（流式）或响应 metadata（阻塞）中提取 usage，转换为 OpenAI 格式返回给客户端；
+同时按 (分钟, 模型, 用户, Key) 在内存中累加，后台定期批量写入 SQLite 汇总表：
+每次写入同时累加分钟和小时两种粒度，分钟数据保留较短时间后删除（小时数据已包含它们），用于容量规划
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import gevent
+
+from metrics import REGISTRY
+from sqlite_pool import shared_pool
+from output_limits import approx_token_count
+
+logger = logging.getLogger(__name__)
+
+TOKENS_TOTAL = REGISTRY.counter(
+    "opendify_tokens_total", "按模型统计的 token 用量", ("model", "type"))
+USAGE_FLUSH_FAILURES = REGISTRY.counter(
+    "opendify_usage_flush_failures_total", "用量写入 SQLite 失败的次数")
+
+RESOLUTION_MINUTE = "minute"
+RESOLUTION_HOUR = "hour"
+_BUCKET_SECONDS = {RESOLUTION_MINUTE: 60, RESOLUTION_HOUR: 3600}
+
+_GROUP_COLUMNS = ("model", "user", "key_id")
+
+
+def load_usage_config() -> dict:
+    """从环境变量读取用量统计配置"""
+    return {
+        "enabled": os.getenv("USAGE_ACCOUNTING", "true").strip().lower() in ("1", "true", "yes", "on"),
+        "flush_interval": float(os.getenv("USAGE_FLUSH_INTERVAL", "10")),
+        "minute_retention_hours": float(os.getenv("USAGE_MINUTE_RETENTION_HOURS", "48")),
+        "hour_retention_days": float(os.getenv("USAGE_HOUR_RETENTION_DAYS", "90")),
+    }
+
+
+def usage_from_dify(dify_usage: Optional[dict]) -> Optional[dict]:
+    """把 Dify metadata.usage 转换为 OpenAI 的 usage，没有可用数据时返回 None"""
+    if not isinstance(dify_usage, dict) or "prompt_tokens" not in dify_usage:
+        return None
+    prompt_tokens = int(dify_usage.get("prompt_tokens") or 0)
+    completion_tokens = int(dify_usage.get("completion_tokens") or 0)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": int(dify_usage.get("total_tokens") or prompt_tokens + completion_tokens),
+    }
+
+
+def estimate_usage(prompt_text: str, completion_text: str) -> dict:
+    """Dify 没有返回 usage（如提前停止生成）时按近似分词估算"""
+    prompt_tokens = approx_token_count(prompt_text)
+    completion_tokens = approx_token_count(completion_text)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+class UsageAccounting:
+    """按模型、用户和 Key 汇总 token 用量，批量写入 SQLite"""
+
+    def __init__(self, db_path: str, config: Optional[dict] = None):
+        self.db_path = db_path
+        self.config = config or load_usage_config()
+        self._lock = threading.Lock()
+        # (分钟桶, 模型, 用户, Key 标识) -> [请求数, prompt, completion, total]
+        self._pending: Dict[Tuple[int, str, str, str], List[int]] = {}
+        self._greenlet = None
+        self._db = shared_pool(db_path, timeout=5.0)
+        self._db.ensure_schema(
+            '''
+            CREATE TABLE IF NOT EXISTS usage_rollup (
+                resolution TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                model TEXT NOT NULL,
+                user TEXT NOT NULL,
+                key_id TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                total_tokens INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (resolution, bucket, model, user, key_id)
+            )
+            ''',
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.config["enabled"]
+
+    def record(self, model: str, user: str, key_id: Optional[str], usage: dict) -> None:
+        """累加一次请求的用量（只写内存，由后台批量写入）"""
+        TOKENS_TOTAL.inc(usage["prompt_tokens"], model=model, type="prompt")
+        TOKENS_TOTAL.inc(usage["completion_tokens"], model=model, type="completion")
+        if not self.enabled:
+            return
+        key = (int(time.time()) // 60 * 60, model, user or "", key_id or "")
+        with self._lock:
+            totals = self._pending.setdefault(key, [0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += usage["prompt_tokens"]
+            totals[2] += usage["completion_tokens"]
+            totals[3] += usage["total_tokens"]
+
+    def flush(self) -> int:
+        """把内存中的用量写入 SQLite 并清理过期的分钟数据，返回写入的分组数"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        rows = []
+        for (minute, model, user, key_id), totals in pending.items():
+            for resolution, seconds in _BUCKET_SECONDS.items():
+                rows.append((resolution, minute // seconds * seconds, model, user, key_id, *totals))
+        now = time.time()
+        try:
+            with self._db.connection() as conn:
+                conn.executemany('''
+                    INSERT INTO usage_rollup (resolution, bucket, model, user, key_id,
+                                              requests, prompt_tokens, completion_tokens, total_tokens)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (resolution, bucket, model, user, key_id) DO UPDATE SET
+                        requests = requests + excluded.requests,
+                        prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                        completion_tokens = completion_tokens + excluded.completion_tokens,
+                        total_tokens = total_tokens + excluded.total_tokens
+                ''', rows)
+                conn.execute(
+                    'DELETE FROM usage_rollup WHERE resolution = ? AND bucket < ?',
+                    (RESOLUTION_MINUTE, now - self.config["minute_retention_hours"] * 3600)
+                )
+                conn.execute(
+                    'DELETE FROM usage_rollup WHERE resolution = ? AND bucket < ?',
+                    (RESOLUTION_HOUR, now - self.config["hour_retention_days"] * 86400)
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            # 写入失败时放回内存，下次再试
+            USAGE_FLUSH_FAILURES.inc()
+            logger.error(f"Usage flush failed: {e}")
+            with self._lock:
+                for key, totals in pending.items():
+                    merged = self._pending.setdefault(key, [0, 0, 0, 0])
+                    for i, value in enumerate(totals):
+                        merged[i] += value
+            return 0
+        return len(pending)
+
+    def query(self, resolution: str = RESOLUTION_HOUR, since: Optional[float] = None,
+              group_by: Tuple[str, ...] = _GROUP_COLUMNS) -> List[dict]:
+        """按粒度和分组读取汇总结果（不包含尚未写入的用量）"""
+        if resolution not in _BUCKET_SECONDS:
+            raise ValueError(f"Unknown resolution: {resolution}")
+        group_by = tuple(column for column in _GROUP_COLUMNS if column in group_by)
+        columns = ", ".join(("bucket",) + group_by)
+        with self._db.connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT {columns}, SUM(requests), SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens)
+                FROM usage_rollup
+                WHERE resolution = ? AND bucket >= ?
+                GROUP BY {columns}
+                ORDER BY bucket
+            ''', (resolution, since or 0))
+            names = ("bucket",) + group_by + ("requests", "prompt_tokens", "completion_tokens", "total_tokens")
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def start(self) -> None:
+        """启动后台批量写入（每个工作进程一次）"""
+        if self._greenlet is not None or not self.enabled:
+            return
+
+        def _loop():
+            while True:
+                gevent.sleep(self.config["flush_interval"])
+                self.flush()
+
+        self._greenlet = gevent.spawn(_loop)
+
+    def reset(self) -> None:
+        """丢弃继承的未写入用量，避免与 master 重复写入；批量写入由 start() 重新启动"""
+        with self._lock:
+            self._pending = {}
+        self._greenlet = None